@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Build an index of the calibrations available in a data repository, for IsrTask
+
+Configure IsrTask with calibIndexPath to use it.
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+
+import lsst.daf.persistence as dafPersist
+from lsst.ip.isr import CalibIndex
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("repo", help="path of data repository")
+parser.add_argument("output", help="path of index to write (JSON)")
+parser.add_argument("--calib", default=None, help="path of calibration repository, if not that of the mapper")
+parser.add_argument("--datasetTypes", nargs="+", default=["bias", "dark", "flat", "fringe"],
+                    help="calibration dataset types to index")
+parser.add_argument("--idKeys", nargs="+", default=["ccd"],
+                    help="registry keys that identify a detector")
+parser.add_argument("--filterKey", default="filter", help="registry key of the filter")
+args = parser.parse_args()
+
+mapperArgs = dict(calibRoot=args.calib) if args.calib else {}
+butler = dafPersist.Butler(args.repo, **mapperArgs)
+calibIndex = CalibIndex.build(butler, args.datasetTypes, args.idKeys, filterKey=args.filterKey)
+calibIndex.write(args.output)
+for datasetType in args.datasetTypes:
+    entryList = calibIndex.entries.get(datasetType)
+    print("%s: %s" % (datasetType, "%d calibrations" % len(entryList) if entryList is not None
+                      else "not indexed (registry query failed)"))
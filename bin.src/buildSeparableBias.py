@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Build a SeparableBiasModel from a master bias and report how well it approximates the bias
+
+The amplifiers are taken from the detector of the bias, if it has one. Use the printed errors to choose
+IsrTask's separableBiasThreshold; IsrTask builds its own models (config.doSeparableBias), but a model
+saved with --output can be loaded with SeparableBiasModel.fromArrays(numpy.load(path)).
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+
+import numpy
+
+import lsst.afw.image as afwImage
+from lsst.ip.isr import SeparableBiasModel
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("bias", help="path of master bias (FITS)")
+parser.add_argument("--threshold", type=float, nargs="+", default=[5.0],
+                    help="threshold(s) for the sparse residuals, in units of the robust standard deviation "
+                    "of the residuals of each amplifier; the model of each is reported")
+parser.add_argument("--output", default=None,
+                    help="path of file (.npz) in which to save the model of the first threshold")
+args = parser.parse_args()
+
+biasExposure = afwImage.ExposureF(args.bias)
+detector = biasExposure.getDetector()
+ampBBoxList = [amp.getBBox() for amp in detector] if detector else [biasExposure.getBBox()]
+print("%s: %d amplifiers" % (args.bias, len(ampBBoxList)))
+for i, threshold in enumerate(args.threshold):
+    model = SeparableBiasModel.fromExposure(biasExposure, ampBBoxList, threshold)
+    stats = model.getErrorStats(biasExposure)
+    print("threshold %g: %d residuals, %d bytes (%.2f%% of the bias); RMS error %.4g, max error %.4g, "
+          "RMS variance error %.4g" % (threshold, stats.numResiduals, stats.numBytes,
+                                       100.0*stats.numBytes/stats.biasBytes, stats.rmsError, stats.maxError,
+                                       stats.rmsVarianceError))
+    if i == 0 and args.output is not None:
+        numpy.savez(args.output, **model.getArrays())
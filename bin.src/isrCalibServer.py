@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Run a local server of calibration products in shared memory for IsrTask processes
+
+Configure IsrTask with calibServerAddress to use it. Unless an authentication key is given (with --authkey
+or environment variable IP_ISR_CALIB_SERVER_AUTHKEY), a key is generated and written next to the Unix
+domain socket, readable only by this user, where IsrTask finds it.
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+import os
+
+from lsst.ip.isr import CalibServer
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("address", nargs="?", default=None,
+                    help="address on which to listen: localhost:port (requires an authentication key) "
+                    "or the path of a Unix domain socket (default: a socket in a new private directory)")
+parser.add_argument("--authkey", default=os.environ.get("IP_ISR_CALIB_SERVER_AUTHKEY"),
+                    help="authentication key clients must present (default: generated)")
+parser.add_argument("--maxBytes", type=int, default=16*1024**3,
+                    help="maximum total size of products without references (bytes); 0 for no limit")
+parser.add_argument("--directory", default=None,
+                    help="directory in which to keep products (default: a new directory in /dev/shm)")
+args = parser.parse_args()
+
+server = CalibServer(args.address, args.authkey, args.maxBytes, directory=args.directory)
+print("Serving calibrations on %s from %s" % (server.address, server.directory))
+if server.authKeyPath is not None:
+    print("Authentication key is in %s" % (server.authKeyPath,))
+try:
+    server.serveForever()
+except KeyboardInterrupt:
+    pass
+finally:
+    server.close()
@@ -0,0 +1,82 @@
+// -*- LSST-C++ -*-
+
+/*
+ * LSST Data Management System
+ * Copyright 2016 LSST Corporation.
+ *
+ * This product includes software developed by the
+ * LSST Project (http://www.lsst.org/).
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the LSST License Statement and
+ * the GNU General Public License along with this program.  If not,
+ * see <http://www.lsstcorp.org/LegalNotices/>.
+ */
+
+#ifndef LSST_IP_ISR_APPLY_DETREND
+#define LSST_IP_ISR_APPLY_DETREND
+
+#include "ndarray.h"
+
+#include "lsst/afw/image.h"
+
+namespace lsst {
+namespace ip {
+namespace isr {
+
+    /**
+    Apply bias, non-linearity, variance, dark and flat corrections in a single pass
+
+    This is equivalent to the following sequence of operations, each of which is skipped
+    if the corresponding calibration is null (or, for linearity and variance, disabled):
+        maskedImage -= bias
+        linearize the image plane with a lookup table (if table is non-empty)
+            or with a squared model (if sqCoeff != 0); see applyLookupTable and LinearizeSquared
+        variance = image/gain + readNoise^2 (unless gain is NaN)
+        maskedImage.scaledMinus(darkScale, dark)
+        maskedImage.scaledDivides(1/flatScale, flat)
+    but every pixel is read and written only once.
+
+    @param[in,out] maskedImage  amplifier masked image to correct; modified in place
+    @param[in] bias  bias masked image of the same dimensions, or null
+    @param[in] dark  dark masked image of the same dimensions, or null
+    @param[in] flat  flat field masked image of the same dimensions, or null
+    @param[in] darkScale  scale applied to the dark (exposure dark time / dark dark time)
+    @param[in] flatScale  the flat is divided by this value before being applied
+    @param[in] gain  amplifier gain (e-/ADU); if NaN the variance plane is not reset
+    @param[in] readNoise  amplifier read noise (ADU/pixel)
+    @param[in] sqCoeff  coefficient of the squared non-linearity model (0 for none)
+    @param[in] table  non-linearity lookup table (empty for none); takes precedence over sqCoeff
+    @param[in] indOffset  scalar added to image value before truncating to lookup column
+
+    @return the number of pixels whose values were out of range of the lookup table
+
+    @throw lsst::pex::exceptions::LengthError if the dimensions of a calibration do not match
+    */
+    template<typename PixelT>
+    int applyDetrend(
+        afw::image::MaskedImage<PixelT> &maskedImage,
+        afw::image::MaskedImage<PixelT> const *bias,
+        afw::image::MaskedImage<PixelT> const *dark,
+        afw::image::MaskedImage<PixelT> const *flat,
+        double darkScale,
+        double flatScale,
+        double gain,
+        double readNoise,
+        double sqCoeff,
+        ndarray::Array<PixelT, 1, 1> const &table,
+        PixelT indOffset
+    );
+
+}}} // lsst::ip::isr
+
+#endif
@@ -22,10 +22,24 @@
 
 from __future__ import absolute_import, division, print_function
 
+from .applyDetrend import *
 from .applyLookupTable import *
 from .isr import *
 from .version import *
+from .instrumentation import *
 from .isrFunctions import *
 from .assembleCcdTask import *
+from .stageCache import *
+from .calibCache import *
+from .mmapCalibStore import *
+from .calibServer import *
+from .calibIndex import *
+from .preparedCalibs import *
+from .derivedCalibStore import *
+from .sparseDark import *
+from .separableBias import *
+from .prefetch import *
+from .asyncWriter import *
 from .isrTask import *
+from .isrDriver import *
 from .linearize import *
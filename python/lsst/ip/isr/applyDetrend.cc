@@ -0,0 +1,74 @@
+/*
+ * LSST Data Management System
+ *
+ * This product includes software developed by the
+ * LSST Project (http://www.lsst.org/).
+ * See the COPYRIGHT file
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the LSST License Statement and
+ * the GNU General Public License along with this program.  If not,
+ * see <https://www.lsstcorp.org/LegalNotices/>.
+ */
+#include "pybind11/pybind11.h"
+#include "pybind11/stl.h"
+
+#include "numpy/arrayobject.h"
+#include "ndarray/pybind11.h"
+
+#include "lsst/ip/isr/applyDetrend.h"
+
+namespace py = pybind11;
+using namespace pybind11::literals;
+
+namespace lsst {
+namespace ip {
+namespace isr {
+
+namespace {
+
+template <typename PixelT>
+static void declareApplyDetrend(py::module& mod) {
+    // Release the GIL so that amplifiers may be processed in parallel threads
+    mod.def("applyDetrend",
+            [](afw::image::MaskedImage<PixelT> &maskedImage, afw::image::MaskedImage<PixelT> const *bias,
+               afw::image::MaskedImage<PixelT> const *dark, afw::image::MaskedImage<PixelT> const *flat,
+               double darkScale, double flatScale, double gain, double readNoise, double sqCoeff,
+               ndarray::Array<PixelT, 1, 1> const &table, PixelT indOffset) {
+                py::gil_scoped_release release;
+                return applyDetrend<PixelT>(maskedImage, bias, dark, flat, darkScale, flatScale, gain,
+                                            readNoise, sqCoeff, table, indOffset);
+            },
+            "maskedImage"_a, "bias"_a, "dark"_a, "flat"_a, "darkScale"_a, "flatScale"_a, "gain"_a,
+            "readNoise"_a, "sqCoeff"_a, "table"_a, "indOffset"_a);
+}
+
+}  // namespace lsst::ip::isr::<anonymous>
+
+PYBIND11_PLUGIN(applyDetrend) {
+    py::module mod("applyDetrend");
+
+    // Need to import numpy for ndarray and eigen conversions
+    if (_import_array() < 0) {
+        PyErr_SetString(PyExc_ImportError, "numpy.core.multiarray failed to import");
+        return nullptr;
+    }
+
+    declareApplyDetrend<float>(mod);
+    declareApplyDetrend<double>(mod);
+
+    return mod.ptr();
+}
+
+}  // isr
+}  // ip
+}  // lsst
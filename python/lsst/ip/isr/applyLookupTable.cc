@@ -38,7 +38,14 @@ namespace {
 
 template <typename PixelT>
 static void declareApplyLookupTable(py::module& mod) {
-    mod.def("applyLookupTable", &applyLookupTable<PixelT>, "image"_a, "table"_a, "indOffset"_a);
+    // Release the GIL so that amplifiers may be processed in parallel threads
+    mod.def("applyLookupTable",
+            [](afw::image::Image<PixelT> &image, ndarray::Array<PixelT, 1, 1> const &table,
+               PixelT indOffset) {
+                py::gil_scoped_release release;
+                return applyLookupTable<PixelT>(image, table, indOffset);
+            },
+            "image"_a, "table"_a, "indOffset"_a);
 }
 
 }  // namespace lsst::ip::isr::<anonymous>
@@ -0,0 +1,187 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object
+
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import sys
+import threading
+import time
+import traceback
+
+import lsst.pipe.base as pipeBase
+
+__all__ = ["AsyncWriter"]
+
+# Pool.apply_async only reports failures to submit a write (e.g. to pickle it for a writer process)
+# through error_callback on Python 3; on Python 2 the results of writes are polled instead
+_hasErrorCallback = sys.version_info[0] >= 3
+
+
+def _write(dataRef, obj, datasetType):
+    """Persist an object, returning None on success or the formatted traceback on failure
+
+    Failures are returned rather than raised so that they can be reported by AsyncWriter.close.
+    """
+    try:
+        dataRef.put(obj, datasetType)
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
+class AsyncWriter(object):
+    """Persist objects with data references on a pool of background threads or processes
+
+    put returns as soon as the write is queued, unless maxQueued writes are already queued or
+    in progress, in which case it waits for one to finish (back-pressure, which bounds the memory
+    held by queued objects). Write failures do not interrupt the caller; they are collected and
+    returned by close, which waits for all queued writes to finish. Failures to send a write to
+    the pool (e.g. to pickle it) are reported in the same way.
+
+    Writer processes are appropriate when writing is CPU-bound (e.g. compression) and does not
+    release the GIL; each object and data reference is then pickled to send it to a process,
+    so both must be picklable.
+    """
+
+    def __init__(self, numWorkers=1, maxQueued=2, useProcesses=False, pollInterval=0.05):
+        """Construct an AsyncWriter
+
+        @param[in] numWorkers  number of writer threads or processes
+        @param[in] maxQueued  maximum number of writes queued or in progress; at least numWorkers
+        @param[in] useProcesses  write in processes rather than threads?
+        @param[in] pollInterval  interval (sec) at which put checks for failed writes while waiting
+            for one to finish; only used on Python 2
+        """
+        if numWorkers < 1:
+            raise RuntimeError("numWorkers=%s must be at least 1" % (numWorkers,))
+        self.numWorkers = numWorkers
+        self.maxQueued = max(maxQueued, numWorkers)
+        self.useProcesses = useProcesses
+        self.pollInterval = pollInterval
+        self._pool = multiprocessing.Pool(numWorkers) if useProcesses else ThreadPool(numWorkers)
+        self._slots = threading.BoundedSemaphore(self.maxQueued)
+        self._lock = threading.Lock()
+        self._failures = []
+        self._pending = []  # (AsyncResult, dataId, datasetType) of each write, if not _hasErrorCallback
+        self._numWritten = 0
+        self._closed = False
+
+    def put(self, dataRef, obj, datasetType):
+        """Queue an object to be persisted, waiting while maxQueued writes are queued or in progress
+
+        put may be called from several threads, including while another thread calls close;
+        a put that does not queue its write before close is called raises RuntimeError.
+
+        @param[in] dataRef  data reference with which to persist the object
+        @param[in] obj  object to persist
+        @param[in] datasetType  dataset type, e.g. "postISRCCD"
+        """
+        self._checkOpen()
+        if _hasErrorCallback:
+            self._slots.acquire()
+        else:
+            while not self._slots.acquire(False):
+                self._checkPending()
+                time.sleep(self.pollInterval)
+        dataId = dataRef.dataId
+
+        def callback(error):
+            self._finish(dataId, datasetType, error)
+
+        def errorCallback(exc):
+            self._finish(dataId, datasetType, "".join(traceback.format_exception_only(type(exc), exc)))
+
+        kwargs = dict(callback=callback)
+        if _hasErrorCallback:
+            kwargs["error_callback"] = errorCallback
+        # the write is submitted while holding the lock, so that close cannot close the pool in between
+        with self._lock:
+            try:
+                self._checkOpen()
+                asyncResult = self._pool.apply_async(_write, (dataRef, obj, datasetType), **kwargs)
+            except Exception:
+                self._slots.release()
+                raise
+            if not _hasErrorCallback:
+                self._pending.append((asyncResult, dataId, datasetType))
+
+    def _checkOpen(self):
+        """Raise RuntimeError if close has been called"""
+        if self._closed:
+            raise RuntimeError("Cannot write to a closed AsyncWriter")
+
+    def _finish(self, dataId, datasetType, error):
+        """Record the outcome of a write and release its slot
+
+        @param[in] dataId  data ID of the write
+        @param[in] datasetType  dataset type of the write
+        @param[in] error  None on success, else a description of the failure
+        """
+        with self._lock:
+            if error is None:
+                self._numWritten += 1
+            else:
+                self._failures.append(pipeBase.Struct(dataId=dataId, datasetType=datasetType, error=error))
+        self._slots.release()
+
+    def _checkPending(self):
+        """Record writes that failed without calling their callback; only used on Python 2
+
+        A result is ready only after its callback (if any) has been called, so a ready result
+        that was not successful is a failure whose slot has not been released.
+        """
+        with self._lock:
+            ready = []
+            pending = []
+            for item in self._pending:
+                (ready if item[0].ready() else pending).append(item)
+            self._pending = pending
+        for asyncResult, dataId, datasetType in ready:
+            if not asyncResult.successful():
+                try:
+                    asyncResult.get()
+                except Exception as exc:
+                    self._finish(dataId, datasetType,
+                                 "".join(traceback.format_exception_only(type(exc), exc)))
+
+    def close(self):
+        """Wait for all queued writes to finish and shut down the writers
+
+        @return a pipeBase.Struct with fields:
+        - numWritten: number of objects written successfully
+        - failures: a list with a pipeBase.Struct for each failed write, with fields
+            dataId, datasetType and error (the formatted traceback)
+        """
+        with self._lock:
+            wasClosed = self._closed
+            if not wasClosed:
+                self._closed = True
+                self._pool.close()
+        if not wasClosed:
+            # the lock is not held while waiting, as the callbacks of the remaining writes acquire it
+            self._pool.join()
+            if not _hasErrorCallback:
+                self._checkPending()
+        with self._lock:
+            return pipeBase.Struct(numWritten=self._numWritten, failures=list(self._failures))
@@ -0,0 +1,147 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object
+
+from collections import OrderedDict
+import threading
+
+import numpy
+
+import lsst.pipe.base as pipeBase
+from .instrumentation import getNumBytes
+
+__all__ = ["CalibCache"]
+
+
+class CalibCache(object):
+    """An in-memory cache of calibration products with a byte budget and least-recently-used eviction
+
+    Entries are keyed by the caller; IsrTask uses the dataset type and the files the butler
+    resolves the calibration to, which identify both the calibration and its validity range.
+    Cached products are shared between callers, so they must not be modified.
+
+    Thread safe, but a product may be read more than once if several threads miss at the same time.
+    """
+
+    def __init__(self, maxBytes):
+        """Construct a CalibCache
+
+        @param[in] maxBytes  maximum total size of cached products (bytes), as measured by getSize;
+                    products larger than this are not cached. 0 to disable caching
+        """
+        self.maxBytes = maxBytes
+        self._entries = OrderedDict()  # key: (product, size), least recently used first
+        self._lock = threading.Lock()
+        self.numBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, readFunc):
+        """Get a calibration product, reading and caching it if it is not cached
+
+        @param[in] key  key identifying the product (hashable)
+        @param[in] readFunc  function that takes no arguments and reads the product
+        @return the calibration product
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.pop(key)
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        product = readFunc()
+        self.put(key, product)
+        return product
+
+    def put(self, key, product):
+        """Add a calibration product, evicting least recently used products to stay within the budget
+
+        @param[in] key  key identifying the product (hashable)
+        @param[in] product  calibration product
+        """
+        size = self.getSize(product)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.numBytes -= old[1]
+            if size > self.maxBytes:
+                return
+            self._entries[key] = (product, size)
+            self.numBytes += size
+            while self.numBytes > self.maxBytes:
+                evictedKey, (evicted, evictedSize) = self._entries.popitem(last=False)
+                self.numBytes -= evictedSize
+                self.evictions += 1
+
+    def clear(self):
+        """Remove all products from the cache
+        """
+        with self._lock:
+            self._entries = OrderedDict()
+            self.numBytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @staticmethod
+    def getSize(product):
+        """Get the number of bytes of pixel data in a calibration product
+
+        Exposures, images, numpy arrays, lists and Structs of these and objects that provide their
+        arrays with getArrays (e.g. SparseDarkModel) are counted; other objects (e.g. defect lists and
+        linearizers) are small and count as 0.
+
+        @param[in] product  calibration product
+        @return size (bytes)
+        """
+        if isinstance(product, pipeBase.Struct):
+            return sum(CalibCache.getSize(value) for value in product.getDict().values())
+        if isinstance(product, (list, tuple)):
+            return sum(CalibCache.getSize(item) for item in product)
+        if isinstance(product, numpy.ndarray) or hasattr(product, "getArray") or \
+                hasattr(product, "getMaskedImage") or hasattr(product, "getVariance"):
+            return getNumBytes(product)
+        if hasattr(product, "getArrays"):
+            return sum(array.nbytes for array in product.getArrays().values())
+        return 0
+
+    def writeMetadata(self, metadata):
+        """Write the cache statistics to metadata
+
+        Sets CALIB_CACHE_HITS, CALIB_CACHE_MISSES, CALIB_CACHE_EVICTIONS, CALIB_CACHE_BYTES
+        and CALIB_CACHE_ENTRIES.
+
+        @param[in,out] metadata  metadata to update (an lsst.daf.base.PropertySet)
+        """
+        with self._lock:
+            metadata.set("CALIB_CACHE_HITS", self.hits)
+            metadata.set("CALIB_CACHE_MISSES", self.misses)
+            metadata.set("CALIB_CACHE_EVICTIONS", self.evictions)
+            metadata.set("CALIB_CACHE_BYTES", self.numBytes)
+            metadata.set("CALIB_CACHE_ENTRIES", len(self._entries))
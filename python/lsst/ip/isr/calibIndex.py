@@ -0,0 +1,214 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object
+
+import json
+import os
+import threading
+
+__all__ = ["CalibIndex"]
+
+
+class CalibIndex(object):
+    """An index of the calibration products that are available, with a cache of known misses
+
+    The index lists, for each indexed dataset type, the available calibrations: their filter,
+    the values of the data ID keys that identify their detector, and their validity range.
+    It is built from the calibration registry by build (e.g. with bin/buildIsrCalibIndex.py),
+    saved as JSON and loaded when IsrTask starts.
+
+    If the index lists the calibration for the fallback filter but not that for the filter of the
+    exposure, IsrTask reads the fallback directly. Otherwise a calibration the index does not list is
+    not assumed to be missing, as the index may be stale (calibrations ingested after it was built)
+    or the registry may not record the filter of a calibration as the science exposures do. Instead
+    IsrTask tries to read it once and records the miss if the butler confirms it; the cache of misses
+    (calibrations that were tried and found missing, by dataset type, filter, detector and date) then
+    tells IsrTask that the fallback filter must be used, or that there is no calibration, without trying
+    to read it again. Dataset types that are not indexed rely on the cache of misses alone.
+    """
+
+    def __init__(self, entries=None, idKeys=()):
+        """Construct a CalibIndex
+
+        @param[in] entries  dict of dataset type: list of [filter, dict of ID key: value, validStart,
+                    validEnd], where validStart and validEnd are dates (YYYY-MM-DD, inclusive)
+                    or None if unlimited; or None for an empty index
+        @param[in] idKeys  data ID keys that identify a detector; used for the cache of misses
+        """
+        self.entries = entries if entries is not None else {}
+        self.idKeys = tuple(idKeys)
+        self._misses = set()
+        self._lock = threading.Lock()
+        self.numLookups = 0
+        self.numMissesAvoided = 0
+
+    @classmethod
+    def build(cls, butler, datasetTypes, idKeys, filterKey="filter", validKeys=("validStart", "validEnd"),
+              placeholderFilters=("NONE", "")):
+        """Build an index from the calibration registry of a butler
+
+        @param[in] butler  data butler (an lsst.daf.persistence.Butler)
+        @param[in] datasetTypes  calibration dataset types to index, e.g. ["bias", "dark", "flat"]
+        @param[in] idKeys  registry keys that identify a detector, e.g. ["ccd"]
+        @param[in] filterKey  registry key of the filter; dataset types without it (e.g. bias) are
+                    indexed with filter None
+        @param[in] validKeys  registry keys of the start and end of the validity range
+        @param[in] placeholderFilters  values of filterKey that mean the calibration has no filter
+                    (e.g. for biases in registries whose tables all have a filter column);
+                    such calibrations are indexed with filter None, so they apply to every filter
+        @return a CalibIndex; dataset types that cannot be queried are not indexed
+        """
+        entries = {}
+        for datasetType in datasetTypes:
+            entryList = []
+            for keys in ([filterKey] + list(idKeys) + list(validKeys), list(idKeys) + list(validKeys)):
+                try:
+                    rows = butler.queryMetadata(datasetType, keys)
+                except Exception:
+                    continue
+                for row in rows:
+                    row = list(row) if isinstance(row, (list, tuple)) else [row]
+                    if len(keys) == len(idKeys) + len(validKeys):
+                        row = [None] + row
+                    elif row[0] in placeholderFilters:
+                        row[0] = None
+                    idValues = row[1:1 + len(idKeys)]
+                    validStart, validEnd = [cls._getDay(value) for value in row[1 + len(idKeys):]]
+                    entryList.append([row[0], dict(zip(idKeys, idValues)), validStart, validEnd])
+                entries[datasetType] = entryList
+                break
+        return cls(entries, idKeys)
+
+    @classmethod
+    def read(cls, path):
+        """Read an index written by write
+
+        @param[in] path  path of JSON file
+        @return a CalibIndex
+        """
+        with open(path) as indexFile:
+            data = json.load(indexFile)
+        return cls(data["entries"], data["idKeys"])
+
+    def write(self, path):
+        """Write the index (but not the cache of misses) to a JSON file
+
+        @param[in] path  path of JSON file
+        """
+        tempPath = "%s.%d.part" % (path, os.getpid())
+        with open(tempPath, "w") as indexFile:
+            json.dump(dict(entries=self.entries, idKeys=list(self.idKeys)), indexFile)
+        os.rename(tempPath, path)
+
+    def isAvailable(self, datasetType, filterName, dataId, date=None, fallbackFilterName=None):
+        """Is a calibration available?
+
+        @param[in] datasetType  calibration dataset type
+        @param[in] filterName  filter of the calibration wanted
+        @param[in] dataId  data ID of the science exposure
+        @param[in] date  date of the science exposure (YYYY-MM-DD, or an ISO date-time, of which only the
+                    date is used), or None to ignore validity ranges
+        @param[in] fallbackFilterName  filter of the calibration to use if that wanted is missing, or None
+        @return True if the index lists the calibration; False if it is a recorded miss, or if the index
+            lists the calibration for fallbackFilterName but not this one; and None if unknown
+            (including other calibrations the index does not list, which should be tried once)
+        """
+        date = self._getDay(date)
+        with self._lock:
+            self.numLookups += 1
+            if self._getMissKey(datasetType, filterName, dataId, date) in self._misses:
+                self.numMissesAvoided += 1
+                return False
+            entryList = self.entries.get(datasetType)
+        if entryList is None:
+            return None
+        if self._isListed(entryList, filterName, dataId, date):
+            return True
+        if fallbackFilterName and fallbackFilterName != filterName and \
+                self._isListed(entryList, fallbackFilterName, dataId, date):
+            with self._lock:
+                self.numMissesAvoided += 1
+            return False
+        return None
+
+    @staticmethod
+    def _isListed(entryList, filterName, dataId, date):
+        """Does a list of index entries include a calibration?
+
+        @param[in] entryList  index entries of the dataset type
+        @param[in] filterName, dataId  as for isAvailable
+        @param[in] date  date (YYYY-MM-DD) of the science exposure, or None to ignore validity ranges
+        """
+        for entryFilter, idDict, validStart, validEnd in entryList:
+            if entryFilter is not None and filterName is not None and entryFilter != filterName:
+                continue
+            if any(key in dataId and dataId[key] != value for key, value in idDict.items()):
+                continue
+            if date is not None and ((validStart is not None and date < validStart) or
+                                     (validEnd is not None and date > validEnd)):
+                continue
+            return True
+        return False
+
+    def isIndexed(self, datasetType):
+        """Is a dataset type in the index?
+
+        @param[in] datasetType  calibration dataset type
+        """
+        return datasetType in self.entries
+
+    def recordMiss(self, datasetType, filterName, dataId, date=None):
+        """Record that a calibration was tried and found missing
+
+        @param[in] datasetType, filterName, dataId, date  as for isAvailable
+        """
+        with self._lock:
+            self._misses.add(self._getMissKey(datasetType, filterName, dataId, self._getDay(date)))
+
+    def clearMisses(self):
+        """Forget the calibrations recorded as missing, e.g. after new calibrations are ingested
+        """
+        with self._lock:
+            self._misses = set()
+
+    def writeMetadata(self, metadata):
+        """Write statistics to metadata: CALIB_INDEX_LOOKUPS (number of lookups) and
+        CALIB_INDEX_MISSES_AVOIDED (number of lookups that found a calibration missing without reading it)
+
+        @param[in,out] metadata  metadata to update (an lsst.daf.base.PropertySet)
+        """
+        with self._lock:
+            metadata.set("CALIB_INDEX_LOOKUPS", self.numLookups)
+            metadata.set("CALIB_INDEX_MISSES_AVOIDED", self.numMissesAvoided)
+
+    def _getMissKey(self, datasetType, filterName, dataId, date):
+        return (datasetType, filterName, tuple((key, dataId[key]) for key in self.idKeys if key in dataId),
+                date)
+
+    @staticmethod
+    def _getDay(date):
+        """Get the date part (YYYY-MM-DD) of a date or ISO date-time, or None
+        """
+        if date is None:
+            return None
+        return str(date)[:10]
@@ -0,0 +1,479 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object
+
+from collections import OrderedDict
+import hashlib
+import hmac
+from multiprocessing.connection import Client, Listener
+import os
+import pickle
+import shutil
+import stat
+import tempfile
+import threading
+import time
+
+import lsst.log
+import lsst.pipe.base as pipeBase
+from .calibCache import CalibCache
+from .mmapCalibStore import MmapCalibStore
+
+__all__ = ["CalibServer", "CalibClient", "parseCalibServerAddress", "getCalibServerAuthKey"]
+
+_localHosts = ("localhost", "127.0.0.1", "::1")
+
+# environment variable from which clients read the authentication key, if it is not given
+authKeyEnvName = "IP_ISR_CALIB_SERVER_AUTHKEY"
+# name of the file holding a generated authentication key, next to the server's Unix domain socket
+authKeyFileName = "authkey"
+
+
+def parseCalibServerAddress(address):
+    """Parse the address of a CalibServer
+
+    @param[in] address  "host:port", where host must be a local host name or address, or the path
+                of a Unix domain socket
+    @return the address as used by multiprocessing.connection: a (host, port) tuple, or a path
+
+    @throw RuntimeError if the address is not local
+    """
+    if ":" in address and not address.startswith("/"):
+        host, port = address.rsplit(":", 1)
+        host = host.strip("[]")
+        if host not in _localHosts:
+            raise RuntimeError("CalibServer address %s is not local; host must be one of %s" %
+                               (address, _localHosts))
+        return (host, int(port))
+    return address
+
+
+def _checkPrivate(path, mode):
+    """Check that a file or directory belongs to this user and that no other user may access it
+
+    @param[in] path  path of file or directory
+    @param[in] mode  permission bits other users must not have, e.g. stat.S_IRWXG | stat.S_IRWXO
+
+    @throw RuntimeError if the path belongs to another user or others have any of the given permissions
+    """
+    info = os.stat(path)
+    if info.st_uid != os.getuid() or info.st_mode & mode:
+        raise RuntimeError("%s must belong to this user and not be accessible to others (mode %o)" %
+                           (path, stat.S_IMODE(info.st_mode)))
+
+
+def getCalibServerAuthKey(address, authkey=None):
+    """Get the authentication key of a CalibServer
+
+    The key is, in order of preference: authkey, if not empty; the value of environment variable
+    IP_ISR_CALIB_SERVER_AUTHKEY; or, if the server listens on a Unix domain socket, the contents of
+    file "authkey" in the directory of the socket, as written by a server that generated its key,
+    which must be readable only by this user.
+
+    @param[in] address  address of the server; see parseCalibServerAddress
+    @param[in] authkey  authentication key (str), or None or "" to find it
+
+    @throw RuntimeError if no key is found
+    """
+    if authkey:
+        return authkey
+    authkey = os.environ.get(authKeyEnvName)
+    if authkey:
+        return authkey
+    address = parseCalibServerAddress(address)
+    if not isinstance(address, tuple):
+        path = os.path.join(os.path.dirname(os.path.abspath(address)), authKeyFileName)
+        if os.path.exists(path):
+            _checkPrivate(path, stat.S_IRWXG | stat.S_IRWXO)
+            with open(path) as authKeyFile:
+                return authKeyFile.read().strip()
+    raise RuntimeError("No authentication key for CalibServer %s: set it explicitly or in environment "
+                       "variable %s" % (address, authKeyEnvName))
+
+
+class CalibServer(object):
+    """A local server of calibration products in shared memory
+
+    The server keeps each calibration product in shared memory (by default under /dev/shm, which
+    is POSIX shared memory on Linux): exposures in a MmapCalibStore, which clients memory-map,
+    and other products (defects, linearizers, brighter-fatter kernels) pickled, which clients load.
+    Products are identified by keys chosen by the clients (see IsrTask.getCalibFileKey).
+
+    The first client to request a product that is not present is asked to load and publish it;
+    other clients requesting it meanwhile wait, so each product is read from its file once.
+
+    Each product has a reference count: the number of clients that have acquired it and not
+    released it (a client's references are released when it disconnects). When the total size of
+    the products exceeds maxBytes, the least recently used products with no references are deleted.
+    Clients that have already mapped a deleted product keep their mapping.
+
+    The server only listens on a local address; see parseCalibServerAddress. By default it listens
+    on a Unix domain socket in a new directory that only this user may access. Requests are
+    authenticated with a key; if none is given, a random key is generated for the session and
+    written, readable only by this user, next to the Unix domain socket, where clients find it
+    (see getCalibServerAuthKey). Pickled products are signed with the key, and clients verify
+    the signature before loading them.
+    """
+
+    def __init__(self, address=None, authkey=None, maxBytes=0, directory=None, log=None):
+        """Construct a CalibServer and start listening
+
+        @param[in] address  address on which to listen (see parseCalibServerAddress), or None for
+                    a Unix domain socket in a new directory only this user may access,
+                    which is deleted by close
+        @param[in] authkey  authentication key (str) that clients must present, or None to generate one;
+                    a key must be given for a TCP address
+        @param[in] maxBytes  maximum total size of products without references (bytes); 0 for no limit
+        @param[in] directory  directory in which to keep products, or None for a new directory in
+                    /dev/shm (or the default temporary directory if there is no /dev/shm),
+                    which is deleted by close; it must belong to this user and not be writable by others
+        @param[in] log  logger (an lsst.log.Log), or None to use the default
+        """
+        self.maxBytes = maxBytes
+        self.log = log if log is not None else lsst.log.Log.getLogger("ip.isr.CalibServer")
+        self._ownDirectory = directory is None
+        if directory is None:
+            # mkdtemp creates the directory with mode 0700
+            directory = tempfile.mkdtemp(prefix="isrCalibServer-",
+                                         dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+        else:
+            _checkPrivate(directory, stat.S_IWGRP | stat.S_IWOTH)
+        self.directory = directory
+        self._socketDirectory = None
+        if address is None:
+            self._socketDirectory = tempfile.mkdtemp(prefix="isrCalibServerSocket-")
+            address = os.path.join(self._socketDirectory, "socket")
+        self.authKeyPath = None
+        if not authkey:
+            if isinstance(parseCalibServerAddress(address), tuple):
+                raise RuntimeError("An authentication key must be given for CalibServer address %s" %
+                                   (address,))
+            authkey = hashlib.sha256(os.urandom(32)).hexdigest()
+            self.authKeyPath = os.path.join(os.path.dirname(os.path.abspath(address)), authKeyFileName)
+            fd = os.open(self.authKeyPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as authKeyFile:
+                authKeyFile.write(authkey)
+        self.authkey = authkey
+        self.store = MmapCalibStore(directory)
+        # key: pipeBase.Struct(kind, numBytes, refCount), least recently used first
+        self._entries = OrderedDict()
+        self._loading = {}  # key: id of client loading it
+        self._lock = threading.Lock()
+        self._closed = False
+        self.listener = Listener(parseCalibServerAddress(address), authkey=authkey.encode())
+        self.address = self.listener.address
+
+    def serveForever(self):
+        """Accept and serve clients, each on its own thread, until close is called or a client
+        sends "shutdown"
+        """
+        while not self._closed:
+            try:
+                connection = self.listener.accept()
+            except Exception:
+                if self._closed:
+                    break
+                self.log.warn("Failed to accept a client connection")
+                continue
+            thread = threading.Thread(target=self._serveClient, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        """Stop listening and delete the products, if the directory was created by this server
+        """
+        self._closed = True
+        try:
+            self.listener.close()
+        except Exception:
+            pass
+        if self._ownDirectory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        if self.authKeyPath is not None:
+            try:
+                os.remove(self.authKeyPath)
+            except OSError:
+                pass
+        if self._socketDirectory is not None:
+            shutil.rmtree(self._socketDirectory, ignore_errors=True)
+
+    def getStats(self):
+        """Get statistics: numEntries, numBytes, numReferenced (entries with references) and numLoading
+        """
+        with self._lock:
+            return dict(numEntries=len(self._entries),
+                        numBytes=sum(entry.numBytes for entry in self._entries.values()),
+                        numReferenced=sum(entry.refCount > 0 for entry in self._entries.values()),
+                        numLoading=len(self._loading))
+
+    def _serveClient(self, connection):
+        """Serve requests from one client until it disconnects
+        """
+        clientId = id(connection)
+        acquired = set()
+        try:
+            while True:
+                try:
+                    request = connection.recv()
+                except (EOFError, IOError):
+                    break
+                if request[0] == "shutdown":
+                    connection.send(("ok",))
+                    self.close()
+                    break
+                connection.send(self._handleRequest(clientId, acquired, request))
+        finally:
+            with self._lock:
+                for key in acquired:
+                    if key in self._entries:
+                        self._entries[key].refCount -= 1
+                for key, loader in list(self._loading.items()):
+                    if loader == clientId:
+                        del self._loading[key]
+                self._evict()
+            connection.close()
+
+    def _handleRequest(self, clientId, acquired, request):
+        """Handle one request from a client
+
+        Requests and replies are tuples:
+        - ("directory",) -> ("ok", directory of products)
+        - ("acquire", key) -> ("hit", kind) if the product is present, with a reference for the client;
+            ("load",) if the client must load and publish it; ("wait",) if another client is loading it
+        - ("publish", key, kind, numBytes) -> ("ok",); the client has a reference to the product
+        - ("abort", key) -> ("ok",); the client failed to load the product
+        - ("release", key) -> ("ok",)
+        - ("stats",) -> ("ok", dict of statistics; see getStats)
+        """
+        command = request[0]
+        if command == "directory":
+            return ("ok", self.directory)
+        if command == "stats":
+            return ("ok", self.getStats())
+        key = request[1]
+        with self._lock:
+            if command == "acquire":
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.pop(key)
+                    self._entries[key] = entry
+                    if key not in acquired:
+                        entry.refCount += 1
+                        acquired.add(key)
+                    return ("hit", entry.kind)
+                loader = self._loading.get(key)
+                if loader is not None and loader != clientId:
+                    return ("wait",)
+                self._loading[key] = clientId
+                return ("load",)
+            if command == "publish":
+                kind, numBytes = request[2:4]
+                self._loading.pop(key, None)
+                self._entries[key] = pipeBase.Struct(kind=kind, numBytes=numBytes, refCount=1)
+                acquired.add(key)
+                self._evict()
+                return ("ok",)
+            if command == "abort":
+                if self._loading.get(key) == clientId:
+                    del self._loading[key]
+                return ("ok",)
+            if command == "release":
+                if key in acquired:
+                    acquired.discard(key)
+                    if key in self._entries:
+                        self._entries[key].refCount -= 1
+                    self._evict()
+                return ("ok",)
+        return ("error", "Unknown request %r" % (command,))
+
+    def _evict(self):
+        """Delete least recently used products with no references until within budget;
+        the caller must hold self._lock
+        """
+        if self.maxBytes <= 0:
+            return
+        numBytes = sum(entry.numBytes for entry in self._entries.values())
+        for key, entry in list(self._entries.items()):
+            if numBytes <= self.maxBytes:
+                break
+            if entry.refCount > 0:
+                continue
+            del self._entries[key]
+            numBytes -= entry.numBytes
+            if entry.kind == "exposure":
+                shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+            else:
+                try:
+                    os.remove(os.path.join(self.directory, key + ".pickle"))
+                except OSError:
+                    pass
+
+
+class CalibClient(object):
+    """A client of a CalibServer
+
+    Thread safe: requests are serialized. The server holds at most one reference to a product
+    for each client, so the client counts its own references (in acquired) and releases the
+    server's reference when the last of them is released.
+    """
+
+    def __init__(self, address, authkey=None, waitInterval=0.05, waitTimeout=600.0, log=None):
+        """Connect to a CalibServer
+
+        @param[in] address  address of the server; see parseCalibServerAddress
+        @param[in] authkey  authentication key (str) of the server, or None to find it;
+                    see getCalibServerAuthKey
+        @param[in] waitInterval  interval (sec) at which to poll for a product another client is loading
+        @param[in] waitTimeout  maximum time (sec) to wait for a product another client is loading,
+                    after which the product is read by this client without publishing it
+        @param[in] log  logger (an lsst.log.Log), or None to use the default
+        """
+        self.waitInterval = waitInterval
+        self.waitTimeout = waitTimeout
+        self.log = log if log is not None else lsst.log.Log.getLogger("ip.isr.CalibClient")
+        self._authkey = getCalibServerAuthKey(address, authkey).encode()
+        self._connection = Client(parseCalibServerAddress(address), authkey=self._authkey)
+        self._lock = threading.Lock()
+        self._refLock = threading.Lock()
+        self.acquired = {}
+        self.directory = self._request("directory")[1]
+        self.store = MmapCalibStore(self.directory)
+
+    def get(self, key, readFunc):
+        """Get a calibration product from the server, loading and publishing it if it is not present
+
+        The client holds a reference to the product until it is released; each call adds a reference.
+
+        @param[in] key  key identifying the product (str)
+        @param[in] readFunc  function that takes no arguments and reads the product
+        @return the product: exposures are memory-mapped from shared memory, other products are copies
+
+        If another client has been loading the product for longer than waitTimeout, the product is read
+        with readFunc and not published.
+        """
+        startTime = time.time()
+        while True:
+            with self._refLock:
+                reply = self._request("acquire", key)
+                if reply[0] == "hit":
+                    self.acquired[key] = self.acquired.get(key, 0) + 1
+            if reply[0] == "hit":
+                return self._read(key, reply[1])
+            if reply[0] == "load":
+                break
+            if time.time() - startTime > self.waitTimeout:
+                self.log.warn("Timed out after %s sec waiting for another client to load %s; reading it" %
+                              (self.waitTimeout, key))
+                product = readFunc()
+                with self._refLock:
+                    # counted so that the caller's release balances; the server ignores a release
+                    # of a product the client has not acquired
+                    self.acquired[key] = self.acquired.get(key, 0) + 1
+                return product
+            time.sleep(self.waitInterval)
+
+        try:
+            product = readFunc()
+            if self.store.write(key, product):
+                kind = "exposure"
+            else:
+                kind = "pickle"
+                path = os.path.join(self.directory, key + ".pickle")
+                tempPath = "%s.%d.part" % (path, os.getpid())
+                data = pickle.dumps(product, protocol=2)
+                with open(tempPath, "wb") as pickleFile:
+                    pickleFile.write(self._sign(data))
+                    pickleFile.write(data)
+                os.rename(tempPath, path)
+        except Exception:
+            self._request("abort", key)
+            raise
+        numBytes = CalibCache.getSize(product)
+        if kind == "pickle":
+            numBytes = max(numBytes, os.path.getsize(os.path.join(self.directory, key + ".pickle")))
+        with self._refLock:
+            self._request("publish", key, kind, numBytes)
+            self.acquired[key] = self.acquired.get(key, 0) + 1
+        return self._read(key, kind) if kind == "exposure" else product
+
+    def release(self, key):
+        """Release one of this client's references to a product
+        """
+        with self._refLock:
+            count = self.acquired.get(key, 0)
+            if count > 1:
+                self.acquired[key] = count - 1
+                return
+            self.acquired.pop(key, None)
+            self._request("release", key)
+
+    def releaseAll(self):
+        """Release all of this client's references
+        """
+        with self._refLock:
+            keys = list(self.acquired)
+            self.acquired.clear()
+            for key in keys:
+                self._request("release", key)
+
+    def getStats(self):
+        """Get the server's statistics; see CalibServer.getStats
+        """
+        return self._request("stats")[1]
+
+    def shutdown(self):
+        """Ask the server to shut down
+        """
+        self._request("shutdown")
+
+    def close(self):
+        """Disconnect from the server, releasing all references
+        """
+        with self._lock:
+            self._connection.close()
+
+    def _request(self, *request):
+        with self._lock:
+            self._connection.send(request)
+            reply = self._connection.recv()
+        if reply[0] == "error":
+            raise RuntimeError("CalibServer error: %s" % (reply[1],))
+        return reply
+
+    def _sign(self, data):
+        """Get the signature of pickled data: its HMAC with the server's authentication key"""
+        return hmac.new(self._authkey, data, hashlib.sha256).digest()
+
+    def _read(self, key, kind):
+        """Read a product published by a client of the server
+
+        Pickled products are only loaded if they were signed with the server's authentication key.
+        """
+        if kind == "exposure":
+            return self.store.read(key)
+        with open(os.path.join(self.directory, key + ".pickle"), "rb") as pickleFile:
+            signature = pickleFile.read(hashlib.sha256().digest_size)
+            data = pickleFile.read()
+        if not hmac.compare_digest(signature, self._sign(data)):
+            raise RuntimeError("CalibServer product %s was not published by a client of the server" % (key,))
+        return pickle.loads(data)
@@ -0,0 +1,194 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+
+import numpy
+
+__all__ = ["DerivedCalibStore"]
+
+
+class DerivedCalibStore(object):
+    """A bounded on-disk store of products derived from calibrations (see PreparedCalibs),
+    which survives process restarts
+
+    Each entry is a directory of uncompressed numpy (.npy) files, one per array, and an index
+    of their names and of any scalars. read maps the files read-only, so a restarted process
+    loads the products without recomputing them, and processes on a node share their pages.
+
+    Entries are keyed by digests of the contents of the source calibration files (see hashFiles)
+    and of the configuration used to derive them, so an entry is never used for a calibration
+    file that has been replaced.
+
+    Entries are written to a temporary directory that is then renamed, so a partially written
+    entry is never read. When the total size of the entries exceeds maxBytes, the least recently
+    used entries are deleted.
+    """
+    _fileHashes = {}  # content digests, by (path, size, modification time); shared by all stores
+    _fileHashLock = threading.Lock()
+
+    def __init__(self, directory, maxBytes=0):
+        """Construct a DerivedCalibStore
+
+        @param[in] directory  directory in which to store entries; created if necessary
+        @param[in] maxBytes  maximum total size of the entries (bytes); 0 for no limit
+        """
+        self.directory = directory
+        self.maxBytes = maxBytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def makeKey(*items):
+        """Make a key from items that identify a derived product (e.g. digests of its sources
+        and config values)
+
+        @param[in] *items  items whose repr identifies the product
+        @return key (str)
+        """
+        return hashlib.md5(repr(items).encode()).hexdigest()
+
+    @classmethod
+    def hashFiles(cls, fileNames):
+        """Compute a digest of the contents of files
+
+        Digests are remembered by path, size and modification time, so each file is read
+        once per process.
+
+        @param[in] fileNames  paths of files; a trailing HDU specification (e.g. "[1]") is ignored
+        @return digest (str), or None if any file cannot be read
+        """
+        md5 = hashlib.md5()
+        for fileName in fileNames:
+            path = re.sub(r"\[[^\]]*\]$", "", fileName)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return None
+            fileKey = (path, stat.st_size, stat.st_mtime)
+            with cls._fileHashLock:
+                digest = cls._fileHashes.get(fileKey)
+            if digest is None:
+                fileMd5 = hashlib.md5()
+                try:
+                    with open(path, "rb") as inFile:
+                        for block in iter(lambda: inFile.read(1 << 20), b""):
+                            fileMd5.update(block)
+                except IOError:
+                    return None
+                digest = fileMd5.hexdigest()
+                with cls._fileHashLock:
+                    cls._fileHashes[fileKey] = digest
+            md5.update(digest.encode())
+        return md5.hexdigest()
+
+    def has(self, key):
+        """Is there an entry for this key?
+        """
+        return os.path.isdir(self._getPath(key))
+
+    def write(self, key, arrays, scalars=None):
+        """Store derived products, then delete least recently used entries if over budget
+
+        @param[in] key  key of entry
+        @param[in] arrays  dict of name: numpy array
+        @param[in] scalars  dict of name: JSON-serializable value, or None
+        """
+        path = self._getPath(key)
+        if os.path.isdir(path):
+            return
+        tempPath = "%s.%d.part" % (path, os.getpid())
+        if os.path.isdir(tempPath):
+            shutil.rmtree(tempPath)
+        os.makedirs(tempPath)
+        try:
+            for name, array in arrays.items():
+                numpy.save(os.path.join(tempPath, name + ".npy"), numpy.ascontiguousarray(array))
+            with open(os.path.join(tempPath, "index.json"), "w") as indexFile:
+                json.dump(dict(arrays=sorted(arrays), scalars=scalars or {}), indexFile)
+            os.rename(tempPath, path)
+        except OSError:
+            # another process may have written the entry first
+            shutil.rmtree(tempPath, ignore_errors=True)
+            if not os.path.isdir(path):
+                raise
+        except Exception:
+            shutil.rmtree(tempPath, ignore_errors=True)
+            raise
+        self.evict()
+
+    def read(self, key):
+        """Get stored products
+
+        @param[in] key  key of entry
+        @return arrays (dict of name: read-only memory-mapped numpy array) and scalars (dict),
+            or None if there is no such entry or it cannot be read
+        """
+        path = self._getPath(key)
+        if not os.path.isdir(path):
+            return None
+        try:
+            with open(os.path.join(path, "index.json")) as indexFile:
+                index = json.load(indexFile)
+            arrays = dict((name, numpy.load(os.path.join(path, name + ".npy"), mmap_mode="r"))
+                          for name in index["arrays"])
+        except (IOError, OSError, ValueError):
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return arrays, index["scalars"]
+
+    def evict(self):
+        """Delete least recently used entries until the total size is no more than maxBytes
+        """
+        if self.maxBytes <= 0:
+            return
+        entryList = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".part") or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, fileName)) for fileName in os.listdir(path))
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            entryList.append((mtime, size, path))
+        totalBytes = sum(entry[1] for entry in entryList)
+        for mtime, size, path in sorted(entryList):
+            if totalBytes <= self.maxBytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            totalBytes -= size
+
+    def _getPath(self, key):
+        return os.path.join(self.directory, key)
@@ -74,7 +74,7 @@ class FringeTask(Task):
     """
     ConfigClass = FringeConfig
 
-    def readFringes(self, dataRef, assembler=None):
+    def readFringes(self, dataRef, assembler=None, reader=None):
         """Read the fringe frame(s)
 
         The current implementation assumes only a single fringe frame and
@@ -85,11 +85,16 @@ class FringeTask(Task):
 
         @param dataRef     Data reference for the science exposure
         @param assembler   An instance of AssembleCcdTask (for assembling fringe frames)
+        @param reader      Function that takes the dataset type ("fringe") and returns the fringe exposure,
+                           or None to read it with dataRef.get
         @return Struct(fringes: fringe exposure or list of fringe exposures;
                        seed: 32-bit uint derived from ccdExposureId for random number generator
         """
         try:
-            fringe = dataRef.get("fringe", immediate=True)
+            if reader is not None:
+                fringe = reader("fringe")
+            else:
+                fringe = dataRef.get("fringe", immediate=True)
         except Exception as e:
             raise RuntimeError("Unable to retrieve fringe for %s: %s" % (dataRef.dataId, e))
         if assembler is not None:
@@ -0,0 +1,222 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object
+
+from contextlib import contextmanager
+import resource
+import threading
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # python 2
+
+import lsst.pipe.base as pipeBase
+
+__all__ = ["StageInstrumentation", "recordBuffer", "getNumBytes", "getActiveInstrumentation",
+           "useInstrumentation"]
+
+# attribute activeList: StageInstrumentation objects that are currently measuring in each thread;
+# see recordBuffer
+_threadState = threading.local()
+# lock for the results of StageInstrumentation, which may be updated by several threads of one stage
+_activeLock = threading.Lock()
+
+
+def _getActiveList():
+    """Get the list of StageInstrumentation objects that are measuring in this thread
+    """
+    activeList = getattr(_threadState, "activeList", None)
+    if activeList is None:
+        activeList = []
+        _threadState.activeList = activeList
+    return activeList
+
+
+def getActiveInstrumentation():
+    """Get the StageInstrumentation objects that are measuring in this thread
+
+    @return a list of StageInstrumentation, for useInstrumentation
+    """
+    return list(_getActiveList())
+
+
+@contextmanager
+def useInstrumentation(instrumentationList):
+    """Context manager that attributes buffers recorded by this thread to the current stages of
+    StageInstrumentation objects measuring in another thread
+
+    Buffers are only attributed to the stages measured in the thread that records them, so that
+    work done concurrently by other threads (e.g. reading ahead) is not charged to a stage.
+    Threads that do the work of a stage (e.g. processing its amplifiers in parallel) should use this.
+
+    @param[in] instrumentationList  StageInstrumentation objects, as returned by getActiveInstrumentation
+        in the thread that is measuring
+    """
+    activeList = _getActiveList()
+    numActive = len(activeList)
+    activeList.extend(instrumentationList)
+    try:
+        yield
+    finally:
+        del activeList[numActive:]
+
+
+def getNumBytes(obj):
+    """Get the number of bytes of pixel data in an array, image, masked image or exposure
+
+    @param[in] obj  numpy array, afw.image.Image or Mask, afw.image.MaskedImage or afw.image.Exposure
+    @return number of bytes
+    """
+    if hasattr(obj, "getMaskedImage"):
+        obj = obj.getMaskedImage()
+    if hasattr(obj, "getVariance"):
+        return sum(getNumBytes(plane) for plane in (obj.getImage(), obj.getMask(), obj.getVariance()))
+    if hasattr(obj, "getArray"):
+        obj = obj.getArray()
+    return obj.nbytes
+
+
+def recordBuffer(description, obj):
+    """Record the creation of a large pixel buffer (e.g. a full-frame copy of an image)
+
+    The buffer is attributed to the current stage of each StageInstrumentation measuring in this thread
+    (see useInstrumentation). This is cheap if none is measuring, so it may be called unconditionally.
+
+    @param[in] description  short description of the buffer, e.g. the name of the function creating it
+    @param[in] obj  the buffer: a numpy array, image, masked image or exposure; see getNumBytes
+    """
+    activeList = getattr(_threadState, "activeList", None)
+    if not activeList:
+        return
+    numBytes = getNumBytes(obj)
+    with _activeLock:
+        for instrumentation in activeList:
+            instrumentation._addBuffer(description, numBytes)
+
+
+class StageInstrumentation(object):
+    """Measure the memory used by each stage of processing
+
+    For each stage measured by measureStage this records:
+    - allocBytes: net bytes allocated by the stage (memory traced by tracemalloc, which includes
+        numpy arrays but not allocations made by C++ code; -1 if tracemalloc is not available)
+    - peakAllocBytes: peak bytes allocated during the stage, relative to the start of the stage
+        (-1 if not available; requires python 3.9 or later to measure each stage separately,
+        otherwise the peak is that since tracing started)
+    - numBuffers: number of large pixel buffers created during the stage (see recordBuffer)
+    - bufferBytes: total size of those buffers
+    - maxRss: peak resident set size of the process at the end of the stage (in units of
+        resource.getrusage, which are kilobytes on Linux)
+    - bufferNames: descriptions of those buffers
+    """
+
+    def __init__(self, enabled=True):
+        """Construct a StageInstrumentation
+
+        @param[in] enabled  measure stages? If False then measureStage does nothing.
+        """
+        self.enabled = enabled
+        self.stageResults = []
+        self._currentStage = None
+        self._startedTracing = False
+
+    @contextmanager
+    def measureStage(self, name):
+        """Context manager that measures the memory used by a stage of processing
+
+        @param[in] name  name of stage
+        """
+        if not self.enabled:
+            yield
+            return
+
+        result = pipeBase.Struct(name=name, allocBytes=-1, peakAllocBytes=-1, numBuffers=0,
+                                 bufferBytes=0, maxRss=0, bufferNames=[])
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._startedTracing = True
+        if tracemalloc is not None:
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+            startBytes = tracemalloc.get_traced_memory()[0]
+        activeList = _getActiveList()
+        with _activeLock:
+            self._currentStage = result
+        activeList.append(self)
+        try:
+            yield
+        finally:
+            activeList.remove(self)
+            with _activeLock:
+                self._currentStage = None
+            if tracemalloc is not None:
+                currentBytes, peakBytes = tracemalloc.get_traced_memory()
+                result.allocBytes = currentBytes - startBytes
+                result.peakAllocBytes = max(peakBytes - startBytes, 0)
+            result.maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.stageResults.append(result)
+
+    def stop(self):
+        """Stop tracing memory allocations, if tracing was started by this object
+        """
+        if self._startedTracing:
+            tracemalloc.stop()
+            self._startedTracing = False
+
+    def writeMetadata(self, metadata):
+        """Write the results to metadata
+
+        For each stage, sets <STAGE>_ALLOC_BYTES, <STAGE>_PEAK_ALLOC_BYTES, <STAGE>_NUM_BUFFERS,
+        <STAGE>_BUFFER_BYTES and <STAGE>_MAX_RSS, where <STAGE> is the stage name in upper case.
+        A stage that was measured more than once reports the sum of its measurements (maximum,
+        for the peak values).
+
+        @param[in,out] metadata  metadata to update (an lsst.daf.base.PropertySet)
+        """
+        totals = {}
+        for result in self.stageResults:
+            total = totals.get(result.name)
+            if total is None:
+                totals[result.name] = pipeBase.Struct(**result.getDict())
+                continue
+            total.allocBytes += result.allocBytes
+            total.peakAllocBytes = max(total.peakAllocBytes, result.peakAllocBytes)
+            total.numBuffers += result.numBuffers
+            total.bufferBytes += result.bufferBytes
+            total.maxRss = max(total.maxRss, result.maxRss)
+        for name, total in totals.items():
+            prefix = name.upper()
+            metadata.set(prefix + "_ALLOC_BYTES", total.allocBytes)
+            metadata.set(prefix + "_PEAK_ALLOC_BYTES", total.peakAllocBytes)
+            metadata.set(prefix + "_NUM_BUFFERS", total.numBuffers)
+            metadata.set(prefix + "_BUFFER_BYTES", total.bufferBytes)
+            metadata.set(prefix + "_MAX_RSS", total.maxRss)
+
+    def _addBuffer(self, description, numBytes):
+        """Record a buffer in the current stage; the caller must hold _activeLock
+        """
+        if self._currentStage is not None:
+            self._currentStage.numBuffers += 1
+            self._currentStage.bufferBytes += numBytes
+            self._currentStage.bufferNames.append(description)
@@ -58,7 +58,13 @@ template <typename PixelT>
 static void declareAll(py::module& mod, std::string const& suffix) {
     declareCountMaskedPixels<PixelT>(mod, suffix);
 
-    mod.def("maskNans", &maskNans<PixelT>, "maskedImage"_a, "maskVal"_a, "allow"_a = 0);
+    mod.def("maskNans",
+            [](afw::image::MaskedImage<PixelT> const &mi, afw::image::MaskPixel maskVal,
+               afw::image::MaskPixel allow) {
+                py::gil_scoped_release release;
+                return maskNans<PixelT>(mi, maskVal, allow);
+            },
+            "maskedImage"_a, "maskVal"_a, "allow"_a = 0);
     mod.def("fitOverscanImage", &fitOverscanImage<PixelT, double>, "overscanFunction"_a, "overscan"_a,
             "stepSize"_a = 1.1, "sigma"_a = 1);
 }
@@ -0,0 +1,471 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object
+
+from collections import OrderedDict
+import json
+import multiprocessing
+import os
+import traceback
+
+import lsst.daf.base as dafBase
+import lsst.log
+import lsst.pipe.base as pipeBase
+from .isrTask import IsrTask, LazyCalib
+
+__all__ = ["IsrPoolDriver", "IsrCostModel"]
+
+# State of an IsrPoolDriver worker process, or of the driver itself when it runs in-process;
+# set by _initWorker
+_workerState = None
+
+
+def _initWorker(taskClass, config, returnExposures, doRaise):
+    """!Initialize a worker: construct the task that will process all data references sent to this worker
+
+    \param[in] taskClass -- task class, e.g. IsrTask
+    \param[in] config -- task config
+    \param[in] returnExposures -- return the ISR-corrected exposures to the driver?
+    \param[in] doRaise -- raise exceptions (rather than reporting them in the results)?
+    """
+    global _workerState
+    _workerState = pipeBase.Struct(
+        task=taskClass(config=config),
+        returnExposures=returnExposures,
+        doRaise=doRaise,
+        calibKey=None,
+        isrData=None,
+        hasFringes=False,
+    )
+
+
+def _runGroup(indexGroup):
+    """!Process a group of data references of one detector, sharing calibration data where possible
+
+    \param[in] indexGroup -- a tuple of (index, list of data references to process, in order)
+    \return a tuple of (index, list of results, one per data reference); see IsrPoolDriver.run
+    """
+    index, dataRefList = indexGroup
+    return index, [_runDataRef(dataRef) for dataRef in dataRefList]
+
+
+def _runDataRef(dataRef):
+    """!Process one data reference with the worker's task
+
+    Calibration data are reused from the previous data reference processed by this worker
+    if they come from the same files; see IsrPoolDriver.getCalibKey. The fringe frames are
+    the exception: FringeTask.run modifies them and their seed depends on the exposure,
+    so they are read for each data reference.
+
+    \param[in] dataRef -- data reference to process
+    \return a pipeBase.Struct; see IsrPoolDriver.run
+    """
+    state = _workerState
+    task = state.task
+    result = pipeBase.Struct(dataId=dataRef.dataId, exposure=None, metadata=None, sharedCalibs=False,
+                             cpuTime=None, error=None)
+    # start with empty metadata, so the result has this data reference's metadata only
+    for subtask in task.getTaskDict().values():
+        subtask.metadata = dafBase.PropertyList()
+    try:
+        ccdExposure = task.readRaw(dataRef)
+        calibKey = IsrPoolDriver.getCalibKey(task, dataRef, ccdExposure)
+        isrData = None
+        if calibKey is not None and calibKey == state.calibKey:
+            isrData = pipeBase.Struct(**state.isrData.getDict())
+            if state.hasFringes:
+                isrData.fringes = task.readFringeData(dataRef)
+            result.sharedCalibs = True
+        else:
+            # don't hold on to the old calibration data while reading new data
+            state.calibKey = None
+            state.isrData = None
+        inputData = task.readDataRef(dataRef, isrData=isrData, ccdExposure=ccdExposure)
+        if not result.sharedCalibs and calibKey is not None:
+            state.calibKey = calibKey
+            state.isrData = pipeBase.Struct(**inputData.isrData.getDict())
+            state.isrData.fringes = pipeBase.Struct(fringes=None)
+            state.hasFringes = isinstance(inputData.isrData.fringes, LazyCalib) or \
+                inputData.isrData.fringes.fringes is not None
+        taskResult = task.processDataRef(dataRef, inputData)
+        if state.returnExposures:
+            result.exposure = taskResult.exposure
+        result.metadata = task.getFullMetadata()
+        cpuTimes = [IsrCostModel.getCpuTime(task.metadata, methodName)
+                    for methodName in ("readRaw", "readDataRef", "processDataRef")]
+        result.cpuTime = None if None in cpuTimes else sum(cpuTimes)
+    except Exception as e:
+        if state.doRaise:
+            raise
+        task.log.fatal("Failed on dataId=%s: %s" % (dataRef.dataId, e))
+        result.error = traceback.format_exc()
+    return result
+
+
+class IsrCostModel(object):
+    """!Estimate the time needed to run instrument signature removal on a detector
+
+    The estimate for a detector that has been processed before is the mean CPU time of its previous
+    runs, as recorded by pipe.base.timeMethod for IsrTask.readRaw, readDataRef and processDataRef.
+    This accounts for properties that cannot be predicted from the data ID, such as the number of defects
+    or saturated pixels.
+
+    Other detectors get a prior estimate: baseCost plus the cost of each optional stage that will run
+    (fringe subtraction only for the filters in config.fringe.filters). Once some detectors have
+    history, prior estimates are scaled to seconds by the mean ratio of measured time to prior estimate.
+
+    The history may be saved to and read from a JSON file, so that it carries over between runs.
+    """
+
+    def __init__(self, baseCost=1.0, fringeCost=0.5, brighterFatterCost=1.0, defectCost=0.2):
+        """!Construct an IsrCostModel
+
+        \param[in] baseCost -- relative cost of the stages that always run
+        \param[in] fringeCost -- relative cost of fringe subtraction
+        \param[in] brighterFatterCost -- relative cost of brighter-fatter correction
+        \param[in] defectCost -- relative cost of defect masking and interpolation
+        """
+        self.baseCost = baseCost
+        self.fringeCost = fringeCost
+        self.brighterFatterCost = brighterFatterCost
+        self.defectCost = defectCost
+        # dict of detector key: [prior estimate, sum of CPU times (sec), number of runs]
+        self.history = {}
+
+    def getPriorCost(self, config, dataId):
+        """!Get the prior (relative) cost of processing a detector
+
+        \param[in] config -- IsrTask config
+        \param[in] dataId -- data ID of detector data to process
+        \return prior cost (arbitrary units)
+        """
+        cost = self.baseCost
+        if config.doFringe:
+            filterName = dataId.get("filter")
+            if filterName is None or filterName in config.fringe.filters:
+                cost += self.fringeCost
+        if config.doBrighterFatter:
+            cost += self.brighterFatterCost
+        if config.doDefect:
+            cost += self.defectCost
+        return cost
+
+    def estimate(self, config, dataId, detectorKey):
+        """!Estimate the CPU time needed to process a detector
+
+        \param[in] config -- IsrTask config
+        \param[in] dataId -- data ID of detector data to process
+        \param[in] detectorKey -- key identifying the detector (hashable); see IsrPoolDriver.getDetectorKey
+        \return estimated CPU time (sec), or prior cost if there is no history for any detector
+        """
+        entry = self.history.get(detectorKey)
+        if entry is not None:
+            return entry[1]/entry[2]
+        return self.getPriorCost(config, dataId)*self.getPriorScale()
+
+    def getPriorScale(self):
+        """!Get the factor that converts prior costs to CPU time (sec); 1 if there is no history
+        """
+        if not self.history:
+            return 1.0
+        ratioList = [sumTime/(numRuns*prior) for prior, sumTime, numRuns in self.history.values()]
+        return sum(ratioList)/len(ratioList)
+
+    def record(self, config, dataId, detectorKey, cpuTime):
+        """!Record the CPU time taken to process a detector
+
+        \param[in] config -- IsrTask config
+        \param[in] dataId -- data ID of detector data that was processed
+        \param[in] detectorKey -- key identifying the detector (hashable)
+        \param[in] cpuTime -- CPU time taken (sec)
+        """
+        entry = self.history.setdefault(detectorKey, [self.getPriorCost(config, dataId), 0.0, 0])
+        entry[1] += cpuTime
+        entry[2] += 1
+
+    @staticmethod
+    def getCpuTime(metadata, methodName):
+        """!Get the CPU time of the last call of a method, as recorded by pipe.base.timeMethod
+
+        \param[in] metadata -- task metadata
+        \param[in] methodName -- name of method
+        \return CPU time (sec), or None if not recorded
+        """
+        startKey = methodName + "StartCpuTime"
+        endKey = methodName + "EndCpuTime"
+        if not metadata.exists(startKey) or not metadata.exists(endKey):
+            return None
+        return metadata.getArray(endKey)[-1] - metadata.getArray(startKey)[-1]
+
+    def readHistory(self, path):
+        """!Read history written by writeHistory, adding it to the current history
+
+        \param[in] path -- path of JSON file
+        """
+        with open(path) as historyFile:
+            for key, prior, sumTime, numRuns in json.load(historyFile):
+                detectorKey = tuple(tuple(item) for item in key)
+                entry = self.history.setdefault(detectorKey, [prior, 0.0, 0])
+                entry[1] += sumTime
+                entry[2] += numRuns
+
+    def writeHistory(self, path):
+        """!Write the history to a JSON file
+
+        The file is written to a temporary file that is then renamed, so it is never partially written.
+
+        \param[in] path -- path of JSON file
+        """
+        tempPath = "%s.%d.part" % (path, os.getpid())
+        with open(tempPath, "w") as historyFile:
+            json.dump([[[list(item) for item in key]] + list(entry) for key, entry in self.history.items()],
+                      historyFile)
+        os.rename(tempPath, path)
+
+
+class IsrPoolDriver(object):
+    """!Run instrument signature removal on many detectors using a pool of processes
+
+    Each worker process constructs one task and keeps it for the life of the pool, so the stack is
+    imported and per-detector information (see IsrTask.getPlan) is derived once per worker rather
+    than once per detector. Data references are grouped by detector and large groups are split into
+    chunks of at most chunkSize data references (see chunkGroups); each chunk is processed by a single
+    worker, in order, and consecutive exposures in a chunk whose calibration data come from the same
+    files share one read of those data.
+
+    Detectors can take very different times to process, so chunks are scheduled longest first,
+    using the estimates of an IsrCostModel, and are handed out one at a time to whichever worker
+    is idle. The cost model learns from the CPU time of each detector processed.
+
+    A full focal-plane visit therefore takes roughly the time to process one detector times
+    (number of detectors / number of processes).
+
+    Example:
+    \code{.py}
+    driver = IsrPoolDriver(config=isrConfig, numProcesses=8, historyPath="isrCost.json")
+    results = driver.run(butler.subset("raw", visit=1234))
+    \endcode
+    """
+
+    def __init__(self, config=None, numProcesses=1, taskClass=IsrTask, returnExposures=False, doRaise=False,
+                 groupKeys=("raft", "sensor", "ccd", "ccdnum", "detector"), costModel=None, historyPath=None,
+                 log=None, chunkSize=None):
+        """!Construct an IsrPoolDriver
+
+        \param[in] config -- config for taskClass, or None for the default config
+        \param[in] numProcesses -- number of worker processes; if <= 1 the data references are processed
+            in this process
+        \param[in] taskClass -- task class to run; IsrTask or a subclass
+        \param[in] returnExposures -- return the ISR-corrected exposures? This transfers each exposure
+            from its worker to this process, so it should only be used for small numbers of detectors;
+            use config.doWrite to persist the exposures instead
+        \param[in] doRaise -- raise an exception when processing a data reference fails?
+            If False the failure is logged and reported in the results, and processing continues.
+        \param[in] groupKeys -- data ID keys that identify a detector; data references with the same
+            values for those of these keys that are present are processed by the same worker
+        \param[in] costModel -- cost model used to schedule detectors (an IsrCostModel),
+            or None for a default IsrCostModel
+        \param[in] historyPath -- path of a JSON file with the history of the cost model, or None;
+            the history is read when the driver is constructed, if the file exists, and written after each run
+        \param[in] log -- logger (an lsst.log.Log), or None to use the default
+        \param[in] chunkSize -- maximum number of data references of one detector processed by one worker
+            in a row, or None to choose it so that there are at least two chunks per process (so that
+            many exposures of a few detectors still use all processes); calibration data are only
+            shared between consecutive data references processed by the same worker
+        """
+        self.taskClass = taskClass
+        self.config = config if config is not None else taskClass.ConfigClass()
+        self.numProcesses = numProcesses
+        self.returnExposures = returnExposures
+        self.doRaise = doRaise
+        self.groupKeys = groupKeys
+        self.costModel = costModel if costModel is not None else IsrCostModel()
+        self.historyPath = historyPath
+        self.chunkSize = chunkSize
+        self.log = log if log is not None else lsst.log.Log.getLogger("ip.isr.IsrPoolDriver")
+        if historyPath and os.path.exists(historyPath):
+            self.costModel.readHistory(historyPath)
+
+    def getDetectorKey(self, dataId):
+        """!Get a key that identifies the detector of a data ID
+
+        \param[in] dataId -- data ID
+        \return a tuple of (name, value) for those keys in groupKeys that are present in dataId
+        """
+        return tuple((name, dataId[name]) for name in self.groupKeys if name in dataId)
+
+    def groupDataRefs(self, dataRefList):
+        """!Group data references by detector
+
+        \param[in] dataRefList -- data references to group
+        \return a list of lists of data references; groups are in order of first appearance
+            and data references keep their relative order within a group
+        """
+        groups = OrderedDict()
+        for dataRef in dataRefList:
+            groups.setdefault(self.getDetectorKey(dataRef.dataId), []).append(dataRef)
+        return list(groups.values())
+
+    def chunkGroups(self, groupList, chunkSize):
+        """!Split groups of data references into chunks of nearly equal size
+
+        \param[in] groupList -- list of groups of data references; see groupDataRefs
+        \param[in] chunkSize -- maximum number of data references in a chunk
+        \return a list of chunks (lists of data references); the chunks of a group are consecutive
+            and data references keep their relative order
+        """
+        chunkList = []
+        for group in groupList:
+            numChunks = -(-len(group)//chunkSize)
+            for i in range(numChunks):
+                chunkList.append(group[i*len(group)//numChunks:(i + 1)*len(group)//numChunks])
+        return chunkList
+
+    def getChunkSize(self, numDataRefs, numProcesses):
+        """!Get the maximum number of data references in a chunk
+
+        \param[in] numDataRefs -- number of data references to process
+        \param[in] numProcesses -- number of processes
+        \return chunkSize if it is not None, else the size that gives at least two chunks per process,
+            or numDataRefs (no splitting) for a single process
+        """
+        if self.chunkSize is not None:
+            return self.chunkSize
+        if numProcesses <= 1:
+            return max(numDataRefs, 1)
+        return max(-(-numDataRefs//(2*numProcesses)), 1)
+
+    def scheduleGroups(self, groupList):
+        """!Order groups of data references longest first
+
+        \param[in] groupList -- list of groups of data references; see groupDataRefs and chunkGroups
+        \return a tuple of:
+        - a list of indices into groupList, in the order the groups should be processed
+        - a list of the estimated cost of each group, in the order of groupList
+        """
+        costList = [sum(self.costModel.estimate(self.config, dataRef.dataId,
+                                                self.getDetectorKey(dataRef.dataId)) for dataRef in group)
+                    for group in groupList]
+        order = sorted(range(len(groupList)), key=lambda i: costList[i], reverse=True)
+        return order, costList
+
+    @staticmethod
+    def getCalibKey(task, dataRef, rawExposure):
+        """!Get a key that identifies the calibration data read by task.readIsrData for a data reference
+
+        The key lists the files of each calibration product the task will read, chosen with the
+        same checks as readIsrData; data references with equal keys can share calibration data.
+
+        \param[in] task -- task that will process the data reference (an IsrTask)
+        \param[in] dataRef -- data reference to process
+        \param[in] rawExposure -- raw exposure of the data reference
+        \return the key (a tuple), or None if the files cannot be determined, in which case
+            the calibration data should not be shared
+        """
+        config = task.config
+        datasetTypes = []
+        for datasetType, doRead in (("bias", config.doBias),
+                                    ("linearizer", task.doLinearize(rawExposure.getDetector())),
+                                    ("dark", config.doDark),
+                                    ("flat", config.doFlat),
+                                    ("brighterFatterKernel", config.doBrighterFatter),
+                                    ("defects", config.doDefect),
+                                    ("fringe", config.doFringe and task.fringe.checkFilter(rawExposure))):
+            if doRead:
+                datasetTypes.append(datasetType)
+        try:
+            return tuple((datasetType, tuple(dataRef.get(datasetType + "_filename")))
+                         for datasetType in datasetTypes)
+        except Exception as e:
+            task.log.warn("Cannot determine the calibration files for %s, so they will not be shared: %s" %
+                          (dataRef.dataId, e))
+            return None
+
+    def run(self, dataRefList):
+        """!Process data references
+
+        \param[in] dataRefList -- data references (daf.persistence.butlerSubset.ButlerDataRef)
+            of the detector data to process; with numProcesses > 1 they must be picklable
+        \return a pipeBase.Struct with fields:
+        - results: a list with one pipeBase.Struct per data reference, in the order of dataRefList,
+            with fields:
+            - dataId: data ID
+            - exposure: the exposure after application of ISR if returnExposures is True, else None
+            - metadata: the task metadata of processing the data reference, or None on failure
+            - sharedCalibs: True if the calibration data were shared with a previous data reference
+            - cpuTime: CPU time taken by readDataRef and processDataRef (sec), or None on failure
+            - error: None on success, else the formatted traceback of the failure
+        - numFailed: number of data references that failed
+        """
+        dataRefList = list(dataRefList)
+        detectorGroupList = self.groupDataRefs(dataRefList)
+        chunkSize = self.getChunkSize(len(dataRefList), self.numProcesses)
+        groupList = self.chunkGroups(detectorGroupList, chunkSize)
+        order, costList = self.scheduleGroups(groupList)
+        numProcesses = min(self.numProcesses, len(groupList))
+        self.log.info("Processing %d data references of %d detectors in %d chunks with %d process(es)" %
+                      (len(dataRefList), len(detectorGroupList), len(groupList), max(numProcesses, 1)))
+        if numProcesses > 1:
+            self.log.info("Estimated cost: total %g, largest chunk %g, balanced per process %g" %
+                          (sum(costList), max(costList), sum(costList)/numProcesses))
+
+        initArgs = (self.taskClass, self.config, self.returnExposures, self.doRaise)
+        jobList = [(i, groupList[i]) for i in order]
+        groupResultList = [None]*len(groupList)
+        if numProcesses <= 1:
+            global _workerState
+            _initWorker(*initArgs)
+            try:
+                for job in jobList:
+                    index, groupResults = _runGroup(job)
+                    groupResultList[index] = groupResults
+            finally:
+                _workerState.task.close()
+                _workerState = None
+        else:
+            # chunksize=1 so each idle worker takes the next (largest remaining) chunk from the queue
+            pool = multiprocessing.Pool(processes=numProcesses, initializer=_initWorker, initargs=initArgs)
+            try:
+                for index, groupResults in pool.imap_unordered(_runGroup, jobList, chunksize=1):
+                    groupResultList[index] = groupResults
+                pool.close()
+            except Exception:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+        resultDict = {}
+        for group, groupResults in zip(groupList, groupResultList):
+            for dataRef, result in zip(group, groupResults):
+                resultDict[id(dataRef)] = result
+                if result.cpuTime is not None:
+                    self.costModel.record(self.config, dataRef.dataId, self.getDetectorKey(dataRef.dataId),
+                                          result.cpuTime)
+        if self.historyPath:
+            self.costModel.writeHistory(self.historyPath)
+        results = [resultDict[id(dataRef)] for dataRef in dataRefList]
+        numFailed = sum(result.error is not None for result in results)
+        if numFailed > 0:
+            self.log.warn("%d of %d data references failed" % (numFailed, len(results)))
+        return pipeBase.Struct(results=results, numFailed=numFailed)
@@ -33,6 +33,8 @@ import lsst.afw.math as afwMath
 import lsst.meas.algorithms as measAlg
 import lsst.pex.exceptions as pexExcept
 
+from .instrumentation import recordBuffer
+
 
 def createPsf(fwhm):
     """Make a double Gaussian PSF
@@ -50,13 +52,99 @@ def transposeMaskedImage(maskedImage):
     @return transposed masked image
     """
     transposed = maskedImage.Factory(afwGeom.Extent2I(maskedImage.getHeight(), maskedImage.getWidth()))
+    recordBuffer("transposeMaskedImage", transposed)
     transposed.getImage().getArray()[:] = maskedImage.getImage().getArray().T
     transposed.getMask().getArray()[:] = maskedImage.getMask().getArray().T
     transposed.getVariance().getArray()[:] = maskedImage.getVariance().getArray().T
     return transposed
 
 
-def interpolateDefectList(maskedImage, defectList, fwhm, fallbackValue=None):
+def binMaskedImage(maskedImage, binSize, average=False):
+    """Bin a masked image by summing (or averaging) blocks of binSize x binSize pixels
+
+    Rows and columns beyond the last whole block are dropped. The mask of a binned pixel
+    is the OR of the masks of its pixels and the variance is that of the sum (or mean).
+
+    @param[in] maskedImage  afw.image.MaskedImage to bin
+    @param[in] binSize  number of pixels per bin along each axis
+    @param[in] average  average the pixels of each block, instead of summing them?
+    @return binned afw.image.MaskedImageF, whose xy0 is that of maskedImage divided by binSize
+    """
+    if binSize <= 0:
+        raise RuntimeError("binSize=%s must be positive" % (binSize,))
+    height, width = [size//binSize for size in maskedImage.getImage().getArray().shape]
+
+    def getBlocks(array):
+        return array[:height*binSize, :width*binSize].reshape(height, binSize, width, binSize)
+
+    xy0 = maskedImage.getXY0()
+    binned = afwImage.MaskedImageF(afwGeom.Box2I(afwGeom.Point2I(xy0.getX()//binSize, xy0.getY()//binSize),
+                                                 afwGeom.Extent2I(width, height)))
+    numPixels = binSize**2
+    imageArray = binned.getImage().getArray()
+    imageArray[:] = getBlocks(maskedImage.getImage().getArray()).sum(axis=(1, 3), dtype=numpy.float64)
+    varianceArray = binned.getVariance().getArray()
+    varianceArray[:] = getBlocks(maskedImage.getVariance().getArray()).sum(axis=(1, 3), dtype=numpy.float64)
+    if average:
+        imageArray /= numPixels
+        varianceArray /= numPixels**2
+    binned.getMask().getArray()[:] = numpy.bitwise_or.reduce(
+        getBlocks(maskedImage.getMask().getArray()), axis=(1, 3))
+    return binned
+
+
+def binWcs(wcs, binSize, xy0=afwGeom.Point2I(0, 0)):
+    """Make the WCS of an image binned by binMaskedImage
+
+    The reference pixel is moved and the CD matrix (or CDELT) and SIP distortion coefficients
+    are scaled, so that each binned pixel maps to the center of the block of pixels it sums.
+
+    @param[in] wcs  WCS of the unbinned image (an afw.image.Wcs)
+    @param[in] binSize  number of pixels per bin along each axis
+    @param[in] xy0  xy0 of the unbinned image
+    @return WCS of the binned image
+    """
+    metadata = wcs.getFitsMetadata()
+    for axis, origin in ((1, xy0.getX()), (2, xy0.getY())):
+        # FITS pixel positions are 1-based; binned pixel i covers unbinned pixels from
+        # origin + binSize*(i - origin//binSize) (see binMaskedImage)
+        crpix = metadata.getAsDouble("CRPIX%d" % (axis,)) - 1.0
+        crpix = (crpix - origin - 0.5*(binSize - 1))/binSize + origin//binSize
+        metadata.set("CRPIX%d" % (axis,), crpix + 1.0)
+    for key in ("CD1_1", "CD1_2", "CD2_1", "CD2_2", "CDELT1", "CDELT2"):
+        if metadata.exists(key):
+            metadata.set(key, metadata.getAsDouble(key)*binSize)
+    for prefix in ("A", "B", "AP", "BP"):
+        orderKey = prefix + "_ORDER"
+        if not metadata.exists(orderKey):
+            continue
+        order = metadata.getAsInt(orderKey)
+        for p in range(order + 1):
+            for q in range(order + 1 - p):
+                key = "%s_%d_%d" % (prefix, p, q)
+                if metadata.exists(key):
+                    metadata.set(key, metadata.getAsDouble(key)*binSize**(p + q - 1))
+    return afwImage.makeWcs(metadata)
+
+
+def makeStripBBoxes(bbox, stripHeight):
+    """Divide a bounding box into horizontal strips
+
+    @param[in] bbox  bounding box to divide (an afw.geom.Box2I)
+    @param[in] stripHeight  number of rows per strip; the last strip may be shorter
+    @return a list of afw.geom.Box2I, in order of increasing y
+    """
+    if stripHeight <= 0:
+        raise RuntimeError("stripHeight=%s must be positive" % (stripHeight,))
+    stripList = []
+    for y0 in range(bbox.getMinY(), bbox.getMaxY() + 1, stripHeight):
+        y1 = min(y0 + stripHeight - 1, bbox.getMaxY())
+        stripList.append(afwGeom.Box2I(afwGeom.Point2I(bbox.getMinX(), y0),
+                                       afwGeom.Point2I(bbox.getMaxX(), y1)))
+    return stripList
+
+
+def interpolateDefectList(maskedImage, defectList, fwhm, fallbackValue=None, psf=None):
     """Interpolate over defects specified in a defect list
 
     @param[in,out] maskedImage  masked image to process
@@ -64,8 +152,10 @@ def interpolateDefectList(maskedImage, defectList, fwhm, fallbackValue=None):
     @param[in] fwhm  FWHM of double Gaussian smoothing kernel
     @param[in] fallbackValue  fallback value if an interpolated value cannot be determined;
                               if None then use clipped mean image value
+    @param[in] psf  PSF to use for interpolation; if None then createPsf(fwhm)
     """
-    psf = createPsf(fwhm)
+    if psf is None:
+        psf = createPsf(fwhm)
     if fallbackValue is None:
         fallbackValue = afwMath.makeStatistics(maskedImage.getImage(), afwMath.MEANCLIP).getValue()
     if 'INTRP' not in maskedImage.getMask().getMaskPlaneDict():
@@ -165,7 +255,24 @@ def makeThresholdMask(maskedImage, threshold, growFootprints=1, maskName='SAT'):
     return defectListFromFootprintList(fpList, growFootprints=0)
 
 
-def interpolateFromMask(maskedImage, fwhm, growFootprints=1, maskName='SAT', fallbackValue=None):
+def setThresholdMask(maskedImage, threshold, maskName='SAT'):
+    """Mask pixels whose value is at or above a threshold
+
+    Sets the same mask bits as makeThresholdMask with growFootprints=0, but uses numpy, which releases
+    the GIL, so amplifiers may be processed in parallel threads; the defects are not returned.
+
+    @param[in,out] maskedImage  afw.image.MaskedImage to process; the mask is altered
+    @param[in] threshold  detection threshold
+    @param[in] maskName  mask plane name
+    """
+    mask = maskedImage.getMask()
+    maskArray = mask.getArray()
+    with numpy.errstate(invalid="ignore"):
+        isAbove = maskedImage.getImage().getArray() >= threshold
+    numpy.bitwise_or(maskArray, mask.getPlaneBitMask(maskName), out=maskArray, where=isAbove)
+
+
+def interpolateFromMask(maskedImage, fwhm, growFootprints=1, maskName='SAT', fallbackValue=None, psf=None):
     """Interpolate over defects identified by a particular mask plane
 
     @param[in,out] maskedImage  afw.image.MaskedImage to process
@@ -173,9 +280,10 @@ def interpolateFromMask(maskedImage, fwhm, growFootprints=1, maskName='SAT', fal
     @param[in] growFootprints  amount by which to grow footprints of detected regions
     @param[in] maskName  mask plane name
     @param[in] fallbackValue  value of last resort for interpolation
+    @param[in] psf  PSF to use for interpolation; if None then createPsf(fwhm)
     """
     defectList = getDefectListFromMask(maskedImage, maskName, growFootprints)
-    interpolateDefectList(maskedImage, defectList, fwhm, fallbackValue=fallbackValue)
+    interpolateDefectList(maskedImage, defectList, fwhm, fallbackValue=fallbackValue, psf=psf)
 
 
 def saturationCorrection(maskedImage, saturation, fwhm, growFootprints=1, interpolate=True, maskName='SAT',
@@ -237,10 +345,10 @@ def updateVariance(maskedImage, gain, readNoise):
     @param[in] gain  amplifier gain (e-/ADU)
     @param[in] readNoise  amplifier read noise (ADU/pixel)
     """
-    var = maskedImage.getVariance()
-    var[:] = maskedImage.getImage()
-    var /= gain
-    var += readNoise**2
+    # numpy releases the GIL, so amplifiers may be processed in parallel threads
+    varArray = maskedImage.getVariance().getArray()
+    numpy.divide(maskedImage.getImage().getArray(), gain, out=varArray)
+    varArray += readNoise**2
 
 
 def flatCorrection(maskedImage, flatMaskedImage, scalingType, userScale=1.0):
@@ -255,6 +363,18 @@ def flatCorrection(maskedImage, flatMaskedImage, scalingType, userScale=1.0):
         raise RuntimeError("maskedImage bbox %s != flatMaskedImage bbox %s" %
                            (maskedImage.getBBox(afwImage.LOCAL), flatMaskedImage.getBBox(afwImage.LOCAL)))
 
+    flatScale = getFlatScale(flatMaskedImage, scalingType, userScale)
+    maskedImage.scaledDivides(1.0/flatScale, flatMaskedImage)
+
+
+def getFlatScale(flatMaskedImage, scalingType, userScale=1.0):
+    """Compute the scale by which a flat is divided before it is applied
+
+    @param[in] flatMaskedImage  flat field afw.image.MaskedImage
+    @param[in] scalingType  how to compute flat scale; one of 'MEAN', 'MEDIAN' or 'USER'
+    @param[in] userScale  scale to use if scalingType is 'USER', else ignored
+    @return flat scale
+    """
     # Figure out scale from the data
     # Ideally the flats are normalized by the calibration product pipelin, but this allows some flexibility
     # in the case that the flat is created by some other mechanism.
@@ -267,8 +387,7 @@ def flatCorrection(maskedImage, flatMaskedImage, scalingType, userScale=1.0):
         flatScale = userScale
     else:
         raise pexExcept.Exception('%s : %s not implemented' % ("flatCorrection", scalingType))
-
-    maskedImage.scaledDivides(1.0/flatScale, flatMaskedImage)
+    return flatScale
 
 
 def illuminationCorrection(maskedImage, illumMaskedImage, illumScale):
@@ -306,9 +425,15 @@ def overscanCorrection(ampMaskedImage, overscanImage, fitType='MEDIAN', order=1,
     @param[in] statControl  Statistics control object
     """
     ampImage = ampMaskedImage.getImage()
+    useNumpy = statControl is None and not hasattr(overscanImage, "getMask")
     if statControl is None:
         statControl = afwMath.StatisticsControl()
-    if fitType == 'MEAN':
+    if fitType in ('MEAN', 'MEDIAN') and useNumpy:
+        # the values afwMath.makeStatistics gives with the default StatisticsControl (which ignores NaNs),
+        # computed with numpy, which releases the GIL, so amplifiers may be processed in parallel threads
+        overscanArray = overscanImage.getArray().astype(numpy.float64)
+        offImage = numpy.nanmean(overscanArray) if fitType == 'MEAN' else numpy.nanmedian(overscanArray)
+    elif fitType == 'MEAN':
         offImage = afwMath.makeStatistics(overscanImage, afwMath.MEAN, statControl).getValue(afwMath.MEAN)
     elif fitType == 'MEDIAN':
         offImage = afwMath.makeStatistics(overscanImage, afwMath.MEDIAN, statControl).getValue(afwMath.MEDIAN)
@@ -405,6 +530,7 @@ def overscanCorrection(ampMaskedImage, overscanImage, fitType='MEDIAN', order=1,
                 figure.close()
 
         offImage = ampImage.Factory(ampImage.getDimensions())
+        recordBuffer("overscanCorrection offImage", offImage)
         offArray = offImage.getArray()
         if shortInd == 1:
             offArray[:, :] = fitBiasArr[:, numpy.newaxis]
@@ -439,4 +565,6 @@ def overscanCorrection(ampMaskedImage, overscanImage, fitType='MEDIAN', order=1,
     else:
         raise pexExcept.Exception('%s : %s an invalid overscan type' % \
             ("overscanCorrection", fitType))
-    ampImage -= offImage
+    # numpy releases the GIL, so amplifiers may be processed in parallel threads
+    ampArray = ampImage.getArray()
+    ampArray -= offImage.getArray() if hasattr(offImage, "getArray") else offImage
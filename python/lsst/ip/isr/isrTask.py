@@ -22,6 +22,7 @@ from builtins import object
 # the GNU General Public License along with this program.  If not,
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
+import hashlib
 import math
 import numpy
 
@@ -38,9 +39,28 @@ from . import isrFunctions
 from .assembleCcdTask import AssembleCcdTask
 from .fringe import FringeTask
 from lsst.afw.geom.polygon import Polygon
-from lsst.afw.cameraGeom import PIXELS, FOCAL_PLANE, NullLinearityType
+from lsst.afw.cameraGeom import PIXELS, FOCAL_PLANE, NullLinearityType, assembleAmplifierImage
+from collections import OrderedDict
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+import threading
+import weakref
 from .isr import maskNans
+from .applyDetrend import applyDetrend
+from .applyLookupTable import applyLookupTable
+from .stageCache import StageCache
+from .calibCache import CalibCache
+from .mmapCalibStore import MmapCalibStore
+from .calibServer import CalibClient
+from .calibIndex import CalibIndex
+from .preparedCalibs import PreparedCalibs
+from .derivedCalibStore import DerivedCalibStore
+from .sparseDark import SparseDarkModel
+from .separableBias import SeparableBiasModel
+from .instrumentation import StageInstrumentation, recordBuffer, getNumBytes, getActiveInstrumentation, \
+    useInstrumentation
+from .prefetch import Prefetcher
+from .asyncWriter import AsyncWriter
 
 
 class IsrTaskConfig(pexConfig.Config):
@@ -132,6 +152,14 @@ class IsrTaskConfig(pexConfig.Config):
         doc="If flatScalingType is 'USER' then scale flat by this amount; ignored otherwise",
         default=1.0,
     )
+    useFlatScaleMetadata = pexConfig.Field(
+        dtype=bool,
+        default=False,
+        doc="If flatScalingType is MEAN or MEDIAN, use the scale recorded in the metadata of the flat "
+        "(ISR_FLAT_SCALE_MEAN or ISR_FLAT_SCALE_MEDIAN, as written by a calibration pipeline), if any, "
+        "instead of measuring it? Either way, the scale of a flat read by this task is remembered for "
+        "the rest of the process by the contents of its files, so each flat is measured once"
+    )
     overscanFitType = pexConfig.ChoiceField(
         dtype=str,
         doc="The method for fitting the overscan bias level.",
@@ -181,7 +209,10 @@ class IsrTaskConfig(pexConfig.Config):
     doAssembleIsrExposures = pexConfig.Field(
         dtype=bool,
         default=False,
-        doc="Assemble amp-level calibration exposures into ccd-level exposure?"
+        doc="Assemble amp-level calibration exposures into ccd-level exposure? Assembled calibrations "
+        "are kept by the calibration cache (calibCacheMaxBytes) and the store of memory-mapped "
+        "calibrations (mmapCalibDir), if enabled, keyed by the assembleCcd config, so each is assembled "
+        "once per process or once per node, respectively"
     )
     doAssembleCcd = pexConfig.Field(
         dtype=bool,
@@ -233,6 +264,251 @@ class IsrTaskConfig(pexConfig.Config):
     )
     fallbackFilterName = pexConfig.Field(dtype=str,
                                          doc="Fallback default filter name for calibrations", optional=True)
+    doFusedDetrend = pexConfig.Field(
+        dtype=bool,
+        default=False,
+        doc="Apply bias, linearity, variance, dark and flat corrections in a single pass over each "
+        "amplifier? "
+        "Ignored if brighter-fatter or pre-flat fringe correction is enabled, or if the linearizer does not "
+        "support it"
+    )
+    doSparseDark = pexConfig.Field(
+        dtype=bool,
+        default=False,
+        doc="Correct dark current with a SparseDarkModel (a dark rate per amplifier plus a sparse list of "
+        "hot pixels) made from the dark, instead of the full dark frame? The model is kept in the "
+        "calibration cache and in derivedCalibDir, if enabled, in place of the dark. "
+        "Not compatible with doFusedDetrend"
+    )
+    sparseDarkThreshold = pexConfig.Field(
+        dtype=float,
+        default=5.0,
+        doc="Threshold for the hot pixels of a SparseDarkModel, in units of the robust standard deviation "
+        "of the dark rate of their amplifier"
+    )
+    doSeparableBias = pexConfig.Field(
+        dtype=bool,
+        default=False,
+        doc="Correct bias with a SeparableBiasModel (a row and a column vector per amplifier plus a sparse "
+        "residual) made from the bias, instead of the full bias frame? The model is kept in the "
+        "calibration cache and in derivedCalibDir, if enabled, in place of the bias. "
+        "Not compatible with doFusedDetrend"
+    )
+    separableBiasThreshold = pexConfig.Field(
+        dtype=float,
+        default=5.0,
+        doc="Threshold for the sparse residuals of a SeparableBiasModel, in units of the robust standard "
+        "deviation of the residuals of their amplifier from the row and column model"
+    )
+    doPrepareCalibs = pexConfig.Field(
+        dtype=bool,
+        default=False,
+        doc="Derive products from the bias, dark and flat once per set of calibrations (a dark rate frame, "
+        "the reciprocal of the scaled flat and its square, and merged calibration masks; see "
+        "PreparedCalibs), so that correcting each exposure needs only multiplications and additions? "
+        "Products are reused for as long as the same calibration objects are supplied, so enable "
+        "calibCacheMaxBytes too. Ignored if doFusedDetrend is used, if calibrations are read in strips and "
+        "if only a region is processed. If doLazyCalibs is True the bias, dark and flat are all loaded by "
+        "the first of those corrections"
+    )
+    stripHeight = pexConfig.Field(
+        dtype=int,
+        default=0,
+        doc="If > 0, bound peak memory by working in horizontal strips of this many rows: runDataRef reads "
+        "bias, dark and flat (the latter only if flatScalingType is USER) one strip at a time as they are "
+        "applied, and brighter-fatter correction is done per strip with a halo wide enough for all of "
+        "its iterations (see brighterFatterCorrectionByStrips).  Calibrations are read whole if "
+        "doAssembleIsrExposures is True.  This bounds the memory used by calibrations and work buffers; "
+        "the science exposure is still held in full"
+    )
+    numAmpThreads = pexConfig.Field(
+        dtype=int,
+        default=1,
+        doc="Number of threads used to run per-amplifier stages (saturation and suspect detection, "
+        "overscan correction, variance and fused detrending) in parallel; 1 to run serially. "
+        "These stages run in numpy or in C++ that releases the GIL, except polynomial and spline "
+        "overscan fits, which partly run Python code and so gain less"
+    )
+    stageCacheDir = pexConfig.Field(
+        dtype=str,
+        default="",
+        doc="Directory in which to cache the exposure after each stage listed in stageCacheStages, keyed by "
+        "a digest of the raw pixels, the config fields each stage uses and the calibration products; "
+        "reprocessing then resumes after the last unchanged cached stage. Disabled if empty"
+    )
+    stageCacheStages = pexConfig.ListField(
+        dtype=str,
+        default=["assemble", "brighterFatter", "detrend", "flat"],
+        doc="Stages after which the exposure is cached, if stageCacheDir is set; "
+        "see IsrTask.makeStageList for the stage names"
+    )
+    stageCacheMaxBytes = pexConfig.Field(
+        dtype=int,
+        default=10*1024**3,
+        doc="Maximum total size of the stage cache (bytes); least recently used entries are deleted "
+        "to stay within it. 0 for no limit"
+    )
+    checkpointDir = pexConfig.Field(
+        dtype=str,
+        default="",
+        doc="Directory in which runDataRef checkpoints the exposure after each stage listed in "
+        "checkpointStages, so that a run that is interrupted resumes from the latest valid checkpoint "
+        "for the same data ID, config and calibration products. Checkpoints are deleted when the run "
+        "completes. Disabled if empty"
+    )
+    quickLookBinSize = pexConfig.Field(
+        dtype=int,
+        default=8,
+        doc="Number of pixels per bin along each axis for runQuickLook"
+    )
+    doInstrument = pexConfig.Field(
+        dtype=bool,
+        default=False,
+        doc="Measure the memory used by each stage of run: bytes allocated (as traced by tracemalloc), "
+        "number and size of large pixel buffers created and peak resident set size. The results are "
+        "written to the task metadata as <STAGE>_ALLOC_BYTES, <STAGE>_PEAK_ALLOC_BYTES, <STAGE>_NUM_BUFFERS, "
+        "<STAGE>_BUFFER_BYTES and <STAGE>_MAX_RSS"
+    )
+    checkpointStages = pexConfig.ListField(
+        dtype=str,
+        default=["assemble", "brighterFatter", "fringe"],
+        doc="Stages after which the exposure is checkpointed, if checkpointDir is set; "
+        "see IsrTask.makeStageList for the stage names"
+    )
+    doLazyCalibs = pexConfig.Field(
+        dtype=bool,
+        default=False,
+        doc="Have readIsrData return LazyCalib handles for the bias, dark, flat and fringe frames, "
+        "which run loads only when the first stage that uses each runs and releases as soon as the last "
+        "stage that uses it is complete, rather than holding all of them for the whole of run"
+    )
+    calibCacheMaxBytes = pexConfig.Field(
+        dtype=int,
+        default=0,
+        doc="Maximum total size (bytes) of the in-process cache of calibration products (bias, dark, flat, "
+        "fringe frames, linearizer, defects and brighter-fatter kernel) read whole by readIsrData, which is "
+        "shared by all IsrTasks in the process; least recently used products are evicted to stay within it. "
+        "Cached products are shared between exposures, so must not be modified (each exposure gets a copy "
+        "of a cached fringe frame). 0 to disable"
+    )
+    mmapCalibDir = pexConfig.Field(
+        dtype=str,
+        default="",
+        doc="Directory in which bias, dark, flat and fringe frames are materialized uncompressed the first "
+        "time they are read (see MmapCalibStore); they are then memory-mapped from there, so all processes "
+        "on a node share one copy in the page cache. Disabled if empty"
+    )
+    calibServerAddress = pexConfig.Field(
+        dtype=str,
+        default="",
+        doc="Address of a local CalibServer (\"localhost:port\" or the path of a Unix domain socket; "
+        "see bin/isrCalibServer.py) from which to get the bias, dark, flat, defects, linearizer and "
+        "brighter-fatter kernel, which it keeps in shared memory for all processes on the node. "
+        "Not used if empty"
+    )
+    calibServerAuthKey = pexConfig.Field(
+        dtype=str,
+        default="",
+        doc="Authentication key of the CalibServer at calibServerAddress. If empty, the key is read from "
+        "environment variable IP_ISR_CALIB_SERVER_AUTHKEY or, for a Unix domain socket, from the key file "
+        "the server wrote next to it (see getCalibServerAuthKey)"
+    )
+    calibServerWaitTimeout = pexConfig.Field(
+        dtype=float,
+        default=600.0,
+        doc="Maximum time (sec) to wait for another process to load a calibration product into the "
+        "CalibServer, after which it is read by this process"
+    )
+    calibIndexPath = pexConfig.Field(
+        dtype=str,
+        default="",
+        doc="Path of an index of the available calibrations (see CalibIndex and bin/buildIsrCalibIndex.py), "
+        "loaded when the task is constructed; calibrations of indexed dataset types that it does not list "
+        "are tried once and, if the butler confirms they are missing, remembered, so that later exposures "
+        "read them with fallbackFilterName directly, or report them missing without trying to read them. "
+        "If empty, calibrations found missing by reading them are remembered if doRememberCalibMisses is True"
+    )
+    doRememberCalibMisses = pexConfig.Field(
+        dtype=bool,
+        default=False,
+        doc="Remember, for the life of the process, calibrations of dataset types not in the index that "
+        "could not be read and that the butler reports do not exist, so they are not tried again for "
+        "the same detector, filter and date? Misses are only remembered if the date of the exposure is "
+        "known (see calibDateKeys); use CalibIndex.clearMisses after ingesting new calibrations"
+    )
+    calibIdKeys = pexConfig.ListField(
+        dtype=str,
+        default=["ccd", "ccdnum", "sensor", "raft", "detector"],
+        doc="Data ID keys that identify a detector, by which calibrations found missing are remembered "
+        "if calibIndexPath is empty and doRememberCalibMisses is True"
+    )
+    detectorIdKey = pexConfig.Field(
+        dtype=str,
+        default="ccd",
+        doc="Data ID key whose value identifies the detector in the camera (the butler dataset \"camera\"); "
+        "used to get the detector without reading the raw data when only a region is processed"
+    )
+    calibDateKeys = pexConfig.ListField(
+        dtype=str,
+        default=["dateObs", "taiObs"],
+        doc="Data ID keys, in order of preference, whose value gives the date of an exposure, "
+        "for checking the validity ranges of calibrations; looked up in the registry of the input dataset "
+        "if not in the data ID. If none is found, validity ranges are not checked"
+    )
+    derivedCalibDir = pexConfig.Field(
+        dtype=str,
+        default="",
+        doc="Directory in which products derived from the bias, dark and flat (see doPrepareCalibs) are "
+        "stored uncompressed, so that they survive process restarts (see DerivedCalibStore). Entries are "
+        "keyed by digests of the contents of the calibration files and of the config fields used; "
+        "this also adds the content digests to the keys of the calibration cache, server and "
+        "memory-mapped store. Each calibration file is read once more per process to compute its "
+        "digest. Not used if empty"
+    )
+    derivedCalibMaxBytes = pexConfig.Field(
+        dtype=int,
+        default=0,
+        doc="Maximum total size (bytes) of the entries in derivedCalibDir; least recently used entries "
+        "are deleted to stay within it. 0 for no limit"
+    )
+    prefetchDepth = pexConfig.Field(
+        dtype=int,
+        default=1,
+        doc="Number of exposures whose raw and calibration data runDataRefList reads on background threads "
+        "ahead of the exposure being corrected; 0 to read each exposure only when it is needed"
+    )
+    prefetchMaxBytes = pexConfig.Field(
+        dtype=int,
+        default=4*1024**3,
+        doc="Maximum total size (bytes) of the raw and calibration exposures that runDataRefList holds "
+        "read ahead; prefetching pauses while it is exceeded. At least one exposure is always read ahead "
+        "if prefetchDepth > 0. 0 for no limit"
+    )
+    prefetchThreads = pexConfig.Field(
+        dtype=int,
+        default=1,
+        doc="Number of threads runDataRefList uses to read ahead; each reads one exposure at a time. "
+        "More than 1 requires a butler that can be read from several threads at once"
+    )
+    numAsyncWriters = pexConfig.Field(
+        dtype=int,
+        default=0,
+        doc="Number of background threads (or processes, if asyncWriteUseProcesses) with which "
+        "runDataRefList persists postISRCCD, so that the next exposure is processed while the previous one "
+        "is written; write failures are reported when the list is complete. 0 to write synchronously"
+    )
+    asyncWriteMaxQueued = pexConfig.Field(
+        dtype=int,
+        default=2,
+        doc="Maximum number of postISRCCD writes queued or in progress if numAsyncWriters > 0; "
+        "processing waits for a write to finish when it is reached"
+    )
+    asyncWriteUseProcesses = pexConfig.Field(
+        dtype=bool,
+        default=False,
+        doc="Write postISRCCD in processes rather than threads if numAsyncWriters > 0; useful if writing "
+        "(e.g. compression) does not release the GIL. Exposures and data references are pickled"
+    )
 
 ## \addtogroup LSST_task_documentation
 ## \{
@@ -315,6 +591,13 @@ class IsrTask(pipeBase.CmdLineTask):
     """
     ConfigClass = IsrTaskConfig
     _DefaultName = "isr"
+    _calibCache = None  # CalibCache shared by all IsrTasks in the process; see getCalibCache
+    _calibCacheLock = threading.Lock()
+    _calibIndexes = {}  # CalibIndex shared by all IsrTasks in the process, by path; see getCalibIndex
+    _flatScales = {}  # flat scales measured in this process, by flat content and scaling type; see readFlat
+    _flatKeys = {}  # id of each flat read by readFlat: (weak reference to the flat, content key of its files)
+    calibKeyName = "ISR_CALIB_KEY"  # metadata key of the content key of a calibration; see readSharedCalib
+    maxCalibFileNames = 64  # number of calibration file lookups remembered; see getCalibFileNames
 
     def __init__(self, *args, **kwargs):
         '''!Constructor for IsrTask
@@ -326,38 +609,713 @@ class IsrTask(pipeBase.CmdLineTask):
         pipeBase.Task.__init__(self, *args, **kwargs)
         self.makeSubtask("assembleCcd")
         self.makeSubtask("fringe")
+        self._ampPool = None
+        self._camera = None
+        self._planCache = {}
+        self._stageCache = None
+        self._binnedCalibs = {}
+        self._preparedCalibs = None
+        self._derivedCalibStore = None
+        self._mmapCalibStore = None
+        self._calibClient = None
+        # keys of CalibServer products acquired for each data ID, until releaseServedCalibs
+        self._servedCalibKeys = {}
+        self._servedCalibLock = threading.Lock()
+        self._calibDate = None
+        # files of calibration products, by data ID, dataset type and fallback filter; see getCalibFileNames
+        self._calibFileNames = OrderedDict()
+        self._calibFileNamesLock = threading.Lock()
+        self._fuseDetrendReasons = set()  # reasons detrending could not be fused, as logged by canFuseDetrend
+        self.getCalibIndex()
+
+    def forEachAmp(self, func, amps):
+        """!Call a function for each amplifier, using a pool of config.numAmpThreads threads if > 1
+
+        The function must only modify pixels belonging to its amplifier, so that
+        amplifiers may safely be processed concurrently.
+
+        \param[in] func -- function to call; takes one item of amps as its only argument
+        \param[in] amps -- amplifiers (e.g. an lsst.afw.cameraGeom.Detector), or other items to process
+        \return a list of the values returned by func, in the order of amps
+
+        The pool is created when first needed and kept until close is called.
+        """
+        amps = list(amps)
+        if self.config.numAmpThreads <= 1 or len(amps) <= 1:
+            return [func(amp) for amp in amps]
+        if self._ampPool is None:
+            self._ampPool = ThreadPool(self.config.numAmpThreads)
+        activeInstrumentation = getActiveInstrumentation()
+        if activeInstrumentation:
+            # the pool threads do the work of the stage being measured by this thread
+            def measuredFunc(amp):
+                with useInstrumentation(activeInstrumentation):
+                    return func(amp)
+            return self._ampPool.map(measuredFunc, amps)
+        return self._ampPool.map(func, amps)
+
+    def close(self):
+        """!Stop the threads of the pool used by forEachAmp, if any
+
+        The task may still be used afterwards; a new pool is created if needed.
+        A task may also be used as a context manager, which calls close on exit.
+        """
+        ampPool = self._ampPool
+        if ampPool is not None:
+            self._ampPool = None
+            ampPool.close()
+            ampPool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def makeStageList(self, ccd, plan, bias=None, linearizer=None, dark=None, flat=None, defects=None,
+                      fringes=None, bfKernel=None, ampIndexList=None, flatScale=None):
+        """!Make the list of enabled processing stages used by run
+
+        Each stage is a pipeBase.Struct with fields:
+        - name: name of stage, one of "assemble" (conversion to float, saturation and suspect detection,
+            overscan correction and assembly), "bias", "linearize", "variance", "brighterFatter", "dark",
+            "fringe", "flat", "detrend" (replaces bias through flat if they are fused; see fusedDetrend),
+            "defect", "saturationInterpolation" and "nan"
+        - func: function that takes the exposure, processes it and returns the processed exposure
+        - configNames: names of the config fields that affect the output of the stage
+        - calibs: calibration products that affect the output of the stage
+
+        \param[in] ccd -- detector information, or a list of FakeAmp
+        \param[in] plan -- execution plan for the detector (an IsrPlan); see getPlan
+        \param[in] bias, linearizer, dark, flat, defects, fringes, bfKernel -- calibration products,
+                                      as for run
+        \param[in] ampIndexList -- indices of the amplifiers to process, if only a region of the detector
+                                   is processed (see makeRoi), else None
+        \param[in] flatScale -- scale by which the flat is divided; if None, computed from flat
+        \return a list of stages, in the order in which they are to be applied
+        """
+        stageList = []
+
+        def addStage(name, func, configNames=(), calibs=()):
+            stageList.append(pipeBase.Struct(name=name, func=func, configNames=list(configNames),
+                                             calibs=list(calibs)))
+
+        def inPlace(func):
+            def stageFunc(exposure):
+                func(exposure)
+                return exposure
+            return stageFunc
+
+        addStage("assemble",
+                 lambda exposure: self.processRawAmpsAndAssemble(self.convertIntToFloat(exposure), plan,
+                                                                 ampIndexList=ampIndexList),
+                 configNames=("gain", "readNoise", "saturation", "saturatedMaskName", "suspectMaskName",
+                              "overscanFitType", "overscanOrder", "overscanRej", "doAssembleCcd",
+                              "assembleCcd"))
+
+        def subtractFringes(exposure):
+            self.fringe.run(exposure, **self.resolveCalib(fringes).getDict())
+
+        varianceConfigNames = ("gain", "readNoise")
+        flatConfigNames = ("flatScalingType", "flatUserScale", "useFlatScaleMetadata")
+        detrendConfigNames = ("doFusedDetrend", "doBias", "doDark", "doFlat")
+        if self.config.doFusedDetrend and self.canFuseDetrend(ccd, linearizer):
+            detrendCalibs = [bias if self.config.doBias else None,
+                             linearizer if plan.doLinearize else None,
+                             dark if self.config.doDark else None,
+                             flat if self.config.doFlat else None]
+            addStage("detrend",
+                     inPlace(lambda exposure: self.fusedDetrend(exposure, ccd,
+                                                                *[self.resolveCalib(calib)
+                                                                  for calib in detrendCalibs],
+                                                                plan=plan, flatScale=flatScale)),
+                     configNames=varianceConfigNames + flatConfigNames + detrendConfigNames,
+                     calibs=detrendCalibs)
+        else:
+            prepared = []  # PreparedCalibs, or None if not used; made by the first correction that uses it
+            preparedCalibList = [calib if doCalib else None for doCalib, calib in
+                                 ((self.config.doBias and not self.config.doSeparableBias, bias),
+                                  (self.config.doDark and not self.config.doSparseDark, dark),
+                                  (self.config.doFlat, flat))]
+            # the masks may be merged if no stage between the corrections uses the mask plane
+            mergeMasks = not self.config.doBrighterFatter and \
+                not (self.config.doFringe and not self.config.fringeAfterFlat)
+            # fields that decide whether and how the corrections use the PreparedCalibs
+            correctConfigNames = ("doPrepareCalibs", "stripHeight", "doBias", "doSeparableBias", "doDark",
+                                  "doSparseDark", "doFlat", "doBrighterFatter", "doFringe", "fringeAfterFlat")
+
+            def correct(calib, correction, preparedCorrection):
+                def stageFunc(exposure):
+                    if self.config.doPrepareCalibs and ampIndexList is None and not prepared:
+                        prepared.append(self.getPreparedCalibs(
+                            *[self.resolveCalib(item) for item in preparedCalibList],
+                            flatScale=flatScale, mergeMasks=mergeMasks))
+                    if prepared and prepared[0] is not None:
+                        preparedCorrection(prepared[0], exposure)
+                    else:
+                        self.applyCalib(exposure, self.resolveCalib(calib), correction)
+                    return exposure
+                return stageFunc
+
+            if self.config.doBias and self.config.doSeparableBias:
+                addStage("bias",
+                         inPlace(lambda exposure: self.biasCorrection(exposure, self.resolveCalib(bias))),
+                         configNames=("doSeparableBias", "separableBiasThreshold"), calibs=[bias])
+            elif self.config.doBias:
+                addStage("bias",
+                         correct(bias, self.biasCorrection,
+                                 lambda preparedCalibs, exposure: preparedCalibs.correctBias(
+                                     exposure.getMaskedImage())),
+                         configNames=correctConfigNames, calibs=[bias])
+
+            if plan.doLinearize and ampIndexList is not None:
+                addStage("linearize",
+                         inPlace(lambda exposure: self.linearizeRegion(exposure, ccd, linearizer, plan)),
+                         calibs=[linearizer])
+            elif plan.doLinearize:
+                addStage("linearize",
+                         inPlace(lambda exposure: linearizer(image=exposure.getMaskedImage().getImage(),
+                                                             detector=ccd, log=self.log)),
+                         calibs=[linearizer])
+
+            def updateVariance(exposure):
+                def updateAmpVariance(indexAmp):
+                    amp = indexAmp[1]
+                    ampExposure = exposure.Factory(exposure, amp.getBBox())
+                    self.updateVariance(ampExposure, amp)
+                self.forEachAmp(updateAmpVariance, plan.getContainedAmps(exposure.getBBox()))
+            addStage("variance", inPlace(updateVariance), configNames=varianceConfigNames)
+
+            if self.config.doBrighterFatter:
+                if self.config.stripHeight > 0:
+                    bfCorrection = self.brighterFatterCorrectionByStrips
+                else:
+                    bfCorrection = self.brighterFatterCorrection
+                addStage("brighterFatter",
+                         inPlace(lambda exposure: bfCorrection(exposure, bfKernel,
+                                                               self.config.brighterFatterMaxIter,
+                                                               self.config.brighterFatterThreshold,
+                                                               self.config.brighterFatterApplyGain,
+                                                               )),
+                         configNames=("brighterFatterMaxIter", "brighterFatterThreshold",
+                                      "brighterFatterApplyGain", "stripHeight"),
+                         calibs=[bfKernel])
+
+            if self.config.doDark and self.config.doSparseDark:
+                addStage("dark",
+                         inPlace(lambda exposure: self.darkCorrection(exposure, self.resolveCalib(dark))),
+                         configNames=("doSparseDark", "sparseDarkThreshold"), calibs=[dark])
+            elif self.config.doDark:
+                addStage("dark",
+                         correct(dark, self.darkCorrection,
+                                 lambda preparedCalibs, exposure: preparedCalibs.correctDark(
+                                     exposure.getMaskedImage(),
+                                     self.getDarkTimes(exposure, self.resolveCalib(dark))[0])),
+                         configNames=correctConfigNames, calibs=[dark])
+
+            if self.config.doFringe and not self.config.fringeAfterFlat:
+                addStage("fringe", inPlace(subtractFringes),
+                         configNames=("fringe",), calibs=[fringes])
+
+            if self.config.doFlat:
+                addStage("flat",
+                         correct(flat,
+                                 lambda exp, flatExp: self.flatCorrection(exp, flatExp, flatScale=flatScale),
+                                 lambda preparedCalibs, exposure: preparedCalibs.correctFlat(
+                                     exposure.getMaskedImage())),
+                         configNames=flatConfigNames + correctConfigNames, calibs=[flat, flatScale])
+
+        if self.config.doDefect:
+            defectList = self.convertDefects(defects)
+            addStage("defect",
+                     inPlace(lambda exposure: self.maskAndInterpDefectList(exposure, defectList,
+                                                                           psf=plan.psf)),
+                     configNames=("fwhm",), calibs=[defects])
+
+        if self.config.doSaturationInterpolation:
+            addStage("saturationInterpolation",
+                     inPlace(lambda exposure: self.saturationInterpolation(exposure, psf=plan.psf)),
+                     configNames=("fwhm", "growSaturationFootprintSize", "saturatedMaskName"))
+
+        addStage("nan", inPlace(lambda exposure: self.maskAndInterpNan(exposure, psf=plan.psf)),
+                 configNames=("fwhm",))
+
+        if self.config.doFringe and self.config.fringeAfterFlat:
+            addStage("fringe", inPlace(subtractFringes),
+                     configNames=("fringe",), calibs=[fringes])
+
+        return stageList
+
+    def getStageCache(self):
+        """!Get the stage cache, or None if config.stageCacheDir is empty
+        """
+        if not self.config.stageCacheDir:
+            return None
+        if self._stageCache is None or self._stageCache.directory != self.config.stageCacheDir:
+            self._stageCache = StageCache(self.config.stageCacheDir, self.config.stageCacheMaxBytes)
+        self._stageCache.maxBytes = self.config.stageCacheMaxBytes
+        return self._stageCache
+
+    def getCalibCache(self):
+        """!Get the cache of calibration products shared by IsrTasks in this process,
+        or None if config.calibCacheMaxBytes is 0
+
+        The budget of the cache is set from config.calibCacheMaxBytes.
+        """
+        if self.config.calibCacheMaxBytes <= 0:
+            return None
+        with IsrTask._calibCacheLock:
+            if IsrTask._calibCache is None:
+                IsrTask._calibCache = CalibCache(self.config.calibCacheMaxBytes)
+            IsrTask._calibCache.maxBytes = self.config.calibCacheMaxBytes
+            return IsrTask._calibCache
+
+    def getCalibIndex(self):
+        """!Get the index of available calibrations shared by IsrTasks in this process
+
+        The index is read from config.calibIndexPath the first time it is needed; if that is empty,
+        an empty index is used, which only remembers the calibrations found missing
+        (see recordCalibMiss).
+        """
+        path = self.config.calibIndexPath
+        with IsrTask._calibCacheLock:
+            calibIndex = IsrTask._calibIndexes.get(path)
+            if calibIndex is None:
+                if path:
+                    calibIndex = CalibIndex.read(path)
+                    self.log.info("Read index of calibrations from %s" % (path,))
+                else:
+                    calibIndex = CalibIndex(idKeys=self.config.calibIdKeys)
+                IsrTask._calibIndexes[path] = calibIndex
+            return calibIndex
+
+    def getCalibDate(self, dataRef):
+        """!Get the date of an exposure, for checking the validity ranges of calibrations
+
+        \param[in] dataRef -- data reference for the science exposure
+        \return the value of the first of config.calibDateKeys in the data ID or, failing that,
+            in the registry; None if not found
+        """
+        dataId = dict(dataRef.dataId)
+        if self._calibDate is not None and self._calibDate[0] == dataId:
+            return self._calibDate[1]
+        date = None
+        for key in self.config.calibDateKeys:
+            if key in dataId:
+                date = dataId[key]
+                break
+        if date is None and self.config.calibDateKeys:
+            for key in self.config.calibDateKeys:
+                try:
+                    values = dataRef.getButler().queryMetadata(self.config.datasetType, [key], dataId)
+                except Exception:
+                    continue
+                if len(values) == 1:
+                    date = values[0]
+                    break
+        self._calibDate = (dataId, date)
+        return date
+
+    def getCalibFileNames(self, dataRef, datasetType):
+        """!Get the files the butler resolves a calibration product to
+
+        If the files cannot be determined for the filter of the exposure, those for
+        config.fallbackFilterName (if set) are used, as readIsrExposure would read them;
+        fringe frames are never read with the fallback filter (see readFringeFrame).
+        The result is remembered for the most recent data references, so each dataset is
+        looked up once per exposure.
+
+        \param[in] dataRef -- data reference for the science exposure
+        \param[in] datasetType -- type of calibration dataset (e.g. 'bias', 'defects')
+        \return a tuple of file names (from dataset "<datasetType>_filename"),
+            or None if the files cannot be determined
+        """
+        fallbackFilterName = self.config.fallbackFilterName if datasetType != "fringe" else None
+        key = (self.getDataIdKey(dataRef.dataId), datasetType, fallbackFilterName)
+        with self._calibFileNamesLock:
+            if key in self._calibFileNames:
+                return self._calibFileNames[key]
+        try:
+            fileNames = tuple(dataRef.get(datasetType + "_filename"))
+        except Exception:
+            fileNames = None
+        if fileNames is None and fallbackFilterName:
+            try:
+                fileNames = tuple(dataRef.get(datasetType + "_filename", filter=fallbackFilterName))
+            except Exception:
+                pass
+        with self._calibFileNamesLock:
+            self._calibFileNames[key] = fileNames
+            while len(self._calibFileNames) > self.maxCalibFileNames:
+                self._calibFileNames.popitem(last=False)
+        return fileNames
+
+    def getCalibFileKey(self, dataRef, datasetType, withContent=False):
+        """!Get a key identifying a calibration product by the files the butler resolves it to
+
+        \param[in] dataRef -- data reference for the science exposure
+        \param[in] datasetType -- type of calibration dataset (e.g. 'bias', 'defects')
+        \param[in] withContent -- include a digest of the contents of the files even if
+            config.derivedCalibDir is not set?
+        \return a tuple of dataset type, file names (see getCalibFileNames),
+            assembly key (see getAssemblyKey) and a digest of the contents of the files if
+            config.derivedCalibDir is set or withContent is True (else None),
+            or None if the files cannot be determined
+        """
+        fileNames = self.getCalibFileNames(dataRef, datasetType)
+        if fileNames is None:
+            return None
+        contentKey = DerivedCalibStore.hashFiles(fileNames) \
+            if withContent or self.getDerivedCalibStore() is not None else None
+        return (datasetType, fileNames, self.getAssemblyKey(), contentKey)
+
+    def getCalibHandleKey(self, dataRef, datasetType):
+        """!Get the key that identifies the calibration product of a CalibRegionReader or LazyCalib
+
+        The key identifies the product in the stage cache and checkpoints without reading it
+        (see StageCache.digestObject), so it includes a digest of the contents of the files if
+        either is enabled, in case a calibration is replaced by a file of the same name.
+
+        \param[in] dataRef -- data reference for the science exposure
+        \param[in] datasetType -- type of calibration dataset (e.g. 'bias', 'fringe')
+        \return key, as for getCalibFileKey, or None if the files cannot be determined
+        """
+        return self.getCalibFileKey(dataRef, datasetType,
+                                    withContent=bool(self.config.stageCacheDir or self.config.checkpointDir))
+
+    def getAssemblyKey(self):
+        """!Get a key identifying how calibration exposures are assembled
+
+        \return None if config.doAssembleIsrExposures is False, else a digest of the assembleCcd config
+        """
+        if not self.config.doAssembleIsrExposures:
+            return None
+        return hashlib.md5(repr(self.config.assembleCcd.toDict()).encode()).hexdigest()
+
+    def getDerivedCalibStore(self):
+        """!Get the store of products derived from calibrations, or None if config.derivedCalibDir is empty
+        """
+        if not self.config.derivedCalibDir:
+            return None
+        if self._derivedCalibStore is None or \
+                self._derivedCalibStore.directory != self.config.derivedCalibDir:
+            self._derivedCalibStore = DerivedCalibStore(self.config.derivedCalibDir)
+        self._derivedCalibStore.maxBytes = self.config.derivedCalibMaxBytes
+        return self._derivedCalibStore
+
+    def getMmapCalibStore(self):
+        """!Get the store of memory-mapped calibration exposures, or None if config.mmapCalibDir is empty
+        """
+        if not self.config.mmapCalibDir:
+            return None
+        if self._mmapCalibStore is None or self._mmapCalibStore.directory != self.config.mmapCalibDir:
+            self._mmapCalibStore = MmapCalibStore(self.config.mmapCalibDir)
+        return self._mmapCalibStore
+
+    def readMappedCalib(self, dataRef, datasetType, readFunc):
+        """!Read a calibration exposure through the store of memory-mapped calibrations, if enabled
+
+        If the exposure is in the store it is memory-mapped from there. Otherwise it is read with readFunc,
+        materialized in the store and then memory-mapped, so that this process shares it too.
+        Exposures whose files cannot be determined (see getCalibFileKey) or that cannot be stored
+        are returned as read.
+
+        \param[in] dataRef -- data reference for the science exposure
+        \param[in] datasetType -- type of calibration dataset (e.g. 'bias', 'fringe')
+        \param[in] readFunc -- function that takes no arguments and reads the exposure
+        \return the calibration exposure
+        """
+        mmapCalibStore = self.getMmapCalibStore()
+        fileKey = self.getCalibFileKey(dataRef, datasetType) if mmapCalibStore is not None else None
+        if fileKey is None:
+            return readFunc()
+        key = mmapCalibStore.makeKey(*fileKey)
+        exposure = mmapCalibStore.read(key)
+        if exposure is None:
+            exposure = readFunc()
+            if mmapCalibStore.write(key, exposure):
+                self.log.info("Materialized %s for %s in %s" % (datasetType, dataRef.dataId,
+                                                                 mmapCalibStore.directory))
+                exposure = mmapCalibStore.read(key)
+        return exposure
+
+    def getCalibClient(self):
+        """!Get the client of the CalibServer at config.calibServerAddress, connecting if necessary,
+        or None if config.calibServerAddress is empty
+        """
+        if not self.config.calibServerAddress:
+            return None
+        if self._calibClient is None:
+            self._calibClient = CalibClient(self.config.calibServerAddress, self.config.calibServerAuthKey,
+                                            waitTimeout=self.config.calibServerWaitTimeout, log=self.log)
+        return self._calibClient
+
+    def readServedCalib(self, dataRef, datasetType, readFunc):
+        """!Get a calibration product from the CalibServer, if configured
+
+        The product is acquired from the server, which asks this task to read (with readFunc) and
+        publish it if no process has done so yet. The reference is held until releaseServedCalibs
+        is called for the data reference.
+        Products whose files cannot be determined (see getCalibFileKey) are read with readFunc.
+
+        \param[in] dataRef -- data reference for the science exposure
+        \param[in] datasetType -- type of calibration dataset (e.g. 'bias', 'defects')
+        \param[in] readFunc -- function that takes no arguments and reads the product
+        \return the calibration product
+        """
+        calibClient = self.getCalibClient()
+        fileKey = self.getCalibFileKey(dataRef, datasetType) if calibClient is not None else None
+        if fileKey is None:
+            return readFunc()
+        key = calibClient.store.makeKey(*fileKey)
+        product = calibClient.get(key, readFunc)
+        with self._servedCalibLock:
+            self._servedCalibKeys.setdefault(self.getDataIdKey(dataRef.dataId), []).append(key)
+        return product
+
+    def releaseServedCalibs(self, dataRef):
+        """!Release this task's references to the products of the CalibServer acquired for a data reference
+
+        References acquired for other data references (e.g. by the prefetch thread of runDataRefList)
+        are kept.
+
+        \param[in] dataRef -- data reference for the science exposure
+        """
+        with self._servedCalibLock:
+            keys = self._servedCalibKeys.pop(self.getDataIdKey(dataRef.dataId), [])
+        for key in keys:
+            self._calibClient.release(key)
+
+    @staticmethod
+    def getDataIdKey(dataId):
+        """!Get a hashable key for a data ID
+
+        \param[in] dataId -- data ID (a dict)
+        \return a tuple of the sorted (key, value) pairs of the data ID
+        """
+        return tuple(sorted(dataId.items()))
+
+    def readSharedCalib(self, dataRef, datasetType, readFunc):
+        """!Read a calibration product through the calibration cache and the CalibServer, if enabled
+
+        \param[in] dataRef -- data reference for the science exposure
+        \param[in] datasetType -- type of calibration dataset (e.g. 'bias', 'defects')
+        \param[in] readFunc -- function that takes no arguments and reads the product
+        \return the calibration product
+        """
+        product = self.readCachedCalib(dataRef, datasetType,
+                                       lambda: self.readServedCalib(dataRef, datasetType, readFunc))
+        derivedCalibStore = self.getDerivedCalibStore()
+        if derivedCalibStore is not None and hasattr(product, "getMetadata"):
+            # identify the exposure by content, for the keys of products derived from it
+            fileKey = self.getCalibFileKey(dataRef, datasetType)
+            if fileKey is not None and fileKey[3] is not None:
+                product.getMetadata().set(self.calibKeyName, derivedCalibStore.makeKey(*fileKey))
+        return product
+
+    def readCachedCalib(self, dataRef, datasetType, readFunc):
+        """!Read a calibration product through the calibration cache, if enabled
+
+        Products are keyed by dataset type and the files the butler resolves them to
+        (from dataset "<datasetType>_filename"), so a product is only reused for exposures
+        that would read the same calibration. If the files cannot be determined the product is
+        read without caching.
+
+        \param[in] dataRef -- data reference for the science exposure
+        \param[in] datasetType -- type of calibration dataset (e.g. 'bias', 'defects')
+        \param[in] readFunc -- function that takes no arguments and reads the product
+        \return the calibration product
+        """
+        calibCache = self.getCalibCache()
+        key = self.getCalibFileKey(dataRef, datasetType) if calibCache is not None else None
+        if key is None:
+            return readFunc()
+        return calibCache.get(key, readFunc)
+
+    def getPreparedCalibs(self, bias=None, dark=None, flat=None, flatScale=None, mergeMasks=False):
+        """!Get the products derived from a bias, dark and flat, making them if these are not
+        the calibration objects of the previous call
+
+        If config.derivedCalibDir is set and the calibrations were read by readSharedCalib (which records
+        their content keys in their metadata), the products are read from the DerivedCalibStore if present
+        and written there if not.
+
+        \param[in] bias, dark, flat -- calibration exposures, or None
+        \param[in] flatScale -- scale by which the flat is divided; if None, computed from flat
+        \param[in] mergeMasks -- merge the calibration masks? See PreparedCalibs
+        \return a PreparedCalibs, or None if any calibration is a CalibRegionReader
+        """
+        calibs = (bias, dark, flat)
+        if any(isinstance(calib, CalibRegionReader) for calib in calibs):
+            return None
+        key = (flatScale, mergeMasks)
+        held = self._preparedCalibs
+        if held is not None and held[1] == key and all(a is b for a, b in zip(held[0], calibs)):
+            return held[2]
+        # drop the old products before making new ones
+        self._preparedCalibs = None
+        derivedCalibStore = self.getDerivedCalibStore()
+        derivedKey = None
+        calibKeys = [calib.getMetadata().get(self.calibKeyName)
+                     if calib is not None and calib.getMetadata().exists(self.calibKeyName) else None
+                     for calib in calibs]
+        if derivedCalibStore is not None and \
+                all(calibKey is not None for calib, calibKey in zip(calibs, calibKeys) if calib is not None):
+            derivedKey = derivedCalibStore.makeKey(
+                "PreparedCalibs", calibKeys, mergeMasks, flatScale if flatScale is not None else
+                (self.config.flatScalingType, self.config.flatUserScale))
+            stored = derivedCalibStore.read(derivedKey)
+            if stored is not None:
+                preparedCalibs = PreparedCalibs.fromArrays(stored[0])
+                self._preparedCalibs = (calibs, key, preparedCalibs)
+                return preparedCalibs
+        darkTime = 1.0
+        if dark is not None:
+            darkTime = dark.getInfo().getVisitInfo().getDarkTime()
+            if math.isnan(darkTime):
+                raise RuntimeError("Dark calib darktime is NAN")
+        if flat is not None and flatScale is None:
+            flatScale = self.getFlatScale(flat)
+        preparedCalibs = PreparedCalibs(bias, dark, flat, darkTime=darkTime,
+                                        flatScale=flatScale if flatScale is not None else 1.0,
+                                        mergeMasks=mergeMasks)
+        if derivedKey is not None:
+            derivedCalibStore.write(derivedKey, preparedCalibs.getArrays())
+        self._preparedCalibs = (calibs, key, preparedCalibs)
+        return preparedCalibs
+
+    def readFringeFrame(self, dataRef, datasetType="fringe"):
+        """!Read a fringe frame through the calibration cache and the store of memory-mapped
+        calibrations, if enabled
+
+        Fringe frames are modified when they are used, so a frame from the calibration cache is copied.
+        Unlike other calibrations, a fringe frame is never read with config.fallbackFilterName
+        (as for FringeTask.readFringes), since that of another filter would be subtracted.
+
+        \param[in] dataRef -- data reference for the science exposure
+        \param[in] datasetType -- type of fringe dataset
+        \return fringe exposure, assembled if config.doAssembleIsrExposures is True
+        """
+        def readFunc():
+            return self.readMappedCalib(dataRef, datasetType,
+                                        lambda: self.readIsrExposure(dataRef, datasetType,
+                                                                     useFallback=False))
+        if self.getCalibCache() is None:
+            return readFunc()
+        fringe = self.readCachedCalib(dataRef, datasetType, readFunc)
+        return fringe.Factory(fringe, True)
+
+    def getCheckpointStore(self):
+        """!Get the store of checkpoints, or None if config.checkpointDir is empty
+
+        Checkpoints are kept in a StageCache without a size limit; run deletes them when it completes.
+        """
+        if not self.config.checkpointDir:
+            return None
+        return StageCache(self.config.checkpointDir, maxBytes=0)
+
+    @staticmethod
+    def makeCheckpointId(dataId):
+        """!Make a checkpoint identifier for a data ID; see run
+
+        \param[in] dataId -- data ID (a dict)
+        \return checkpoint identifier (str)
+        """
+        return hashlib.md5(repr(sorted(dataId.items())).encode()).hexdigest()
+
+    def getPlan(self, ccdExposure):
+        """!Get the execution plan for the detector of an exposure
+
+        Plans are cached by detector name, ID, serial number and bounding box (as serial numbers of
+        simulated and test detectors may be empty or repeated) and by the config fields the plan
+        depends on, read on every call as the config may change between calls. So the per-detector
+        information is only derived for the first exposure of each detector, and there is at most one
+        plan per detector and configuration.
 
-    def readIsrData(self, dataRef, rawExposure):
+        \param[in] ccdExposure -- exposure whose detector is to be processed
+        \return an IsrPlan; if the exposure has no detector, an uncached plan with a single FakeAmp
+        """
+        ccd = ccdExposure.getDetector()
+        if not ccd:
+            assert not self.config.doAssembleCcd, "You need a Detector to run assembleCcd"
+            return IsrPlan(self, [FakeAmp(ccdExposure, self.config)])
+        bbox = ccd.getBBox()
+        key = (ccd.getName(), ccd.getId(), ccd.getSerial(),
+               (bbox.getMinX(), bbox.getMinY(), bbox.getMaxX(), bbox.getMaxY()),
+               self.config.doLinearize, self.config.fwhm)
+        plan = self._planCache.get(key)
+        if plan is None:
+            plan = IsrPlan(self, ccd)
+            self._planCache[key] = plan
+        return plan
+
+    def readIsrData(self, dataRef, rawExposure, bbox=None, bfKernel=None):
         """!Retrieve necessary frames for instrument signature removal
         \param[in] dataRef -- a daf.persistence.butlerSubset.ButlerDataRef
                               of the detector data to be processed
         \param[in] rawExposure -- a reference raw exposure that will later be
                                   corrected with the retrieved calibration data;
                                   should not be modified in this method.
+        \param[in] bbox -- if not None, read only this region (in PARENT coordinates) of the bias,
+                           dark and flat (the latter only if flatScalingType is USER); see makeRoi
+        \param[in] bfKernel -- brighter-fatter kernel, if it has already been read, or None to read it
+                               (if config.doBrighterFatter is True)
         \return a pipeBase.Struct with fields containing kwargs expected by run()
-         - bias: exposure of bias frame
-         - dark: exposure of dark frame
+         - bias: exposure of bias frame, or a SeparableBiasModel if config.doSeparableBias
+         - dark: exposure of dark frame, or a SparseDarkModel if config.doSparseDark
          - flat: exposure of flat field
          - defects: list of detects
          - fringeStruct: a pipeBase.Struct with field fringes containing
                          exposure of fringe frame or list of fringe exposure
+        If config.doLazyCalibs is True then bias, dark, flat and fringes are LazyCalib handles
+        (unless they are read in strips, as CalibRegionReaders).
         """
         ccd = rawExposure.getDetector()
 
-        biasExposure = self.getIsrExposure(dataRef, "bias") if self.config.doBias else None
+        def readCalib(datasetType, allowStrips=True):
+            if datasetType == "bias" and self.config.doSeparableBias:
+                def loadFunc():
+                    return self.readSeparableBias(dataRef, ccd)
+            elif datasetType == "dark" and self.config.doSparseDark:
+                def loadFunc():
+                    return self.readSparseDark(dataRef, ccd)
+            elif datasetType == "flat":
+                def loadFunc():
+                    return self.readFlat(dataRef, allowStrips=allowStrips, bbox=bbox)
+            else:
+                def loadFunc():
+                    return self.readIsrCalib(dataRef, datasetType, allowStrips=allowStrips, bbox=bbox)
+            if not self.config.doLazyCalibs or \
+                    (allowStrips and bbox is None and self.config.stripHeight > 0 and
+                     not self.config.doAssembleIsrExposures):
+                return loadFunc()
+            return LazyCalib(loadFunc, datasetType, dataRef.dataId,
+                             calibKey=self.getCalibHandleKey(dataRef, datasetType))
+
+        biasExposure = readCalib("bias") if self.config.doBias else None
         # immediate=True required for functors and linearizers are functors; see ticket DM-6515
-        linearizer = dataRef.get("linearizer", immediate=True) if self.doLinearize(ccd) else None
-        darkExposure = self.getIsrExposure(dataRef, "dark") if self.config.doDark else None
-        flatExposure = self.getIsrExposure(dataRef, "flat") if self.config.doFlat else None
-        brighterFatterKernel = dataRef.get("brighterFatterKernel") if self.config.doBrighterFatter else None
-        defectList = dataRef.get("defects") if self.config.doDefect else None
+        linearizer = self.readSharedCalib(dataRef, "linearizer",
+                                          lambda: dataRef.get("linearizer", immediate=True)) \
+            if self.doLinearize(ccd) else None
+        darkExposure = readCalib("dark") if self.config.doDark else None
+        flatExposure = readCalib("flat", allowStrips=self.config.flatScalingType == "USER") \
+            if self.config.doFlat else None
+        brighterFatterKernel = bfKernel
+        if brighterFatterKernel is None and self.config.doBrighterFatter:
+            brighterFatterKernel = self.readBrighterFatterKernel(dataRef)
+        defectList = self.readSharedCalib(dataRef, "defects", lambda: dataRef.get("defects")) \
+            if self.config.doDefect else None
 
         if self.config.doFringe and self.fringe.checkFilter(rawExposure):
-            fringeStruct = self.fringe.readFringes(dataRef, assembler=self.assembleCcd
-                                                   if self.config.doAssembleIsrExposures else None)
+            fringeStruct = self.readFringeData(dataRef)
         else:
             fringeStruct = pipeBase.Struct(fringes=None)
 
+        calibCache = self.getCalibCache()
+        if calibCache is not None:
+            calibCache.writeMetadata(self.metadata)
+        self.getCalibIndex().writeMetadata(self.metadata)
+
         # Struct should include only kwargs to run()
         return pipeBase.Struct(bias=biasExposure,
                                linearizer=linearizer,
@@ -368,9 +1326,58 @@ class IsrTask(pipeBase.CmdLineTask):
                                bfKernel=brighterFatterKernel
                                )
 
+    def readBrighterFatterKernel(self, dataRef):
+        """!Read the brighter-fatter kernel for a data reference
+
+        \param[in] dataRef -- a daf.persistence.butlerSubset.ButlerDataRef
+                              of the detector data to be processed
+        \return the brighter-fatter kernel
+        """
+        return self.readSharedCalib(dataRef, "brighterFatterKernel",
+                                    lambda: dataRef.get("brighterFatterKernel"))
+
+    def getDetector(self, dataRef):
+        """!Get the detector of a data reference from the camera, without reading the raw data
+
+        The camera is read once and kept for the life of the task.
+
+        \param[in] dataRef -- a daf.persistence.butlerSubset.ButlerDataRef
+                              of the detector data to be processed
+        \return the detector (an lsst.afw.cameraGeom.Detector)
+        """
+        detectorId = dataRef.dataId.get(self.config.detectorIdKey)
+        if detectorId is None:
+            raise RuntimeError("Cannot find the detector for %s: no %r in the data ID" %
+                               (dataRef.dataId, self.config.detectorIdKey))
+        if self._camera is None:
+            self._camera = dataRef.getButler().get("camera", immediate=True)
+        return self._camera[detectorId]
+
+    def readFringeData(self, dataRef):
+        """!Read the fringe frames and random number seed for a data reference
+
+        FringeTask.run modifies the fringe frames and the seed depends on the exposure,
+        so the result must not be used for more than one data reference.
+
+        \param[in] dataRef -- a daf.persistence.butlerSubset.ButlerDataRef
+                              of the detector data to be processed
+        \return a pipeBase.Struct as returned by FringeTask.readFringes,
+            or a LazyCalib handle for it if config.doLazyCalibs is True
+        """
+        def readFringes():
+            if self.getMmapCalibStore() is None and self.getCalibCache() is None:
+                return self.fringe.readFringes(dataRef, assembler=self.assembleCcd
+                                               if self.config.doAssembleIsrExposures else None)
+            return self.fringe.readFringes(dataRef, reader=lambda datasetType: self.readFringeFrame(
+                dataRef, datasetType))
+        if self.config.doLazyCalibs:
+            return LazyCalib(readFringes, "fringe", dataRef.dataId,
+                             calibKey=self.getCalibHandleKey(dataRef, "fringe"))
+        return readFringes()
+
     @pipeBase.timeMethod
     def run(self, ccdExposure, bias=None, linearizer=None, dark=None, flat=None, defects=None,
-            fringes=None, bfKernel=None):
+            fringes=None, bfKernel=None, checkpointId=None, bbox=None):
         """!Perform instrument signature removal on an exposure
 
         Steps include:
@@ -379,14 +1386,27 @@ class IsrTask(pipeBase.CmdLineTask):
         - Interpolate over defects, saturated pixels and all NaNs
 
         \param[in] ccdExposure  -- lsst.afw.image.exposure of detector data
-        \param[in] bias -- exposure of bias frame
+        \param[in] bias -- exposure of bias frame, a CalibRegionReader, a SeparableBiasModel or a LazyCalib
         \param[in] linearizer -- linearizing functor; a subclass of lsst.ip.isrFunctions.LinearizeBase
-        \param[in] dark -- exposure of dark frame
-        \param[in] flat -- exposure of flatfield
+        \param[in] dark -- exposure of dark frame, a CalibRegionReader, a SparseDarkModel or a LazyCalib
+        \param[in] flat -- exposure of flatfield, a CalibRegionReader or a LazyCalib
         \param[in] defects -- list of detects
         \param[in] fringes -- a pipeBase.Struct with field fringes containing
-                              exposure of fringe frame or list of fringe exposure
+                              exposure of fringe frame or list of fringe exposure, or a LazyCalib
+                              of such a Struct
         \param[in] bfKernel -- kernel for brighter-fatter correction
+        \param[in] checkpointId -- a string identifying the exposure (e.g. a digest of its data ID),
+                                   used to checkpoint and resume processing if config.checkpointDir is set;
+                                   if None then no checkpoints are written or read
+        \param[in] bbox -- region of interest, in PARENT coordinates of the assembled detector, or None for
+                           the whole detector; if specified, only the amplifiers needed to correct this region
+                           (including a halo for interpolation and brighter-fatter correction; see makeRoi)
+                           are processed and the returned exposure covers just this region.
+                           ccdExposure need only contain the raw data of those amplifiers
+                           and calibration exposures need only cover the region of those amplifiers
+
+        LazyCalib calibration products are loaded by the first stage that uses them and released
+        after the last; all are released by the time run returns.
 
         \return a pipeBase.Struct with field:
          - exposure
@@ -398,7 +1418,427 @@ class IsrTask(pipeBase.CmdLineTask):
 
         ccd = ccdExposure.getDetector()
 
-        # Validate Input
+        fringes = self.validateInputs(ccd, bias=bias, linearizer=linearizer, dark=dark, flat=flat,
+                                      defects=defects, fringes=fringes, bfKernel=bfKernel)
+
+        plan = self.getPlan(ccdExposure)
+        if not ccd:
+            ccd = plan.amps
+
+        roi = None
+        flatScale = None
+        if bbox is not None:
+            roi = self.makeRoi(ccd, bbox, bfKernel)
+            if ccdExposure.getBBox() != roi.rawBBox:
+                ccdExposure = ccdExposure.Factory(ccdExposure, roi.rawBBox)
+            if self.config.doFlat and not isinstance(flat, CalibRegionReader):
+                # the scale must be measured on the whole flat
+                flatScale = self.getFlatScale(self.resolveCalib(flat))
+            bias, dark, flat = [self.cropToRegion(calib, roi.regionBBox) for calib in (bias, dark, flat)]
+            fringes = self.cropFringesToRegion(fringes, roi.regionBBox)
+            if defects is not None:
+                defects = self.clipDefects(defects, roi.regionBBox)
+            if checkpointId is not None:
+                checkpointId += repr(roi.rawBBox)
+
+        stageList = self.makeStageList(ccd, plan, bias=bias, linearizer=linearizer, dark=dark, flat=flat,
+                                       defects=defects, fringes=fringes, bfKernel=bfKernel,
+                                       ampIndexList=roi.ampIndexList if roi is not None else None,
+                                       flatScale=flatScale)
+
+        # stores of intermediate exposures: pipeBase.Struct(description, cache, keyList, stageNames)
+        storeList = []
+        stageCache = self.getStageCache()
+        if stageCache is not None:
+            storeList.append(pipeBase.Struct(
+                description="the stage cache",
+                cache=stageCache,
+                keyList=stageCache.makeKeys(stageCache.digestExposure(ccdExposure), stageList, self.config),
+                stageNames=self.config.stageCacheStages,
+            ))
+        checkpointStore = self.getCheckpointStore() if checkpointId is not None else None
+        if checkpointStore is not None:
+            storeList.append(pipeBase.Struct(
+                description="a checkpoint",
+                cache=checkpointStore,
+                keyList=checkpointStore.makeKeys(checkpointId, stageList, self.config),
+                stageNames=self.config.checkpointStages,
+            ))
+
+        startIndex = 0
+        for i in reversed(range(len(stageList))):
+            storedExposure = None
+            for store in storeList:
+                if stageList[i].name in store.stageNames:
+                    storedExposure = store.cache.get(store.keyList[i])
+                    if storedExposure is not None:
+                        self.log.info("Resuming ISR after stage %s from %s" %
+                                      (stageList[i].name, store.description))
+                        break
+            if storedExposure is not None:
+                if ccdExposure.getDetector():
+                    storedExposure.setDetector(ccdExposure.getDetector())
+                ccdExposure = storedExposure
+                startIndex = i + 1
+                break
+
+        # index of the last stage that uses each lazily loaded calibration product, by id
+        lastUseDict = {}
+        lazyCalibs = {}
+        for i, stage in enumerate(stageList):
+            for calib in stage.calibs:
+                if isinstance(calib, LazyCalib):
+                    lastUseDict[id(calib)] = i
+                    lazyCalibs[id(calib)] = calib
+
+        instrumentation = StageInstrumentation(enabled=self.config.doInstrument)
+        try:
+            try:
+                for i in range(startIndex, len(stageList)):
+                    stage = stageList[i]
+                    with instrumentation.measureStage(stage.name):
+                        ccdExposure = stage.func(ccdExposure)
+                        for calib in stage.calibs:
+                            if lastUseDict.get(id(calib)) == i:
+                                calib.release()
+                    for store in storeList:
+                        if stage.name in store.stageNames:
+                            store.cache.put(store.keyList[i], ccdExposure)
+            finally:
+                for calib in lazyCalibs.values():
+                    calib.release()
+
+            if checkpointStore is not None:
+                for key in storeList[-1].keyList:
+                    checkpointStore.remove(key)
+
+            if roi is not None:
+                with instrumentation.measureStage("roi"):
+                    ccdExposure = ccdExposure.Factory(ccdExposure, roi.bbox, afwImage.PARENT, True)
+                    recordBuffer("region of interest", ccdExposure)
+        finally:
+            # stop tracing even if a stage fails, so the rest of the process is not traced
+            instrumentation.stop()
+
+        if self.config.doInstrument:
+            instrumentation.writeMetadata(self.metadata)
+
+        exposureTime = ccdExposure.getInfo().getVisitInfo().getExposureTime()
+        ccdExposure.getCalib().setFluxMag0(self.config.fluxMag0T1*exposureTime)
+
+        frame = getDebugFrame(self._display, "postISRCCD")
+        if frame:
+            getDisplay(frame).mtv(ccdExposure)
+
+        return pipeBase.Struct(
+            exposure=ccdExposure,
+        )
+
+    @pipeBase.timeMethod
+    def runBatch(self, ccdExposureList, bias=None, linearizer=None, dark=None, flat=None, defects=None,
+                 fringes=None, bfKernel=None):
+        """!Perform instrument signature removal on several exposures of the same detector
+
+        The result is the same as calling run on each exposure with the same calibration products,
+        but validation, defect conversion, flat scaling and other per-detector setup are done once,
+        and the pixel-wise corrections (bias, linearity, variance, dark and flat) are vectorized
+        across the stack of exposures.  To do this the assembled exposures are copied into 3-d image,
+        mask and variance arrays, which then back the returned exposures.
+
+        \param[in] ccdExposureList -- list of lsst.afw.image.exposure of detector data; all must have
+                                      the same detector (or all have none) and the same dimensions
+        \param[in] bias, linearizer, dark, flat, defects, fringes, bfKernel -- calibration products,
+                                      as for run; bias, dark and flat must be exposures, except that
+                                      the bias may be a SeparableBiasModel and the dark a SparseDarkModel
+        \return a pipeBase.Struct with field:
+         - exposures: list of ISR-corrected exposures, in the order of ccdExposureList
+        """
+        if len(ccdExposureList) == 0:
+            return pipeBase.Struct(exposures=[])
+
+        bias, dark, flat, fringes = [self.resolveCalib(calib) for calib in (bias, dark, flat, fringes)]
+        ccd = ccdExposureList[0].getDetector()
+        fringes = self.validateInputs(ccd, bias=bias, linearizer=linearizer, dark=dark, flat=flat,
+                                      defects=defects, fringes=fringes, bfKernel=bfKernel)
+        for calib in (bias, dark, flat):
+            if isinstance(calib, CalibRegionReader):
+                raise RuntimeError("runBatch does not support CalibRegionReader calibrations")
+        for ccdExposure in ccdExposureList[1:]:
+            detector = ccdExposure.getDetector()
+            if bool(detector) != bool(ccd) or (detector and detector.getSerial() != ccd.getSerial()):
+                raise RuntimeError("All exposures must have the same detector, or all none")
+        plan = self.getPlan(ccdExposureList[0])
+        if not ccd:
+            ccd = plan.amps
+        defectList = self.convertDefects(defects) if self.config.doDefect else None
+
+        exposureList = []
+        for ccdExposure in ccdExposureList:
+            ccdExposure = self.convertIntToFloat(ccdExposure)
+            exposureList.append(self.processRawAmpsAndAssemble(ccdExposure, plan))
+
+        bbox = exposureList[0].getBBox()
+        for exposure in exposureList[1:]:
+            if exposure.getBBox() != bbox:
+                raise RuntimeError("All exposures must have the same bbox: %s != %s" %
+                                   (exposure.getBBox(), bbox))
+        cube = self.stackExposures(exposureList)
+        exposureList = cube.exposures
+        ampSlices = plan.getContainedAmps(bbox)
+
+        if self.config.doBias and isinstance(bias, SeparableBiasModel):
+            for i, exposure in enumerate(exposureList):
+                bias.applyToArrays(cube.image[i], cube.variance[i], cube.mask[i],
+                                   exposure.getX0(), exposure.getY0())
+        elif self.config.doBias:
+            self.checkCalibBBox(exposureList[0], bias, "bias")
+            biasMI = bias.getMaskedImage()
+            cube.image -= biasMI.getImage().getArray()
+            cube.mask |= biasMI.getMask().getArray()
+            cube.variance += biasMI.getVariance().getArray()
+            del biasMI
+
+        if plan.doLinearize:
+            ampParamsList = linearizer.getAmpParams(ccd)
+            if ampParamsList is not None and all(len(params.table) == 0 for params in ampParamsList):
+                def linearizeAmp(indexAmpSlice):
+                    i, amp, ampSlice = indexAmpSlice
+                    sqCoeff = ampParamsList[i].sqCoeff
+                    if sqCoeff != 0:
+                        ampImage = cube.image[(slice(None),) + ampSlice]
+                        ampImage *= 1 + sqCoeff*ampImage
+                self.forEachAmp(linearizeAmp, ampSlices)
+            else:
+                for exposure in exposureList:
+                    linearizer(image=exposure.getMaskedImage().getImage(), detector=ccd, log=self.log)
+
+        def updateAmpVariance(indexAmpSlice):
+            i, amp, ampSlice = indexAmpSlice
+            if not math.isnan(amp.getGain()):
+                stackSlice = (slice(None),) + ampSlice
+                ampVariance = cube.variance[stackSlice]
+                numpy.divide(cube.image[stackSlice], amp.getGain(), out=ampVariance)
+                ampVariance += amp.getReadNoise()**2
+        self.forEachAmp(updateAmpVariance, ampSlices)
+
+        if self.config.doBrighterFatter:
+            for exposure in exposureList:
+                self.brighterFatterCorrection(exposure, bfKernel,
+                                              self.config.brighterFatterMaxIter,
+                                              self.config.brighterFatterThreshold,
+                                              self.config.brighterFatterApplyGain,
+                                              )
+
+        # Work buffer for the products of calibration and exposure planes
+        temp = numpy.empty_like(cube.image[0])
+
+        if self.config.doDark and isinstance(dark, SparseDarkModel):
+            for i, exposure in enumerate(exposureList):
+                expTime = exposure.getInfo().getVisitInfo().getDarkTime()
+                if math.isnan(expTime):
+                    raise RuntimeError("Exposure darktime is NAN")
+                dark.applyToArrays(cube.image[i], cube.variance[i], cube.mask[i],
+                                   exposure.getX0(), exposure.getY0(), expTime)
+        elif self.config.doDark:
+            self.checkCalibBBox(exposureList[0], dark, "dark")
+            darkMI = dark.getMaskedImage()
+            darkImage = darkMI.getImage().getArray()
+            darkVariance = darkMI.getVariance().getArray()
+            for i, exposure in enumerate(exposureList):
+                expTime, darkTime = self.getDarkTimes(exposure, dark)
+                scale = expTime/darkTime
+                numpy.multiply(darkImage, scale, out=temp)
+                cube.image[i] -= temp
+                numpy.multiply(darkVariance, scale**2, out=temp)
+                cube.variance[i] += temp
+            cube.mask |= darkMI.getMask().getArray()
+            del darkMI, darkImage, darkVariance
+
+        if self.config.doFringe and not self.config.fringeAfterFlat:
+            for exposure in exposureList:
+                self.fringe.run(exposure, **fringes.getDict())
+
+        if self.config.doFlat:
+            self.checkCalibBBox(exposureList[0], flat, "flat")
+            # maskedImage.scaledDivides(c, flat) with c = 1/flatScale sets:
+            #   image = image/(c*flat)
+            #   variance = variance/(c*flat)**2 + image**2*flatVariance/(c**2*flat**4)
+            flatMI = flat.getMaskedImage()
+            mult = 1.0/self.getFlatScale(flat)
+            recip = 1.0/(mult*flatMI.getImage().getArray())
+            recip2 = recip**2
+            imageVarianceWeight = flatMI.getVariance().getArray()*mult**2*recip2**2
+            for i in range(len(exposureList)):
+                cube.variance[i] *= recip2
+                numpy.multiply(cube.image[i], cube.image[i], out=temp)
+                temp *= imageVarianceWeight
+                cube.variance[i] += temp
+                cube.image[i] *= recip
+            cube.mask |= flatMI.getMask().getArray()
+            del flatMI, recip, recip2, imageVarianceWeight
+        del temp
+
+        for exposure in exposureList:
+            if self.config.doDefect:
+                self.maskAndInterpDefectList(exposure, defectList, psf=plan.psf)
+
+            if self.config.doSaturationInterpolation:
+                self.saturationInterpolation(exposure, psf=plan.psf)
+
+            self.maskAndInterpNan(exposure, psf=plan.psf)
+
+            if self.config.doFringe and self.config.fringeAfterFlat:
+                self.fringe.run(exposure, **fringes.getDict())
+
+            exposureTime = exposure.getInfo().getVisitInfo().getExposureTime()
+            exposure.getCalib().setFluxMag0(self.config.fluxMag0T1*exposureTime)
+
+        return pipeBase.Struct(
+            exposures=exposureList,
+        )
+
+    @pipeBase.timeMethod
+    def runQuickLook(self, ccdExposure, bias=None, dark=None, flat=None, defects=None, binSize=None):
+        """!Perform approximate instrument signature removal on a binned copy of an exposure
+
+        This is intended for low-latency previews. Saturation and suspect pixel detection,
+        overscan correction and assembly are done at full resolution; the exposure is then binned
+        binSize x binSize, summing pixels so that fluxes (and hence the photometric zero point)
+        are preserved. Bias, dark and flat corrections are applied using calibration exposures binned
+        the same way (the flat is averaged, rather than summed); binned calibrations are cached between
+        calls, for as long as the same calibration objects are supplied. The variance plane is set from
+        the amplifier gains and read noise; a bin that straddles amplifiers uses the mean inverse gain
+        of its pixels, which is exact only if the flux is uniform across the bin.
+
+        Linearity, brighter-fatter and fringe corrections are skipped, as is all interpolation;
+        defects and NaNs are masked, but not interpolated over.
+
+        The binned exposure has the exposure info of the input (including the detector, whose
+        geometry is that of the unbinned pixels), with the Wcs binned to match; see binWcs.
+
+        \param[in] ccdExposure -- lsst.afw.image.exposure of detector data
+        \param[in] bias -- exposure of bias frame
+        \param[in] dark -- exposure of dark frame
+        \param[in] flat -- exposure of flatfield
+        \param[in] defects -- list of defects
+        \param[in] binSize -- number of pixels per bin along each axis; if None, config.quickLookBinSize
+
+        \return a pipeBase.Struct with fields:
+         - exposure: the binned, ISR-corrected exposure
+         - binSize: the number of pixels per bin along each axis
+        """
+        if binSize is None:
+            binSize = self.config.quickLookBinSize
+        bias, dark, flat = [self.resolveCalib(calib) for calib in (bias, dark, flat)]
+        for doCalib, calib, name in ((self.config.doBias, bias, "bias"), (self.config.doDark, dark, "dark"),
+                                     (self.config.doFlat, flat, "flat")):
+            if doCalib:
+                if calib is None:
+                    raise RuntimeError("Must supply a %s exposure if config.do%s True" %
+                                       (name, name.capitalize()))
+                if isinstance(calib, (CalibRegionReader, SparseDarkModel, SeparableBiasModel)):
+                    raise RuntimeError("runQuickLook does not support %s calibrations" %
+                                       (type(calib).__name__,))
+        if self.config.doDefect and defects is None:
+            raise RuntimeError("Must supply defects if config.doDefect True")
+
+        ccdExposure = self.convertIntToFloat(ccdExposure)
+        plan = self.getPlan(ccdExposure)
+        ccdExposure = self.processRawAmpsAndAssemble(ccdExposure, plan)
+        maskedImage = isrFunctions.binMaskedImage(ccdExposure.getMaskedImage(), binSize)
+
+        # binned calibrations are kept only for the calibrations used by this call
+        binnedCalibs = {}
+
+        def getBinnedCalib(calib, average=False):
+            key = (id(calib), binSize, average)
+            held = self._binnedCalibs.get(key)
+            if held is None or held[0] is not calib:
+                held = (calib, isrFunctions.binMaskedImage(calib.getMaskedImage(), binSize, average=average))
+            binnedCalibs[key] = held
+            return held[1]
+
+        if self.config.doBias:
+            isrFunctions.biasCorrection(maskedImage, getBinnedCalib(bias))
+
+        numPixels = binSize**2
+        imageArray = maskedImage.getImage().getArray()
+        varianceArray = maskedImage.getVariance().getArray()
+        # per bin, sums over its pixels of: 1 (for amps with a known gain), 1/gain and readNoise^2
+        weightSum, invGainSum, readNoiseSum = [numpy.zeros(imageArray.shape) for i in range(3)]
+
+        # the bins covered by a slice of unbinned pixels, and the number of its pixels in each
+        def getBinCounts(ampSlice, numBins):
+            binSlice = slice(ampSlice.start//binSize, min(-(-ampSlice.stop//binSize), numBins))
+            starts = numpy.arange(binSlice.start, binSlice.stop)*binSize
+            counts = numpy.minimum(starts + binSize, ampSlice.stop) - numpy.maximum(starts, ampSlice.start)
+            return binSlice, counts
+
+        for i, amp, (ySlice, xSlice) in plan.getContainedAmps(ccdExposure.getBBox()):
+            gain = amp.getGain()
+            if not math.isnan(gain):
+                yBins, yCounts = getBinCounts(ySlice, imageArray.shape[0])
+                xBins, xCounts = getBinCounts(xSlice, imageArray.shape[1])
+                weights = numpy.outer(yCounts, xCounts)
+                weightSum[yBins, xBins] += weights
+                invGainSum[yBins, xBins] += weights/gain
+                readNoiseSum[yBins, xBins] += weights*amp.getReadNoise()**2
+        known = weightSum > 0
+        varianceArray[known] = (imageArray[known]*invGainSum[known] +
+                                numPixels*readNoiseSum[known])/weightSum[known]
+
+        if self.config.doDark:
+            expScale, darkScale = self.getDarkTimes(ccdExposure, dark)
+            isrFunctions.darkCorrection(maskedImage, getBinnedCalib(dark), expScale, darkScale)
+
+        if self.config.doFlat:
+            isrFunctions.flatCorrection(maskedImage, getBinnedCalib(flat, average=True),
+                                        self.config.flatScalingType, self.config.flatUserScale)
+
+        self._binnedCalibs = binnedCalibs
+
+        if self.config.doDefect:
+            # bin defects as binMaskedImage bins pixels: from the image origin, to a binned origin of
+            # xy0//binSize, so that defects land on the bins holding their pixels for any xy0
+            x0, y0 = ccdExposure.getXY0()
+
+            def binPoint(x, y):
+                return afwGeom.Point2I(x0//binSize + (x - x0)//binSize, y0//binSize + (y - y0)//binSize)
+
+            binnedDefectList = []
+            for defect in defects:
+                bbox = defect.getBBox()
+                binnedDefectList.append(measAlg.Defect(afwGeom.Box2I(
+                    binPoint(bbox.getMinX(), bbox.getMinY()), binPoint(bbox.getMaxX(), bbox.getMaxY()))))
+            isrFunctions.maskPixelsFromDefectList(maskedImage, binnedDefectList, maskName='BAD')
+
+        maskedImage.getMask().addMaskPlane("UNMASKEDNAN")
+        numNans = maskNans(maskedImage, maskedImage.getMask().getPlaneBitMask("UNMASKEDNAN"))
+        self.metadata.set("NUMNANS", numNans)
+
+        exposure = afwImage.ExposureF(maskedImage, afwImage.ExposureInfo(ccdExposure.getInfo(), True))
+        if ccdExposure.hasWcs():
+            exposure.setWcs(isrFunctions.binWcs(ccdExposure.getWcs(), binSize, ccdExposure.getXY0()))
+        exposure.getMetadata().set("ISR_BIN", binSize)
+        exposureTime = exposure.getInfo().getVisitInfo().getExposureTime()
+        exposure.getCalib().setFluxMag0(self.config.fluxMag0T1*exposureTime)
+
+        return pipeBase.Struct(
+            exposure=exposure,
+            binSize=binSize,
+        )
+
+    def validateInputs(self, ccd, bias=None, linearizer=None, dark=None, flat=None, defects=None,
+                       fringes=None, bfKernel=None):
+        """!Check that the calibration products required by the configuration have been supplied
+
+        \param[in] ccd -- detector information (an lsst.afw.cameraGeom.Detector)
+        \param[in] bias, linearizer, dark, flat, defects, fringes, bfKernel -- calibration products,
+                                      as for run
+        \return fringes, or an empty pipeBase.Struct if fringes is None
+
+        \throw RuntimeError if a required calibration product is missing
+        """
         if self.config.doBias and bias is None:
             raise RuntimeError("Must supply a bias exposure if config.doBias True")
         if self.doLinearize(ccd) and linearizer is None:
@@ -411,81 +1851,267 @@ class IsrTask(pipeBase.CmdLineTask):
             raise RuntimeError("Must supply a kernel if config.doBrighterFatter True")
         if fringes is None:
             fringes = pipeBase.Struct(fringes=None)
-        if self.config.doFringe and not isinstance(fringes, pipeBase.Struct):
+        if self.config.doFringe and not isinstance(fringes, (pipeBase.Struct, LazyCalib)):
             raise RuntimeError("Must supply fringe exposure as a pipeBase.Struct")
         if self.config.doDefect and defects is None:
             raise RuntimeError("Must supply defects if config.doDefect True")
+        return fringes
 
-        ccdExposure = self.convertIntToFloat(ccdExposure)
+    def processRawAmpsAndAssemble(self, ccdExposure, plan, ampIndexList=None):
+        """!Detect saturated and suspect pixels and correct overscan for each amplifier, then assemble
 
-        if not ccd:
-            assert not self.config.doAssembleCcd, "You need a Detector to run assembleCcd"
-            ccd = [FakeAmp(ccdExposure, self.config)]
-
-        for amp in ccd:
-            # if ccdExposure is one amp, check for coverage to prevent performing ops multiple times
-            if ccdExposure.getBBox().contains(amp.getBBox()):
-                self.saturationDetection(ccdExposure, amp)
-                self.suspectDetection(ccdExposure, amp)
-                self.overscanCorrection(ccdExposure, amp)
+        \param[in,out] ccdExposure -- floating point raw exposure; processed in place
+        \param[in] plan -- execution plan for the detector (an IsrPlan); see getPlan
+        \param[in] ampIndexList -- indices of the amplifiers to process and assemble (see makeRoi),
+                                   or None for all amplifiers in ccdExposure
+        \return the assembled exposure (ccdExposure itself if config.doAssembleCcd is False)
+        """
+        def processRawAmp(indexAmp):
+            amp = indexAmp[1]
+            self.saturationDetection(ccdExposure, amp)
+            self.suspectDetection(ccdExposure, amp)
+            self.overscanCorrection(ccdExposure, amp)
+        if ampIndexList is not None:
+            self.forEachAmp(processRawAmp, [(i, plan.amps[i]) for i in ampIndexList])
+        else:
+            # if ccdExposure is one amp, only process amps it covers to prevent performing ops multiple times
+            self.forEachAmp(processRawAmp, plan.getContainedAmps(ccdExposure.getBBox()))
 
-        if self.config.doAssembleCcd:
+        if self.config.doAssembleCcd and ampIndexList is not None:
+            ccdExposure = self.assembleRegion(ccdExposure, ampIndexList)
+        elif self.config.doAssembleCcd:
             ccdExposure = self.assembleCcd.assembleCcd(ccdExposure)
+            recordBuffer("assembleCcd", ccdExposure)
             if self.config.expectWcs and not ccdExposure.getWcs():
                 self.log.warn("No WCS found in input exposure")
+        return ccdExposure
 
-        if self.config.doBias:
-            self.biasCorrection(ccdExposure, bias)
+    def getRoiHalo(self, bfKernel=None):
+        """!Get the width of the border around a region of interest that must also be processed
 
-        if self.doLinearize(ccd):
-            linearizer(image=ccdExposure.getMaskedImage().getImage(), detector=ccd, log=self.log)
-
-        for amp in ccd:
-            # if ccdExposure is one amp, check for coverage to prevent performing ops multiple times
-            if ccdExposure.getBBox().contains(amp.getBBox()):
-                ampExposure = ccdExposure.Factory(ccdExposure, amp.getBBox())
-                self.updateVariance(ampExposure, amp)
+        Interpolation uses pixels within the PSF kernel (see isrFunctions.createPsf) and each iteration
+        of brighter-fatter correction spreads charge by the half-width of its kernel.
 
+        \param[in] bfKernel -- brighter-fatter kernel (ignored if config.doBrighterFatter is False)
+        \return halo width (pixels)
+        """
+        halo = 4*int(self.config.fwhm) + 1
         if self.config.doBrighterFatter:
-            self.brighterFatterCorrection(ccdExposure, bfKernel,
-                                          self.config.brighterFatterMaxIter,
-                                          self.config.brighterFatterThreshold,
-                                          self.config.brighterFatterApplyGain,
-                                          )
-
-        if self.config.doDark:
-            self.darkCorrection(ccdExposure, dark)
-
-        if self.config.doFringe and not self.config.fringeAfterFlat:
-            self.fringe.run(ccdExposure, **fringes.getDict())
+            halo += self.config.brighterFatterMaxIter*(max(numpy.shape(bfKernel))//2 + 1)
+        return halo
 
-        if self.config.doFlat:
-            self.flatCorrection(ccdExposure, flat)
+    def makeRoi(self, ccd, bbox, bfKernel=None):
+        """!Determine what must be processed to correct a region of interest
 
-        if self.config.doDefect:
-            self.maskAndInterpDefect(ccdExposure, defects)
-
-        if self.config.doSaturationInterpolation:
-            self.saturationInterpolation(ccdExposure)
-
-        self.maskAndInterpNan(ccdExposure)
+        \param[in] ccd -- detector information (an lsst.afw.cameraGeom.Detector)
+        \param[in] bbox -- region of interest, in PARENT coordinates of the assembled detector
+        \param[in] bfKernel -- brighter-fatter kernel (ignored if config.doBrighterFatter is False)
+        \return a pipeBase.Struct with fields:
+         - bbox: the region of interest, clipped to the detector
+         - ampIndexList: indices of the amplifiers that overlap the region of interest plus halo
+            (see getRoiHalo)
+         - regionBBox: the union of the bounding boxes of those amplifiers, which is the region
+            of the detector (and of the calibration exposures) that is processed
+         - rawBBox: the region of the raw exposure containing those amplifiers
+            (including overscan, if config.doAssembleCcd is True)
+
+        \throw RuntimeError if there is no detector or bbox does not overlap it
+        """
+        if isinstance(ccd, list) or not ccd:
+            raise RuntimeError("A region of interest can only be processed for an exposure with a Detector")
+        roiBBox = afwGeom.Box2I(bbox)
+        roiBBox.clip(ccd.getBBox())
+        if roiBBox.isEmpty():
+            raise RuntimeError("Region of interest %s does not overlap detector bbox %s" %
+                               (bbox, ccd.getBBox()))
+        haloBBox = afwGeom.Box2I(roiBBox)
+        haloBBox.grow(self.getRoiHalo(bfKernel))
+        haloBBox.clip(ccd.getBBox())
+
+        ampIndexList = []
+        regionBBox = afwGeom.Box2I()
+        rawBBox = afwGeom.Box2I()
+        for i, amp in enumerate(ccd):
+            if amp.getBBox().overlaps(haloBBox):
+                ampIndexList.append(i)
+                regionBBox.include(amp.getBBox())
+                if self.config.doAssembleCcd:
+                    rawBBox.include(amp.getRawBBox())
+        if not self.config.doAssembleCcd:
+            rawBBox = regionBBox
+        return pipeBase.Struct(
+            bbox=roiBBox,
+            ampIndexList=ampIndexList,
+            regionBBox=regionBBox,
+            rawBBox=rawBBox,
+        )
 
-        if self.config.doFringe and self.config.fringeAfterFlat:
-            self.fringe.run(ccdExposure, **fringes.getDict())
+    @staticmethod
+    def cropToRegion(calib, bbox):
+        """!Get the part of a calibration exposure covering a region
 
-        exposureTime = ccdExposure.getInfo().getVisitInfo().getExposureTime()
-        ccdExposure.getCalib().setFluxMag0(self.config.fluxMag0T1*exposureTime)
+        \param[in] calib -- calibration exposure, a list of exposures, a CalibRegionReader,
+                            a SparseDarkModel, a SeparableBiasModel, a LazyCalib or None
+        \param[in] bbox -- region, in PARENT coordinates
+        \return a view of the region of calib (or a list of views), or calib itself if it is
+            a CalibRegionReader, a SparseDarkModel or SeparableBiasModel (which apply to any region),
+            None or already covers just bbox; a LazyCalib of the view if calib is a LazyCalib
+        """
+        if isinstance(calib, LazyCalib):
+            return calib.derive(lambda value: IsrTask.cropToRegion(value, bbox))
+        if calib is None or isinstance(calib, (CalibRegionReader, SparseDarkModel, SeparableBiasModel)):
+            return calib
+        if isinstance(calib, (list, tuple)):
+            return [IsrTask.cropToRegion(item, bbox) for item in calib]
+        if calib.getBBox() == bbox:
+            return calib
+        return calib.Factory(calib, bbox)
+
+    @staticmethod
+    def cropFringesToRegion(fringes, bbox):
+        """!Get the part of fringe frames covering a region
+
+        \param[in] fringes -- a pipeBase.Struct with field fringes, as for run, or a LazyCalib of one
+        \param[in] bbox -- region, in PARENT coordinates
+        \return a copy of fringes with field fringes cropped by cropToRegion (a LazyCalib of the copy
+            if fringes is a LazyCalib)
+        """
+        if isinstance(fringes, LazyCalib):
+            return fringes.derive(lambda value: IsrTask.cropFringesToRegion(value, bbox))
+        if fringes.fringes is None:
+            return fringes
+        fringes = pipeBase.Struct(**fringes.getDict())
+        fringes.fringes = IsrTask.cropToRegion(fringes.fringes, bbox)
+        return fringes
+
+    @staticmethod
+    def resolveCalib(calib):
+        """!Get a calibration product, loading it if it is a LazyCalib
+
+        \param[in] calib -- calibration product, or a LazyCalib
+        \return the calibration product
+        """
+        if isinstance(calib, LazyCalib):
+            return calib.get()
+        return calib
 
-        frame = getDebugFrame(self._display, "postISRCCD")
-        if frame:
-            getDisplay(frame).mtv(ccdExposure)
+    @staticmethod
+    def clipDefects(defects, bbox):
+        """!Clip defects to a region, discarding those outside it
 
-        return pipeBase.Struct(
-            exposure=ccdExposure,
-        )
+        \param[in] defects -- list of defects (lsst.meas.algorithms.DefectBase or subclass)
+        \param[in] bbox -- region, in PARENT coordinates
+        \return a list of lsst.meas.algorithms.Defect
+        """
+        clippedList = []
+        for defect in defects:
+            defectBBox = afwGeom.Box2I(defect.getBBox())
+            defectBBox.clip(bbox)
+            if not defectBBox.isEmpty():
+                clippedList.append(measAlg.Defect(defectBBox))
+        return clippedList
+
+    def assembleRegion(self, ccdExposure, ampIndexList):
+        """!Assemble some of the amplifiers of a raw exposure
+
+        \param[in] ccdExposure -- raw exposure containing the raw data of the amplifiers
+        \param[in] ampIndexList -- indices of the amplifiers to assemble; their bounding boxes should
+                                   tile a rectangle, as those found by makeRoi do
+        \return an exposure covering the union of the bounding boxes of the amplifiers
+
+        \throw RuntimeError if assembleCcd.doTrim is False
+        """
+        if not self.assembleCcd.config.doTrim:
+            raise RuntimeError("Assembling a region of a detector requires assembleCcd.doTrim True")
+        ccd = ccdExposure.getDetector()
+        ampList = [ccd[i] for i in ampIndexList]
+        bbox = afwGeom.Box2I()
+        for amp in ampList:
+            bbox.include(amp.getBBox())
+        outExposure = afwImage.ExposureF(bbox)
+        recordBuffer("assembleRegion", outExposure)
+        outMI = outExposure.getMaskedImage()
+        inMI = ccdExposure.getMaskedImage()
+        for amp in ampList:
+            assembleAmplifierImage(outMI, inMI, amp)
+        outExposure.setDetector(ccd)
+        self.assembleCcd.postprocessExposure(outExposure=outExposure, inExposure=ccdExposure)
+        return outExposure
+
+    def linearizeRegion(self, exposure, ccd, linearizer, plan):
+        """!Correct non-linearity of the amplifiers contained in an exposure, in place
+
+        Unlike calling the linearizer, this does not require the exposure to cover the whole detector.
+
+        \param[in,out] exposure -- exposure to correct
+        \param[in] ccd -- detector information (an lsst.afw.cameraGeom.Detector)
+        \param[in] linearizer -- linearizing functor supporting getAmpParams
+        \param[in] plan -- execution plan for the detector (an IsrPlan); see getPlan
+
+        \throw RuntimeError if the linearizer does not support getAmpParams
+        """
+        ampParamsList = linearizer.getAmpParams(ccd)
+        if ampParamsList is None:
+            raise RuntimeError("Linearizer %s cannot be applied to a region of a detector" %
+                               (type(linearizer).__name__,))
+        image = exposure.getMaskedImage().getImage()
+        numOutOfRange = 0
+        for i, amp, ampSlice in plan.getContainedAmps(exposure.getBBox()):
+            ampParams = ampParamsList[i]
+            ampImage = image.Factory(image, amp.getBBox())
+            if len(ampParams.table) > 0:
+                numOutOfRange += applyLookupTable(ampImage, numpy.asarray(ampParams.table,
+                                                                          dtype=ampImage.getArray().dtype),
+                                                  ampParams.indOffset)
+            elif ampParams.sqCoeff != 0:
+                ampArr = ampImage.getArray()
+                ampArr *= 1 + ampParams.sqCoeff*ampArr
+        if numOutOfRange > 0:
+            self.log.warn("%s pixels were out of range of the linearization table" % (numOutOfRange,))
+
+    def stackExposures(self, exposureList):
+        """!Copy the pixels of exposures of identical dimensions into 3-d arrays
+
+        \param[in] exposureList -- list of exposures of identical dimensions
+        \return a pipeBase.Struct with fields:
+         - image, mask, variance: 3-d arrays with the planes of the exposures, indexed by [exposure, y, x]
+         - exposures: list of exposures whose pixels are views of the 3-d arrays and whose other
+                      information is shared with the corresponding input exposure
+        """
+        maskedImage = exposureList[0].getMaskedImage()
+        planeNames = ("image", "mask", "variance")
+        planeGetters = dict(image="getImage", mask="getMask", variance="getVariance")
+        cube = pipeBase.Struct()
+        for name in planeNames:
+            array = getattr(maskedImage, planeGetters[name])().getArray()
+            cube.set(name, numpy.empty((len(exposureList),) + array.shape, dtype=array.dtype))
+
+        stackedList = []
+        for i, exposure in enumerate(exposureList):
+            maskedImage = exposure.getMaskedImage()
+            planes = []
+            for name in planeNames:
+                plane = getattr(maskedImage, planeGetters[name])()
+                stackArray = getattr(cube, name)[i]
+                stackArray[:, :] = plane.getArray()
+                planes.append(plane.Factory(stackArray, False, plane.getXY0()))
+            stackedList.append(exposure.Factory(maskedImage.Factory(*planes), exposure.getInfo()))
+        cube.set("exposures", stackedList)
+        return cube
+
+    @staticmethod
+    def checkCalibBBox(exposure, calib, name):
+        """!Check that a calibration exposure has the same dimensions as the science exposure
+
+        \throw RuntimeError if not
+        """
+        bbox = exposure.getMaskedImage().getBBox(afwImage.LOCAL)
+        calibBBox = calib.getMaskedImage().getBBox(afwImage.LOCAL)
+        if bbox != calibBBox:
+            raise RuntimeError("maskedImage bbox %s != %sMaskedImage bbox %s" % (bbox, name, calibBBox))
 
     @pipeBase.timeMethod
-    def runDataRef(self, sensorRef):
+    def runDataRef(self, sensorRef, bbox=None, isrData=None):
         """!Perform instrument signature removal on a ButlerDataRef of a Sensor
 
         - Read in necessary detrending/isr/calibration data
@@ -494,20 +2120,166 @@ class IsrTask(pipeBase.CmdLineTask):
 
         \param[in] sensorRef -- daf.persistence.butlerSubset.ButlerDataRef of the
                                 detector data to be processed
+        \param[in] bbox -- region of interest, in PARENT coordinates of the assembled detector, or None for
+                           the whole detector; if specified, only the raw and calibration data for the
+                           amplifiers needed to correct this region are read (see makeRoi)
+        \param[in] isrData -- calibration data for this detector as returned by readIsrData, or None to read
+                              them; used to share calibration data between exposures (see IsrPoolDriver);
+                              must be None if bbox is specified
         \return a pipeBase.Struct with fields:
         - exposure: the exposure after application of ISR
         """
-        self.log.info("Performing ISR on sensor %s" % (sensorRef.dataId))
-        ccdExposure = sensorRef.get('raw')
-        isrData = self.readIsrData(sensorRef, ccdExposure)
+        return self.processDataRef(sensorRef, self.readDataRef(sensorRef, bbox=bbox, isrData=isrData))
+
+    @pipeBase.timeMethod
+    def readRaw(self, sensorRef):
+        """!Read the raw exposure of a ButlerDataRef of a Sensor
+
+        \param[in] sensorRef -- daf.persistence.butlerSubset.ButlerDataRef of the
+                                detector data to be processed
+        \return the raw exposure
+        """
+        return sensorRef.get('raw')
 
-        result = self.run(ccdExposure, **isrData.getDict())
+    @pipeBase.timeMethod
+    def readDataRef(self, sensorRef, bbox=None, isrData=None, ccdExposure=None):
+        """!Read the raw and calibration data needed to process a ButlerDataRef of a Sensor
+
+        \param[in] sensorRef -- daf.persistence.butlerSubset.ButlerDataRef of the
+                                detector data to be processed
+        \param[in] bbox -- region of interest, or None for the whole detector; see runDataRef
+        \param[in] isrData -- calibration data, or None to read them; see runDataRef
+        \param[in] ccdExposure -- the raw exposure, if it has already been read (see readRaw),
+                                  or None to read it; must be None if bbox is specified
+        \return a pipeBase.Struct with fields:
+        - ccdExposure: the raw exposure (converted to float if config.stripHeight > 0)
+        - isrData: calibration data, as returned by readIsrData
+        - bbox: bbox
+        """
+        if bbox is None:
+            if ccdExposure is None:
+                ccdExposure = self.readRaw(sensorRef)
+            if isrData is None:
+                isrData = self.readIsrData(sensorRef, ccdExposure)
+        else:
+            if isrData is not None or ccdExposure is not None:
+                raise RuntimeError("isrData and ccdExposure cannot be specified with a region of interest")
+            # read just the amplifiers that are needed
+            ccd = self.getDetector(sensorRef)
+            bfKernel = self.readBrighterFatterKernel(sensorRef) if self.config.doBrighterFatter else None
+            roi = self.makeRoi(ccd, bbox, bfKernel)
+            ccdExposure = sensorRef.get('raw_sub', bbox=roi.rawBBox, immediate=True)
+            isrData = self.readIsrData(sensorRef, ccdExposure, bbox=roi.regionBBox, bfKernel=bfKernel)
+        if self.config.stripHeight > 0:
+            # Don't hold on to the integer raw exposure while the float copy is processed
+            ccdExposure = self.convertIntToFloat(ccdExposure)
+        return pipeBase.Struct(ccdExposure=ccdExposure, isrData=isrData, bbox=bbox)
+
+    @pipeBase.timeMethod
+    def processDataRef(self, sensorRef, inputData, writer=None):
+        """!Perform instrument signature removal on data read by readDataRef and persist the result
+
+        \param[in] sensorRef -- daf.persistence.butlerSubset.ButlerDataRef of the
+                                detector data to be processed
+        \param[in] inputData -- data read by readDataRef
+        \param[in] writer -- AsyncWriter with which to persist the result, or None to persist it
+                             before returning
+        \return a pipeBase.Struct; see run
+        """
+        self.log.info("Performing ISR on sensor %s" % (sensorRef.dataId))
+        checkpointId = self.makeCheckpointId(sensorRef.dataId) if self.config.checkpointDir else None
+        try:
+            result = self.run(inputData.ccdExposure, checkpointId=checkpointId, bbox=inputData.bbox,
+                              **inputData.isrData.getDict())
+        finally:
+            self.releaseServedCalibs(sensorRef)
 
         if self.config.doWrite:
-            sensorRef.put(result.exposure, "postISRCCD")
+            if writer is not None:
+                writer.put(sensorRef, result.exposure, "postISRCCD")
+            else:
+                sensorRef.put(result.exposure, "postISRCCD")
 
         return result
 
+    @pipeBase.timeMethod
+    def runDataRefList(self, sensorRefList, bbox=None, returnExposures=False):
+        """!Perform instrument signature removal on a sequence of ButlerDataRefs, reading ahead
+
+        While one exposure is corrected, the raw and calibration data for the next
+        config.prefetchDepth exposures are read on config.prefetchThreads background threads,
+        holding at most about config.prefetchMaxBytes of read-ahead data; see Prefetcher.
+        Each exposure is otherwise processed as by runDataRef, including persisting the result
+        if config.doWrite is True. If config.numAsyncWriters > 0 the results are persisted by an
+        AsyncWriter, so the next exposure is processed while the previous one is written.
+
+        \param[in] sensorRefList -- daf.persistence.butlerSubset.ButlerDataRefs of the detector data
+                                    to be processed
+        \param[in] bbox -- region of interest, or None for whole detectors; see runDataRef
+        \param[in] returnExposures -- return the ISR-corrected exposures? If False they are released
+                                      as soon as each has been processed
+        \return a pipeBase.Struct with fields:
+        - exposures: a list of the exposures after application of ISR, in the order of sensorRefList,
+                     if returnExposures is True; else None
+
+        \throw RuntimeError if any asynchronous write failed; this is raised after all exposures
+            have been processed and all other writes have finished
+        """
+        sensorRefList = list(sensorRefList)
+        prefetcher = Prefetcher(
+            readFunc=lambda sensorRef: self.readDataRef(sensorRef, bbox=bbox),
+            items=sensorRefList,
+            depth=self.config.prefetchDepth,
+            maxBytes=self.config.prefetchMaxBytes,
+            numThreads=self.config.prefetchThreads,
+            sizeFunc=self.getInputBytes,
+        )
+        writer = None
+        if self.config.doWrite and self.config.numAsyncWriters > 0:
+            writer = AsyncWriter(numWorkers=self.config.numAsyncWriters,
+                                 maxQueued=self.config.asyncWriteMaxQueued,
+                                 useProcesses=self.config.asyncWriteUseProcesses)
+        exposureList = [] if returnExposures else None
+        try:
+            for i, inputData in enumerate(prefetcher):
+                result = self.processDataRef(sensorRefList[i], inputData, writer=writer)
+                del inputData
+                if returnExposures:
+                    exposureList.append(result.exposure)
+                del result
+        finally:
+            prefetcher.close()
+            if writer is not None:
+                writeResult = writer.close()
+                for failure in writeResult.failures:
+                    self.log.warn("Failed to write %s for %s:\n%s" %
+                                  (failure.datasetType, failure.dataId, failure.error))
+        if writer is not None and writeResult.failures:
+            raise RuntimeError("Failed to write %d of %d outputs: %s" %
+                               (len(writeResult.failures), writeResult.numWritten + len(writeResult.failures),
+                                ", ".join(str(failure.dataId) for failure in writeResult.failures)))
+        return pipeBase.Struct(exposures=exposureList)
+
+    @staticmethod
+    def getInputBytes(inputData):
+        """!Get the number of bytes of pixel data in data read by readDataRef
+
+        Only exposures are counted (including those in lists and Structs, such as fringes);
+        calibration products read on demand (CalibRegionReader) count as 0.
+
+        \param[in] inputData -- data read by readDataRef
+        \return number of bytes
+        """
+        def countBytes(obj):
+            if isinstance(obj, pipeBase.Struct):
+                return sum(countBytes(value) for value in obj.getDict().values())
+            if isinstance(obj, (list, tuple)):
+                return sum(countBytes(item) for item in obj)
+            if hasattr(obj, "getMaskedImage"):
+                return getNumBytes(obj)
+            return 0
+        return countBytes(inputData.ccdExposure) + countBytes(inputData.isrData)
+
     def convertIntToFloat(self, exposure):
         """Convert an exposure from uint16 to float, set variance plane to 1 and mask plane to 0
         """
@@ -518,6 +2290,7 @@ class IsrTask(pipeBase.CmdLineTask):
             raise RuntimeError("Unable to convert exposure (%s) to float" % type(exposure))
 
         newexposure = exposure.convertF()
+        recordBuffer("convertIntToFloat", newexposure)
         maskedImage = newexposure.getMaskedImage()
         varArray = maskedImage.getVariance().getArray()
         varArray[:, :] = 1
@@ -529,22 +2302,53 @@ class IsrTask(pipeBase.CmdLineTask):
         """!Apply bias correction in place
 
         \param[in,out]  exposure        exposure to process
-        \param[in]      biasExposure    bias exposure of same size as exposure
+        \param[in]      biasExposure    bias exposure of same size as exposure, or a SeparableBiasModel
         """
+        if isinstance(biasExposure, SeparableBiasModel):
+            biasExposure.apply(exposure.getMaskedImage())
+            return
         isrFunctions.biasCorrection(exposure.getMaskedImage(), biasExposure.getMaskedImage())
 
+    def applyCalib(self, exposure, calib, correction):
+        """!Apply a calibration correction in place, strip by strip if the calibration is a CalibRegionReader
+
+        \param[in,out]  exposure        exposure to process
+        \param[in]      calib           calibration exposure of same size as exposure, or a CalibRegionReader
+        \param[in]      correction      correction method taking (exposure, calib), e.g. self.biasCorrection
+        """
+        if not isinstance(calib, CalibRegionReader):
+            correction(exposure, calib)
+            return
+        for bbox in isrFunctions.makeStripBBoxes(exposure.getBBox(), self.config.stripHeight):
+            correction(exposure.Factory(exposure, bbox), calib.read(bbox))
+
+    def getCalibRegion(self, calib, exposure, bbox):
+        """!Get the region of a calibration corresponding to a region of the science exposure
+
+        \param[in] calib       calibration exposure the size of the science exposure, or a CalibRegionReader
+        \param[in] exposure    science exposure
+        \param[in] bbox        region to get, in PARENT coordinates of the science exposure
+        \return calibration exposure covering bbox (a view, if calib is an exposure)
+        """
+        if isinstance(calib, CalibRegionReader):
+            return calib.read(bbox)
+        localBBox = afwGeom.Box2I(bbox)
+        localBBox.shift(afwGeom.Extent2I(-exposure.getX0(), -exposure.getY0()))
+        return calib.Factory(calib, localBBox, afwImage.LOCAL)
+
     def darkCorrection(self, exposure, darkExposure):
         """!Apply dark correction in place
 
         \param[in,out]  exposure        exposure to process
-        \param[in]      darkExposure    dark exposure of same size as exposure
+        \param[in]      darkExposure    dark exposure of same size as exposure, or a SparseDarkModel
         """
-        expScale = exposure.getInfo().getVisitInfo().getDarkTime()
-        if math.isnan(expScale):
-            raise RuntimeError("Exposure darktime is NAN")
-        darkScale = darkExposure.getInfo().getVisitInfo().getDarkTime()
-        if math.isnan(darkScale):
-            raise RuntimeError("Dark calib darktime is NAN")
+        if isinstance(darkExposure, SparseDarkModel):
+            expScale = exposure.getInfo().getVisitInfo().getDarkTime()
+            if math.isnan(expScale):
+                raise RuntimeError("Exposure darktime is NAN")
+            darkExposure.apply(exposure.getMaskedImage(), expScale)
+            return
+        expScale, darkScale = self.getDarkTimes(exposure, darkExposure)
         isrFunctions.darkCorrection(
             maskedImage=exposure.getMaskedImage(),
             darkMaskedImage=darkExposure.getMaskedImage(),
@@ -552,14 +2356,33 @@ class IsrTask(pipeBase.CmdLineTask):
             darkScale=darkScale,
         )
 
+    def getDarkTimes(self, exposure, darkExposure):
+        """!Get the dark times of an exposure and of the dark used to correct it
+
+        \param[in]      exposure        exposure to process
+        \param[in]      darkExposure    dark exposure
+
+        \return the dark time of exposure and the dark time of darkExposure
+
+        \throw RuntimeError if either dark time is NaN
+        """
+        expScale = exposure.getInfo().getVisitInfo().getDarkTime()
+        if math.isnan(expScale):
+            raise RuntimeError("Exposure darktime is NAN")
+        darkScale = darkExposure.getInfo().getVisitInfo().getDarkTime()
+        if math.isnan(darkScale):
+            raise RuntimeError("Dark calib darktime is NAN")
+        return expScale, darkScale
+
     def doLinearize(self, detector):
         """!Is linearization wanted for this detector?
 
         Checks config.doLinearize and the linearity type of the first amplifier.
 
-        \param[in]  detector  detector information (an lsst.afw.cameraGeom.Detector)
+        \param[in]  detector  detector information (an lsst.afw.cameraGeom.Detector),
+                              or None if the exposure has no detector
         """
-        return self.config.doLinearize and \
+        return self.config.doLinearize and bool(detector) and \
             detector.getAmpInfoCatalog()[0].getLinearityType() != NullLinearityType
 
     def updateVariance(self, ampExposure, amp):
@@ -575,44 +2398,366 @@ class IsrTask(pipeBase.CmdLineTask):
                 readNoise=amp.getReadNoise(),
             )
 
-    def flatCorrection(self, exposure, flatExposure):
+    def flatCorrection(self, exposure, flatExposure, flatScale=None):
         """!Apply flat correction in place
 
         \param[in,out]  exposure        exposure to process
         \param[in]      flatExposure    flatfield exposure same size as exposure
+        \param[in]      flatScale       scale by which the flat is divided; if None, from getFlatScale
         """
         isrFunctions.flatCorrection(
             maskedImage=exposure.getMaskedImage(),
             flatMaskedImage=flatExposure.getMaskedImage(),
-            scalingType=self.config.flatScalingType,
-            userScale=self.config.flatUserScale,
+            scalingType="USER",
+            userScale=self.getFlatScale(flatExposure) if flatScale is None else flatScale,
         )
 
-    def getIsrExposure(self, dataRef, datasetType, immediate=True):
+    def getFlatScale(self, flat):
+        """!Get the scale by which the flat is divided before it is applied
+
+        If config.useFlatScaleMetadata is True, a scale recorded in the metadata of the flat is used
+        (see getFlatScaleKey). Otherwise the scale of a flat read by readFlat is measured once for its
+        files and remembered; that of other flats is measured on every call. The flat is not modified.
+
+        \param[in]      flat    flatfield exposure, or a CalibRegionReader if flatScalingType is USER
+        \return flat scale
+        """
+        if isinstance(flat, CalibRegionReader):
+            if self.config.flatScalingType != "USER":
+                raise RuntimeError("Flat scaling type %s requires the full flat, not a CalibRegionReader" %
+                                   (self.config.flatScalingType,))
+            return self.config.flatUserScale
+        if self.config.flatScalingType == "USER":
+            return isrFunctions.getFlatScale(flat.getMaskedImage(), self.config.flatScalingType,
+                                             self.config.flatUserScale)
+        if self.config.useFlatScaleMetadata:
+            metadata = flat.getMetadata()
+            if metadata.exists(self.getFlatScaleKey()):
+                return metadata.get(self.getFlatScaleKey())
+        key = None
+        with IsrTask._calibCacheLock:
+            held = IsrTask._flatKeys.get(id(flat))
+            if held is not None and held[0]() is flat:
+                key = (held[1], self.config.flatScalingType)
+                flatScale = IsrTask._flatScales.get(key)
+                if flatScale is not None:
+                    return flatScale
+        flatScale = isrFunctions.getFlatScale(flat.getMaskedImage(), self.config.flatScalingType)
+        if key is not None:
+            with IsrTask._calibCacheLock:
+                IsrTask._flatScales[key] = flatScale
+        return flatScale
+
+    def getFlatScaleKey(self):
+        """!Get the metadata key of the flat scale for config.flatScalingType, e.g. ISR_FLAT_SCALE_MEDIAN
+        """
+        return "ISR_FLAT_SCALE_" + self.config.flatScalingType
+
+    def readFlat(self, dataRef, allowStrips=True, bbox=None):
+        """!Read the flat, remembering the content of its files so that its scale is measured once
+
+        If the scale of a whole flat is measured (see getFlatScale), it is remembered for the rest of the
+        process by a digest of the contents of the flat's files (see getCalibFileKey), so that it is
+        not measured again for other exposures, even if the flat is read again.
+
+        \param[in] dataRef, allowStrips, bbox -- as for readIsrCalib
+        \return flat, as for readIsrCalib
+        """
+        flat = self.readIsrCalib(dataRef, "flat", allowStrips=allowStrips, bbox=bbox)
+        if bbox is not None or isinstance(flat, CalibRegionReader) or self.config.flatScalingType == "USER":
+            return flat
+        fileKey = self.getCalibFileKey(dataRef, "flat", withContent=True)
+        if fileKey is None or fileKey[3] is None:
+            return flat
+        flatId = id(flat)
+
+        def forget(ref):
+            with IsrTask._calibCacheLock:
+                held = IsrTask._flatKeys.get(flatId)
+                if held is not None and held[0] is ref:
+                    del IsrTask._flatKeys[flatId]
+        try:
+            ref = weakref.ref(flat, forget)
+        except TypeError:
+            return flat  # cannot be remembered without keeping the flat alive
+        with IsrTask._calibCacheLock:
+            IsrTask._flatKeys[flatId] = (ref, fileKey)
+        return flat
+
+    def readSparseDark(self, dataRef, ccd):
+        """!Get a SparseDarkModel of the dark
+
+        \param[in] dataRef -- data reference for the science exposure
+        \param[in] ccd -- detector information (an lsst.afw.cameraGeom.Detector), or None
+        \return a SparseDarkModel; see readCalibModel
+        """
+        return self.readCalibModel(dataRef, "dark", SparseDarkModel, self.config.sparseDarkThreshold, ccd)
+
+    def readSeparableBias(self, dataRef, ccd):
+        """!Get a SeparableBiasModel of the bias
+
+        \param[in] dataRef -- data reference for the science exposure
+        \param[in] ccd -- detector information (an lsst.afw.cameraGeom.Detector), or None
+        \return a SeparableBiasModel; see readCalibModel
+        """
+        return self.readCalibModel(dataRef, "bias", SeparableBiasModel, self.config.separableBiasThreshold,
+                                   ccd)
+
+    def readCalibModel(self, dataRef, datasetType, modelClass, threshold, ccd):
+        """!Get a compact model of a calibration exposure, e.g. a SparseDarkModel of the dark
+
+        The model is kept in the calibration cache and the DerivedCalibStore, if enabled, keyed by
+        the files (or contents) of the calibration, the model class and threshold; the calibration
+        exposure itself is only read to make the model, and is not cached.
+
+        \param[in] dataRef -- data reference for the science exposure
+        \param[in] datasetType -- type of calibration dataset (e.g. 'dark')
+        \param[in] modelClass -- class of model, with classmethods fromExposure(exposure, ampBBoxList,
+                                 threshold) and fromArrays, and method getArrays
+        \param[in] threshold -- threshold for the sparse pixels of the model
+        \param[in] ccd -- detector information (an lsst.afw.cameraGeom.Detector), or None
+        \return the model
+        """
+        fileKey = self.getCalibFileKey(dataRef, datasetType)
+        key = fileKey + (modelClass.__name__, threshold) if fileKey is not None else None
+        derivedCalibStore = self.getDerivedCalibStore()
+        storeKey = derivedCalibStore.makeKey(*key) \
+            if derivedCalibStore is not None and key is not None and key[3] is not None else None
+
+        def makeModel():
+            if storeKey is not None:
+                stored = derivedCalibStore.read(storeKey)
+                if stored is not None:
+                    return modelClass.fromArrays(stored[0])
+            calibExposure = self.readIsrExposure(dataRef, datasetType)
+            ampBBoxList = [amp.getBBox() for amp in ccd] if ccd else [calibExposure.getBBox()]
+            model = modelClass.fromExposure(calibExposure, ampBBoxList, threshold)
+            self.log.info("Made %s of %s for %s with %d bytes" %
+                          (modelClass.__name__, datasetType, dataRef.dataId,
+                           sum(array.nbytes for array in model.getArrays().values())))
+            if storeKey is not None:
+                derivedCalibStore.write(storeKey, model.getArrays())
+            return model
+
+        calibCache = self.getCalibCache()
+        if calibCache is None or key is None:
+            return makeModel()
+        return calibCache.get(key, makeModel)
+
+    def canFuseDetrend(self, ccd, linearizer):
+        """!Can bias, linearity, variance, dark and flat corrections be applied by fusedDetrend?
+
+        The fused kernel cannot be used if another stage (brighter-fatter correction or fringe
+        subtraction before flat-fielding) must run between these corrections, if the dark is
+        a SparseDarkModel (config.doSparseDark), if the bias is a SeparableBiasModel (config.doSeparableBias)
+        or if the linearizer cannot provide per-amplifier
+        parameters (see LinearizeBase.getAmpParams).
+
+        The decision is made for each call, as the config may change between calls; the reason
+        fusion is not possible is logged once for each reason.
+
+        \param[in]  ccd         detector information, or a list of FakeAmp
+        \param[in]  linearizer  linearizing functor, or None
+        """
+        linearizerType = type(linearizer) \
+            if not isinstance(ccd, list) and self.doLinearize(ccd) and linearizer is not None else None
+        reason = None
+        if self.config.doBrighterFatter:
+            reason = "brighter-fatter correction"
+        elif self.config.doDark and self.config.doSparseDark:
+            reason = "a sparse dark model"
+        elif self.config.doBias and self.config.doSeparableBias:
+            reason = "a separable bias model"
+        elif self.config.doFringe and not self.config.fringeAfterFlat:
+            reason = "fringe correction before flat-fielding"
+        elif linearizerType is not None and linearizer.getAmpParams(ccd) is None:
+            reason = "linearizer %s, which does not support it" % (linearizerType.__name__,)
+        if reason is not None and reason not in self._fuseDetrendReasons:
+            self.log.info("Cannot fuse detrending with %s; running stages separately" % (reason,))
+            self._fuseDetrendReasons.add(reason)
+        return reason is None
+
+    def fusedDetrend(self, ccdExposure, ccd, bias=None, linearizer=None, dark=None, flat=None, plan=None,
+                     flatScale=None):
+        """!Apply bias, linearity, variance, dark and flat corrections in a single pass, in place
+
+        The result matches biasCorrection, linearizer, updateVariance, darkCorrection and
+        flatCorrection applied in that order (to within floating point rounding), but each
+        amplifier's pixels are read and written only once; see lsst.ip.isr.applyDetrend.
+
+        \param[in,out]  ccdExposure     assembled exposure to process
+        \param[in]      ccd             detector information, or a list of FakeAmp
+        \param[in]      bias            bias exposure of same size as ccdExposure, a CalibRegionReader,
+                                        or None to skip
+        \param[in]      linearizer      linearizing functor supporting getAmpParams, or None to skip
+        \param[in]      dark            dark exposure of same size as ccdExposure, a CalibRegionReader,
+                                        or None to skip
+        \param[in]      flat            flatfield exposure of same size as ccdExposure, a CalibRegionReader,
+                                        or None to skip
+        \param[in]      plan            execution plan for ccd (an IsrPlan), or None to make one
+        \param[in]      flatScale       scale by which the flat is divided; if None, computed from flat
+        """
+        if plan is None:
+            plan = IsrPlan(self, ccd)
+        maskedImage = ccdExposure.getMaskedImage()
+        for name, calib in (("bias", bias), ("dark", dark), ("flat", flat)):
+            if calib is not None and not isinstance(calib, CalibRegionReader) and \
+                    maskedImage.getBBox(afwImage.LOCAL) != calib.getMaskedImage().getBBox(afwImage.LOCAL):
+                raise RuntimeError("maskedImage bbox %s != %sMaskedImage bbox %s" %
+                                   (maskedImage.getBBox(afwImage.LOCAL), name,
+                                    calib.getMaskedImage().getBBox(afwImage.LOCAL)))
+
+        if flatScale is None:
+            flatScale = self.getFlatScale(flat) if flat is not None else 1.0
+        pixelType = maskedImage.getImage().getArray().dtype
+        ampParamsList = linearizer.getAmpParams(ccd) if linearizer is not None else None
+
+        def detrendAmp(indexAmp):
+            i, amp = indexAmp[:2]
+            biasView, darkView, flatView = [self.getCalibRegion(calib, ccdExposure, amp.getBBox())
+                                            if calib is not None else None for calib in (bias, dark, flat)]
+            darkScale = 1.0
+            if darkView is not None:
+                expTime, darkTime = self.getDarkTimes(ccdExposure, darkView)
+                darkScale = expTime/darkTime
+            if ampParamsList is not None:
+                ampParams = ampParamsList[i]
+            else:
+                ampParams = pipeBase.Struct(sqCoeff=0.0, table=(), indOffset=0.0)
+            return applyDetrend(
+                maskedImage.Factory(maskedImage, amp.getBBox()),
+                *[view.getMaskedImage() if view is not None else None
+                  for view in (biasView, darkView, flatView)],
+                darkScale=darkScale,
+                flatScale=flatScale,
+                gain=amp.getGain(),
+                readNoise=amp.getReadNoise(),
+                sqCoeff=ampParams.sqCoeff,
+                table=numpy.asarray(ampParams.table, dtype=pixelType),
+                indOffset=ampParams.indOffset,
+            )
+
+        # if ccdExposure is one amp, only process amps it covers to prevent performing ops multiple times
+        numOutOfRange = sum(self.forEachAmp(detrendAmp, plan.getContainedAmps(ccdExposure.getBBox())))
+        if numOutOfRange > 0:
+            self.log.warn("%s pixels were out of range of the linearization table" % (numOutOfRange,))
+
+    def getIsrExposure(self, dataRef, datasetType, immediate=True, bbox=None):
         """!Retrieve a calibration dataset for removing instrument signature
 
         \param[in]      dataRef         data reference for exposure
         \param[in]      datasetType     type of dataset to retrieve (e.g. 'bias', 'flat')
         \param[in]      immediate       if True, disable butler proxies to enable error
                                         handling within this routine
+        \param[in]      bbox            if not None, read only this region (in PARENT coordinates);
+                                        not supported if config.doAssembleIsrExposures is True
+        \return exposure; whole exposures are read through the calibration cache, the CalibServer
+            (see readSharedCalib) and the store of memory-mapped calibrations (see readMappedCalib)
+        """
+        if bbox is None:
+            def readFunc():
+                return self.readMappedCalib(dataRef, datasetType,
+                                            lambda: self.readIsrExposure(dataRef, datasetType,
+                                                                         immediate=immediate))
+            return self.readSharedCalib(dataRef, datasetType, readFunc)
+        return self.readIsrExposure(dataRef, datasetType, immediate=immediate, bbox=bbox)
+
+    def readIsrExposure(self, dataRef, datasetType, immediate=True, bbox=None, useFallback=True):
+        """!Read a calibration dataset for removing instrument signature, bypassing the calibration cache
+
+        \param[in] dataRef, datasetType, immediate, bbox -- as for getIsrExposure
+        \param[in] useFallback -- if the calibration for the filter of the exposure cannot be read,
+            read that for config.fallbackFilterName (if set)?
         \return exposure
         """
-        try:
-            exp = dataRef.get(datasetType, immediate=immediate)
-        except Exception as exc1:
-            if not self.config.fallbackFilterName:
-                raise RuntimeError("Unable to retrieve %s for %s: %s" % (datasetType, dataRef.dataId, exc1))
+        kwargs = dict(immediate=immediate)
+        calibType = datasetType
+        if bbox is not None:
+            if self.config.doAssembleIsrExposures:
+                raise RuntimeError("Cannot read a region of a calibration that must be assembled")
+            datasetType += "_sub"
+            kwargs["bbox"] = bbox
+        calibIndex = self.getCalibIndex()
+        dataId = dataRef.dataId
+        date = self.getCalibDate(dataRef)
+        fallbackFilterName = self.config.fallbackFilterName if useFallback else None
+        available = calibIndex.isAvailable(calibType, dataId.get("filter"), dataId, date,
+                                           fallbackFilterName=fallbackFilterName)
+        if available is False:
+            # found missing before: go straight to the fallback filter, unless it was found missing too
+            if not fallbackFilterName or \
+                    calibIndex.isAvailable(calibType, fallbackFilterName, dataId, date) is False:
+                raise RuntimeError("Unable to retrieve %s for %s: not available%s" %
+                                   (datasetType, dataId, ", even with fallback filter %s" % fallbackFilterName
+                                    if fallbackFilterName else ""))
             try:
-                exp = dataRef.get(datasetType, filter=self.config.fallbackFilterName, immediate=immediate)
-            except Exception as exc2:
-                raise RuntimeError("Unable to retrieve %s for %s, even with fallback filter %s: %s AND %s" %
-                                   (datasetType, dataRef.dataId, self.config.fallbackFilterName, exc1, exc2))
-            self.log.warn("Using fallback calibration from filter %s" % self.config.fallbackFilterName)
+                exp = dataRef.get(datasetType, filter=fallbackFilterName, **kwargs)
+            except Exception as exc:
+                self.recordCalibMiss(dataRef, calibType, fallbackFilterName, date)
+                raise RuntimeError("Unable to retrieve %s for %s with fallback filter %s: %s" %
+                                   (datasetType, dataId, fallbackFilterName, exc))
+            self.log.warn("Using fallback calibration from filter %s" % fallbackFilterName)
+        else:
+            try:
+                exp = dataRef.get(datasetType, **kwargs)
+            except Exception as exc1:
+                self.recordCalibMiss(dataRef, calibType, None, date)
+                if not fallbackFilterName:
+                    raise RuntimeError("Unable to retrieve %s for %s: %s" % (datasetType, dataId, exc1))
+                try:
+                    exp = dataRef.get(datasetType, filter=fallbackFilterName, **kwargs)
+                except Exception as exc2:
+                    self.recordCalibMiss(dataRef, calibType, fallbackFilterName, date)
+                    raise RuntimeError("Unable to retrieve %s for %s, even with fallback filter %s: "
+                                       "%s AND %s" % (datasetType, dataId, fallbackFilterName, exc1, exc2))
+                self.log.warn("Using fallback calibration from filter %s" % fallbackFilterName)
 
         if self.config.doAssembleIsrExposures:
             exp = self.assembleCcd.assembleCcd(exp)
         return exp
 
+    def recordCalibMiss(self, dataRef, datasetType, filterName, date):
+        """!Remember that a calibration is missing, so that it is not tried again
+
+        The miss is only recorded if config.doRememberCalibMisses is True or the dataset type is in the
+        index (see getCalibIndex), the date of the exposure is known and the butler reports that the dataset
+        does not exist, so that a failure to read an existing calibration (e.g. a transient I/O error)
+        is not remembered.
+
+        \param[in] dataRef -- data reference for the science exposure
+        \param[in] datasetType -- type of calibration dataset (e.g. 'flat')
+        \param[in] filterName -- filter with which the calibration was read, or None for that of the exposure
+        \param[in] date -- date of the exposure (see getCalibDate), or None if unknown
+        """
+        if date is None or \
+                not (self.config.doRememberCalibMisses or self.getCalibIndex().isIndexed(datasetType)):
+            return
+        kwargs = dict(filter=filterName) if filterName is not None else {}
+        try:
+            exists = dataRef.datasetExists(datasetType, **kwargs)
+        except Exception:
+            return
+        if not exists:
+            self.getCalibIndex().recordMiss(datasetType, filterName or dataRef.dataId.get("filter"),
+                                            dataRef.dataId, date)
+
+    def readIsrCalib(self, dataRef, datasetType, allowStrips=True, bbox=None):
+        """!Retrieve a calibration exposure, or a reader for strips of it if config.stripHeight > 0
+
+        \param[in]      dataRef         data reference for exposure
+        \param[in]      datasetType     type of dataset to retrieve (e.g. 'bias', 'flat')
+        \param[in]      allowStrips     may the calibration be read in parts (strips or a region)?
+        \param[in]      bbox            if not None, read only this region (in PARENT coordinates),
+                                        if allowStrips and the calibration need not be assembled
+        \return exposure, or CalibRegionReader
+        """
+        if allowStrips and not self.config.doAssembleIsrExposures:
+            if bbox is not None:
+                return self.getIsrExposure(dataRef, datasetType, bbox=bbox)
+            if self.config.stripHeight > 0:
+                return CalibRegionReader(self, dataRef, datasetType)
+        return self.getIsrExposure(dataRef, datasetType)
+
     def saturationDetection(self, exposure, amp):
         """!Detect saturated pixels and mask them using mask plane config.saturatedMaskName, in place
 
@@ -622,17 +2767,17 @@ class IsrTask(pipeBase.CmdLineTask):
         if not math.isnan(amp.getSaturation()):
             maskedImage = exposure.getMaskedImage()
             dataView = maskedImage.Factory(maskedImage, amp.getRawBBox())
-            isrFunctions.makeThresholdMask(
+            isrFunctions.setThresholdMask(
                 maskedImage=dataView,
                 threshold=amp.getSaturation(),
-                growFootprints=0,
                 maskName=self.config.saturatedMaskName,
             )
 
-    def saturationInterpolation(self, ccdExposure):
+    def saturationInterpolation(self, ccdExposure, psf=None):
         """!Interpolate over saturated pixels, in place
 
         \param[in,out]  ccdExposure     exposure to process
+        \param[in]      psf             PSF used for interpolation; if None, made from config.fwhm
 
         \warning:
         - Call saturationDetection first, so that saturated pixels have been identified in the "SAT" mask.
@@ -643,6 +2788,7 @@ class IsrTask(pipeBase.CmdLineTask):
             fwhm=self.config.fwhm,
             growFootprints=self.config.growSaturationFootprintSize,
             maskName=self.config.saturatedMaskName,
+            psf=psf,
         )
 
     def suspectDetection(self, exposure, amp):
@@ -663,10 +2809,9 @@ class IsrTask(pipeBase.CmdLineTask):
 
         maskedImage = exposure.getMaskedImage()
         dataView = maskedImage.Factory(maskedImage, amp.getRawBBox())
-        isrFunctions.makeThresholdMask(
+        isrFunctions.setThresholdMask(
             maskedImage=dataView,
             threshold=suspectLevel,
-            growFootprints=0,
             maskName=self.config.suspectMaskName,
         )
 
@@ -678,20 +2823,33 @@ class IsrTask(pipeBase.CmdLineTask):
 
         \warning: call this after CCD assembly, since defects may cross amplifier boundaries
         """
+        self.maskAndInterpDefectList(ccdExposure, self.convertDefects(defectBaseList))
+
+    def convertDefects(self, defectBaseList):
+        """!Convert a list of defects to a list of lsst.meas.algorithms.Defect
+
+        \param[in] defectBaseList a list of defects (lsst.meas.algorithms.DefectBase or subclass)
+        \return a list of lsst.meas.algorithms.Defect
+        """
+        return [measAlg.Defect(d.getBBox()) for d in defectBaseList]
+
+    def maskAndInterpDefectList(self, ccdExposure, defectList, psf=None):
+        """!Mask defects using mask plane "BAD" and interpolate over them, in place
+
+        \param[in,out]  ccdExposure     exposure to process
+        \param[in] defectList a list of defects (lsst.meas.algorithms.Defect); see convertDefects
+        \param[in] psf PSF used for interpolation; if None, made from config.fwhm
+        """
         maskedImage = ccdExposure.getMaskedImage()
-        defectList = []
-        for d in defectBaseList:
-            bbox = d.getBBox()
-            nd = measAlg.Defect(bbox)
-            defectList.append(nd)
         isrFunctions.maskPixelsFromDefectList(maskedImage, defectList, maskName='BAD')
         isrFunctions.interpolateDefectList(
             maskedImage=maskedImage,
             defectList=defectList,
             fwhm=self.config.fwhm,
+            psf=psf,
         )
 
-    def maskAndInterpNan(self, exposure):
+    def maskAndInterpNan(self, exposure, psf=None):
         """!Mask NaNs using mask plane "UNMASKEDNAN" and interpolate over them, in place
 
         We mask and interpolate over all NaNs, including those
@@ -701,6 +2859,7 @@ class IsrTask(pipeBase.CmdLineTask):
         is used to preserve the historical name.
 
         \param[in,out]  exposure        exposure to process
+        \param[in]      psf             PSF used for interpolation; if None, made from config.fwhm
         """
         maskedImage = exposure.getMaskedImage()
 
@@ -722,6 +2881,7 @@ class IsrTask(pipeBase.CmdLineTask):
                 maskedImage=exposure.getMaskedImage(),
                 defectList=nanDefectList,
                 fwhm=self.config.fwhm,
+                psf=psf,
             )
 
     def overscanCorrection(self, exposure, amp):
@@ -809,6 +2969,7 @@ class IsrTask(pipeBase.CmdLineTask):
             kernelImage = afwImage.ImageD(kLx, kLy)
             kernelImage.getArray()[:, :] = kernel
             tempImage = image.clone()
+            recordBuffer("brighterFatterCorrection tempImage", tempImage)
 
             nanIndex = numpy.isnan(tempImage.getArray())
             tempImage.getArray()[nanIndex] = 0.
@@ -816,6 +2977,9 @@ class IsrTask(pipeBase.CmdLineTask):
             outImage = afwImage.ImageF(image.getDimensions())
             corr = numpy.zeros_like(image.getArray())
             prev_image = numpy.zeros_like(image.getArray())
+            recordBuffer("brighterFatterCorrection outImage", outImage)
+            recordBuffer("brighterFatterCorrection corr", corr)
+            recordBuffer("brighterFatterCorrection prev_image", prev_image)
             convCntrl = afwMath.ConvolutionControl(False, True, 1)
             fixedKernel = afwMath.FixedKernel(kernelImage)
 
@@ -863,6 +3027,39 @@ class IsrTask(pipeBase.CmdLineTask):
             image.getArray()[startY + 1:endY - 1, startX + 1:endX - 1] += \
                 corr[startY + 1:endY - 1, startX + 1:endX - 1]
 
+    def brighterFatterCorrectionByStrips(self, exposure, kernel, maxIter, threshold, applyGain):
+        """Apply brighter fatter correction in place, one strip of config.stripHeight rows at a time
+
+        Each strip is corrected together with a halo of rows on either side that is wide enough for
+        the correction of the strip to be independent of pixels outside it for all maxIter iterations,
+        so only strip-sized work buffers are allocated.  The exposure itself is still held in full;
+        this bounds only the work buffers of the correction.
+
+        Each strip stops iterating when its own summed difference between iterations is below its share
+        of threshold (threshold scaled by the fraction of the image's rows in the strip and its halo),
+        so strips may stop after different numbers of iterations.  Thus the result is identical to that
+        of brighterFatterCorrection when every strip and the full frame run maxIter iterations (e.g. if
+        threshold is 0), and otherwise differs from it by an amount of the order of the convergence
+        tolerance: the summed absolute difference is normally less than threshold.
+
+        See brighterFatterCorrection for the parameters.
+        """
+        # Each iteration depends on pixels within the kernel half-width, plus one for the derivatives
+        halo = maxIter*(max(numpy.shape(kernel))//2 + 1)
+        image = exposure.getMaskedImage().getImage()
+        bbox = image.getBBox()
+        for stripBBox in isrFunctions.makeStripBBoxes(bbox, self.config.stripHeight):
+            haloBBox = afwGeom.Box2I(stripBBox)
+            haloBBox.grow(afwGeom.Extent2I(0, halo))
+            haloBBox.clip(bbox)
+            stripImage = image.Factory(image, haloBBox, afwImage.PARENT, True)
+            recordBuffer("brighterFatterCorrectionByStrips stripImage", stripImage)
+            stripExposure = afwImage.ExposureF(afwImage.MaskedImageF(stripImage))
+            stripExposure.setDetector(exposure.getDetector())
+            self.brighterFatterCorrection(stripExposure, kernel, maxIter,
+                                          threshold*haloBBox.getHeight()/bbox.getHeight(), applyGain)
+            outView = image.Factory(image, stripBBox)
+            outView.getArray()[:, :] = stripImage.Factory(stripImage, stripBBox).getArray()
 
     @contextmanager
     def gainContext(self, exp, image, apply):
@@ -871,8 +3068,9 @@ class IsrTask(pipeBase.CmdLineTask):
         if apply:
             ccd = exp.getDetector()
             for amp in ccd:
-                sim = image.Factory(image, amp.getBBox())
-                sim *= amp.getGain()
+                sim = self._getAmpImage(image, amp)
+                if sim is not None:
+                    sim *= amp.getGain()
 
         try:
             yield exp
@@ -880,8 +3078,223 @@ class IsrTask(pipeBase.CmdLineTask):
             if apply:
                 ccd = exp.getDetector()
                 for amp in ccd:
-                    sim = image.Factory(image, amp.getBBox())
-                    sim /= amp.getGain()
+                    sim = self._getAmpImage(image, amp)
+                    if sim is not None:
+                        sim /= amp.getGain()
+
+    @staticmethod
+    def _getAmpImage(image, amp):
+        """Get a view of the part of an amplifier contained in an image, or None if they do not overlap
+        """
+        bbox = afwGeom.Box2I(amp.getBBox())
+        bbox.clip(image.getBBox())
+        if bbox.isEmpty():
+            return None
+        return image.Factory(image, bbox)
+
+
+class CalibRegionReader(object):
+    """Read regions of a calibration exposure on demand, instead of the whole exposure
+
+    Attribute calibKey identifies the calibration without reading it (see IsrTask.getCalibHandleKey).
+    Reads are serialized, so a reader may be shared by threads processing different amplifiers.
+    """
+
+    def __init__(self, task, dataRef, datasetType):
+        """Construct a CalibRegionReader
+
+        @param[in] task  IsrTask used to read the calibration (see IsrTask.getIsrExposure)
+        @param[in] dataRef  data reference for the science exposure
+        @param[in] datasetType  type of calibration dataset (e.g. 'bias', 'flat')
+        """
+        self._task = task
+        self._dataRef = dataRef
+        self.datasetType = datasetType
+        self.dataId = dataRef.dataId
+        self.calibKey = task.getCalibHandleKey(dataRef, datasetType)
+        self._lock = threading.Lock()
+
+    def read(self, bbox):
+        """Read a region of the calibration
+
+        @param[in] bbox  region to read (an afw.geom.Box2I in PARENT coordinates)
+        @return calibration exposure covering bbox
+        """
+        with self._lock:
+            return self._task.getIsrExposure(self._dataRef, self.datasetType, bbox=bbox)
+
+
+class LazyCalib(object):
+    """A handle to a calibration product that is loaded when it is first needed and may be released
+
+    Attribute calibKey identifies the product without loading it (see IsrTask.getCalibHandleKey
+    and StageCache.digestObject); the data ID is that of the science exposure, so it does not.
+    Loading is serialized, so a handle may be shared by threads.
+    """
+
+    def __init__(self, loadFunc, datasetType, dataId, calibKey=None):
+        """Construct a LazyCalib
+
+        @param[in] loadFunc  function that takes no arguments and returns the calibration product
+        @param[in] datasetType  type of calibration dataset (e.g. 'bias', 'flat')
+        @param[in] dataId  data ID of the science exposure
+        @param[in] calibKey  key identifying the calibration product, e.g. from IsrTask.getCalibHandleKey;
+                    None if unknown, in which case the product is not identified by the stage cache
+                    and checkpoints, so stages that use it are always run
+        """
+        self._loadFunc = loadFunc
+        self.datasetType = datasetType
+        self.dataId = dataId
+        self.calibKey = calibKey
+        self._value = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Get the calibration product, loading it if it is not loaded
+        """
+        with self._lock:
+            if self._value is None:
+                self._value = self._loadFunc()
+            return self._value
+
+    def isLoaded(self):
+        """Is the calibration product loaded?
+        """
+        return self._value is not None
+
+    def release(self):
+        """Drop this handle's reference to the calibration product; get will load it again
+        """
+        with self._lock:
+            self._value = None
+
+    def derive(self, func):
+        """Make a LazyCalib of a function of this calibration product, e.g. a region of it
+
+        When the new handle is loaded this one is released, so only the derived product is held.
+
+        @param[in] func  function that takes the calibration product and returns the derived product
+        @return a LazyCalib with the same dataset type, data ID and calibKey; the derived product must be
+            determined by the product and by inputs that are identified separately (e.g. the region
+            of the science exposure to which the product is cropped; see IsrTask.cropToRegion)
+        """
+        def loadFunc():
+            value = func(self.get())
+            self.release()
+            return value
+        return LazyCalib(loadFunc, self.datasetType, self.dataId, calibKey=self.calibKey)
+
+
+class IsrPlan(object):
+    """Per-detector information used by IsrTask, derived once and reused for every exposure
+
+    Deriving amplifier geometry and parameters, the linearity type and the interpolation PSF
+    is cheap for one exposure, but dominates processing time for small frames.
+    IsrTask.getPlan caches one plan per detector and configuration.
+
+    Attributes:
+    - amps: list of CachedAmp (or FakeAmp if the exposure has no detector)
+    - ampBBoxArr: int array of shape (number of amps, 4) with minX, minY, maxX, maxY of each amp bbox
+    - doLinearize: is linearization wanted for this detector? (see IsrTask.doLinearize)
+    - linearityType: linearity type of the first amplifier, or None if there is no detector
+    - psf: PSF used for interpolation, made from config.fwhm
+    """
+
+    def __init__(self, task, ccd):
+        """!Construct an IsrPlan
+
+        \param[in] task -- the IsrTask that will use this plan
+        \param[in] ccd -- detector information (an lsst.afw.cameraGeom.Detector), or a list of FakeAmp
+        """
+        if isinstance(ccd, list):
+            self.amps = ccd
+            self.linearityType = None
+            self.doLinearize = False
+        else:
+            self.amps = [CachedAmp(amp) for amp in ccd]
+            self.linearityType = ccd.getAmpInfoCatalog()[0].getLinearityType()
+            self.doLinearize = task.doLinearize(ccd)
+        self.ampBBoxArr = numpy.array([[bbox.getMinX(), bbox.getMinY(), bbox.getMaxX(), bbox.getMaxY()]
+                                       for bbox in (amp.getBBox() for amp in self.amps)], dtype=int)
+        self.psf = isrFunctions.createPsf(task.config.fwhm)
+        self._containedAmps = {}
+        self._lock = threading.Lock()
+
+    def getContainedAmps(self, bbox):
+        """!Get the amplifiers whose bounding box is contained in a bounding box
+
+        \param[in] bbox -- bounding box, e.g. of a raw or assembled exposure
+        \return a list of (index, amp, slices), where index is the index of amp in self.amps
+            and slices is a tuple of (y slice, x slice) locating amp in an array covering bbox
+        """
+        key = (bbox.getMinX(), bbox.getMinY(), bbox.getMaxX(), bbox.getMaxY())
+        with self._lock:
+            containedAmps = self._containedAmps.get(key)
+            if containedAmps is None:
+                minX, minY, maxX, maxY = key
+                arr = self.ampBBoxArr
+                isContained = (arr[:, 0] >= minX) & (arr[:, 1] >= minY) & \
+                    (arr[:, 2] <= maxX) & (arr[:, 3] <= maxY)
+                containedAmps = [(i, self.amps[i],
+                                  (slice(arr[i, 1] - minY, arr[i, 3] - minY + 1),
+                                   slice(arr[i, 0] - minX, arr[i, 2] - minX + 1)))
+                                 for i in numpy.flatnonzero(isContained)]
+                self._containedAmps[key] = containedAmps
+        return containedAmps
+
+
+class CachedAmp(object):
+    """A Detector-like amplifier that returns values read once from an amplifier record
+    """
+
+    def __init__(self, amp):
+        """!Construct a CachedAmp
+
+        \param[in] amp -- amplifier information (an lsst.afw.table.AmpInfoRecord)
+        """
+        self._name = amp.getName()
+        self._bbox = amp.getBBox()
+        self._gain = amp.getGain()
+        self._readNoise = amp.getReadNoise()
+        self._saturation = amp.getSaturation()
+        self._suspectLevel = amp.getSuspectLevel()
+        self._hasRawInfo = amp.getHasRawInfo()
+        if self._hasRawInfo:
+            self._rawBBox = amp.getRawBBox()
+            self._rawDataBBox = amp.getRawDataBBox()
+            self._rawHorizontalOverscanBBox = amp.getRawHorizontalOverscanBBox()
+        else:
+            self._rawBBox = self._rawDataBBox = self._rawHorizontalOverscanBBox = None
+
+    def getName(self):
+        return self._name
+
+    def getBBox(self):
+        return self._bbox
+
+    def getRawBBox(self):
+        return self._rawBBox
+
+    def getRawDataBBox(self):
+        return self._rawDataBBox
+
+    def getHasRawInfo(self):
+        return self._hasRawInfo
+
+    def getRawHorizontalOverscanBBox(self):
+        return self._rawHorizontalOverscanBBox
+
+    def getGain(self):
+        return self._gain
+
+    def getReadNoise(self):
+        return self._readNoise
+
+    def getSaturation(self):
+        return self._saturation
+
+    def getSuspectLevel(self):
+        return self._suspectLevel
 
 
 class FakeAmp(object):
@@ -72,6 +72,19 @@ class LinearizeBase(with_metaclass(abc.ABCMeta, object)):
         if self.LinearityType != ampInfoType:
             raise RuntimeError("Linearity types don't match: %s != %s" % (self.LinearityType, ampInfoType))
 
+    def getAmpParams(self, detector):
+        """Get per-amplifier parameters for the fused detrending kernel (lsst.ip.isr.applyDetrend)
+
+        @param[in] detector  detector information (an instance of lsst::afw::cameraGeom::Detector)
+
+        @return a list with one lsst.pipe.base.Struct per amplifier containing:
+        - sqCoeff  coefficient of the squared model (0 if not used)
+        - table  lookup table row (a 1-dimensional array; empty if not used)
+        - indOffset  lookup table column offset
+        or None if this linearizer cannot be expressed in those terms (the default)
+        """
+        return None
+
 
 class LinearizeLookupTable(LinearizeBase):
     """Correct non-linearity with a persisted lookup table
@@ -190,6 +203,21 @@ class LinearizeLookupTable(LinearizeBase):
                                (numAmps, len(self._rowIndArr)))
         self.checkLinearityType(detector)
 
+    def getAmpParams(self, detector):
+        """Get per-amplifier parameters for the fused detrending kernel (lsst.ip.isr.applyDetrend)
+
+        @param[in] detector  detector info about image (an lsst.afw.cameraGeom.Detector);
+                    the name, serial and number of amplifiers must match persisted data
+
+        @return a list with one lsst.pipe.base.Struct per amplifier; see LinearizeBase.getAmpParams
+
+        @throw RuntimeError if the linearity type is wrong or if the detector name, serial
+            or number of amplifiers does not match the saved data
+        """
+        self.checkDetector(detector)
+        return [Struct(sqCoeff=0.0, table=self._table[rowInd, :], indOffset=colIndOffset)
+                for rowInd, colIndOffset in zip(self._rowIndArr, self._colIndOffsetArr)]
+
 
 class LinearizeSquared(LinearizeBase):
     """Correct non-linearity with a squared model
@@ -233,3 +261,16 @@ class LinearizeSquared(LinearizeBase):
             numAmps=numAmps,
             numLinearized=numLinearized,
         )
+
+    def getAmpParams(self, detector):
+        """Get per-amplifier parameters for the fused detrending kernel (lsst.ip.isr.applyDetrend)
+
+        @param[in] detector  detector info about image (an lsst.afw.cameraGeom.Detector)
+
+        @return a list with one lsst.pipe.base.Struct per amplifier; see LinearizeBase.getAmpParams
+
+        @throw RuntimeError if the linearity type is wrong
+        """
+        self.checkLinearityType(detector)
+        return [Struct(sqCoeff=ampInfo.getLinearityCoeffs()[0], table=np.zeros(0), indOffset=0.0)
+                for ampInfo in detector.getAmpInfoCatalog()]
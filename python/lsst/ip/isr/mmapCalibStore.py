@@ -0,0 +1,143 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy
+
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+
+__all__ = ["MmapCalibStore"]
+
+
+class MmapCalibStore(object):
+    """A directory of calibration exposures stored uncompressed, to be memory-mapped
+
+    Each entry is a directory holding one raw binary file per plane (image, mask and variance),
+    which starts at offset 0 and so is page-aligned, an index of their types and shapes, and a
+    single-pixel FITS file carrying the rest of the exposure (metadata, WCS, filter, etc.).
+
+    read maps the plane files copy-on-write: the files are opened read-only and all processes
+    reading the same entry share the pages in the page cache. A process that modifies an exposure
+    gets private copies of just the pages it writes; the files are never modified.
+
+    Entries are written to a temporary directory that is then renamed, so a partially written
+    entry is never read, and several processes may race to write the same entry.
+    """
+    planeNames = ("image", "mask", "variance")
+
+    def __init__(self, directory):
+        """Construct a MmapCalibStore
+
+        @param[in] directory  directory in which to store entries; created if necessary
+        """
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def makeKey(*items):
+        """Make a key from items that identify a calibration (e.g. dataset type and file names)
+
+        @param[in] *items  items whose repr identifies the calibration
+        @return key (str)
+        """
+        return hashlib.md5(repr(items).encode()).hexdigest()
+
+    def has(self, key):
+        """Is there an entry for this key?
+        """
+        return os.path.isdir(self._getPath(key))
+
+    def write(self, key, exposure):
+        """Materialize an exposure
+
+        @param[in] key  key of entry
+        @param[in] exposure  exposure to write; must be an lsst.afw.image.ExposureF
+        @return True if written (or already present); False if the exposure is of a type that cannot be stored
+        """
+        if not isinstance(exposure, afwImage.ExposureF):
+            return False
+        path = self._getPath(key)
+        if os.path.isdir(path):
+            return True
+        tempPath = "%s.%d.part" % (path, os.getpid())
+        if os.path.isdir(tempPath):
+            shutil.rmtree(tempPath)
+        os.makedirs(tempPath)
+        try:
+            maskedImage = exposure.getMaskedImage()
+            index = dict(xy0=[exposure.getX0(), exposure.getY0()], planes={})
+            planes = (maskedImage.getImage(), maskedImage.getMask(), maskedImage.getVariance())
+            for name, plane in zip(self.planeNames, planes):
+                array = numpy.ascontiguousarray(plane.getArray())
+                array.tofile(os.path.join(tempPath, name + ".bin"))
+                index["planes"][name] = [array.dtype.str, list(array.shape)]
+            header = exposure.Factory(exposure, afwGeom.Box2I(exposure.getXY0(), afwGeom.Extent2I(1, 1)),
+                                      afwImage.PARENT, True)
+            header.writeFits(os.path.join(tempPath, "header.fits"))
+            with open(os.path.join(tempPath, "index.json"), "w") as indexFile:
+                json.dump(index, indexFile)
+            os.rename(tempPath, path)
+        except OSError:
+            # another process may have written the entry first
+            shutil.rmtree(tempPath, ignore_errors=True)
+            if not os.path.isdir(path):
+                raise
+        except Exception:
+            shutil.rmtree(tempPath, ignore_errors=True)
+            raise
+        return True
+
+    def read(self, key):
+        """Get a memory-mapped exposure
+
+        @param[in] key  key of entry
+        @return an lsst.afw.image.ExposureF whose planes are mapped copy-on-write from the entry's files,
+            or None if there is no such entry
+        """
+        path = self._getPath(key)
+        if not os.path.isdir(path):
+            return None
+        with open(os.path.join(path, "index.json")) as indexFile:
+            index = json.load(indexFile)
+        xy0 = afwGeom.Point2I(*index["xy0"])
+        arrays = {}
+        for name in self.planeNames:
+            dtype, shape = index["planes"][name]
+            arrays[name] = numpy.memmap(os.path.join(path, name + ".bin"), dtype=numpy.dtype(dtype),
+                                        mode="c", shape=tuple(shape))
+        maskedImage = afwImage.MaskedImageF(afwImage.ImageF(arrays["image"], False, xy0),
+                                            afwImage.Mask(arrays["mask"], False, xy0),
+                                            afwImage.ImageF(arrays["variance"], False, xy0))
+        exposure = afwImage.ExposureF(os.path.join(path, "header.fits"))
+        exposure.setMaskedImage(maskedImage)
+        return exposure
+
+    def _getPath(self, key):
+        return os.path.join(self.directory, key)
@@ -0,0 +1,152 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object, range
+
+import sys
+import threading
+
+from future.utils import raise_
+
+__all__ = ["Prefetcher"]
+
+
+class Prefetcher(object):
+    """Read items ahead of their use on background threads
+
+    Iterating over a Prefetcher yields the result of readFunc for each item, in order. While the
+    caller uses one result, up to depth further items are read on background threads. A read
+    does not start while the results that are ready but not yet used total maxBytes or more,
+    so the memory held by prefetched data is bounded.
+
+    An exception raised by readFunc is raised by the iteration that would have yielded its result.
+    Prefetching stops when iteration ends or close is called; close waits for reads in progress.
+    """
+
+    def __init__(self, readFunc, items, depth=1, maxBytes=0, numThreads=1, sizeFunc=None):
+        """Construct a Prefetcher and start reading
+
+        @param[in] readFunc  function that reads one item; takes the item as its only argument
+        @param[in] items  items to read
+        @param[in] depth  maximum number of items read ahead of the one being used; 0 to read each item
+                    only when it is needed, on the calling thread
+        @param[in] maxBytes  maximum total size of results read ahead (bytes), as measured by sizeFunc;
+                    0 for no limit. At least one item is always read ahead, whatever its size.
+        @param[in] numThreads  number of background threads
+        @param[in] sizeFunc  function that returns the size (bytes) of a result of readFunc,
+                    or None if maxBytes is 0
+        """
+        self.readFunc = readFunc
+        self.items = list(items)
+        self.depth = depth
+        self.maxBytes = maxBytes
+        self.sizeFunc = sizeFunc
+        if maxBytes > 0 and sizeFunc is None:
+            raise RuntimeError("sizeFunc must be specified if maxBytes > 0")
+        self._cond = threading.Condition()
+        self._results = {}  # index: (result, exc_info, size)
+        self._nextRead = 0
+        self._nextUse = 0
+        self._readyBytes = 0
+        self._closed = False
+        self._threads = []
+        if depth > 0:
+            for i in range(max(1, min(numThreads, depth))):
+                thread = threading.Thread(target=self._readLoop, name="IsrPrefetch-%d" % (i,))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def __iter__(self):
+        try:
+            for index in range(len(self.items)):
+                if self.depth <= 0:
+                    yield self.readFunc(self.items[index])
+                    continue
+                with self._cond:
+                    while index not in self._results:
+                        self._cond.wait()
+                    result, excInfo, size = self._results.pop(index)
+                    self._readyBytes -= size
+                    self._nextUse = index + 1
+                    self._cond.notify_all()
+                if excInfo is not None:
+                    raise_(*excInfo)
+                yield result
+                del result
+        finally:
+            self.close()
+
+    def __len__(self):
+        return len(self.items)
+
+    def close(self):
+        """Stop prefetching and wait for reads in progress to finish; unused results are discarded
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        with self._cond:
+            self._results = {}
+            self._readyBytes = 0
+
+    def _mayRead(self):
+        """Can another read start? The caller must hold self._cond
+        """
+        if self._nextRead >= len(self.items):
+            return False
+        # items read or being read ahead of the next one to be used
+        if self._nextRead - self._nextUse >= self.depth:
+            return False
+        if self.maxBytes > 0 and self._results and self._readyBytes >= self.maxBytes:
+            return False
+        return True
+
+    def _readLoop(self):
+        """Read items until all are read or the Prefetcher is closed
+        """
+        while True:
+            with self._cond:
+                while not self._closed and not self._mayRead():
+                    if self._nextRead >= len(self.items):
+                        return
+                    self._cond.wait()
+                if self._closed:
+                    return
+                index = self._nextRead
+                self._nextRead += 1
+            result, excInfo, size = None, None, 0
+            try:
+                result = self.readFunc(self.items[index])
+                if self.maxBytes > 0:
+                    size = self.sizeFunc(result)
+            except Exception:
+                excInfo = sys.exc_info()
+            with self._cond:
+                if not self._closed:
+                    self._results[index] = (result, excInfo, size)
+                    self._readyBytes += size
+                self._cond.notify_all()
+            del result
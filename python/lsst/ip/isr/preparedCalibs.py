@@ -0,0 +1,186 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object
+
+import numpy
+
+from .instrumentation import recordBuffer
+
+__all__ = ["PreparedCalibs"]
+
+
+class PreparedCalibs(object):
+    """Products derived once from a bias, dark and flat, so that correcting an exposure
+    needs only multiplications and additions
+
+    The products are:
+    - the bias image and variance (used as they are)
+    - the dark rate: the dark image and variance divided by the dark time and its square,
+        so the dark correction is image -= expTime*rate, variance += expTime**2*rateVariance
+    - the reciprocal flat with the flat scale folded in (flatScale/flat), its square and the
+        flat variance term (flat variance/flatScale**2 * reciprocal flat**4), so the flat correction is
+        variance = variance*reciprocal**2 + image**2*varianceTerm, image *= reciprocal
+    - the calibration masks; if mergeMasks is True they are ORed together once and applied by the last
+        correction, otherwise each is applied by its own correction. Masks that are all zero are skipped.
+
+    The results match isrFunctions.biasCorrection, darkCorrection and flatCorrection to within
+    floating point rounding.
+    """
+
+    def __init__(self, bias=None, dark=None, flat=None, darkTime=1.0, flatScale=1.0, mergeMasks=False):
+        """Construct a PreparedCalibs
+
+        @param[in] bias  bias exposure, or None
+        @param[in] dark  dark exposure, or None
+        @param[in] flat  flat field exposure, or None
+        @param[in] darkTime  dark time of dark
+        @param[in] flatScale  scale by which the flat is divided (see isrFunctions.getFlatScale)
+        @param[in] mergeMasks  merge the calibration masks and apply them with the last correction?
+                    Only correct if nothing between the corrections uses the mask plane.
+        """
+        self.shape = None
+        for calib in (bias, dark, flat):
+            if calib is None:
+                continue
+            shape = calib.getMaskedImage().getImage().getArray().shape
+            if self.shape is not None and shape != self.shape:
+                raise RuntimeError("Calibration shapes differ: %s != %s" % (shape, self.shape))
+            self.shape = shape
+
+        masks = {}
+        self.biasImage = self.biasVariance = None
+        if bias is not None:
+            maskedImage = bias.getMaskedImage()
+            self.biasImage = maskedImage.getImage().getArray()
+            self.biasVariance = maskedImage.getVariance().getArray()
+            masks["bias"] = maskedImage.getMask().getArray()
+
+        self.darkRate = self.darkRateVariance = None
+        if dark is not None:
+            maskedImage = dark.getMaskedImage()
+            self.darkRate = maskedImage.getImage().getArray()/darkTime
+            self.darkRateVariance = maskedImage.getVariance().getArray()/darkTime**2
+            recordBuffer("PreparedCalibs dark rate", self.darkRate)
+            masks["dark"] = maskedImage.getMask().getArray()
+
+        self.flatReciprocal = self.flatReciprocalSq = self.flatVarianceTerm = None
+        if flat is not None:
+            maskedImage = flat.getMaskedImage()
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                self.flatReciprocal = flatScale/maskedImage.getImage().getArray()
+            self.flatReciprocalSq = self.flatReciprocal**2
+            flatVariance = maskedImage.getVariance().getArray()
+            if flatVariance.any():
+                self.flatVarianceTerm = flatVariance*self.flatReciprocalSq**2/flatScale**2
+            recordBuffer("PreparedCalibs reciprocal flat", self.flatReciprocal)
+            masks["flat"] = maskedImage.getMask().getArray()
+
+        self.masks = {}
+        if mergeMasks and masks:
+            lastName = [name for name in ("bias", "dark", "flat") if name in masks][-1]
+            merged = None
+            for mask in masks.values():
+                if mask.any():
+                    merged = mask.copy() if merged is None else merged | mask
+            if merged is not None:
+                self.masks[lastName] = merged
+        else:
+            self.masks = dict((name, mask) for name, mask in masks.items() if mask.any())
+
+    arrayNames = ("biasImage", "biasVariance", "darkRate", "darkRateVariance",
+                  "flatReciprocal", "flatReciprocalSq", "flatVarianceTerm")
+
+    def getArrays(self):
+        """Get the products as arrays, e.g. to store them (see DerivedCalibStore)
+
+        @return dict of name: numpy array; masks are named "<correction>Mask"
+        """
+        arrays = dict((name, getattr(self, name)) for name in self.arrayNames
+                      if getattr(self, name) is not None)
+        arrays.update((name + "Mask", mask) for name, mask in self.masks.items())
+        return arrays
+
+    @classmethod
+    def fromArrays(cls, arrays):
+        """Make a PreparedCalibs from the arrays returned by getArrays
+
+        @param[in] arrays  dict of name: numpy array, as returned by getArrays
+        @return a PreparedCalibs
+        """
+        self = cls.__new__(cls)
+        for name in self.arrayNames:
+            setattr(self, name, arrays.get(name))
+        self.masks = dict((name[:-len("Mask")], array) for name, array in arrays.items()
+                          if name.endswith("Mask"))
+        self.shape = tuple(next(iter(arrays.values())).shape) if arrays else None
+        return self
+
+    def correctBias(self, maskedImage):
+        """Apply bias correction in place
+
+        @param[in,out] maskedImage  afw.image.MaskedImage to correct, of the same size as the calibrations
+        """
+        self._checkShape(maskedImage)
+        imageArray = maskedImage.getImage().getArray()
+        imageArray -= self.biasImage
+        varianceArray = maskedImage.getVariance().getArray()
+        varianceArray += self.biasVariance
+        self._applyMask(maskedImage, "bias")
+
+    def correctDark(self, maskedImage, expTime):
+        """Apply dark correction in place
+
+        @param[in,out] maskedImage  afw.image.MaskedImage to correct, of the same size as the calibrations
+        @param[in] expTime  dark time of the exposure
+        """
+        self._checkShape(maskedImage)
+        imageArray = maskedImage.getImage().getArray()
+        imageArray -= (expTime*self.darkRate).astype(imageArray.dtype, copy=False)
+        varianceArray = maskedImage.getVariance().getArray()
+        varianceArray += (expTime**2*self.darkRateVariance).astype(varianceArray.dtype, copy=False)
+        self._applyMask(maskedImage, "dark")
+
+    def correctFlat(self, maskedImage):
+        """Apply flat correction in place
+
+        @param[in,out] maskedImage  afw.image.MaskedImage to correct, of the same size as the calibrations
+        """
+        self._checkShape(maskedImage)
+        imageArray = maskedImage.getImage().getArray()
+        varianceArray = maskedImage.getVariance().getArray()
+        varianceArray *= self.flatReciprocalSq
+        if self.flatVarianceTerm is not None:
+            varianceArray += imageArray**2*self.flatVarianceTerm
+        imageArray *= self.flatReciprocal
+        self._applyMask(maskedImage, "flat")
+
+    def _checkShape(self, maskedImage):
+        shape = maskedImage.getImage().getArray().shape
+        if shape != self.shape:
+            raise RuntimeError("maskedImage shape %s != calibration shape %s" % (shape, self.shape))
+
+    def _applyMask(self, maskedImage, name):
+        mask = self.masks.get(name)
+        if mask is not None:
+            maskArray = maskedImage.getMask().getArray()
+            maskArray |= mask
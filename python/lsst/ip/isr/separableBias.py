@@ -0,0 +1,222 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object, zip
+
+import numpy
+
+import lsst.pipe.base as pipeBase
+
+__all__ = ["SeparableBiasModel"]
+
+
+class SeparableBiasModel(object):
+    """A compact model of a bias frame: a row vector and a column vector per amplifier plus a sparse
+    residual
+
+    Within each amplifier the bias is modelled as row[y] + column[x], where row is the median of each
+    row of the amplifier and column is the median of each column once row has been subtracted.
+    A pixel whose residual from this model exceeds threshold times the amplifier's robust standard
+    deviation of the residual, that is masked in the bias, or that is not in any amplifier is listed
+    individually with its residual. The variance is modelled as the amplifier's median variance plus
+    the sparse residuals, as for SparseDarkModel.
+
+    apply subtracts the model by broadcasting the vectors over each amplifier and scattering the
+    sparse residuals, with no full-frame calibration image.
+    """
+    arrayNames = ("ampBoxes", "rowValues", "columnValues", "ampVariances", "residualX", "residualY",
+                  "residuals", "residualVariances", "residualMasks")
+
+    def __init__(self, ampBoxes, rowValues, columnValues, ampVariances, residualX, residualY, residuals,
+                 residualVariances, residualMasks):
+        """Construct a SeparableBiasModel
+
+        @param[in] ampBoxes  int array of shape (number of amps, 4): minX, minY, maxX, maxY
+                    (inclusive, PARENT coordinates) of each amplifier
+        @param[in] rowValues  row vectors of the amplifiers, concatenated in the order of ampBoxes
+        @param[in] columnValues  column vectors of the amplifiers, concatenated in the order of ampBoxes
+        @param[in] ampVariances  variance of the bias of each amplifier
+        @param[in] residualX, residualY  int arrays of the PARENT positions of the sparse residuals
+        @param[in] residuals  bias of each of those pixels, less the row and column model
+        @param[in] residualVariances  variance of each of those pixels, less that of its amplifier
+        @param[in] residualMasks  mask value of each of those pixels in the bias
+        """
+        self.ampBoxes = numpy.asarray(ampBoxes, dtype=numpy.int32).reshape(-1, 4)
+        self.rowValues = numpy.asarray(rowValues, dtype=numpy.float32)
+        self.columnValues = numpy.asarray(columnValues, dtype=numpy.float32)
+        self.ampVariances = numpy.asarray(ampVariances, dtype=float)
+        self.residualX = numpy.asarray(residualX, dtype=numpy.int32)
+        self.residualY = numpy.asarray(residualY, dtype=numpy.int32)
+        self.residuals = numpy.asarray(residuals, dtype=numpy.float32)
+        self.residualVariances = numpy.asarray(residualVariances, dtype=numpy.float32)
+        self.residualMasks = numpy.asarray(residualMasks)
+        heights = self.ampBoxes[:, 3] - self.ampBoxes[:, 1] + 1
+        widths = self.ampBoxes[:, 2] - self.ampBoxes[:, 0] + 1
+        if heights.sum() != len(self.rowValues) or widths.sum() != len(self.columnValues):
+            raise RuntimeError("Row and column vectors (%d, %d values) do not match the amplifiers "
+                               "(%d rows, %d columns)" % (len(self.rowValues), len(self.columnValues),
+                                                          heights.sum(), widths.sum()))
+        self._rowStarts = numpy.concatenate([[0], numpy.cumsum(heights)[:-1]]).astype(int)
+        self._columnStarts = numpy.concatenate([[0], numpy.cumsum(widths)[:-1]]).astype(int)
+
+    @classmethod
+    def fromExposure(cls, biasExposure, ampBBoxList, threshold=5.0):
+        """Make a model of a bias exposure
+
+        @param[in] biasExposure  bias exposure
+        @param[in] ampBBoxList  bounding boxes (PARENT coordinates) of the amplifiers
+        @param[in] threshold  threshold for the sparse residuals, in units of the robust standard
+                    deviation (1.4826 times the median absolute deviation) of the residuals of their
+                    amplifier from the row and column model
+        @return a SeparableBiasModel
+        """
+        maskedImage = biasExposure.getMaskedImage()
+        x0, y0 = maskedImage.getX0(), maskedImage.getY0()
+        image = maskedImage.getImage().getArray()
+        variance = maskedImage.getVariance().getArray()
+        maskArray = maskedImage.getMask().getArray()
+        residual = image.astype(float)
+        varianceResidual = variance.astype(float)
+        sparse = maskArray != 0
+        covered = numpy.zeros(image.shape, dtype=bool)
+        ampBoxes, rowValues, columnValues, ampVariances = [], [], [], []
+        for bbox in ampBBoxList:
+            ampBox = [bbox.getMinX(), bbox.getMinY(), bbox.getMaxX(), bbox.getMaxY()]
+            ampSlice = (slice(ampBox[1] - y0, ampBox[3] + 1 - y0), slice(ampBox[0] - x0, ampBox[2] + 1 - x0))
+            ampResidual = residual[ampSlice]
+            rowVector = numpy.median(ampResidual, axis=1)
+            ampResidual -= rowVector[:, numpy.newaxis]
+            columnVector = numpy.median(ampResidual, axis=0)
+            ampResidual -= columnVector[numpy.newaxis, :]
+            sigma = 1.4826*numpy.median(numpy.abs(ampResidual))
+            sparse[ampSlice] |= numpy.abs(ampResidual) > threshold*sigma
+            ampVariance = numpy.median(variance[ampSlice])
+            varianceResidual[ampSlice] -= ampVariance
+            covered[ampSlice] = True
+            ampBoxes.append(ampBox)
+            rowValues.append(rowVector)
+            columnValues.append(columnVector)
+            ampVariances.append(ampVariance)
+        sparse |= ~covered
+        residualY, residualX = numpy.nonzero(sparse)
+        return cls(ampBoxes, numpy.concatenate(rowValues) if rowValues else [],
+                   numpy.concatenate(columnValues) if columnValues else [], ampVariances,
+                   residualX + x0, residualY + y0, residual[residualY, residualX],
+                   varianceResidual[residualY, residualX], maskArray[residualY, residualX])
+
+    def getArrays(self):
+        """Get the model as arrays, e.g. to store it (see DerivedCalibStore)
+
+        @return dict of name: numpy array
+        """
+        return dict((name, getattr(self, name)) for name in self.arrayNames)
+
+    @classmethod
+    def fromArrays(cls, arrays):
+        """Make a SeparableBiasModel from the arrays returned by getArrays
+
+        @param[in] arrays  dict of name: numpy array, as returned by getArrays (or a numpy .npz file
+                    of them)
+        @return a SeparableBiasModel
+        """
+        return cls(*[arrays[name] for name in cls.arrayNames])
+
+    def getNumResiduals(self):
+        """Get the number of sparse residuals
+        """
+        return len(self.residualX)
+
+    def getNumBytes(self):
+        """Get the number of bytes in the arrays of the model
+        """
+        return sum(array.nbytes for array in self.getArrays().values())
+
+    def apply(self, maskedImage):
+        """Apply bias correction in place
+
+        The result matches isrFunctions.biasCorrection with the bias exposure the model was made from,
+        except that pixels that are not sparse residuals are corrected by the row and column model
+        and have the variance of their amplifier.
+
+        @param[in,out] maskedImage  afw.image.MaskedImage to correct; any region of the detector
+        """
+        self.applyToArrays(maskedImage.getImage().getArray(), maskedImage.getVariance().getArray(),
+                           maskedImage.getMask().getArray(), maskedImage.getX0(), maskedImage.getY0())
+
+    def applyToArrays(self, imageArray, varianceArray, maskArray, x0, y0):
+        """Apply bias correction in place to the planes of a masked image
+
+        @param[in,out] imageArray, varianceArray, maskArray  image, variance and mask planes
+        @param[in] x0, y0  PARENT position of the first pixel of the planes
+        """
+        height, width = imageArray.shape
+        for (minX, minY, maxX, maxY), rowStart, columnStart, ampVariance in zip(
+                self.ampBoxes, self._rowStarts, self._columnStarts, self.ampVariances):
+            xBegin, xEnd = max(minX - x0, 0), min(maxX + 1 - x0, width)
+            yBegin, yEnd = max(minY - y0, 0), min(maxY + 1 - y0, height)
+            if xBegin >= xEnd or yBegin >= yEnd:
+                continue
+            rowVector = self.rowValues[rowStart + yBegin + y0 - minY:rowStart + yEnd + y0 - minY]
+            columnVector = self.columnValues[columnStart + xBegin + x0 - minX:columnStart + xEnd + x0 - minX]
+            ampImage = imageArray[yBegin:yEnd, xBegin:xEnd]
+            ampImage -= rowVector[:, numpy.newaxis]
+            ampImage -= columnVector[numpy.newaxis, :]
+            varianceArray[yBegin:yEnd, xBegin:xEnd] += ampVariance
+
+        residualX = self.residualX - x0
+        residualY = self.residualY - y0
+        inside = (residualX >= 0) & (residualX < width) & (residualY >= 0) & (residualY < height)
+        if not inside.all():
+            residualX, residualY = residualX[inside], residualY[inside]
+        imageArray[residualY, residualX] -= self.residuals[inside]
+        varianceArray[residualY, residualX] += self.residualVariances[inside]
+        maskArray[residualY, residualX] |= self.residualMasks[inside].astype(maskArray.dtype)
+
+    def getErrorStats(self, biasExposure):
+        """Measure how well the model approximates a bias exposure
+
+        @param[in] biasExposure  bias exposure, normally the one the model was made from
+        @return an lsst.pipe.base.Struct containing:
+        - rmsError  root mean square of bias - model over all pixels
+        - maxError  maximum absolute value of bias - model
+        - rmsVarianceError  root mean square of the difference in the variance plane
+        - numResiduals  number of sparse residuals
+        - numBytes  number of bytes in the model
+        - biasBytes  number of bytes in the image, mask and variance planes of the bias
+        """
+        maskedImage = biasExposure.getMaskedImage()
+        image = maskedImage.getImage().getArray()
+        variance = maskedImage.getVariance().getArray()
+        mask = maskedImage.getMask().getArray()
+        imageError = image.astype(float)
+        varianceError = numpy.zeros_like(imageError)
+        self.applyToArrays(imageError, varianceError, numpy.zeros_like(mask),
+                           maskedImage.getX0(), maskedImage.getY0())
+        varianceError -= variance
+        return pipeBase.Struct(
+            rmsError=float(numpy.sqrt(numpy.mean(imageError**2))),
+            maxError=float(numpy.abs(imageError).max()),
+            rmsVarianceError=float(numpy.sqrt(numpy.mean(varianceError**2))),
+            numResiduals=self.getNumResiduals(),
+            numBytes=self.getNumBytes(),
+            biasBytes=image.nbytes + variance.nbytes + mask.nbytes,
+        )
@@ -0,0 +1,172 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object, zip
+
+import numpy
+
+__all__ = ["SparseDarkModel"]
+
+
+class SparseDarkModel(object):
+    """A compact model of a dark frame: a dark rate per amplifier plus a sparse list of hot pixels
+
+    The rates are per unit dark time. A pixel is "hot" (listed individually, with its difference from
+    its amplifier's rate) if its rate differs from the amplifier's median rate by more than threshold
+    times the amplifier's robust standard deviation, if it is masked in the dark, or if it is not in any
+    amplifier. The variance rate is modelled the same way, so the dark variance of ordinary pixels is
+    approximated by their amplifier's median.
+
+    apply subtracts the model: a scalar per amplifier and a scatter over the hot pixels, with no
+    full-frame calibration image. The model is a few arrays of (number of hot pixels) elements,
+    so it is orders of magnitude smaller than a dark exposure.
+    """
+    arrayNames = ("ampBoxes", "ampRates", "ampVarianceRates", "hotX", "hotY", "hotRates",
+                  "hotVarianceRates", "hotMasks")
+
+    def __init__(self, ampBoxes, ampRates, ampVarianceRates, hotX, hotY, hotRates, hotVarianceRates,
+                 hotMasks):
+        """Construct a SparseDarkModel
+
+        @param[in] ampBoxes  int array of shape (number of amps, 4): minX, minY, maxX, maxY
+                    (inclusive, PARENT coordinates) of each amplifier
+        @param[in] ampRates  dark rate of each amplifier
+        @param[in] ampVarianceRates  variance of the dark rate of each amplifier
+        @param[in] hotX, hotY  int arrays of the PARENT positions of the hot pixels
+        @param[in] hotRates  rate of each hot pixel, less that of its amplifier
+        @param[in] hotVarianceRates  variance rate of each hot pixel, less that of its amplifier
+        @param[in] hotMasks  mask value of each hot pixel in the dark
+        """
+        self.ampBoxes = numpy.asarray(ampBoxes, dtype=numpy.int32).reshape(-1, 4)
+        self.ampRates = numpy.asarray(ampRates, dtype=float)
+        self.ampVarianceRates = numpy.asarray(ampVarianceRates, dtype=float)
+        self.hotX = numpy.asarray(hotX, dtype=numpy.int32)
+        self.hotY = numpy.asarray(hotY, dtype=numpy.int32)
+        self.hotRates = numpy.asarray(hotRates, dtype=numpy.float32)
+        self.hotVarianceRates = numpy.asarray(hotVarianceRates, dtype=numpy.float32)
+        self.hotMasks = numpy.asarray(hotMasks)
+
+    @classmethod
+    def fromExposure(cls, darkExposure, ampBBoxList, threshold=5.0, darkTime=None):
+        """Make a model of a dark exposure
+
+        @param[in] darkExposure  dark exposure
+        @param[in] ampBBoxList  bounding boxes (PARENT coordinates) of the amplifiers
+        @param[in] threshold  threshold for hot pixels, in units of the robust standard deviation
+                    (1.4826 times the median absolute deviation) of the rate of their amplifier
+        @param[in] darkTime  dark time of darkExposure; if None, from its visit info
+        @return a SparseDarkModel
+        """
+        if darkTime is None:
+            darkTime = darkExposure.getInfo().getVisitInfo().getDarkTime()
+        if numpy.isnan(darkTime):
+            raise RuntimeError("Dark calib darktime is NAN")
+        maskedImage = darkExposure.getMaskedImage()
+        x0, y0 = maskedImage.getX0(), maskedImage.getY0()
+        rate = maskedImage.getImage().getArray()/darkTime
+        varianceRate = maskedImage.getVariance().getArray()/darkTime**2
+        maskArray = maskedImage.getMask().getArray()
+        hot = maskArray != 0
+        ampRateArray = numpy.zeros_like(rate)
+        ampVarianceRateArray = numpy.zeros_like(varianceRate)
+        covered = numpy.zeros(rate.shape, dtype=bool)
+        ampBoxes, ampRates, ampVarianceRates = [], [], []
+        for bbox in ampBBoxList:
+            ampBox = [bbox.getMinX(), bbox.getMinY(), bbox.getMaxX(), bbox.getMaxY()]
+            ampSlice = (slice(ampBox[1] - y0, ampBox[3] + 1 - y0), slice(ampBox[0] - x0, ampBox[2] + 1 - x0))
+            ampRate = rate[ampSlice]
+            median = numpy.median(ampRate)
+            sigma = 1.4826*numpy.median(numpy.abs(ampRate - median))
+            hot[ampSlice] |= numpy.abs(ampRate - median) > threshold*sigma
+            ampVarianceRate = numpy.median(varianceRate[ampSlice])
+            ampRateArray[ampSlice] = median
+            ampVarianceRateArray[ampSlice] = ampVarianceRate
+            covered[ampSlice] = True
+            ampBoxes.append(ampBox)
+            ampRates.append(median)
+            ampVarianceRates.append(ampVarianceRate)
+        hot |= ~covered
+        hotY, hotX = numpy.nonzero(hot)
+        return cls(ampBoxes, ampRates, ampVarianceRates, hotX + x0, hotY + y0,
+                   rate[hotY, hotX] - ampRateArray[hotY, hotX],
+                   varianceRate[hotY, hotX] - ampVarianceRateArray[hotY, hotX],
+                   maskArray[hotY, hotX])
+
+    def getArrays(self):
+        """Get the model as arrays, e.g. to store it (see DerivedCalibStore)
+
+        @return dict of name: numpy array
+        """
+        return dict((name, getattr(self, name)) for name in self.arrayNames)
+
+    @classmethod
+    def fromArrays(cls, arrays):
+        """Make a SparseDarkModel from the arrays returned by getArrays
+
+        @param[in] arrays  dict of name: numpy array, as returned by getArrays
+        @return a SparseDarkModel
+        """
+        return cls(*[arrays[name] for name in cls.arrayNames])
+
+    def getNumHotPixels(self):
+        """Get the number of hot pixels
+        """
+        return len(self.hotX)
+
+    def apply(self, maskedImage, darkTime):
+        """Apply dark correction in place
+
+        The result matches isrFunctions.darkCorrection with the dark exposure the model was made from
+        (with dark time 1), except that the variance of pixels that are not hot is that of their amplifier.
+
+        @param[in,out] maskedImage  afw.image.MaskedImage to correct; any region of the detector
+        @param[in] darkTime  dark time of the exposure
+        """
+        self.applyToArrays(maskedImage.getImage().getArray(), maskedImage.getVariance().getArray(),
+                           maskedImage.getMask().getArray(), maskedImage.getX0(), maskedImage.getY0(),
+                           darkTime)
+
+    def applyToArrays(self, imageArray, varianceArray, maskArray, x0, y0, darkTime):
+        """Apply dark correction in place to the planes of a masked image
+
+        @param[in,out] imageArray, varianceArray, maskArray  image, variance and mask planes
+        @param[in] x0, y0  PARENT position of the first pixel of the planes
+        @param[in] darkTime  dark time of the exposure
+        """
+        height, width = imageArray.shape
+        for (minX, minY, maxX, maxY), rate, varianceRate in zip(self.ampBoxes, self.ampRates,
+                                                                self.ampVarianceRates):
+            xSlice = slice(max(minX - x0, 0), min(maxX + 1 - x0, width))
+            ySlice = slice(max(minY - y0, 0), min(maxY + 1 - y0, height))
+            if xSlice.start >= xSlice.stop or ySlice.start >= ySlice.stop:
+                continue
+            imageArray[ySlice, xSlice] -= darkTime*rate
+            varianceArray[ySlice, xSlice] += darkTime**2*varianceRate
+
+        hotX = self.hotX - x0
+        hotY = self.hotY - y0
+        inside = (hotX >= 0) & (hotX < width) & (hotY >= 0) & (hotY < height)
+        if not inside.all():
+            hotX, hotY = hotX[inside], hotY[inside]
+        imageArray[hotY, hotX] -= darkTime*self.hotRates[inside]
+        varianceArray[hotY, hotX] += darkTime**2*self.hotVarianceRates[inside]
+        maskArray[hotY, hotX] |= self.hotMasks[inside].astype(maskArray.dtype)
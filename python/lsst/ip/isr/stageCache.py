@@ -0,0 +1,251 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object
+
+import hashlib
+import os
+import pickle
+import threading
+import uuid
+import weakref
+
+import numpy
+
+import lsst.afw.image as afwImage
+import lsst.pex.config as pexConfig
+import lsst.pipe.base as pipeBase
+
+__all__ = ["StageCache"]
+
+
+class StageCache(object):
+    """A bounded on-disk cache of intermediate ISR exposures
+
+    Each entry is an uncompressed FITS file named by a key. Keys are chained digests:
+    the key of a stage output is a digest of the key of its input, the stage name,
+    the values of the config fields the stage uses and the identities of the calibration
+    products it applies (see makeKeys). Thus an entry is only found if the input pixels
+    and everything that affected them are unchanged.
+
+    When the total size of the entries exceeds maxBytes, the least recently used entries
+    are deleted.
+    """
+
+    def __init__(self, directory, maxBytes):
+        """!Construct a StageCache
+
+        \param[in] directory -- directory in which to store entries; created if necessary
+        \param[in] maxBytes -- maximum total size of the entries (bytes); 0 for no limit
+        """
+        self.directory = directory
+        self.maxBytes = maxBytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # digests of calibration exposures: id: (weak reference to exposure, digest)
+        self._calibDigests = {}
+        self._lock = threading.Lock()
+
+    def makeKeys(self, seed, stageList, config):
+        """!Make the key of the output of each stage
+
+        \param[in] seed -- digest of the input to the first stage; see digestExposure
+        \param[in] stageList -- list of stages, each a pipeBase.Struct with fields
+            name, configNames (names of config fields the stage uses) and calibs (calibration products
+            the stage applies); see IsrTask.makeStageList
+        \param[in] config -- task config
+        \return a list of keys (str), one per stage
+        """
+        keyList = []
+        key = seed
+        for stage in stageList:
+            md5 = hashlib.md5()
+            md5.update(key.encode())
+            md5.update(stage.name.encode())
+            for name in stage.configNames:
+                value = getattr(config, name)
+                if isinstance(value, pexConfig.Config):
+                    value = value.toDict()
+                md5.update(repr((name, value)).encode())
+            for calib in stage.calibs:
+                md5.update(self.digestObject(calib).encode())
+            key = md5.hexdigest()
+            keyList.append(key)
+        return keyList
+
+    @staticmethod
+    def digestExposure(exposure):
+        """!Compute a digest of the pixels and exposure and dark times of an exposure
+
+        \param[in] exposure -- exposure to digest
+        \return digest (str)
+        """
+        md5 = hashlib.md5()
+        maskedImage = exposure.getMaskedImage()
+        for plane in (maskedImage.getImage(), maskedImage.getMask(), maskedImage.getVariance()):
+            array = numpy.ascontiguousarray(plane.getArray())
+            md5.update(repr((array.dtype.str, array.shape, plane.getXY0())).encode())
+            md5.update(array.view(numpy.uint8).data)
+        visitInfo = exposure.getInfo().getVisitInfo()
+        if visitInfo is not None:
+            md5.update(repr((visitInfo.getExposureTime(), visitInfo.getDarkTime())).encode())
+        detector = exposure.getDetector()
+        if detector is not None:
+            md5.update(repr(detector.getSerial()).encode())
+        return md5.hexdigest()
+
+    def digestObject(self, obj):
+        """!Compute a digest that identifies a calibration product
+
+        Exposures are identified by their pixels; the digest is computed once per object, and remembered
+        only while the object exists. Handles of calibration products that are read later
+        (CalibRegionReader and LazyCalib) are identified by their calibKey (the files of the product
+        and, optionally, a digest of their contents; see IsrTask.getCalibHandleKey); a handle
+        whose calibKey is None cannot be identified, so it gets a unique digest that matches no entry.
+        Defects are identified by their bounding boxes and other objects by their pickled state.
+
+        \param[in] obj -- calibration product, or None
+        \return digest (str)
+        """
+        if obj is None or isinstance(obj, (str, int, float)):
+            return repr(obj)
+        if isinstance(obj, (list, tuple)):
+            return repr([self.digestObject(item) for item in obj])
+        if isinstance(obj, pipeBase.Struct):
+            return repr(sorted((name, self.digestObject(value)) for name, value in obj.getDict().items()))
+        if isinstance(obj, numpy.ndarray):
+            return hashlib.md5(numpy.ascontiguousarray(obj).view(numpy.uint8).data).hexdigest()
+        if hasattr(obj, "calibKey"):
+            if obj.calibKey is None:
+                return uuid.uuid4().hex
+            return repr(("calibKey", obj.calibKey))
+        if hasattr(obj, "getMaskedImage"):
+            objId = id(obj)
+            with self._lock:
+                held = self._calibDigests.get(objId)
+                if held is not None and held[0]() is obj:
+                    return held[1]
+            digest = self.digestExposure(obj)
+            try:
+                ref = weakref.ref(obj, lambda ref: self._forgetDigest(objId, ref))
+            except TypeError:
+                return digest  # cannot be remembered without keeping the object alive
+            with self._lock:
+                self._calibDigests[objId] = (ref, digest)
+            return digest
+        if hasattr(obj, "getBBox"):
+            return repr(obj.getBBox())
+        return hashlib.md5(pickle.dumps(obj, protocol=2)).hexdigest()
+
+    def releaseCalibs(self):
+        """!Forget the digests of calibration products
+
+        Digests are forgotten when their objects are freed, so this is only needed to save the
+        (small) memory of the digests themselves.
+        """
+        with self._lock:
+            self._calibDigests = {}
+
+    def _forgetDigest(self, objId, ref):
+        """!Forget the digest of a freed object, unless its id has been reused for another object
+        """
+        with self._lock:
+            held = self._calibDigests.get(objId)
+            if held is not None and held[0] is ref:
+                del self._calibDigests[objId]
+
+    def get(self, key):
+        """!Get a cached exposure
+
+        \param[in] key -- key of entry
+        \return the cached exposure (an lsst.afw.image.ExposureF), or None if not found or unreadable
+        """
+        path = self._getPath(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            exposure = afwImage.ExposureF(path)
+        except Exception:
+            self._remove(path)
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return exposure
+
+    def has(self, key):
+        """!Is there an entry for this key?
+        """
+        return os.path.exists(self._getPath(key))
+
+    def put(self, key, exposure):
+        """!Add an exposure to the cache, then delete least recently used entries if over budget
+
+        The entry is written to a temporary file that is then renamed, so a partially written
+        entry is never found.
+
+        \param[in] key -- key of entry
+        \param[in] exposure -- exposure to cache
+        """
+        path = self._getPath(key)
+        tempPath = "%s.%d.part" % (path, os.getpid())
+        exposure.writeFits(tempPath)
+        os.rename(tempPath, path)
+        self.evict()
+
+    def remove(self, key):
+        """!Remove an entry, if present
+        """
+        self._remove(self._getPath(key))
+
+    def evict(self):
+        """!Delete least recently used entries until the total size is no more than maxBytes
+        """
+        if self.maxBytes <= 0:
+            return
+        entryList = []
+        for fileName in os.listdir(self.directory):
+            if not fileName.endswith(".fits"):
+                continue
+            path = os.path.join(self.directory, fileName)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entryList.append((stat.st_mtime, stat.st_size, path))
+        totalBytes = sum(entry[1] for entry in entryList)
+        for mtime, size, path in sorted(entryList):
+            if totalBytes <= self.maxBytes:
+                break
+            self._remove(path)
+            totalBytes -= size
+
+    def _getPath(self, key):
+        return os.path.join(self.directory, key + ".fits")
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,173 @@
+// -*- LSST-C++ -*-
+
+/*
+ * LSST Data Management System
+ * Copyright 2016 LSST Corporation.
+ *
+ * This product includes software developed by the
+ * LSST Project (http://www.lsst.org/).
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the LSST License Statement and
+ * the GNU General Public License along with this program.  If not,
+ * see <http://www.lsstcorp.org/LegalNotices/>.
+ */
+
+#include <cmath>
+
+#include "boost/format.hpp"
+
+#include "lsst/pex/exceptions.h"
+#include "lsst/ip/isr/applyDetrend.h"
+
+namespace lsst {
+namespace ip {
+namespace isr {
+
+namespace {
+
+template<typename PixelT>
+void checkDimensions(
+    afw::image::MaskedImage<PixelT> const &maskedImage,
+    afw::image::MaskedImage<PixelT> const *calib,
+    std::string const &name
+) {
+    if (calib && calib->getDimensions() != maskedImage.getDimensions()) {
+        throw LSST_EXCEPT(
+            pex::exceptions::LengthError,
+            (boost::format("%s dimensions %dx%d != image dimensions %dx%d") % name %
+             calib->getWidth() % calib->getHeight() % maskedImage.getWidth() % maskedImage.getHeight()).str()
+        );
+    }
+}
+
+} // anonymous namespace
+
+template<typename PixelT>
+int applyDetrend(
+    afw::image::MaskedImage<PixelT> &maskedImage,
+    afw::image::MaskedImage<PixelT> const *bias,
+    afw::image::MaskedImage<PixelT> const *dark,
+    afw::image::MaskedImage<PixelT> const *flat,
+    double darkScale,
+    double flatScale,
+    double gain,
+    double readNoise,
+    double sqCoeff,
+    ndarray::Array<PixelT, 1, 1> const &table,
+    PixelT indOffset
+) {
+    typedef afw::image::MaskPixel MaskPixel;
+    typedef afw::image::VariancePixel VariancePixel;
+
+    checkDimensions(maskedImage, bias, "bias");
+    checkDimensions(maskedImage, dark, "dark");
+    checkDimensions(maskedImage, flat, "flat");
+
+    bool const doTable = table.size() > 0u;
+    bool const doSquared = !doTable && sqCoeff != 0;
+    bool const doVariance = !std::isnan(gain);
+    double const readNoise2 = readNoise*readNoise;
+    double const darkScale2 = darkScale*darkScale;
+    // scaledDivides(c, flat) divides by c*flat; c = 1/flatScale
+    double const flatMult = 1.0/flatScale;
+    double const flatMult2 = flatMult*flatMult;
+    int const maxLookupCol = static_cast<int>(table.size()) - 1;
+
+    int numOutOfRange = 0;
+    int const width = maskedImage.getWidth();
+    for (int y = 0, height = maskedImage.getHeight(); y < height; ++y) {
+        PixelT *imageRow = maskedImage.getImage()->getArray()[y].getData();
+        MaskPixel *maskRow = maskedImage.getMask()->getArray()[y].getData();
+        VariancePixel *varianceRow = maskedImage.getVariance()->getArray()[y].getData();
+        PixelT const *biasImageRow = nullptr, *darkImageRow = nullptr, *flatImageRow = nullptr;
+        MaskPixel const *biasMaskRow = nullptr, *darkMaskRow = nullptr, *flatMaskRow = nullptr;
+        VariancePixel const *biasVarianceRow = nullptr, *darkVarianceRow = nullptr,
+            *flatVarianceRow = nullptr;
+        if (bias) {
+            biasImageRow = bias->getImage()->getArray()[y].getData();
+            biasMaskRow = bias->getMask()->getArray()[y].getData();
+            biasVarianceRow = bias->getVariance()->getArray()[y].getData();
+        }
+        if (dark) {
+            darkImageRow = dark->getImage()->getArray()[y].getData();
+            darkMaskRow = dark->getMask()->getArray()[y].getData();
+            darkVarianceRow = dark->getVariance()->getArray()[y].getData();
+        }
+        if (flat) {
+            flatImageRow = flat->getImage()->getArray()[y].getData();
+            flatMaskRow = flat->getMask()->getArray()[y].getData();
+            flatVarianceRow = flat->getVariance()->getArray()[y].getData();
+        }
+
+        for (int x = 0; x < width; ++x) {
+            double image = imageRow[x];
+            double variance = varianceRow[x];
+            MaskPixel mask = maskRow[x];
+
+            if (bias) {
+                image -= biasImageRow[x];
+                variance += biasVarianceRow[x];
+                mask |= biasMaskRow[x];
+            }
+
+            if (doTable) {
+                int lookupCol = indOffset + static_cast<PixelT>(image);
+                if (lookupCol < 0) {
+                    lookupCol = 0;
+                    ++numOutOfRange;
+                } else if (lookupCol > maxLookupCol) {
+                    lookupCol = maxLookupCol;
+                    ++numOutOfRange;
+                }
+                image += table[lookupCol];
+            } else if (doSquared) {
+                image *= 1 + sqCoeff*image;
+            }
+
+            if (doVariance) {
+                variance = image/gain + readNoise2;
+            }
+
+            if (dark) {
+                image -= darkScale*darkImageRow[x];
+                variance += darkScale2*darkVarianceRow[x];
+                mask |= darkMaskRow[x];
+            }
+
+            if (flat) {
+                double const flatValue = flatImageRow[x];
+                double const flatValue2 = flatValue*flatValue;
+                variance = (variance*flatValue2 + flatVarianceRow[x]*image*image)/
+                    (flatMult2*flatValue2*flatValue2);
+                image /= flatMult*flatValue;
+                mask |= flatMaskRow[x];
+            }
+
+            imageRow[x] = image;
+            varianceRow[x] = variance;
+            maskRow[x] = mask;
+        }
+    }
+    return numOutOfRange;
+}
+
+#define INSTANTIATE(T) \
+    template int applyDetrend<T>(afw::image::MaskedImage<T> &, afw::image::MaskedImage<T> const *, \
+                                 afw::image::MaskedImage<T> const *, afw::image::MaskedImage<T> const *, \
+                                 double, double, double, double, double, \
+                                 ndarray::Array<T, 1, 1> const &, T);
+
+INSTANTIATE(float);
+INSTANTIATE(double);
+
+}}} // lsst::ip::isr
@@ -0,0 +1,166 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object, range
+import threading
+import time
+import unittest
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.ip.isr as ipIsr
+
+
+class WriterDataRef(object):
+    """Quacks like a ButlerDataRef; records what is written, slowly, and fails for visit 3"""
+    lock = threading.Lock()
+    numActive = 0
+    maxActive = 0
+
+    def __init__(self, visit, raw=None, calibs=None):
+        self.dataId = dict(visit=visit)
+        self.raw = raw
+        self.calibs = calibs
+        self.outputs = {}
+
+    def get(self, datasetType, immediate=False):
+        if datasetType == "raw":
+            return self.raw
+        return self.calibs[datasetType]
+
+    def put(self, obj, datasetType):
+        with self.lock:
+            WriterDataRef.numActive += 1
+            WriterDataRef.maxActive = max(WriterDataRef.maxActive, WriterDataRef.numActive)
+        time.sleep(0.02)
+        with self.lock:
+            WriterDataRef.numActive -= 1
+        if self.dataId["visit"] == 3:
+            raise IOError("Cannot write visit 3")
+        self.outputs[datasetType] = obj
+
+
+class AsyncWriterTestCase(lsst.utils.tests.TestCase):
+    """!Unit tests for AsyncWriter and asynchronous writes in IsrTask.runDataRefList"""
+
+    def setUp(self):
+        WriterDataRef.numActive = 0
+        WriterDataRef.maxActive = 0
+
+    def makeExposure(self, value):
+        exposure = afwImage.ExposureF(afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(20, 10)))
+        exposure.getMaskedImage().getImage().getArray()[:] = value
+        exposure.getInfo().setVisitInfo(afwImage.VisitInfo(exposureTime=1.0, darkTime=1.0))
+        return exposure
+
+    def testWriter(self):
+        dataRefList = [WriterDataRef(visit) for visit in range(8)]
+        writer = ipIsr.AsyncWriter(numWorkers=2, maxQueued=3)
+        for dataRef in dataRefList:
+            writer.put(dataRef, dataRef.dataId["visit"], "postISRCCD")
+        result = writer.close()
+        self.assertEqual(result.numWritten, 7)
+        self.assertEqual([failure.dataId for failure in result.failures], [dict(visit=3)])
+        self.assertIn("Cannot write visit 3", result.failures[0].error)
+        self.assertLessEqual(WriterDataRef.maxActive, 2)
+        for dataRef in dataRefList:
+            if dataRef.dataId["visit"] != 3:
+                self.assertEqual(dataRef.outputs["postISRCCD"], dataRef.dataId["visit"])
+        with self.assertRaises(RuntimeError):
+            writer.put(dataRefList[0], 0, "postISRCCD")
+
+    def testUnpicklable(self):
+        """!Test that writes that cannot be sent to a writer process are reported and free their slots"""
+        dataRefList = [WriterDataRef(visit) for visit in range(4)]
+        for dataRef in dataRefList:
+            dataRef.lock = threading.Lock()  # not picklable
+        writer = ipIsr.AsyncWriter(numWorkers=1, maxQueued=1, useProcesses=True, pollInterval=0.01)
+        for dataRef in dataRefList:
+            writer.put(dataRef, dataRef.dataId["visit"], "postISRCCD")
+        result = writer.close()
+        self.assertEqual(result.numWritten, 0)
+        self.assertEqual([failure.dataId for failure in result.failures],
+                         [dataRef.dataId for dataRef in dataRefList])
+
+    def testConcurrentClose(self):
+        """!Test that puts racing close either queue their write or raise RuntimeError"""
+        writer = ipIsr.AsyncWriter(numWorkers=2, maxQueued=2)
+        numQueued = [0]
+        errors = []
+
+        def produce(firstVisit):
+            for visit in range(firstVisit, firstVisit + 10):
+                try:
+                    writer.put(WriterDataRef(visit), visit, "postISRCCD")
+                except RuntimeError:
+                    continue
+                except Exception as exc:
+                    errors.append(exc)
+                    continue
+                with WriterDataRef.lock:
+                    numQueued[0] += 1
+
+        threadList = [threading.Thread(target=produce, args=(10*i + 10,)) for i in range(4)]
+        for thread in threadList:
+            thread.start()
+        time.sleep(0.05)
+        result = writer.close()
+        for thread in threadList:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(result.failures, [])
+        self.assertEqual(result.numWritten, numQueued[0])
+
+    def testRunDataRefList(self):
+        """!Test that write failures are raised after all exposures are processed and written"""
+        config = ipIsr.IsrTask.ConfigClass()
+        config.doAssembleCcd = False
+        config.doDark = False
+        config.doFlat = False
+        config.doDefect = False
+        config.doFringe = False
+        config.doLinearize = False
+        config.numAsyncWriters = 2
+        calibs = dict(bias=self.makeExposure(10.0))
+        dataRefList = [WriterDataRef(visit, self.makeExposure(100.0*visit), calibs) for visit in range(1, 6)]
+        task = ipIsr.IsrTask(config=config)
+        with self.assertRaises(RuntimeError):
+            task.runDataRefList(dataRefList)
+        for dataRef in dataRefList:
+            if dataRef.dataId["visit"] != 3:
+                exposure = dataRef.outputs["postISRCCD"]
+                self.assertFloatsAlmostEqual(exposure.getMaskedImage().getImage().getArray(),
+                                             100.0*dataRef.dataId["visit"] - 10.0, rtol=1e-6)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
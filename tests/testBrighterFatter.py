@@ -25,6 +25,8 @@ import unittest
 import pickle
 import os
 
+import numpy as np
+
 import lsst.utils.tests
 import lsst.afw.image as afwImage
 import lsst.ip.isr as ipIsr
@@ -58,6 +60,34 @@ class BrighterFatterTestCases(lsst.utils.tests.TestCase):
         isrTask.brighterFatterCorrection(exp, bfKernel, 5, 100, False)
         self.assertImagesEqual(ref_image, image)
 
+    def testBrighterFatterByStrips(self):
+        """Test brighter fatter correction by strips against correction of the full frame"""
+        yy, xx = np.mgrid[0:40, 0:30]
+        starArray = 100.0 + 5000.0*np.exp(-((xx - 14.5)**2 + (yy - 20.0)**2)/8.0)
+        ky, kx = np.mgrid[-4:5, -4:5]
+        bfKernel = 1.0e-7*np.exp(-(kx**2 + ky**2)/4.0)
+
+        config = ipIsr.IsrTask.ConfigClass()
+        config.stripHeight = 10
+        isrTask = ipIsr.IsrTask(config=config)
+        for maxIter, threshold in ((3, 0), (10, 1.0)):
+            exposures = []
+            for i in range(2):
+                image = afwImage.ImageF(30, 40)
+                image.getArray()[:, :] = starArray
+                exposures.append(afwImage.makeExposure(afwImage.makeMaskedImage(image)))
+            isrTask.brighterFatterCorrection(exposures[0], bfKernel, maxIter, threshold, False)
+            isrTask.brighterFatterCorrectionByStrips(exposures[1], bfKernel, maxIter, threshold, False)
+            fullArray, stripArray = [exposure.getMaskedImage().getImage().getArray()
+                                     for exposure in exposures]
+            self.assertGreater(np.abs(fullArray - starArray).max(), 0)
+            if threshold == 0:
+                # every strip runs all maxIter iterations, as does the full frame
+                np.testing.assert_allclose(stripArray, fullArray, rtol=1e-5)
+            else:
+                # strips may stop after different numbers of iterations
+                self.assertLess(np.abs(stripArray - fullArray).sum(), threshold)
+
 
 class MemoryTester(lsst.utils.tests.MemoryTestCase):
     pass
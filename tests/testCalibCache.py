@@ -0,0 +1,196 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object, range
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.pipe.base as pipeBase
+import lsst.ip.isr as ipIsr
+
+
+class CalibDataRef(object):
+    """Quacks like a ButlerDataRef, counting reads of in-memory calibration products"""
+
+    def __init__(self, dataId, datasets, fileNames):
+        self.dataId = dataId
+        self.datasets = datasets
+        self.fileNames = fileNames
+        self.numReads = {}
+
+    def get(self, datasetType, immediate=False):
+        if datasetType.endswith("_filename"):
+            return [self.fileNames[datasetType[:-len("_filename")]]]
+        self.numReads[datasetType] = self.numReads.get(datasetType, 0) + 1
+        return self.datasets[datasetType]
+
+
+class CalibCacheTestCase(lsst.utils.tests.TestCase):
+    """!Unit tests for CalibCache and its use by IsrTask"""
+
+    def testLru(self):
+        cache = ipIsr.CalibCache(maxBytes=250)
+        products = dict((name, np.zeros(100, dtype=np.uint8)) for name in "abcd")
+        for name in "abc":
+            self.assertIs(cache.get(name, lambda: products[name]), products[name])
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (0, 3, 1))
+        self.assertNotIn("a", cache)
+        self.assertIs(cache.get("b", lambda: None), products["b"])  # "b" is now most recently used
+        cache.put("d", products["d"])
+        self.assertNotIn("c", cache)
+        self.assertIn("b", cache)
+        self.assertEqual(cache.numBytes, 200)
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (1, 3, 2))
+
+        # products bigger than the budget are not cached
+        cache.put("e", np.zeros(300, dtype=np.uint8))
+        self.assertNotIn("e", cache)
+        self.assertEqual(len(cache), 2)
+
+    def testSize(self):
+        exposure = afwImage.ExposureF(10, 20)
+        self.assertEqual(ipIsr.CalibCache.getSize(exposure), 10*20*(4 + 2 + 4))
+        self.assertEqual(ipIsr.CalibCache.getSize(pipeBase.Struct(fringes=[exposure, exposure], seed=3)),
+                         2*10*20*(4 + 2 + 4))
+        self.assertEqual(ipIsr.CalibCache.getSize([]), 0)
+
+    def testReadIsrData(self):
+        """!Test that IsrTask.readIsrData reuses calibrations that resolve to the same files"""
+        config = ipIsr.IsrTask.ConfigClass()
+        config.doAssembleCcd = False
+        config.doDark = False
+        config.doFringe = False
+        config.doLinearize = False
+        config.calibCacheMaxBytes = 10*1024**2
+        bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(20, 10))
+        datasets = dict(bias=afwImage.ExposureF(bbox), flat=afwImage.ExposureF(bbox), defects=[])
+        task = ipIsr.IsrTask(config=config)
+        task.getCalibCache().clear()
+        rawExposure = afwImage.ExposureF(bbox)
+        fileNames = dict(bias="bias.fits", flat="flat-g.fits", defects="defects.fits")
+        dataRef1 = CalibDataRef(dict(visit=1), datasets, fileNames)
+        dataRef2 = CalibDataRef(dict(visit=2), datasets, fileNames)
+        dataRef3 = CalibDataRef(dict(visit=3), datasets, dict(fileNames, flat="flat-r.fits"))
+        hits = task.getCalibCache().hits
+        isrData1 = task.readIsrData(dataRef1, rawExposure)
+        isrData2 = task.readIsrData(dataRef2, rawExposure)
+        task.readIsrData(dataRef3, rawExposure)
+        self.assertEqual(dataRef1.numReads, dict(bias=1, flat=1, defects=1))
+        self.assertEqual(dataRef2.numReads, dict())
+        self.assertEqual(dataRef3.numReads, dict(flat=1))
+        self.assertIs(isrData1.bias, isrData2.bias)
+        self.assertEqual(task.getCalibCache().hits - hits, 5)
+        self.assertEqual(task.metadata.get("CALIB_CACHE_HITS"), task.getCalibCache().hits)
+        task.getCalibCache().clear()
+
+    def testAssembledCalibs(self):
+        """!Test that assembled calibrations are keyed by the assembly config and that cached
+        fringe frames are copied"""
+        config = ipIsr.IsrTask.ConfigClass()
+        config.calibCacheMaxBytes = 10*1024**2
+        dataRef = CalibDataRef(dict(visit=1), dict(fringe=afwImage.ExposureF(10, 20)),
+                               dict(flat="flat-g.fits", fringe="fringe-i.fits"))
+        task = ipIsr.IsrTask(config=config)
+        task.getCalibCache().clear()
+        self.assertIsNone(task.getCalibFileKey(dataRef, "flat")[2])
+        assembledKeys = []
+        for doTrim in (False, True):
+            assembleConfig = ipIsr.IsrTask.ConfigClass()
+            assembleConfig.doAssembleIsrExposures = True
+            assembleConfig.assembleCcd.doTrim = doTrim
+            assembledKeys.append(ipIsr.IsrTask(config=assembleConfig).getCalibFileKey(dataRef, "flat"))
+        self.assertIsNotNone(assembledKeys[0][2])
+        self.assertNotEqual(assembledKeys[0], assembledKeys[1])
+
+        fringes = [task.readFringeFrame(dataRef) for i in range(2)]
+        self.assertEqual(dataRef.numReads, dict(fringe=1))
+        self.assertIsNot(fringes[0], fringes[1])
+        self.assertIsNot(fringes[0], dataRef.datasets["fringe"])
+        fringes[0].getMaskedImage().getImage().getArray()[:] = 1
+        self.assertEqual(fringes[1].getMaskedImage().getImage().getArray().sum(), 0)
+        task.getCalibCache().clear()
+
+    def testFringeFallbackFilter(self):
+        """!Test that fringe frames, unlike other calibrations, are not read with the fallback filter"""
+        class FallbackDataRef(CalibDataRef):
+            def get(self, datasetType, immediate=False, filter=None):
+                return CalibDataRef.get(self, datasetType + ("-" + filter if filter else ""), immediate)
+
+        config = ipIsr.IsrTask.ConfigClass()
+        config.calibCacheMaxBytes = 10*1024**2
+        config.fallbackFilterName = "g"
+        dataRef = FallbackDataRef(dict(visit=1), {"flat-g": afwImage.ExposureF(10, 20),
+                                                  "fringe-g": afwImage.ExposureF(10, 20)},
+                                  dict(flat="flat-i.fits", fringe="fringe-i.fits"))
+        task = ipIsr.IsrTask(config=config)
+        task.getCalibCache().clear()
+        self.assertIs(task.readIsrExposure(dataRef, "flat"), dataRef.datasets["flat-g"])
+        with self.assertRaises(RuntimeError):
+            task.readFringeFrame(dataRef)
+        self.assertNotIn("fringe-g", dataRef.numReads)
+        task.getCalibCache().clear()
+
+    def testFallbackFilterKey(self):
+        """!Test that calibrations read with the fallback filter are keyed by its files,
+        which are looked up once per exposure
+        """
+        class FallbackDataRef(CalibDataRef):
+            def get(self, datasetType, immediate=False, filter=None):
+                suffix = "-" + filter if filter else ""
+                if datasetType.endswith("_filename"):
+                    self.numReads[datasetType + suffix] = self.numReads.get(datasetType + suffix, 0) + 1
+                    return [self.fileNames[datasetType[:-len("_filename")] + suffix]]
+                return CalibDataRef.get(self, datasetType + suffix, immediate)
+
+        config = ipIsr.IsrTask.ConfigClass()
+        config.calibCacheMaxBytes = 10*1024**2
+        config.fallbackFilterName = "g"
+        datasets = {"flat-g": afwImage.ExposureF(10, 20)}
+        fileNames = {"flat-g": "flat-g.fits"}
+        dataRefList = [FallbackDataRef(dict(visit=visit), datasets, fileNames) for visit in (1, 2)]
+        task = ipIsr.IsrTask(config=config)
+        task.getCalibCache().clear()
+        flats = [task.getIsrExposure(dataRef, "flat") for dataRef in dataRefList]
+        self.assertIs(flats[0], flats[1])
+        self.assertEqual(task.getCalibFileKey(dataRefList[0], "flat")[1], ("flat-g.fits",))
+        # the flat for the exposure's own filter is tried once, then read with the fallback filter
+        self.assertEqual(dataRefList[0].numReads, {"flat_filename": 1, "flat_filename-g": 1,
+                                                   "flat": 1, "flat-g": 1})
+        self.assertEqual(dataRefList[1].numReads, {"flat_filename": 1, "flat_filename-g": 1})
+        task.getCalibCache().clear()
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,229 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object
+import os
+import shutil
+import tempfile
+import unittest
+
+import lsst.utils.tests
+import lsst.afw.image as afwImage
+import lsst.ip.isr as ipIsr
+
+
+class IndexDataRef(object):
+    """Quacks like a ButlerDataRef, with calibrations available only for some filters and detectors"""
+
+    def __init__(self, dataId, available):
+        self.dataId = dataId
+        self.available = available  # set of (datasetType, filter), or (datasetType, filter, ccd)
+        self.numGets = 0
+        self.numFailedGets = 0
+
+    def get(self, datasetType, immediate=False, filter=None):
+        self.numGets += 1
+        if not self.datasetExists(datasetType, filter=filter):
+            self.numFailedGets += 1
+            raise RuntimeError("No %s for filter %s" % (datasetType, filter))
+        return afwImage.ExposureF(4, 4)
+
+    def datasetExists(self, datasetType, filter=None):
+        filterName = filter or self.dataId["filter"]
+        return (datasetType, filterName) in self.available or \
+            (datasetType, filterName, self.dataId.get("ccd")) in self.available
+
+
+class FlakyDataRef(IndexDataRef):
+    """An IndexDataRef whose reads of existing calibrations fail for the exposure's own filter"""
+
+    def get(self, datasetType, immediate=False, filter=None):
+        if filter is None:
+            self.numGets += 1
+            raise IOError("Transient failure reading %s" % (datasetType,))
+        return IndexDataRef.get(self, datasetType, immediate=immediate, filter=filter)
+
+
+class FakeButler(object):
+    """Quacks like a Butler with a calibration registry"""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def queryMetadata(self, datasetType, keys):
+        if datasetType not in self.rows or len(keys) != len(self.rows[datasetType][0]):
+            raise RuntimeError("No such key")
+        return self.rows[datasetType]
+
+
+class CalibIndexTestCase(lsst.utils.tests.TestCase):
+    """!Unit tests for CalibIndex and its use by IsrTask"""
+
+    def setUp(self):
+        self.entries = dict(flat=[["g", dict(ccd=1), "2017-01-01", "2017-01-31"],
+                                  ["r", dict(ccd=1), None, None]],
+                            bias=[[None, dict(ccd=1), "2017-01-01", "2017-01-31"]])
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testIsAvailable(self):
+        calibIndex = ipIsr.CalibIndex(self.entries, idKeys=["ccd"])
+        self.assertTrue(calibIndex.isAvailable("flat", "g", dict(ccd=1), "2017-01-15T03:00:00"))
+        self.assertTrue(calibIndex.isAvailable("flat", "g", dict(ccd=1)))
+        self.assertTrue(calibIndex.isAvailable("bias", "i", dict(ccd=1), "2017-01-31"))
+        self.assertIsNone(calibIndex.isAvailable("dark", "g", dict(ccd=1)))
+        # calibrations the index does not list are unknown until they are found missing
+        self.assertIsNone(calibIndex.isAvailable("flat", "g", dict(ccd=1), "2017-02-01"))
+        self.assertIsNone(calibIndex.isAvailable("flat", "g", dict(ccd=2)))
+        self.assertIsNone(calibIndex.isAvailable("flat", "i", dict(ccd=1), "2017-01-15"))
+        self.assertEqual(calibIndex.numMissesAvoided, 0)
+        calibIndex.recordMiss("flat", "i", dict(ccd=1, visit=5), "2017-01-15")
+        self.assertFalse(calibIndex.isAvailable("flat", "i", dict(ccd=1, visit=6), "2017-01-15"))
+        self.assertEqual(calibIndex.numMissesAvoided, 1)
+        calibIndex.clearMisses()
+        # a calibration the index lists only for the fallback filter is missing
+        self.assertFalse(calibIndex.isAvailable("flat", "i", dict(ccd=1), "2017-01-15",
+                                                fallbackFilterName="r"))
+        self.assertEqual(calibIndex.numMissesAvoided, 2)
+        self.assertIsNone(calibIndex.isAvailable("flat", "i", dict(ccd=2), "2017-01-15",
+                                                 fallbackFilterName="r"))
+        self.assertTrue(calibIndex.isAvailable("flat", "g", dict(ccd=1), "2017-01-15",
+                                               fallbackFilterName="r"))
+
+        # dataset types that are not indexed rely on recorded misses
+        calibIndex.recordMiss("dark", "g", dict(ccd=1, visit=5), "2017-01-15")
+        self.assertFalse(calibIndex.isAvailable("dark", "g", dict(ccd=1, visit=6), "2017-01-15T12:00:00"))
+        self.assertIsNone(calibIndex.isAvailable("dark", "g", dict(ccd=2, visit=6), "2017-01-15"))
+        self.assertIsNone(calibIndex.isAvailable("dark", "g", dict(ccd=1, visit=6), "2017-01-16"))
+        calibIndex.clearMisses()
+        self.assertIsNone(calibIndex.isAvailable("dark", "g", dict(ccd=1, visit=6), "2017-01-15"))
+
+    def testBuildReadWrite(self):
+        butler = FakeButler(dict(flat=[("g", 1, "2017-01-01", "2017-01-31")],
+                                 bias=[(1, "2017-01-01 00:00:00", "2017-01-31")],
+                                 dark=[("NONE", 1, "2017-01-01", "2017-01-31")]))
+        calibIndex = ipIsr.CalibIndex.build(butler, ["flat", "bias", "dark", "fringe"], ["ccd"])
+        self.assertEqual(calibIndex.entries["flat"], [["g", dict(ccd=1), "2017-01-01", "2017-01-31"]])
+        self.assertEqual(calibIndex.entries["bias"], [[None, dict(ccd=1), "2017-01-01", "2017-01-31"]])
+        # a placeholder filter means the calibration applies to every filter
+        self.assertEqual(calibIndex.entries["dark"], [[None, dict(ccd=1), "2017-01-01", "2017-01-31"]])
+        self.assertTrue(calibIndex.isAvailable("dark", "g", dict(ccd=1), "2017-01-15"))
+        self.assertNotIn("fringe", calibIndex.entries)
+
+        path = os.path.join(self.directory, "calibIndex.json")
+        calibIndex.write(path)
+        readIndex = ipIsr.CalibIndex.read(path)
+        self.assertEqual(readIndex.entries, calibIndex.entries)
+        self.assertEqual(readIndex.idKeys, ("ccd",))
+
+    def testReadIsrExposure(self):
+        """!Test that IsrTask reads fallback calibrations the index lists without first trying the missing
+        ones, and tries calibrations the index does not list once
+        """
+        path = os.path.join(self.directory, "calibIndex.json")
+        entries = dict(self.entries, bias=[["NONE", dict(ccd=1), None, None]])
+        ipIsr.CalibIndex(entries, idKeys=["ccd"]).write(path)
+        config = ipIsr.IsrTask.ConfigClass()
+        config.fallbackFilterName = "r"
+        config.calibIndexPath = path
+        task = ipIsr.IsrTask(config=config)
+        available = set([("flat", "g", 1), ("flat", "r", 1), ("flat", "z", 3), ("bias", "g", 1)])
+
+        def readFlat(dataId, datasetType="flat"):
+            dataRef = IndexDataRef(dict(dataId, dateObs="2017-01-15"), available)
+            try:
+                task.readIsrExposure(dataRef, datasetType)
+            finally:
+                numGetsList.append(dataRef.numGets)
+                numFailedGetsList.append(dataRef.numFailedGets)
+
+        try:
+            # the index is current, so the fallback is read without a failed read, even the first time
+            numGetsList = []
+            numFailedGetsList = []
+            readFlat(dict(ccd=1, filter="i", visit=1))
+            readFlat(dict(ccd=1, filter="i", visit=2))
+            readFlat(dict(ccd=1, filter="g"))
+            # a filter-less dataset type indexed with a placeholder filter is read too
+            readFlat(dict(ccd=1, filter="g"), datasetType="bias")
+            self.assertEqual(numGetsList, [1, 1, 1, 1])
+            self.assertEqual(numFailedGetsList, [0, 0, 0, 0])
+
+            # calibrations missing from a stale index are read
+            numGetsList = []
+            readFlat(dict(ccd=3, filter="z"))
+            self.assertEqual(numGetsList, [1])
+
+            # calibrations that are missing, with no listed fallback, are tried once
+            numGetsList = []
+            for visit in (1, 2):
+                with self.assertRaises(RuntimeError):
+                    readFlat(dict(ccd=2, filter="g", visit=visit))
+            self.assertEqual(numGetsList, [2, 0])
+        finally:
+            task.getCalibIndex().clearMisses()
+
+    def testMissCache(self):
+        """!Test that IsrTask remembers calibrations found missing when there is no index, if enabled"""
+        config = ipIsr.IsrTask.ConfigClass()
+        config.fallbackFilterName = "r"
+        available = set([("flat", "r")])
+
+        def readFlats(task, dataRefClass=IndexDataRef, dateObs="2017-01-15"):
+            task.getCalibIndex().clearMisses()
+            numGetsList = []
+            for visit in (1, 2, 3):
+                dataId = dict(ccd=1, visit=visit, filter="g")
+                if dateObs is not None:
+                    dataId["dateObs"] = dateObs
+                dataRef = dataRefClass(dataId, available | set([("flat", "g")])
+                                       if dataRefClass is FlakyDataRef else available)
+                task.readIsrExposure(dataRef, "flat")
+                numGetsList.append(dataRef.numGets)
+            task.getCalibIndex().clearMisses()
+            return numGetsList
+
+        # misses are not remembered by default
+        self.assertEqual(readFlats(ipIsr.IsrTask(config=config)), [2, 2, 2])
+
+        config.doRememberCalibMisses = True
+        task = ipIsr.IsrTask(config=config)
+        self.assertEqual(readFlats(task), [2, 1, 1])
+        # not without a date, which would make the miss apply to all dates
+        self.assertEqual(readFlats(task, dateObs=None), [2, 2, 2])
+        # nor if the calibration exists but could not be read
+        self.assertEqual(readFlats(task, dataRefClass=FlakyDataRef), [2, 2, 2])
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
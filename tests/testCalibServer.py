@@ -0,0 +1,208 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object, range
+import os
+import pickle
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import unittest
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.image.testUtils  # noqa F401; for assertMaskedImagesEqual
+import lsst.ip.isr as ipIsr
+
+
+class ServerDataRef(object):
+    """Quacks like a ButlerDataRef, counting reads of in-memory calibration products"""
+
+    def __init__(self, datasets):
+        self.dataId = dict(visit=1)
+        self.datasets = datasets
+        self.numReads = {}
+
+    def get(self, datasetType, immediate=False):
+        if datasetType.endswith("_filename"):
+            return [datasetType[:-len("_filename")] + ".fits"]
+        self.numReads[datasetType] = self.numReads.get(datasetType, 0) + 1
+        return self.datasets[datasetType]
+
+
+class CalibServerTestCase(lsst.utils.tests.TestCase):
+    """!Unit tests for CalibServer, CalibClient and their use by IsrTask"""
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.address = os.path.join(self.tempDir, "socket")
+        self.server = ipIsr.CalibServer(self.address, "test", maxBytes=1, directory=self.tempDir)
+        self.thread = threading.Thread(target=self.server.serveForever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(20, 10))
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.tempDir)
+        self.server = None
+        self.bbox = None
+
+    def testNotLocal(self):
+        with self.assertRaises(RuntimeError):
+            ipIsr.parseCalibServerAddress("example.com:1234")
+        self.assertEqual(ipIsr.parseCalibServerAddress("localhost:1234"), ("localhost", 1234))
+
+    def testClients(self):
+        """!Test that products are read once, shared, and evicted when no longer referenced"""
+        exposure = afwImage.ExposureF(self.bbox)
+        exposure.getMaskedImage().getImage().getArray()[:] = 5.0
+        client1 = ipIsr.CalibClient(self.address, "test")
+        client2 = ipIsr.CalibClient(self.address, "test")
+        numReads = []
+
+        def read(product):
+            def readFunc():
+                numReads.append(product)
+                return product
+            return readFunc
+
+        for client in (client1, client2):
+            served = client.get("flat", read(exposure))
+            self.assertMaskedImagesEqual(served.getMaskedImage(), exposure.getMaskedImage())
+            self.assertEqual(client.get("defects", read([1, 2, 3])), [1, 2, 3])
+        self.assertEqual(len(numReads), 2)
+        self.assertEqual(client1.getStats()["numReferenced"], 2)
+
+        # products are over budget, so are deleted when the last reference is released
+        client1.releaseAll()
+        self.assertEqual(client1.getStats()["numEntries"], 2)
+        client2.close()
+        for i in range(100):
+            # wait for the server to notice client2 disconnecting
+            if client1.getStats()["numEntries"] == 0:
+                break
+            time.sleep(0.01)
+        self.assertEqual(client1.getStats()["numEntries"], 0)
+        self.assertEqual(os.listdir(self.tempDir), ["socket"])
+        client1.close()
+
+    def testReferenceCounting(self):
+        """!Test that a product is referenced until each of a client's references is released"""
+        client = ipIsr.CalibClient(self.address, "test")
+        for i in range(2):
+            self.assertEqual(client.get("defects", lambda: [1, 2, 3]), [1, 2, 3])
+        client.release("defects")
+        self.assertEqual(client.getStats()["numReferenced"], 1)
+        client.release("defects")
+        self.assertEqual(client.getStats()["numEntries"], 0)
+        client.close()
+
+    def testGeneratedKey(self):
+        """!Test that by default the server listens on a private Unix domain socket with a generated key"""
+        server = ipIsr.CalibServer(maxBytes=0)
+        thread = threading.Thread(target=server.serveForever)
+        thread.daemon = True
+        thread.start()
+        try:
+            socketDir = os.path.dirname(server.address)
+            self.assertEqual(stat.S_IMODE(os.stat(socketDir).st_mode), 0o700)
+            self.assertEqual(stat.S_IMODE(os.stat(server.authKeyPath).st_mode), 0o600)
+            self.assertEqual(os.path.dirname(server.authKeyPath), socketDir)
+            self.assertNotEqual(server.authkey, "ip_isr")
+            client = ipIsr.CalibClient(server.address)
+            self.assertEqual(client.get("defects", lambda: [1, 2, 3]), [1, 2, 3])
+            client.close()
+        finally:
+            server.close()
+        self.assertFalse(os.path.exists(socketDir))
+        with self.assertRaises(RuntimeError):
+            ipIsr.CalibServer("localhost:0", maxBytes=0)
+
+    def testWaitTimeout(self):
+        """!Test that a client reads a product itself if another client takes too long to load it"""
+        client1 = ipIsr.CalibClient(self.address, "test")
+        self.assertEqual(client1._request("acquire", "defects"), ("load",))
+        client2 = ipIsr.CalibClient(self.address, "test", waitInterval=0.01, waitTimeout=0.1)
+        self.assertEqual(client2.get("defects", lambda: [1, 2, 3]), [1, 2, 3])
+        self.assertEqual(client2.getStats()["numEntries"], 0)
+        client2.release("defects")
+        self.assertEqual(client2.acquired, {})
+        client1.close()
+        client2.close()
+
+    def testUnsignedProduct(self):
+        """!Test that a pickled product not published by a client of the server is not loaded"""
+        client = ipIsr.CalibClient(self.address, "test")
+        self.assertEqual(client.get("defects", lambda: [1, 2, 3]), [1, 2, 3])
+        self.assertEqual(client._read("defects", "pickle"), [1, 2, 3])
+        with open(os.path.join(self.tempDir, "forged.pickle"), "wb") as pickleFile:
+            pickleFile.write(b"\0"*32)
+            pickle.dump([4, 5, 6], pickleFile, protocol=2)
+        with self.assertRaises(RuntimeError):
+            client._read("forged", "pickle")
+        client.release("defects")
+        client.close()
+
+    def testReadIsrData(self):
+        config = ipIsr.IsrTask.ConfigClass()
+        config.doAssembleCcd = False
+        config.doDark = False
+        config.doFlat = False
+        config.doFringe = False
+        config.doLinearize = False
+        config.calibServerAddress = self.address
+        config.calibServerAuthKey = "test"
+        dataRef = ServerDataRef(dict(bias=afwImage.ExposureF(self.bbox), defects=[]))
+        taskList = [ipIsr.IsrTask(config=config) for i in range(2)]
+        for task in taskList:
+            isrData = task.readIsrData(dataRef, afwImage.ExposureF(self.bbox))
+            self.assertEqual(isrData.bias.getBBox(), self.bbox)
+            self.assertEqual(isrData.defects, [])
+        self.assertEqual(dataRef.numReads, dict(bias=1, defects=1))
+        client = taskList[0].getCalibClient()
+        self.assertEqual(client.getStats()["numReferenced"], 2)
+        # releasing another data reference's products keeps these
+        otherDataRef = ServerDataRef({})
+        otherDataRef.dataId = dict(visit=2)
+        for task in taskList:
+            task.releaseServedCalibs(otherDataRef)
+        self.assertEqual(client.getStats()["numReferenced"], 2)
+        for task in taskList:
+            task.releaseServedCalibs(dataRef)
+        self.assertEqual(taskList[0].getCalibClient().getStats()["numEntries"], 0)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,131 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object, range
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.ip.isr as ipIsr
+
+
+class FileDataRef(object):
+    """Quacks like a ButlerDataRef, reading calibrations from FITS files"""
+
+    def __init__(self, dataId, fileNames):
+        self.dataId = dataId
+        self.fileNames = fileNames
+        self.numReads = 0
+
+    def get(self, datasetType, immediate=False):
+        if datasetType.endswith("_filename"):
+            return [self.fileNames[datasetType[:-len("_filename")]]]
+        self.numReads += 1
+        return afwImage.ExposureF(self.fileNames[datasetType])
+
+
+class DerivedCalibStoreTestCase(lsst.utils.tests.TestCase):
+    """!Unit tests for DerivedCalibStore and its use by IsrTask"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testStore(self):
+        store = ipIsr.DerivedCalibStore(os.path.join(self.directory, "store"), maxBytes=0)
+        arrays = dict(a=np.arange(12, dtype=np.float32).reshape(3, 4), b=np.ones(5, dtype=np.int32))
+        key = store.makeKey("test", 1)
+        self.assertIsNone(store.read(key))
+        store.write(key, arrays, dict(scale=2.5))
+        self.assertTrue(store.has(key))
+        readArrays, scalars = store.read(key)
+        self.assertEqual(scalars, dict(scale=2.5))
+        self.assertEqual(sorted(readArrays), ["a", "b"])
+        for name, array in arrays.items():
+            np.testing.assert_array_equal(readArrays[name], array)
+
+        # least recently used entries are deleted when over budget
+        store.maxBytes = 1
+        store.write(store.makeKey("test", 2), arrays)
+        self.assertFalse(store.has(key))
+
+    def testHashFiles(self):
+        path = os.path.join(self.directory, "calib.fits")
+        with open(path, "w") as outFile:
+            outFile.write("contents")
+        digest = ipIsr.DerivedCalibStore.hashFiles([path + "[1]"])
+        self.assertIsNotNone(digest)
+        self.assertIsNone(ipIsr.DerivedCalibStore.hashFiles([path + ".missing"]))
+        with open(path, "w") as outFile:
+            outFile.write("other contents")
+        self.assertNotEqual(ipIsr.DerivedCalibStore.hashFiles([path]), digest)
+
+    def testPreparedCalibs(self):
+        """!Test that a new IsrTask reads the products derived by another from the store"""
+        bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(20, 10))
+        fileNames = {}
+        for name, value in (("dark", 4.0), ("flat", 2.0)):
+            exposure = afwImage.ExposureF(bbox)
+            exposure.getMaskedImage().getImage().set(value)
+            exposure.getMaskedImage().getMask().getArray()[0, 0] = 1
+            exposure.getInfo().setVisitInfo(afwImage.VisitInfo(exposureTime=2.0, darkTime=2.0))
+            fileNames[name] = os.path.join(self.directory, name + ".fits")
+            exposure.writeFits(fileNames[name])
+        config = ipIsr.IsrTask.ConfigClass()
+        config.doPrepareCalibs = True
+        config.derivedCalibDir = os.path.join(self.directory, "derived")
+        config.flatScalingType = "MEAN"
+        dataRef = FileDataRef(dict(ccd=1), fileNames)
+
+        preparedList = []
+        for i in range(2):
+            task = ipIsr.IsrTask(config=config)
+            dark, flat = [task.getIsrExposure(dataRef, name) for name in ("dark", "flat")]
+            self.assertTrue(flat.getMetadata().exists(task.calibKeyName))
+            preparedList.append(task.getPreparedCalibs(None, dark, flat, mergeMasks=True))
+        self.assertEqual(len(os.listdir(config.derivedCalibDir)), 1)
+        self.assertIsInstance(preparedList[1].darkRate, np.memmap)
+        for name in ("darkRate", "flatReciprocal", "flatReciprocalSq"):
+            np.testing.assert_array_equal(getattr(preparedList[0], name), getattr(preparedList[1], name))
+        self.assertEqual(sorted(preparedList[1].masks), ["flat"])
+        self.assertAlmostEqual(float(preparedList[1].flatReciprocal[1, 1]), 1.0)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
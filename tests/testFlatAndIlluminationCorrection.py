@@ -21,8 +21,12 @@
 #
 from __future__ import absolute_import, division, print_function
 
-from builtins import range
+from builtins import object, range
+import os
+import shutil
+import tempfile
 import unittest
+import uuid
 
 import lsst.utils.tests
 import lsst.afw.image as afwImage
@@ -98,6 +102,72 @@ class IsrTestCases(unittest.TestCase):
     def testIllum3(self):
         self.doIllum(scaling=3.7)
 
+    def testFlatScaleMetadata(self):
+        """Test that IsrTask measures the scale of a flat it is given from its pixels, without modifying it,
+        and only uses a scale recorded in its metadata if configured to
+        """
+        config = ipIsr.IsrTask.ConfigClass()
+        config.flatScalingType = "MEDIAN"
+        task = ipIsr.IsrTask(config=config)
+        flatexposure = afwImage.ExposureF(afwGeom.Box2I(self.pmin, self.pmax))
+        flatexposure.getMaskedImage().getImage().set(2)
+        self.assertAlmostEqual(task.getFlatScale(flatexposure), 2)
+        self.assertFalse(flatexposure.getMetadata().exists("ISR_FLAT_SCALE_MEDIAN"))
+        flatexposure.getMaskedImage().getImage().set(4)
+        self.assertAlmostEqual(task.getFlatScale(flatexposure), 4)
+
+        # a scale recorded by a calibration pipeline is ignored by default
+        flatexposure.getMetadata().set("ISR_FLAT_SCALE_MEDIAN", 2.0)
+        self.assertAlmostEqual(task.getFlatScale(flatexposure), 4)
+
+        config.useFlatScaleMetadata = True
+        task = ipIsr.IsrTask(config=config)
+        self.assertAlmostEqual(task.getFlatScale(flatexposure), 2)
+        exposure = afwImage.ExposureF(afwGeom.Box2I(self.pmin, self.pmax))
+        exposure.getMaskedImage().getImage().set(10)
+        task.flatCorrection(exposure, flatexposure)
+        self.assertAlmostEqual(exposure.getMaskedImage().getImage().get(0, 0), 10*2/4, 5)
+
+    def testReadFlat(self):
+        """Test that IsrTask.readFlat remembers the scale of a flat by the contents of its files"""
+        pmin, pmax = self.pmin, self.pmax
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "flat.fits")
+
+        class FlatDataRef(object):
+            dataId = dict(ccd=1)
+            reads = []
+
+            def get(self, datasetType, immediate=True):
+                if datasetType == "flat_filename":
+                    return [path]
+                flatexposure = afwImage.ExposureF(afwGeom.Box2I(pmin, pmax))
+                flatexposure.getMaskedImage().getImage().set(len(FlatDataRef.reads) + 3)
+                FlatDataRef.reads.append(flatexposure)
+                return flatexposure
+
+        config = ipIsr.IsrTask.ConfigClass()
+        config.flatScalingType = "MEAN"
+        task = ipIsr.IsrTask(config=config)
+        try:
+            with open(path, "w") as flatFile:
+                flatFile.write("flat %s" % (uuid.uuid4().hex,))
+            # the second read has different pixels but the same files, so the scale is remembered
+            for i in range(2):
+                flatexposure = task.readFlat(FlatDataRef())
+                self.assertAlmostEqual(task.getFlatScale(flatexposure), 3)
+                self.assertFalse(flatexposure.getMetadata().exists("ISR_FLAT_SCALE_MEAN"))
+            self.assertEqual(len(FlatDataRef.reads), 2)
+
+            # a flat replaced by one with different contents is measured again
+            with open(path, "w") as flatFile:
+                flatFile.write("new flat %s" % (uuid.uuid4().hex,))
+            task = ipIsr.IsrTask(config=config)
+            flatexposure = task.readFlat(FlatDataRef())
+            self.assertAlmostEqual(task.getFlatScale(flatexposure), 5)
+        finally:
+            shutil.rmtree(directory)
+
 
 class MemoryTester(lsst.utils.tests.MemoryTestCase):
     pass
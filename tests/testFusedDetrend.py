@@ -0,0 +1,252 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.cameraGeom as cameraGeom
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.image.testUtils  # noqa F401; for assertMaskedImagesAlmostEqual
+import lsst.afw.table as afwTable
+from lsst.afw.geom.testUtils import BoxGrid
+import lsst.ip.isr as ipIsr
+
+
+def makeMaskedImage(bbox, mean, sigma, maskVal=0):
+    """!Make a masked image with random image and variance planes
+
+    @param[in] bbox  bounding box of masked image
+    @param[in] mean  mean image value
+    @param[in] sigma  standard deviation of image values
+    @param[in] maskVal  value to which to set the corner pixel of the mask plane
+    """
+    maskedImage = afwImage.MaskedImageF(bbox)
+    shape = maskedImage.getImage().getArray().shape
+    maskedImage.getImage().getArray()[:] = np.random.normal(loc=mean, scale=sigma, size=shape)
+    maskedImage.getVariance().getArray()[:] = np.random.uniform(0.1, 1.0, size=shape)
+    maskedImage.getMask().getArray()[:] = 0
+    maskedImage.getMask().getArray()[0, 0] = maskVal
+    return maskedImage
+
+
+class ApplyDetrendTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(-3, 5), afwGeom.Extent2I(27, 19))
+        self.gain = 2.5
+        self.readNoise = 4.3
+        self.darkScale = 3.7
+        self.flatScale = 1.3
+
+    def tearDown(self):
+        self.bbox = None
+
+    def makeInputs(self):
+        science = makeMaskedImage(self.bbox, 1000.0, 100.0)
+        bias = makeMaskedImage(self.bbox, 50.0, 5.0, maskVal=1)
+        dark = makeMaskedImage(self.bbox, 2.0, 0.5, maskVal=2)
+        flat = makeMaskedImage(self.bbox, 1.0, 0.05, maskVal=4)
+        return science, bias, dark, flat
+
+    def referenceDetrend(self, maskedImage, bias, dark, flat, sqCoeff=0.0, table=None, indOffset=0.0):
+        """!Apply the same corrections as applyDetrend, one step at a time"""
+        if bias is not None:
+            ipIsr.biasCorrection(maskedImage, bias)
+        if table is not None:
+            ipIsr.applyLookupTable(maskedImage.getImage(), table, indOffset)
+        elif sqCoeff != 0:
+            imArr = maskedImage.getImage().getArray()
+            imArr *= (1 + sqCoeff*imArr)
+        ipIsr.updateVariance(maskedImage, self.gain, self.readNoise)
+        if dark is not None:
+            ipIsr.darkCorrection(maskedImage, dark, self.darkScale, 1.0)
+        if flat is not None:
+            ipIsr.flatCorrection(maskedImage, flat, 'USER', self.flatScale)
+
+    def checkDetrend(self, useBias, useDark, useFlat, sqCoeff=0.0, table=None, indOffset=0.0):
+        science, bias, dark, flat = self.makeInputs()
+        bias = bias if useBias else None
+        dark = dark if useDark else None
+        flat = flat if useFlat else None
+
+        refImage = science.Factory(science, True)
+        self.referenceDetrend(refImage, bias, dark, flat, sqCoeff=sqCoeff, table=table, indOffset=indOffset)
+
+        measImage = science.Factory(science, True)
+        ipIsr.applyDetrend(measImage, bias, dark, flat,
+                           darkScale=self.darkScale,
+                           flatScale=self.flatScale,
+                           gain=self.gain,
+                           readNoise=self.readNoise,
+                           sqCoeff=sqCoeff,
+                           table=table if table is not None else np.zeros(0, dtype=np.float32),
+                           indOffset=indOffset,
+                           )
+        self.assertMaskedImagesAlmostEqual(refImage, measImage, rtol=1e-5)
+
+    def testAllCalibs(self):
+        self.checkDetrend(True, True, True)
+
+    def testSomeCalibs(self):
+        self.checkDetrend(False, True, True)
+        self.checkDetrend(True, False, True)
+        self.checkDetrend(True, True, False)
+        self.checkDetrend(False, False, False)
+
+    def testSquared(self):
+        self.checkDetrend(True, True, True, sqCoeff=2.1e-6)
+
+    def testLookupTable(self):
+        table = np.array(np.random.normal(scale=5, size=1500), dtype=np.float32)
+        self.checkDetrend(True, True, True, table=table, indOffset=-200.0)
+
+    def testBadDimensions(self):
+        science, bias, dark, flat = self.makeInputs()
+        smallBias = afwImage.MaskedImageF(afwGeom.Extent2I(3, 3))
+        with self.assertRaises(Exception):
+            ipIsr.applyDetrend(science, smallBias, dark, flat, darkScale=1.0, flatScale=1.0,
+                               gain=1.0, readNoise=0.0, sqCoeff=0.0,
+                               table=np.zeros(0, dtype=np.float32), indOffset=0.0)
+
+    def testForEachAmp(self):
+        """!Test that IsrTask.forEachAmp runs in a pool of threads that close stops"""
+        config = ipIsr.IsrTask.ConfigClass()
+        config.numAmpThreads = 2
+        with ipIsr.IsrTask(config=config) as task:
+            self.assertEqual(task.forEachAmp(lambda i: 2*i, range(5)), [0, 2, 4, 6, 8])
+            task.close()
+            self.assertEqual(task.forEachAmp(lambda i: i + 1, range(3)), [1, 2, 3])
+
+
+class FusedDetrendTaskTestCase(lsst.utils.tests.TestCase):
+    """!Test that IsrTask.run gives the same result with and without the fused detrending kernel"""
+
+    def setUp(self):
+        np.random.seed(42)
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(24, 16))
+        self.numAmps = (2, 2)
+        self.config = ipIsr.IsrTask.ConfigClass()
+        self.config.doAssembleCcd = False
+        self.config.doDefect = False
+        self.config.doFringe = False
+        self.config.doWrite = False
+        self.config.flatUserScale = 1.3
+
+    def tearDown(self):
+        self.bbox = None
+        self.config = None
+
+    def makeExposure(self, mean, sigma, darkTime=1.0, maskVal=0):
+        exposure = afwImage.ExposureF(makeMaskedImage(self.bbox, mean, sigma, maskVal=maskVal), None)
+        exposure.getInfo().setVisitInfo(afwImage.VisitInfo(exposureTime=darkTime, darkTime=darkTime))
+        return exposure
+
+    def makeDetector(self, linearityType, coeffsList):
+        """!Make a detector with a grid of amplifiers covering self.bbox
+
+        @param[in] linearityType  linearity type of each amplifier
+        @param[in] coeffsList  linearity coefficients of each amplifier
+        """
+        ampInfoCat = afwTable.AmpInfoCatalog(afwTable.AmpInfoTable.makeMinimalSchema())
+        boxArr = BoxGrid(box=self.bbox, numColRow=self.numAmps)
+        for i in range(self.numAmps[0]):
+            for j in range(self.numAmps[1]):
+                ampInfo = ampInfoCat.addNew()
+                ampInfo.setName("amp %d_%d" % (i + 1, j + 1))
+                ampInfo.setBBox(boxArr[i, j])
+                ampInfo.setHasRawInfo(True)
+                ampInfo.setRawBBox(boxArr[i, j])
+                ampInfo.setRawDataBBox(boxArr[i, j])
+                ampInfo.setRawHorizontalOverscanBBox(afwGeom.Box2I())
+                ampInfo.setGain(2.5 + 0.1*len(ampInfoCat))
+                ampInfo.setReadNoise(4.3)
+                ampInfo.setSaturation(1e6)
+                ampInfo.setSuspectLevel(float("nan"))
+                ampInfo.setLinearityType(linearityType)
+                ampInfo.setLinearityCoeffs(np.array(coeffsList[len(ampInfoCat) - 1], dtype=float))
+        return cameraGeom.Detector("det_a", 1, cameraGeom.SCIENCE, "123", self.bbox, ampInfoCat,
+                                   cameraGeom.Orientation(), afwGeom.Extent2D(1, 1), {})
+
+    def checkFusedMatchesStages(self, detector, linearizer):
+        science = self.makeExposure(1000.0, 100.0)
+        science.setDetector(detector)
+        calibs = dict(bias=self.makeExposure(50.0, 5.0, maskVal=1),
+                      dark=self.makeExposure(2.0, 0.5, darkTime=10.0, maskVal=2),
+                      flat=self.makeExposure(1.0, 0.05, maskVal=4),
+                      linearizer=linearizer)
+        resultList = []
+        for doFusedDetrend in (False, True):
+            self.config.doFusedDetrend = doFusedDetrend
+            task = ipIsr.IsrTask(config=self.config)
+            plan = task.getPlan(science)
+            stageNames = [stage.name for stage in task.makeStageList(detector, plan, **calibs)]
+            self.assertEqual("detrend" in stageNames, doFusedDetrend)
+            resultList.append(task.run(science.clone(), **calibs).exposure)
+        self.assertMaskedImagesAlmostEqual(resultList[0].getMaskedImage(), resultList[1].getMaskedImage(),
+                                           rtol=1e-5)
+
+    def testSquared(self):
+        numAmps = self.numAmps[0]*self.numAmps[1]
+        detector = self.makeDetector("Squared", [[1.5e-6*(i + 1)] for i in range(numAmps)])
+        self.checkFusedMatchesStages(detector, ipIsr.LinearizeSquared())
+
+    def testLookupTable(self):
+        numAmps = self.numAmps[0]*self.numAmps[1]
+        detector = self.makeDetector("LookupTable", [[numAmps - 1 - i, -200, 0, 0] for i in range(numAmps)])
+        table = np.array(np.random.normal(scale=5, size=(numAmps, 1500)), dtype=np.float32)
+        self.checkFusedMatchesStages(detector, ipIsr.LinearizeLookupTable(table=table, detector=detector))
+
+    def testFallback(self):
+        """!Test that the stages run separately if they cannot be fused, including after a config change"""
+        self.config.doLinearize = False
+        self.config.doFusedDetrend = True
+        science = self.makeExposure(1000.0, 100.0)
+        calibs = dict(bias=self.makeExposure(50.0, 5.0), dark=self.makeExposure(2.0, 0.5),
+                      flat=self.makeExposure(1.0, 0.05))
+        task = ipIsr.IsrTask(config=self.config)
+        plan = task.getPlan(science)
+        self.assertTrue(task.canFuseDetrend(plan.amps, None))
+        for name in ("doBrighterFatter", "doSparseDark", "doSeparableBias"):
+            setattr(task.config, name, True)
+            self.assertFalse(task.canFuseDetrend(plan.amps, None))
+            stageNames = [stage.name for stage in task.makeStageList(plan.amps, plan, **calibs)]
+            self.assertNotIn("detrend", stageNames)
+            self.assertIn("flat", stageNames)
+            setattr(task.config, name, False)
+        self.assertTrue(task.canFuseDetrend(plan.amps, None))
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
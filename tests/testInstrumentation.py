@@ -0,0 +1,140 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+import threading
+import unittest
+
+import numpy as np
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # python 2
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.daf.base as dafBase
+import lsst.ip.isr as ipIsr
+
+
+class StageInstrumentationTestCase(lsst.utils.tests.TestCase):
+
+    def testBuffers(self):
+        """!Test that buffers are attributed to the stage being measured"""
+        instrumentation = ipIsr.StageInstrumentation()
+        array = np.zeros((10, 20), dtype=np.float32)
+        ipIsr.recordBuffer("not measured", array)
+        with instrumentation.measureStage("first"):
+            ipIsr.recordBuffer("a", array)
+            ipIsr.recordBuffer("b", afwImage.MaskedImageF(afwGeom.Extent2I(20, 10)))
+        with instrumentation.measureStage("second"):
+            pass
+        instrumentation.stop()
+
+        self.assertEqual([result.name for result in instrumentation.stageResults], ["first", "second"])
+        first, second = instrumentation.stageResults
+        self.assertEqual(first.numBuffers, 2)
+        self.assertEqual(first.bufferNames, ["a", "b"])
+        self.assertEqual(first.bufferBytes, array.nbytes + ipIsr.getNumBytes(
+            afwImage.MaskedImageF(afwGeom.Extent2I(20, 10))))
+        self.assertEqual(second.numBuffers, 0)
+        self.assertGreater(first.maxRss, 0)
+
+        metadata = dafBase.PropertySet()
+        instrumentation.writeMetadata(metadata)
+        self.assertEqual(metadata.get("FIRST_NUM_BUFFERS"), 2)
+        self.assertEqual(metadata.get("SECOND_NUM_BUFFERS"), 0)
+
+    def testThreads(self):
+        """!Test that buffers recorded by other threads are only attributed to a stage
+        if the thread uses the instrumentation
+        """
+        instrumentation = ipIsr.StageInstrumentation()
+        array = np.zeros((10, 20), dtype=np.float32)
+
+        def recordInThread(activeList=None):
+            def record():
+                if activeList is None:
+                    ipIsr.recordBuffer("other thread", array)
+                else:
+                    with ipIsr.useInstrumentation(activeList):
+                        ipIsr.recordBuffer("worker thread", array)
+            thread = threading.Thread(target=record)
+            thread.start()
+            thread.join()
+
+        with instrumentation.measureStage("first"):
+            recordInThread()
+            recordInThread(ipIsr.getActiveInstrumentation())
+        instrumentation.stop()
+        self.assertEqual(instrumentation.stageResults[0].bufferNames, ["worker thread"])
+
+    def testDisabled(self):
+        instrumentation = ipIsr.StageInstrumentation(enabled=False)
+        with instrumentation.measureStage("first"):
+            ipIsr.recordBuffer("a", np.zeros(5))
+        self.assertEqual(instrumentation.stageResults, [])
+
+    def testIsrTask(self):
+        """!Test that IsrTask.run writes the measurements to its metadata"""
+        config = ipIsr.IsrTask.ConfigClass()
+        config.doAssembleCcd = False
+        config.doBias = False
+        config.doDark = False
+        config.doFlat = False
+        config.doDefect = False
+        config.doFringe = False
+        config.doLinearize = False
+        config.doWrite = False
+        config.doInstrument = True
+        exposure = afwImage.ExposureU(afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(30, 20)))
+        exposure.getMaskedImage().getImage().getArray()[:] = 100
+        exposure.getInfo().setVisitInfo(afwImage.VisitInfo(exposureTime=1.0, darkTime=1.0))
+
+        task = ipIsr.IsrTask(config=config)
+        task.run(exposure)
+        self.assertEqual(task.metadata.get("ASSEMBLE_NUM_BUFFERS"), 1)  # conversion to float
+        for name in ("ASSEMBLE", "VARIANCE", "NAN"):
+            self.assertTrue(task.metadata.exists(name + "_MAX_RSS"))
+
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            # tracing stops even if a stage fails
+            def failStage(*args, **kwargs):
+                raise RuntimeError("Stage failed")
+            task.maskAndInterpNan = failStage
+            with self.assertRaises(RuntimeError):
+                task.run(exposure)
+            self.assertFalse(tracemalloc.is_tracing())
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
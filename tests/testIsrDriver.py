@@ -0,0 +1,286 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.image.utils as afwImageUtils
+import lsst.ip.isr as ipIsr
+
+
+def makeExposure(bbox, value, darkTime=1.0):
+    """!Make an exposure with a constant image plane and a visit info"""
+    exposure = afwImage.ExposureF(bbox)
+    exposure.getMaskedImage().getImage().getArray()[:] = value
+    exposure.getInfo().setVisitInfo(afwImage.VisitInfo(exposureTime=darkTime, darkTime=darkTime))
+    return exposure
+
+
+class DriverDataRef(object):
+    """Quacks like a ButlerDataRef, providing in-memory raw and calibration data"""
+
+    def __init__(self, dataId, datasets, fileNames):
+        self.dataId = dataId
+        self.datasets = datasets
+        self.fileNames = fileNames
+        self.numReads = {}
+        self.outputs = {}
+
+    def get(self, datasetType, bbox=None, immediate=False):
+        if datasetType.endswith("_filename"):
+            return [self.fileNames[datasetType[:-len("_filename")]]]
+        self.numReads[datasetType] = self.numReads.get(datasetType, 0) + 1
+        if datasetType == "raw_sub":
+            return self.datasets["raw"].Factory(self.datasets["raw"], bbox, afwImage.PARENT, True)
+        if datasetType in ("raw", "fringe"):
+            return self.datasets[datasetType].Factory(self.datasets[datasetType], True)
+        return self.datasets[datasetType]
+
+    def put(self, obj, datasetType):
+        self.outputs[datasetType] = obj
+
+
+class IsrPoolDriverTestCase(lsst.utils.tests.TestCase):
+    """!Unit tests for IsrPoolDriver"""
+
+    def setUp(self):
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(20, 10))
+        self.config = ipIsr.IsrTask.ConfigClass()
+        self.config.doAssembleCcd = False
+        self.config.doDefect = False
+        self.config.doFringe = False
+        self.config.doLinearize = False
+        self.config.doWrite = True
+        self.calibs = dict(bias=makeExposure(self.bbox, 10.0),
+                           dark=makeExposure(self.bbox, 1.0),
+                           flat=makeExposure(self.bbox, 2.0))
+
+    def tearDown(self):
+        self.bbox = None
+        self.config = None
+        self.calibs = None
+
+    def makeDataRefList(self):
+        """!Make data references for two visits of two detectors; the second detector's second visit
+        has a different flat
+        """
+        dataRefList = []
+        for visit in (1, 2):
+            for ccd in (0, 1):
+                datasets = dict(self.calibs)
+                datasets["raw"] = makeExposure(self.bbox, 100.0*visit + ccd)
+                fileNames = dict(bias="bias-%d" % ccd, dark="dark-%d" % ccd, flat="flat-%d" % ccd)
+                if ccd == 1 and visit == 2:
+                    fileNames["flat"] = "flat-1-new"
+                dataRefList.append(DriverDataRef(dict(visit=visit, ccd=ccd), datasets, fileNames))
+        return dataRefList
+
+    def checkExposure(self, exposure, dataId):
+        expected = (100.0*dataId["visit"] + dataId["ccd"] - 10.0 - 1.0)/2.0
+        self.assertFloatsAlmostEqual(exposure.getMaskedImage().getImage().getArray(), expected, rtol=1e-6)
+
+    def testGroups(self):
+        driver = ipIsr.IsrPoolDriver(config=self.config)
+        dataRefList = self.makeDataRefList()
+        groupList = driver.groupDataRefs(dataRefList)
+        self.assertEqual([[dataRef.dataId for dataRef in group] for group in groupList],
+                         [[dict(visit=1, ccd=0), dict(visit=2, ccd=0)],
+                          [dict(visit=1, ccd=1), dict(visit=2, ccd=1)]])
+
+    def testInProcess(self):
+        """!Test processing in this process, and sharing of calibration data"""
+        driver = ipIsr.IsrPoolDriver(config=self.config)
+        dataRefList = self.makeDataRefList()
+        result = driver.run(dataRefList)
+        self.assertEqual(result.numFailed, 0)
+        self.assertEqual([res.dataId for res in result.results], [dataRef.dataId for dataRef in dataRefList])
+        self.assertEqual([res.sharedCalibs for res in result.results], [False, False, True, False])
+        for dataRef in dataRefList:
+            self.checkExposure(dataRef.outputs["postISRCCD"], dataRef.dataId)
+            self.assertEqual(dataRef.numReads["raw"], 1)
+        self.assertEqual(set(driver.costModel.history), {(("ccd", 0),), (("ccd", 1),)})
+        self.assertNotIn("bias", dataRefList[2].numReads)
+        self.assertEqual(dataRefList[3].numReads["bias"], 1)
+
+    def testDefaultConfig(self):
+        """!Test that calibration data are shared with the default config, which enables linearization
+        and fringe subtraction for detectors and filters that have none
+        """
+        self.config = ipIsr.IsrTask.ConfigClass()
+        self.config.doAssembleCcd = False
+        dataRefList = self.makeDataRefList()
+        for dataRef in dataRefList:
+            dataRef.datasets["defects"] = []
+            dataRef.fileNames["defects"] = "defects-%d" % dataRef.dataId["ccd"]
+        driver = ipIsr.IsrPoolDriver(config=self.config)
+        result = driver.run(dataRefList)
+        self.assertEqual(result.numFailed, 0)
+        self.assertEqual([res.sharedCalibs for res in result.results], [False, False, True, False])
+        for dataRef in dataRefList:
+            self.checkExposure(dataRef.outputs["postISRCCD"], dataRef.dataId)
+        # the metadata of each result is that of its own data reference
+        for res in result.results:
+            self.assertEqual(len(res.metadata.getArray("isr.processDataRefStartCpuTime")), 1)
+
+    def testFringesNotShared(self):
+        """!Test that fringe frames and seeds are not shared between exposures"""
+        self.config.doFringe = True
+        self.config.fringe.filters = ["FILTER"]
+        self.config.fringe.num = 50
+        self.config.fringe.small = 1
+        self.config.fringe.large = 2
+        afwImageUtils.defineFilter("FILTER", lambdaEff=0)
+        try:
+            fringe = makeExposure(self.bbox, 0.0)
+            xx = np.arange(self.bbox.getWidth())
+            fringe.getMaskedImage().getImage().getArray()[:] = np.sin(xx)
+            dataRefList = self.makeDataRefList()
+            for dataRef in dataRefList:
+                dataRef.datasets["raw"].setFilter(afwImage.Filter("FILTER"))
+                dataRef.datasets["raw"].getMaskedImage().getImage().getArray()[:] += np.sin(xx)
+                dataRef.datasets["fringe"] = fringe
+                dataRef.datasets["ccdExposureId"] = 10*dataRef.dataId["visit"] + dataRef.dataId["ccd"]
+                dataRef.fileNames["fringe"] = "fringe-%d" % dataRef.dataId["ccd"]
+            driver = ipIsr.IsrPoolDriver(config=self.config)
+            result = driver.run(dataRefList)
+            self.assertEqual(result.numFailed, 0)
+            self.assertEqual([res.sharedCalibs for res in result.results], [False, False, True, False])
+            for dataRef in dataRefList:
+                self.assertEqual(dataRef.numReads["fringe"], 1)
+                self.assertEqual(dataRef.numReads["ccdExposureId"], 1)
+        finally:
+            afwImageUtils.resetFilters()
+
+    def testPool(self):
+        """!Test processing with a pool of processes"""
+        self.config.doWrite = False
+        driver = ipIsr.IsrPoolDriver(config=self.config, numProcesses=2, returnExposures=True)
+        dataRefList = self.makeDataRefList()
+        result = driver.run(dataRefList)
+        self.assertEqual(result.numFailed, 0)
+        for dataRef, res in zip(dataRefList, result.results):
+            self.assertEqual(res.dataId, dataRef.dataId)
+            self.checkExposure(res.exposure, dataRef.dataId)
+
+    def testChunks(self):
+        """!Test that many exposures of one detector are split into chunks for several processes"""
+        driver = ipIsr.IsrPoolDriver(config=self.config, numProcesses=2)
+        dataRefList = [DriverDataRef(dict(visit=visit, ccd=0), {}, {}) for visit in range(5)]
+        self.assertEqual(driver.getChunkSize(len(dataRefList), 2), 2)
+        self.assertEqual(driver.getChunkSize(len(dataRefList), 1), 5)
+        chunkList = driver.chunkGroups(driver.groupDataRefs(dataRefList), 2)
+        self.assertEqual([[dataRef.dataId["visit"] for dataRef in chunk] for chunk in chunkList],
+                         [[0], [1, 2], [3, 4]])
+
+        self.config.doWrite = False
+        driver = ipIsr.IsrPoolDriver(config=self.config, numProcesses=2, returnExposures=True, chunkSize=1)
+        dataRefList = self.makeDataRefList()
+        result = driver.run(dataRefList)
+        self.assertEqual(result.numFailed, 0)
+        for dataRef, res in zip(dataRefList, result.results):
+            self.checkExposure(res.exposure, dataRef.dataId)
+
+    def testFailure(self):
+        """!Test that a failure is reported and does not stop processing"""
+        dataRefList = self.makeDataRefList()
+        del dataRefList[1].datasets["raw"]
+        driver = ipIsr.IsrPoolDriver(config=self.config)
+        result = driver.run(dataRefList)
+        self.assertEqual(result.numFailed, 1)
+        self.assertIsNotNone(result.results[1].error)
+        self.assertEqual(sum(res.metadata is not None for res in result.results), 3)
+
+        driver = ipIsr.IsrPoolDriver(config=self.config, doRaise=True)
+        with self.assertRaises(KeyError):
+            driver.run(dataRefList)
+
+
+class IsrCostModelTestCase(lsst.utils.tests.TestCase):
+    """!Unit tests for IsrCostModel and scheduling by IsrPoolDriver"""
+
+    def setUp(self):
+        self.config = ipIsr.IsrTask.ConfigClass()
+        self.config.doFringe = True
+        self.config.fringe.filters = ["y"]
+        self.config.doBrighterFatter = False
+        self.config.doDefect = False
+
+    def tearDown(self):
+        self.config = None
+
+    def testPrior(self):
+        costModel = ipIsr.IsrCostModel(baseCost=1.0, fringeCost=0.5)
+        self.assertEqual(costModel.getPriorCost(self.config, dict(filter="g")), 1.0)
+        self.assertEqual(costModel.getPriorCost(self.config, dict(filter="y")), 1.5)
+        self.assertEqual(costModel.getPriorCost(self.config, dict()), 1.5)
+
+    def testHistory(self):
+        costModel = ipIsr.IsrCostModel(baseCost=1.0, fringeCost=0.5)
+        key0 = (("ccd", 0),)
+        key1 = (("ccd", 1),)
+        self.assertEqual(costModel.estimate(self.config, dict(filter="g"), key0), 1.0)
+        costModel.record(self.config, dict(filter="g"), key0, 4.0)
+        costModel.record(self.config, dict(filter="g"), key0, 6.0)
+        self.assertEqual(costModel.estimate(self.config, dict(filter="g"), key0), 5.0)
+        # prior estimates are scaled to seconds using the history of other detectors
+        self.assertEqual(costModel.estimate(self.config, dict(filter="y"), key1), 7.5)
+
+        tempDir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempDir, "history.json")
+            costModel.writeHistory(path)
+            newCostModel = ipIsr.IsrCostModel(baseCost=1.0, fringeCost=0.5)
+            newCostModel.readHistory(path)
+        finally:
+            shutil.rmtree(tempDir)
+        self.assertEqual(newCostModel.history, costModel.history)
+
+    def testSchedule(self):
+        """!Test that detectors are scheduled longest first"""
+        dataRefList = [DriverDataRef(dict(visit=1, ccd=ccd, filter="y"), {}, {}) for ccd in range(4)]
+        driver = ipIsr.IsrPoolDriver(config=self.config)
+        for ccd, cpuTime in ((0, 1.5), (1, 4.5), (2, 3.0)):
+            driver.costModel.record(self.config, dataRefList[ccd].dataId, (("ccd", ccd),), cpuTime)
+        order, costList = driver.scheduleGroups(driver.groupDataRefs(dataRefList))
+        self.assertEqual(costList, [1.5, 4.5, 3.0, 3.0])
+        self.assertEqual(order, [1, 2, 3, 0])
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,156 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+import unittest
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.table as afwTable
+import lsst.afw.cameraGeom as cameraGeom
+from lsst.afw.geom.testUtils import BoxGrid
+import lsst.ip.isr as ipIsr
+
+
+class IsrPlanTestCase(lsst.utils.tests.TestCase):
+    """!Unit tests for IsrPlan and IsrTask.getPlan"""
+
+    def setUp(self):
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(40, 30))
+        self.numAmps = (2, 3)
+        self.exposure = afwImage.ExposureF(self.bbox)
+        self.exposure.setDetector(self.makeDetector())
+        self.config = ipIsr.IsrTask.ConfigClass()
+        self.config.doLinearize = False
+
+    def tearDown(self):
+        self.bbox = None
+        self.exposure = None
+        self.config = None
+
+    def testCache(self):
+        """!Test that plans are reused for the same detector and configuration"""
+        task = ipIsr.IsrTask(config=self.config)
+        plan = task.getPlan(self.exposure)
+        self.assertIs(task.getPlan(self.exposure), plan)
+
+        task.config.fwhm += 1.0
+        newPlan = task.getPlan(self.exposure)
+        self.assertIsNot(newPlan, plan)
+        self.assertEqual(newPlan.psf.computeShape().getDeterminantRadius(),
+                         ipIsr.createPsf(task.config.fwhm).computeShape().getDeterminantRadius())
+
+        task.config.doLinearize = True
+        self.assertTrue(task.getPlan(self.exposure).doLinearize)
+
+    def testSameSerial(self):
+        """!Test that detectors with the same (or an empty) serial number get their own plans"""
+        task = ipIsr.IsrTask(config=self.config)
+        for serial in ("123", ""):
+            planList = []
+            for name, detectorId, numAmps in (("det_a", 1, (2, 3)), ("det_b", 2, (3, 2))):
+                self.numAmps = numAmps
+                exposure = afwImage.ExposureF(self.bbox)
+                exposure.setDetector(self.makeDetector(name=name, detectorId=detectorId, serial=serial))
+                planList.append(task.getPlan(exposure))
+            self.assertIsNot(planList[0], planList[1])
+            self.assertEqual(planList[1].amps[0].getBBox(),
+                             BoxGrid(box=self.bbox, numColRow=(3, 2))[0, 0])
+
+    def testAmps(self):
+        """!Test that amplifier information and contained amplifiers are correct"""
+        task = ipIsr.IsrTask(config=self.config)
+        plan = task.getPlan(self.exposure)
+        ampInfoCat = self.exposure.getDetector().getAmpInfoCatalog()
+        self.assertEqual(len(plan.amps), len(ampInfoCat))
+        for amp, ampInfo in zip(plan.amps, ampInfoCat):
+            self.assertEqual(amp.getBBox(), ampInfo.getBBox())
+            self.assertEqual(amp.getName(), ampInfo.getName())
+            self.assertEqual(amp.getHasRawInfo(), ampInfo.getHasRawInfo())
+
+        containedAmps = plan.getContainedAmps(self.bbox)
+        self.assertEqual([i for i, amp, slices in containedAmps], list(range(len(ampInfoCat))))
+        imArr = self.exposure.getMaskedImage().getImage().getArray()
+        for i, amp, slices in containedAmps:
+            imArr[slices] = i
+        for i, ampInfo in enumerate(ampInfoCat):
+            ampArr = self.exposure.getMaskedImage().getImage().Factory(
+                self.exposure.getMaskedImage().getImage(), ampInfo.getBBox()).getArray()
+            self.assertTrue((ampArr == i).all())
+
+        ampBBox = ampInfoCat[3].getBBox()
+        containedAmps = plan.getContainedAmps(ampBBox)
+        self.assertEqual(len(containedAmps), 1)
+        self.assertEqual(containedAmps[0][0], 3)
+        self.assertEqual(containedAmps[0][2], (slice(0, ampBBox.getHeight()), slice(0, ampBBox.getWidth())))
+
+    def testNoDetector(self):
+        """!Test that an exposure with no detector gets a plan with a single FakeAmp"""
+        self.config.doAssembleCcd = False
+        task = ipIsr.IsrTask(config=self.config)
+        plan = task.getPlan(afwImage.ExposureF(self.bbox))
+        self.assertEqual(len(plan.amps), 1)
+        self.assertEqual(plan.amps[0].getBBox(), self.bbox)
+        self.assertFalse(plan.doLinearize)
+
+    def makeDetector(self, name="det_a", detectorId=1, serial="123"):
+        """!Make a detector with a grid of amplifiers covering self.bbox
+
+        @param[in] name  name of detector
+        @param[in] detectorId  ID of detector
+        @param[in] serial  serial number of detector
+        @return a detector (an lsst.afw.cameraGeom.Detector)
+        """
+        schema = afwTable.AmpInfoTable.makeMinimalSchema()
+        ampInfoCat = afwTable.AmpInfoCatalog(schema)
+        boxArr = BoxGrid(box=self.bbox, numColRow=self.numAmps)
+        for i in range(self.numAmps[0]):
+            for j in range(self.numAmps[1]):
+                ampInfo = ampInfoCat.addNew()
+                ampInfo.setName("amp %d_%d" % (i + 1, j + 1))
+                ampInfo.setBBox(boxArr[i, j])
+                ampInfo.setLinearityType("Squared")
+                ampInfo.setLinearityCoeffs([0.0])
+        return cameraGeom.Detector(
+            name,
+            detectorId,
+            cameraGeom.SCIENCE,
+            serial,
+            self.bbox,
+            ampInfoCat,
+            cameraGeom.Orientation(),
+            afwGeom.Extent2D(1, 1),
+            {},
+        )
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,139 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+import os
+import shutil
+import tempfile
+import unittest
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.image.testUtils  # noqa F401; for assertMaskedImagesAlmostEqual
+import lsst.ip.isr as ipIsr
+
+
+def makeExposure(bbox, value):
+    """!Make an exposure with a constant image plane and a visit info"""
+    exposure = afwImage.ExposureF(bbox)
+    exposure.getMaskedImage().getImage().getArray()[:] = value
+    exposure.getInfo().setVisitInfo(afwImage.VisitInfo(exposureTime=1.0, darkTime=1.0))
+    return exposure
+
+
+class LazyCalibTestCase(lsst.utils.tests.TestCase):
+    """!Unit tests for LazyCalib and its use by IsrTask.run"""
+
+    def setUp(self):
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(20, 10))
+        self.config = ipIsr.IsrTask.ConfigClass()
+        self.config.doAssembleCcd = False
+        self.config.doDefect = False
+        self.config.doFringe = False
+        self.config.doLinearize = False
+        self.config.doWrite = False
+        self.calibs = dict(bias=makeExposure(self.bbox, 10.0),
+                           dark=makeExposure(self.bbox, 1.0),
+                           flat=makeExposure(self.bbox, 2.0))
+        self.loads = []
+        self.lazyCalibs = {}
+
+    def tearDown(self):
+        self.bbox = None
+        self.config = None
+        self.calibs = None
+        self.lazyCalibs = None
+
+    def makeLazyCalib(self, name):
+        def load():
+            self.loads.append((name, sorted(otherName for otherName, lazyCalib in self.lazyCalibs.items()
+                                            if lazyCalib.isLoaded())))
+            return self.calibs[name]
+        lazyCalib = ipIsr.LazyCalib(load, name, dict(visit=1))
+        self.lazyCalibs[name] = lazyCalib
+        return lazyCalib
+
+    def testLazyCalib(self):
+        lazyCalib = self.makeLazyCalib("bias")
+        self.assertFalse(lazyCalib.isLoaded())
+        self.assertIs(lazyCalib.get(), self.calibs["bias"])
+        self.assertIs(lazyCalib.get(), self.calibs["bias"])
+        self.assertTrue(lazyCalib.isLoaded())
+        self.assertEqual(len(self.loads), 1)
+        lazyCalib.release()
+        self.assertFalse(lazyCalib.isLoaded())
+
+        derived = lazyCalib.derive(lambda calib: calib.getBBox())
+        self.assertEqual(derived.datasetType, "bias")
+        self.assertEqual(derived.get(), self.bbox)
+        self.assertFalse(lazyCalib.isLoaded())
+
+        keyed = ipIsr.LazyCalib(lambda: self.calibs["bias"], "bias", dict(visit=1), calibKey=("bias", "a"))
+        self.assertEqual(keyed.derive(lambda calib: calib.getBBox()).calibKey, ("bias", "a"))
+
+    def testCalibKey(self):
+        """!Test that the stage cache identifies a LazyCalib by its calibKey, not the science data ID"""
+        directory = tempfile.mkdtemp()
+        try:
+            self.config.stageCacheDir = directory
+            self.config.stageCacheStages = ["bias"]
+            task = ipIsr.IsrTask(config=self.config)
+            oldKey = ("bias", ("bias.fits",), None, "1")
+            newKey = ("bias", ("bias.fits",), None, "2")  # re-certified bias in a file of the same name
+            for calibKey, numEntries in ((oldKey, 1), (oldKey, 1), (newKey, 2)):
+                bias = ipIsr.LazyCalib(lambda: self.calibs["bias"], "bias", dict(visit=1), calibKey=calibKey)
+                task.run(makeExposure(self.bbox, 100.0), bias=bias, dark=self.calibs["dark"],
+                         flat=self.calibs["flat"])
+                self.assertEqual(len([name for name in os.listdir(directory) if name.endswith(".fits")]),
+                                 numEntries)
+        finally:
+            shutil.rmtree(directory)
+
+    def testRun(self):
+        """!Test that run loads each calibration only when needed and releases it when done"""
+        for doFusedDetrend in (False, True):
+            self.config.doFusedDetrend = doFusedDetrend
+            self.loads = []
+            task = ipIsr.IsrTask(config=self.config)
+            expected = task.run(makeExposure(self.bbox, 100.0), **self.calibs).exposure
+            lazyCalibs = dict((name, self.makeLazyCalib(name)) for name in ("bias", "dark", "flat"))
+            result = task.run(makeExposure(self.bbox, 100.0), **lazyCalibs).exposure
+            self.assertMaskedImagesAlmostEqual(result.getMaskedImage(), expected.getMaskedImage())
+            self.assertEqual([load[0] for load in self.loads], ["bias", "dark", "flat"])
+            if not doFusedDetrend:
+                # each calibration has been released before the next is loaded
+                self.assertEqual([load[1] for load in self.loads], [[], [], []])
+            for lazyCalib in lazyCalibs.values():
+                self.assertFalse(lazyCalib.isLoaded())
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,119 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.image.testUtils  # noqa F401; for assertMaskedImagesEqual
+import lsst.ip.isr as ipIsr
+
+
+def makeExposure(bbox, mean):
+    """!Make an exposure with random image and variance planes, a mask plane and some metadata"""
+    exposure = afwImage.ExposureF(bbox)
+    maskedImage = exposure.getMaskedImage()
+    shape = maskedImage.getImage().getArray().shape
+    maskedImage.getImage().getArray()[:] = np.random.normal(loc=mean, size=shape)
+    maskedImage.getVariance().getArray()[:] = np.random.uniform(1.0, 2.0, size=shape)
+    maskedImage.getMask().getArray()[::3, ::2] = 1
+    exposure.getMetadata().set("CALIBID", "test")
+    return exposure
+
+
+class MmapDataRef(object):
+    """Quacks like a ButlerDataRef, counting reads of in-memory calibration exposures"""
+
+    def __init__(self, datasets):
+        self.dataId = dict(visit=1)
+        self.datasets = datasets
+        self.numReads = 0
+
+    def get(self, datasetType, immediate=False):
+        if datasetType.endswith("_filename"):
+            return [datasetType[:-len("_filename")] + ".fits"]
+        self.numReads += 1
+        return self.datasets[datasetType]
+
+
+class MmapCalibStoreTestCase(lsst.utils.tests.TestCase):
+    """!Unit tests for MmapCalibStore and its use by IsrTask"""
+
+    def setUp(self):
+        np.random.seed(1)
+        self.directory = tempfile.mkdtemp()
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(3, 4), afwGeom.Extent2I(20, 10))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        self.bbox = None
+
+    def testRoundTrip(self):
+        store = ipIsr.MmapCalibStore(self.directory)
+        exposure = makeExposure(self.bbox, 100.0)
+        key = store.makeKey("bias", ("bias.fits",))
+        self.assertFalse(store.has(key))
+        self.assertIsNone(store.read(key))
+        self.assertTrue(store.write(key, exposure))
+        self.assertTrue(store.has(key))
+        self.assertFalse(store.write(key, afwImage.ExposureU(self.bbox)))
+
+        mapped = store.read(key)
+        self.assertEqual(mapped.getBBox(), self.bbox)
+        self.assertMaskedImagesEqual(mapped.getMaskedImage(), exposure.getMaskedImage())
+        self.assertEqual(mapped.getMetadata().get("CALIBID"), "test")
+
+        # modifying a mapped exposure does not modify the store
+        mapped.getMaskedImage().getImage().getArray()[:] = 0.0
+        self.assertMaskedImagesEqual(store.read(key).getMaskedImage(), exposure.getMaskedImage())
+
+    def testGetIsrExposure(self):
+        """!Test that a calibration is read once, then memory-mapped by any task"""
+        config = ipIsr.IsrTask.ConfigClass()
+        config.mmapCalibDir = self.directory
+        bias = makeExposure(self.bbox, 10.0)
+        dataRef = MmapDataRef(dict(bias=bias))
+        for i in range(2):
+            task = ipIsr.IsrTask(config=config)
+            mapped = task.getIsrExposure(dataRef, "bias")
+            self.assertMaskedImagesEqual(mapped.getMaskedImage(), bias.getMaskedImage())
+            self.assertIsNot(mapped, bias)
+        self.assertEqual(dataRef.numReads, 1)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -24,9 +24,12 @@ from __future__ import absolute_import, division, print_function
 from builtins import range
 import unittest
 
+import numpy as np
+
 import lsst.utils.tests
 import lsst.afw.image as afwImage
 import lsst.afw.geom as afwGeom
+import lsst.afw.math as afwMath
 import lsst.ip.isr as ipIsr
 
 
@@ -164,6 +167,23 @@ class IsrTestCases(lsst.utils.tests.TestCase):
             self.checkPolyOverscanCorrectionX(fitType=fitType, order=5)
             self.checkPolyOverscanCorrectionY(fitType=fitType, order=5)
 
+    def testNumpyStatistics(self):
+        """Test that the numpy mean and median of an overscan image match those of afwMath"""
+        np.random.seed(5)
+        bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(7, 30))
+        overscan = afwImage.ImageF(bbox)
+        overscan.getArray()[:] = np.random.normal(loc=100.0, scale=3.0, size=overscan.getArray().shape)
+        overscan.getArray()[3, 4] = np.nan
+        for fitType in ("MEAN", "MEDIAN"):
+            results = []
+            # an explicit StatisticsControl makes overscanCorrection use afwMath
+            for statControl in (None, afwMath.StatisticsControl()):
+                maskedImage = afwImage.MaskedImageF(bbox)
+                maskedImage.set(200, 0x0, 1)
+                ipIsr.overscanCorrection(maskedImage, overscan, fitType=fitType, statControl=statControl)
+                results.append(maskedImage.getImage().getArray().copy())
+            self.assertFloatsAlmostEqual(results[0], results[1], rtol=1e-6)
+
 
 class MemoryTester(lsst.utils.tests.MemoryTestCase):
     pass
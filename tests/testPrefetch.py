@@ -0,0 +1,139 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object, range
+import threading
+import time
+import unittest
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.ip.isr as ipIsr
+
+
+class PrefetchDataRef(object):
+    """Quacks like a ButlerDataRef, providing in-memory raw and calibration data"""
+
+    def __init__(self, dataId, raw, calibs):
+        self.dataId = dataId
+        self.raw = raw
+        self.calibs = calibs
+        self.outputs = {}
+
+    def get(self, datasetType, immediate=False):
+        if datasetType == "raw":
+            return self.raw
+        return self.calibs[datasetType]
+
+    def put(self, obj, datasetType):
+        self.outputs[datasetType] = obj
+
+
+class PrefetcherTestCase(lsst.utils.tests.TestCase):
+    """!Unit tests for Prefetcher"""
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.started = []
+
+    def read(self, item):
+        with self.lock:
+            self.started.append(item)
+        time.sleep(0.01)
+        if item == 7:
+            raise ValueError("cannot read %s" % (item,))
+        return item
+
+    def testDepth(self):
+        """!Test that results are in order and at most depth items are read ahead"""
+        for numThreads in (1, 2):
+            self.started = []
+            prefetcher = ipIsr.Prefetcher(self.read, list(range(6)), depth=2, numThreads=numThreads)
+            resultList = []
+            for result in prefetcher:
+                time.sleep(0.03)
+                with self.lock:
+                    self.assertLessEqual(max(self.started) - result, 2)
+                resultList.append(result)
+            self.assertEqual(resultList, list(range(6)))
+
+    def testMaxBytes(self):
+        """!Test that reads wait while the results read ahead are too large"""
+        prefetcher = ipIsr.Prefetcher(self.read, list(range(6)), depth=3, maxBytes=10, sizeFunc=lambda x: 10)
+        for result in prefetcher:
+            time.sleep(0.03)
+            with self.lock:
+                self.assertLessEqual(max(self.started) - result, 1)
+
+    def testException(self):
+        """!Test that a read failure is raised when its result is used"""
+        resultList = []
+        with self.assertRaises(ValueError):
+            for result in ipIsr.Prefetcher(self.read, list(range(10)), depth=2):
+                resultList.append(result)
+        self.assertEqual(resultList, list(range(7)))
+
+    def testNoDepth(self):
+        self.assertEqual(list(ipIsr.Prefetcher(self.read, list(range(3)), depth=0)), [0, 1, 2])
+
+
+class RunDataRefListTestCase(lsst.utils.tests.TestCase):
+    """!Unit tests for IsrTask.runDataRefList"""
+
+    def makeExposure(self, value):
+        exposure = afwImage.ExposureF(afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(20, 10)))
+        exposure.getMaskedImage().getImage().getArray()[:] = value
+        exposure.getInfo().setVisitInfo(afwImage.VisitInfo(exposureTime=1.0, darkTime=1.0))
+        return exposure
+
+    def testRunDataRefList(self):
+        config = ipIsr.IsrTask.ConfigClass()
+        config.doAssembleCcd = False
+        config.doDark = False
+        config.doDefect = False
+        config.doFringe = False
+        config.doLinearize = False
+        config.prefetchDepth = 2
+        calibs = dict(bias=self.makeExposure(10.0), flat=self.makeExposure(2.0))
+        dataRefList = [PrefetchDataRef(dict(visit=visit), self.makeExposure(100.0*visit), calibs)
+                       for visit in range(1, 5)]
+        task = ipIsr.IsrTask(config=config)
+        self.assertGreater(task.getInputBytes(task.readDataRef(dataRefList[0])), 0)
+        result = task.runDataRefList(dataRefList, returnExposures=True)
+        for visit, dataRef, exposure in zip(range(1, 5), dataRefList, result.exposures):
+            self.assertIs(dataRef.outputs["postISRCCD"], exposure)
+            self.assertFloatsAlmostEqual(exposure.getMaskedImage().getImage().getArray(),
+                                         (100.0*visit - 10.0)/2.0, rtol=1e-6)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,108 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.image.testUtils  # noqa F401; for assertMaskedImagesAlmostEqual
+import lsst.ip.isr as ipIsr
+
+
+def makeExposure(bbox, rng, mean, sigma, darkTime=1.0, maskValue=0):
+    """!Make an exposure with random image and variance planes, a constant mask and a visit info"""
+    exposure = afwImage.ExposureF(bbox)
+    maskedImage = exposure.getMaskedImage()
+    maskedImage.getImage().getArray()[:] = rng.normal(mean, sigma, size=(bbox.getHeight(), bbox.getWidth()))
+    maskedImage.getVariance().getArray()[:] = rng.uniform(0.1, 1.0, size=(bbox.getHeight(), bbox.getWidth()))
+    maskedImage.getMask().getArray()[0, :] = maskValue
+    exposure.getInfo().setVisitInfo(afwImage.VisitInfo(exposureTime=darkTime, darkTime=darkTime))
+    return exposure
+
+
+class PreparedCalibsTestCase(lsst.utils.tests.TestCase):
+    """!Unit tests for PreparedCalibs and its use by IsrTask.run"""
+
+    def setUp(self):
+        self.rng = np.random.RandomState(12345)
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(20, 10))
+        self.calibs = dict(bias=makeExposure(self.bbox, self.rng, 10.0, 1.0, maskValue=1),
+                           dark=makeExposure(self.bbox, self.rng, 4.0, 0.5, darkTime=2.0, maskValue=2),
+                           flat=makeExposure(self.bbox, self.rng, 2.0, 0.1, maskValue=4))
+
+    def tearDown(self):
+        self.bbox = None
+        self.calibs = None
+
+    def testCorrections(self):
+        """!Test that the prepared corrections match those of isrFunctions"""
+        for mergeMasks in (False, True):
+            preparedCalibs = ipIsr.PreparedCalibs(darkTime=2.0, flatScale=3.0, mergeMasks=mergeMasks,
+                                                  **self.calibs)
+            exposure = makeExposure(self.bbox, self.rng, 100.0, 5.0, darkTime=5.0)
+            expected = exposure.getMaskedImage().clone()
+            ipIsr.biasCorrection(expected, self.calibs["bias"].getMaskedImage())
+            ipIsr.darkCorrection(expected, self.calibs["dark"].getMaskedImage(), 5.0, 2.0)
+            ipIsr.flatCorrection(expected, self.calibs["flat"].getMaskedImage(), "USER", 3.0)
+            maskedImage = exposure.getMaskedImage()
+            preparedCalibs.correctBias(maskedImage)
+            preparedCalibs.correctDark(maskedImage, 5.0)
+            preparedCalibs.correctFlat(maskedImage)
+            self.assertMaskedImagesAlmostEqual(maskedImage, expected, rtol=1e-5)
+
+    def testRun(self):
+        """!Test that IsrTask.run gives the same result with and without prepared calibrations,
+        and reuses the prepared products for the same calibrations"""
+        config = ipIsr.IsrTask.ConfigClass()
+        config.doAssembleCcd = False
+        config.doDefect = False
+        config.doFringe = False
+        config.doLinearize = False
+        config.doWrite = False
+        raw = makeExposure(self.bbox, self.rng, 100.0, 5.0)
+        task = ipIsr.IsrTask(config=config)
+        expected = task.run(afwImage.ExposureF(raw, True), **self.calibs).exposure
+        config.doPrepareCalibs = True
+        task = ipIsr.IsrTask(config=config)
+        calibList = [self.calibs[name] for name in ("bias", "dark", "flat")]
+        preparedList = []
+        for i in range(2):
+            result = task.run(afwImage.ExposureF(raw, True), **self.calibs).exposure
+            self.assertMaskedImagesAlmostEqual(result.getMaskedImage(), expected.getMaskedImage(), rtol=1e-5)
+            preparedList.append(task.getPreparedCalibs(*calibList, mergeMasks=True))
+        self.assertIs(preparedList[0], preparedList[1])
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
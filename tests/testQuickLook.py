@@ -0,0 +1,220 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.coord as afwCoord
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.table as afwTable
+import lsst.afw.cameraGeom as cameraGeom
+import lsst.meas.algorithms as measAlg
+import lsst.ip.isr as ipIsr
+
+
+def makeExposure(imageArray, varianceArray=None, exposureTime=1.0, darkTime=1.0):
+    """!Make an exposure from image and variance arrays, with a visit info
+
+    @param[in] imageArray  image plane (a 2-d array)
+    @param[in] varianceArray  variance plane, or None for zero variance
+    @param[in] exposureTime  exposure time (sec)
+    @param[in] darkTime  dark time (sec)
+    """
+    height, width = imageArray.shape
+    exposure = afwImage.ExposureF(afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(width, height)))
+    maskedImage = exposure.getMaskedImage()
+    maskedImage.getImage().getArray()[:] = imageArray
+    maskedImage.getVariance().getArray()[:] = varianceArray if varianceArray is not None else 0.0
+    exposure.getInfo().setVisitInfo(afwImage.VisitInfo(exposureTime=exposureTime, darkTime=darkTime))
+    return exposure
+
+
+def makeDetector(bbox, ampWidthList, gainList, readNoise):
+    """!Make a detector whose amplifiers are side by side, with no overscan
+
+    @param[in] bbox  bounding box of the detector
+    @param[in] ampWidthList  width of each amplifier
+    @param[in] gainList  gain of each amplifier
+    @param[in] readNoise  read noise of the amplifiers
+    """
+    schema = afwTable.AmpInfoTable.makeMinimalSchema()
+    ampInfoCat = afwTable.AmpInfoCatalog(schema)
+    x0 = bbox.getMinX()
+    for i, (width, gain) in enumerate(zip(ampWidthList, gainList)):
+        ampBBox = afwGeom.Box2I(afwGeom.Point2I(x0, bbox.getMinY()),
+                                afwGeom.Extent2I(width, bbox.getHeight()))
+        x0 += width
+        ampInfo = ampInfoCat.addNew()
+        ampInfo.setName("amp %d" % (i,))
+        ampInfo.setBBox(ampBBox)
+        ampInfo.setGain(gain)
+        ampInfo.setReadNoise(readNoise)
+        ampInfo.setSaturation(float("nan"))
+        ampInfo.setSuspectLevel(float("nan"))
+        ampInfo.setHasRawInfo(True)
+        ampInfo.setRawBBox(ampBBox)
+        ampInfo.setRawDataBBox(ampBBox)
+        ampInfo.setRawHorizontalOverscanBBox(afwGeom.Box2I())
+        ampInfo.setLinearityType("None")
+    return cameraGeom.Detector("det_a", 1, cameraGeom.SCIENCE, "123", bbox, ampInfoCat,
+                               cameraGeom.Orientation(), afwGeom.Extent2D(1, 1), {})
+
+
+class QuickLookTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        np.random.seed(3)
+        self.binSize = 4
+        self.shape = (24, 32)
+        self.config = ipIsr.IsrTask.ConfigClass()
+        self.config.doAssembleCcd = False
+        self.config.doDefect = False
+        self.config.doFringe = False
+        self.config.doLinearize = False
+        self.config.doWrite = False
+        self.config.gain = 2.0
+        self.config.readNoise = 3.0
+
+    def tearDown(self):
+        self.config = None
+
+    def testBinMaskedImage(self):
+        maskedImage = makeExposure(np.arange(30, dtype=float).reshape(5, 6), np.ones((5, 6))).getMaskedImage()
+        maskedImage.getMask().getArray()[1, 3] = 4
+        binned = ipIsr.binMaskedImage(maskedImage, 2)
+        self.assertEqual(binned.getDimensions(), afwGeom.Extent2I(3, 2))
+        self.assertFloatsAlmostEqual(binned.getImage().getArray()[0], [14, 22, 30])
+        self.assertFloatsAlmostEqual(binned.getVariance().getArray(), 4.0)
+        self.assertEqual(binned.getMask().getArray()[0, 1], 4)
+        self.assertEqual(binned.getMask().getArray().sum(), 4)
+
+        averaged = ipIsr.binMaskedImage(maskedImage, 2, average=True)
+        self.assertFloatsAlmostEqual(averaged.getImage().getArray()[0], [3.5, 5.5, 7.5])
+        self.assertFloatsAlmostEqual(averaged.getVariance().getArray(), 0.25)
+
+    def testMatchesBinnedRun(self):
+        """!Test that runQuickLook matches binning the output of run, for a flat that is uniform per bin"""
+        bias = makeExposure(np.random.normal(50.0, 1.0, self.shape), np.full(self.shape, 0.5))
+        dark = makeExposure(np.random.normal(2.0, 0.1, self.shape), np.full(self.shape, 0.1), darkTime=10.0)
+        blockShape = (self.shape[0]//self.binSize, self.shape[1]//self.binSize)
+        flatArray = np.kron(np.random.uniform(0.9, 1.1, blockShape), np.ones((self.binSize, self.binSize)))
+        flat = makeExposure(flatArray)
+        raw = makeExposure(np.random.normal(1000.0, 30.0, self.shape), exposureTime=5.0, darkTime=5.0)
+
+        task = ipIsr.IsrTask(config=self.config)
+        refExposure = task.run(raw.clone(), bias=bias, dark=dark, flat=flat).exposure
+        refBinned = ipIsr.binMaskedImage(refExposure.getMaskedImage(), self.binSize)
+
+        result = task.runQuickLook(raw.clone(), bias=bias, dark=dark, flat=flat, binSize=self.binSize)
+        self.assertEqual(result.binSize, self.binSize)
+        binned = result.exposure.getMaskedImage()
+        self.assertFloatsAlmostEqual(binned.getImage().getArray(), refBinned.getImage().getArray(), rtol=1e-5)
+        self.assertFloatsAlmostEqual(binned.getVariance().getArray(), refBinned.getVariance().getArray(),
+                                     rtol=1e-5)
+
+        # a second call reuses the binned calibrations and gives the same result
+        result2 = task.runQuickLook(raw.clone(), bias=bias, dark=dark, flat=flat, binSize=self.binSize)
+        self.assertFloatsAlmostEqual(result2.exposure.getMaskedImage().getImage().getArray(),
+                                     binned.getImage().getArray())
+
+    def testAmpBoundaries(self):
+        """!Test the variance of bins that straddle amplifiers with different gains"""
+        self.config.doBias = False
+        self.config.doDark = False
+        self.config.doFlat = False
+        raw = makeExposure(np.full(self.shape, 1000.0))
+        # the amplifier boundary at x=10 is not on a bin boundary
+        raw.setDetector(makeDetector(raw.getBBox(), [10, self.shape[1] - 10], [1.5, 3.0], 4.0))
+        task = ipIsr.IsrTask(config=self.config)
+        refExposure = task.run(raw.clone()).exposure
+        refBinned = ipIsr.binMaskedImage(refExposure.getMaskedImage(), self.binSize)
+
+        binned = task.runQuickLook(raw.clone(), binSize=self.binSize).exposure.getMaskedImage()
+        self.assertFloatsAlmostEqual(binned.getVariance().getArray(), refBinned.getVariance().getArray(),
+                                     rtol=1e-5)
+
+    def testDefectsWithUnalignedXY0(self):
+        """!Test that defects mask the bins holding their pixels when xy0 is not a multiple of binSize"""
+        self.config.doBias = False
+        self.config.doDark = False
+        self.config.doFlat = False
+        self.config.doDefect = True
+        raw = makeExposure(np.full(self.shape, 1000.0))
+        raw.setXY0(afwGeom.Point2I(3, 5))
+        raw.setDetector(makeDetector(raw.getBBox(), [self.shape[1]], [2.0], 3.0))
+        # parent pixels (7, 9) through (8, 9) are local pixels (4, 4) through (5, 4), in local bin (1, 1);
+        # binning parent coordinates directly would put them in bin (1, 2) of the binned image
+        defects = [measAlg.Defect(afwGeom.Box2I(afwGeom.Point2I(7, 9), afwGeom.Point2I(8, 9)))]
+        task = ipIsr.IsrTask(config=self.config)
+        binned = task.runQuickLook(raw.clone(), defects=defects, binSize=self.binSize).exposure
+        self.assertEqual(binned.getXY0(), afwGeom.Point2I(0, 1))
+
+        mask = binned.getMaskedImage().getMask()
+        badArray = (mask.getArray() & mask.getPlaneBitMask("BAD")) != 0
+        expected = np.zeros_like(badArray)
+        expected[1, 1] = True
+        self.assertTrue(np.array_equal(badArray, expected))
+
+    def testExposureInfo(self):
+        """!Test that the binned exposure keeps the exposure info of the input, with a binned Wcs"""
+        self.config.doBias = False
+        self.config.doDark = False
+        self.config.doFlat = False
+        raw = makeExposure(np.random.normal(1000.0, 30.0, self.shape), exposureTime=5.0)
+        raw.setXY0(afwGeom.Point2I(3, 5))
+        raw.setDetector(makeDetector(raw.getBBox(), [self.shape[1]], [2.0], 3.0))
+        crval = afwCoord.IcrsCoord(30.0*afwGeom.degrees, -20.0*afwGeom.degrees)
+        wcs = afwImage.makeWcs(crval, afwGeom.Point2D(12.3, 8.7), 5.0e-5, 1.0e-6, -1.0e-6, 5.0e-5)
+        raw.setWcs(wcs)
+        task = ipIsr.IsrTask(config=self.config)
+
+        inputExposure = raw.clone()
+        exposure = task.runQuickLook(inputExposure, binSize=self.binSize).exposure
+        self.assertEqual(exposure.getDetector().getName(), "det_a")
+        self.assertEqual(exposure.getInfo().getVisitInfo().getExposureTime(), 5.0)
+        self.assertEqual(exposure.getMetadata().get("ISR_BIN"), self.binSize)
+        self.assertFalse(inputExposure.getMetadata().exists("ISR_BIN"))
+        binnedWcs = exposure.getWcs()
+        for x, y in ((0, 1), (3, 4), (7, 5)):
+            # the xy0 of the binned exposure is (0, 1), and its first pixel is the sum of the block
+            # of pixels starting at the xy0 of the raw exposure, (3, 5)
+            unbinned = afwGeom.Point2D(3 + self.binSize*x + 0.5*(self.binSize - 1),
+                                       5 + self.binSize*(y - 1) + 0.5*(self.binSize - 1))
+            separation = binnedWcs.pixelToSky(afwGeom.Point2D(x, y)).angularSeparation(
+                wcs.pixelToSky(unbinned))
+            self.assertLess(separation.asArcseconds(), 1.0e-6)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
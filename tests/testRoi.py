@@ -0,0 +1,227 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.image.testUtils  # noqa F401; for assertMaskedImagesAlmostEqual
+import lsst.afw.table as afwTable
+import lsst.afw.cameraGeom as cameraGeom
+from lsst.afw.geom.testUtils import BoxGrid
+import lsst.ip.isr as ipIsr
+
+
+def makeExposure(bbox, mean, sigma, detector=None, darkTime=1.0):
+    """!Make an exposure with a random image plane and a visit info
+
+    @param[in] bbox  bounding box of exposure
+    @param[in] mean  mean image value
+    @param[in] sigma  standard deviation of image values
+    @param[in] detector  detector to attach, or None
+    @param[in] darkTime  dark time (sec)
+    """
+    exposure = afwImage.ExposureF(bbox)
+    maskedImage = exposure.getMaskedImage()
+    shape = maskedImage.getImage().getArray().shape
+    maskedImage.getImage().getArray()[:] = np.random.normal(loc=mean, scale=sigma, size=shape)
+    maskedImage.getVariance().getArray()[:] = 0.1
+    exposure.getInfo().setVisitInfo(afwImage.VisitInfo(exposureTime=darkTime, darkTime=darkTime))
+    if detector is not None:
+        exposure.setDetector(detector)
+    return exposure
+
+
+class RoiButler(object):
+    """Quacks like a Butler, providing only a camera"""
+
+    def __init__(self, camera):
+        self.camera = camera
+
+    def get(self, datasetType, immediate=False):
+        if datasetType != "camera":
+            raise RuntimeError("Unknown dataset type %s" % (datasetType,))
+        return self.camera
+
+
+class RoiDataRef(object):
+    """Quacks like a ButlerDataRef, providing regions of in-memory raw and calibration data"""
+
+    def __init__(self, dataId, datasets, camera):
+        self.dataId = dataId
+        self.datasets = datasets
+        self.butler = RoiButler(camera)
+        self.bboxes = {}
+
+    def getButler(self):
+        return self.butler
+
+    def get(self, datasetType, bbox=None, immediate=False):
+        if datasetType.endswith("_filename"):
+            raise RuntimeError("No file names for %s" % (datasetType,))
+        if not datasetType.endswith("_sub"):
+            raise RuntimeError("Only regions may be read, not %s" % (datasetType,))
+        datasetType = datasetType[:-len("_sub")]
+        self.bboxes.setdefault(datasetType, []).append(bbox)
+        exposure = self.datasets[datasetType]
+        return exposure.Factory(exposure, bbox, afwImage.PARENT, True)
+
+
+class RoiTestCase(lsst.utils.tests.TestCase):
+    """!Unit tests for processing a region of interest with IsrTask"""
+
+    def setUp(self):
+        np.random.seed(5)
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(80, 60))
+        self.numAmps = (4, 2)
+        self.detector = self.makeDetector()
+        self.config = ipIsr.IsrTask.ConfigClass()
+        self.config.doAssembleCcd = False
+        self.config.doDefect = False
+        self.config.doFringe = False
+        self.config.doLinearize = False
+        self.config.doWrite = False
+        self.config.fwhm = 1.0
+        self.bias = makeExposure(self.bbox, 50.0, 2.0)
+        self.dark = makeExposure(self.bbox, 2.0, 0.1, darkTime=10.0)
+        self.flat = makeExposure(self.bbox, 1.0, 0.05)
+
+    def tearDown(self):
+        self.bbox = None
+        self.detector = None
+        self.config = None
+        self.bias = None
+        self.dark = None
+        self.flat = None
+
+    def testMakeRoi(self):
+        task = ipIsr.IsrTask(config=self.config)
+        halo = task.getRoiHalo()
+        ampInfoCat = self.detector.getAmpInfoCatalog()
+        ampBBox = ampInfoCat[0].getBBox()
+        # a region well inside amp 0
+        roiBBox = afwGeom.Box2I(afwGeom.Point2I(ampBBox.getMinX() + halo, ampBBox.getMinY() + halo),
+                                afwGeom.Extent2I(2, 2))
+        roi = task.makeRoi(self.detector, roiBBox)
+        self.assertEqual(roi.ampIndexList, [0])
+        self.assertEqual(roi.regionBBox, ampBBox)
+        self.assertEqual(roi.bbox, roiBBox)
+
+        # a region that reaches the edge of amp 0 requires its neighbors
+        roiBBox = afwGeom.Box2I(afwGeom.Point2I(ampBBox.getMaxX(), ampBBox.getMaxY()), afwGeom.Extent2I(1, 1))
+        roi = task.makeRoi(self.detector, roiBBox)
+        self.assertGreater(len(roi.ampIndexList), 1)
+        for i in roi.ampIndexList:
+            self.assertTrue(roi.regionBBox.contains(ampInfoCat[i].getBBox()))
+
+        with self.assertRaises(RuntimeError):
+            task.makeRoi(self.detector, afwGeom.Box2I(afwGeom.Point2I(-10, -10), afwGeom.Extent2I(2, 2)))
+
+    def testMatchesFullRun(self):
+        """!Test that processing a region of interest matches the same region of a full run"""
+        for flatScalingType in ("USER", "MEAN"):
+            self.config.flatScalingType = flatScalingType
+            raw = makeExposure(self.bbox, 1000.0, 30.0, detector=self.detector)
+            task = ipIsr.IsrTask(config=self.config)
+            roiBBox = afwGeom.Box2I(afwGeom.Point2I(15, 20), afwGeom.Extent2I(12, 9))
+
+            refExposure = task.run(raw.clone(), bias=self.bias, dark=self.dark, flat=self.flat).exposure
+            exposure = task.run(raw.clone(), bias=self.bias, dark=self.dark, flat=self.flat,
+                                bbox=roiBBox).exposure
+
+            self.assertEqual(exposure.getBBox(), roiBBox)
+            refView = refExposure.getMaskedImage().Factory(refExposure.getMaskedImage(), roiBBox)
+            self.assertMaskedImagesAlmostEqual(exposure.getMaskedImage(), refView)
+
+    def testRunDataRef(self):
+        """!Test that runDataRef reads only the amplifiers needed for a region of interest"""
+        raw = makeExposure(self.bbox, 1000.0, 30.0, detector=self.detector)
+        dataRef = RoiDataRef(dict(ccd=self.detector.getId()),
+                             dict(raw=raw, bias=self.bias, dark=self.dark, flat=self.flat),
+                             {self.detector.getId(): self.detector})
+        task = ipIsr.IsrTask(config=self.config)
+        roiBBox = afwGeom.Box2I(afwGeom.Point2I(15, 20), afwGeom.Extent2I(12, 9))
+        roi = task.makeRoi(self.detector, roiBBox)
+
+        exposure = task.runDataRef(dataRef, bbox=roiBBox).exposure
+
+        self.assertEqual(dataRef.bboxes["raw"], [roi.rawBBox])
+        self.assertEqual(dataRef.bboxes["bias"], [roi.regionBBox])
+        self.assertEqual(exposure.getBBox(), roiBBox)
+        refExposure = task.run(raw.clone(), bias=self.bias, dark=self.dark, flat=self.flat).exposure
+        refView = refExposure.getMaskedImage().Factory(refExposure.getMaskedImage(), roiBBox)
+        self.assertMaskedImagesAlmostEqual(exposure.getMaskedImage(), refView)
+
+        del dataRef.dataId["ccd"]
+        with self.assertRaises(RuntimeError):
+            task.runDataRef(dataRef, bbox=roiBBox)
+
+    def makeDetector(self):
+        """!Make a detector with a grid of amplifiers covering self.bbox, with no overscan
+
+        @return a detector (an lsst.afw.cameraGeom.Detector)
+        """
+        schema = afwTable.AmpInfoTable.makeMinimalSchema()
+        ampInfoCat = afwTable.AmpInfoCatalog(schema)
+        boxArr = BoxGrid(box=self.bbox, numColRow=self.numAmps)
+        for i in range(self.numAmps[0]):
+            for j in range(self.numAmps[1]):
+                ampInfo = ampInfoCat.addNew()
+                ampInfo.setName("amp %d_%d" % (i + 1, j + 1))
+                ampInfo.setBBox(boxArr[i, j])
+                ampInfo.setGain(1.5 + 0.1*i)
+                ampInfo.setReadNoise(5.0)
+                ampInfo.setSaturation(float("nan"))
+                ampInfo.setSuspectLevel(float("nan"))
+                ampInfo.setHasRawInfo(True)
+                ampInfo.setRawBBox(boxArr[i, j])
+                ampInfo.setRawDataBBox(boxArr[i, j])
+                ampInfo.setRawHorizontalOverscanBBox(afwGeom.Box2I())
+                ampInfo.setLinearityType("None")
+        return cameraGeom.Detector(
+            "det_a",
+            1,
+            cameraGeom.SCIENCE,
+            "123",
+            self.bbox,
+            ampInfoCat,
+            cameraGeom.Orientation(),
+            afwGeom.Extent2D(1, 1),
+            {},
+        )
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
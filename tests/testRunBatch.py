@@ -0,0 +1,145 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.cameraGeom as cameraGeom
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.table as afwTable
+import lsst.afw.image.testUtils  # noqa F401; for assertMaskedImagesAlmostEqual
+import lsst.ip.isr as ipIsr
+
+
+def makeExposure(bbox, mean, sigma, exposureTime=1.0, darkTime=1.0, maskVal=0):
+    """!Make an exposure with random image and variance planes and a visit info
+
+    @param[in] bbox  bounding box of exposure
+    @param[in] mean  mean image value
+    @param[in] sigma  standard deviation of image values
+    @param[in] exposureTime  exposure time (sec)
+    @param[in] darkTime  dark time (sec)
+    @param[in] maskVal  value to which to set the corner pixel of the mask plane
+    """
+    maskedImage = afwImage.MaskedImageF(bbox)
+    shape = maskedImage.getImage().getArray().shape
+    maskedImage.getImage().getArray()[:] = np.random.normal(loc=mean, scale=sigma, size=shape)
+    maskedImage.getVariance().getArray()[:] = np.random.uniform(0.1, 1.0, size=shape)
+    maskedImage.getMask().getArray()[:] = 0
+    maskedImage.getMask().getArray()[0, 0] = maskVal
+    exposure = afwImage.ExposureF(maskedImage, None)
+    exposure.getInfo().setVisitInfo(afwImage.VisitInfo(exposureTime=exposureTime, darkTime=darkTime))
+    return exposure
+
+
+class RunBatchTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(31, 17))
+        self.config = ipIsr.IsrTask.ConfigClass()
+        self.config.doAssembleCcd = False
+        self.config.doDefect = False
+        self.config.doFringe = False
+        self.config.doLinearize = False
+        self.config.doWrite = False
+        self.config.gain = 2.5
+        self.config.readNoise = 4.3
+        self.config.flatScalingType = "USER"
+        self.config.flatUserScale = 1.3
+        self.bias = makeExposure(self.bbox, 50.0, 5.0, maskVal=1)
+        self.dark = makeExposure(self.bbox, 2.0, 0.5, darkTime=10.0, maskVal=2)
+        self.flat = makeExposure(self.bbox, 1.0, 0.05, maskVal=4)
+
+    def tearDown(self):
+        self.bbox = None
+        self.config = None
+        self.bias = None
+        self.dark = None
+        self.flat = None
+
+    def testMatchesRun(self):
+        """Test that runBatch gives the same result as calling run on each exposure"""
+        exposureList = [makeExposure(self.bbox, 1000.0, 100.0, exposureTime=expTime, darkTime=expTime)
+                        for expTime in (1.0, 15.0, 30.0)]
+        task = ipIsr.IsrTask(config=self.config)
+
+        refList = [task.run(exposure.clone(), bias=self.bias, dark=self.dark, flat=self.flat).exposure
+                   for exposure in exposureList]
+        batchList = task.runBatch(exposureList, bias=self.bias, dark=self.dark, flat=self.flat).exposures
+
+        self.assertEqual(len(batchList), len(refList))
+        for batchExp, refExp in zip(batchList, refList):
+            self.assertMaskedImagesAlmostEqual(batchExp.getMaskedImage(), refExp.getMaskedImage(),
+                                               rtol=1e-5)
+
+    def testEmpty(self):
+        task = ipIsr.IsrTask(config=self.config)
+        self.assertEqual(task.runBatch([], bias=self.bias, dark=self.dark, flat=self.flat).exposures, [])
+
+    def testBadDimensions(self):
+        """Test that exposures of differing dimensions are rejected"""
+        exposureList = [makeExposure(self.bbox, 1000.0, 100.0),
+                        makeExposure(afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(30, 17)),
+                                     1000.0, 100.0)]
+        task = ipIsr.IsrTask(config=self.config)
+        with self.assertRaises(RuntimeError):
+            task.runBatch(exposureList, bias=self.bias, dark=self.dark, flat=self.flat)
+
+
+    def testDetectorMismatch(self):
+        """Test that exposures are rejected if only some have a detector"""
+        task = ipIsr.IsrTask(config=self.config)
+        for withDetector in ((False, True), (True, False)):
+            exposureList = [makeExposure(self.bbox, 1000.0, 100.0) for _ in withDetector]
+            for exposure, hasDetector in zip(exposureList, withDetector):
+                if hasDetector:
+                    exposure.setDetector(self.makeDetector())
+            with self.assertRaises(RuntimeError):
+                task.runBatch(exposureList, bias=self.bias, dark=self.dark, flat=self.flat)
+
+    def makeDetector(self):
+        """Make a detector with one amplifier covering self.bbox"""
+        ampInfoCat = afwTable.AmpInfoCatalog(afwTable.AmpInfoTable.makeMinimalSchema())
+        ampInfo = ampInfoCat.addNew()
+        ampInfo.setName("amp")
+        ampInfo.setBBox(self.bbox)
+        ampInfo.setGain(self.config.gain)
+        ampInfo.setReadNoise(self.config.readNoise)
+        return cameraGeom.Detector("det_a", 1, cameraGeom.SCIENCE, "123", self.bbox, ampInfoCat,
+                                   cameraGeom.Orientation(), afwGeom.Extent2D(1, 1), {})
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
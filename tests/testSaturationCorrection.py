@@ -24,6 +24,8 @@ from __future__ import absolute_import, division, print_function
 from builtins import range
 import unittest
 
+import numpy as np
+
 import lsst.utils.tests
 import lsst.afw.image as afwImage
 import lsst.afw.geom as afwGeom
@@ -87,6 +89,24 @@ class IsrTestCases(lsst.utils.tests.TestCase):
                 else:
                     self.assertEqual(mask.get(i, j), 0)
 
+    def testSetThresholdMask(self):
+        """Test that setThresholdMask sets the same mask bits as makeThresholdMask without growing"""
+        np.random.seed(3)
+        bbox = afwGeom.Box2I(afwGeom.Point2I(3, 4), afwGeom.Extent2I(20, 15))
+        maskedImageList = [afwImage.MaskedImageF(bbox) for i in range(2)]
+        shape = maskedImageList[0].getImage().getArray().shape
+        imageArray = np.random.normal(loc=1000.0, scale=100.0, size=shape)
+        imageArray[2, 3] = np.nan
+        imageArray[5, 6] = 1100.0
+        for maskedImage in maskedImageList:
+            maskedImage.getImage().getArray()[:] = imageArray
+            maskedImage.getMask().getArray()[:] = 1
+        ipIsr.makeThresholdMask(maskedImageList[0], threshold=1100.0, growFootprints=0, maskName='SAT')
+        ipIsr.setThresholdMask(maskedImageList[1], threshold=1100.0, maskName='SAT')
+        self.assertTrue(np.any(maskedImageList[1].getMask().getArray() != 1))
+        self.assertTrue(np.array_equal(maskedImageList[0].getMask().getArray(),
+                                       maskedImageList[1].getMask().getArray()))
+
 
 class MemoryTester(lsst.utils.tests.MemoryTestCase):
     pass
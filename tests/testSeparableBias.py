@@ -0,0 +1,170 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+import os
+import shutil
+import tempfile
+import unittest
+from builtins import object, range, zip
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.ip.isr as ipIsr
+
+
+def makeBias(bbox):
+    """!Make a bias with row and column structure in each half (amplifier), two outliers and a masked pixel
+    """
+    bias = afwImage.ExposureF(bbox)
+    maskedImage = bias.getMaskedImage()
+    imageArray = maskedImage.getImage().getArray()
+    rows = np.arange(bbox.getHeight(), dtype=float)
+    columns = np.array([0, 0, 0, 0, 0, 0, 1, 2, 3, 4], dtype=float)
+    imageArray[:, :10] = 0.5*rows[:, np.newaxis] + columns[np.newaxis, :]
+    imageArray[:, 10:] = 10.0 + rows[:, np.newaxis] + columns[np.newaxis, ::-1]
+    imageArray[3, 7] = 50.0
+    imageArray[7, 11] = 80.0
+    maskedImage.getVariance().getArray()[:] = 2.0
+    maskedImage.getMask().getArray()[5, 12] = 1
+    return bias
+
+
+class SeparableBiasTestCase(lsst.utils.tests.TestCase):
+    """!Unit tests for SeparableBiasModel and its use by IsrTask"""
+
+    def setUp(self):
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(20, 10))
+        self.ampBBoxList = [afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(10, 10)),
+                            afwGeom.Box2I(afwGeom.Point2I(10, 0), afwGeom.Extent2I(10, 10))]
+        self.bias = makeBias(self.bbox)
+
+    def tearDown(self):
+        self.bbox = None
+        self.ampBBoxList = None
+        self.bias = None
+
+    def makeExposure(self):
+        exposure = afwImage.ExposureF(self.bbox)
+        exposure.getMaskedImage().getImage().getArray()[:] = 100.0
+        return exposure
+
+    def testModel(self):
+        model = ipIsr.SeparableBiasModel.fromExposure(self.bias, self.ampBBoxList, threshold=5.0)
+        np.testing.assert_array_almost_equal(model.ampVariances, [2.0, 2.0])
+        self.assertEqual(len(model.rowValues), 20)
+        self.assertEqual(len(model.columnValues), 20)
+        self.assertEqual(model.getNumResiduals(), 3)
+        self.assertEqual(sorted(zip(model.residualX, model.residualY)), [(7, 3), (11, 7), (12, 5)])
+
+        expected = self.makeExposure()
+        ipIsr.biasCorrection(expected.getMaskedImage(), self.bias.getMaskedImage())
+        exposure = self.makeExposure()
+        model.apply(exposure.getMaskedImage())
+        self.assertMaskedImagesAlmostEqual(exposure.getMaskedImage(), expected.getMaskedImage())
+
+        # a region of the detector
+        regionBBox = afwGeom.Box2I(afwGeom.Point2I(8, 2), afwGeom.Extent2I(10, 6))
+        region = self.makeExposure()
+        region = region.Factory(region, regionBBox, afwImage.PARENT, True)
+        model.apply(region.getMaskedImage())
+        self.assertMaskedImagesAlmostEqual(region.getMaskedImage(),
+                                           expected.Factory(expected, regionBBox).getMaskedImage())
+
+        stats = model.getErrorStats(self.bias)
+        self.assertAlmostEqual(stats.rmsError, 0.0)
+        self.assertAlmostEqual(stats.maxError, 0.0)
+        self.assertAlmostEqual(stats.rmsVarianceError, 0.0)
+        self.assertEqual(stats.numResiduals, 3)
+        self.assertLess(stats.numBytes, stats.biasBytes)
+
+        restored = ipIsr.SeparableBiasModel.fromArrays(model.getArrays())
+        for name in ipIsr.SeparableBiasModel.arrayNames:
+            np.testing.assert_array_equal(getattr(restored, name), getattr(model, name))
+
+    def testNoise(self):
+        """!Test that noise is left out of the model, and only outliers are kept as residuals"""
+        imageArray = self.bias.getMaskedImage().getImage().getArray()
+        imageArray += np.random.RandomState(5).normal(0.0, 1.0, imageArray.shape)
+        model = ipIsr.SeparableBiasModel.fromExposure(self.bias, self.ampBBoxList, threshold=5.0)
+        self.assertIn((7, 3), list(zip(model.residualX, model.residualY)))
+        self.assertLess(model.getNumResiduals(), 10)
+        stats = model.getErrorStats(self.bias)
+        self.assertLess(stats.rmsError, 1.5)
+        self.assertGreater(stats.rmsError, 0.0)
+
+    def testIsrTask(self):
+        """!Test that IsrTask makes, caches and stores the model of a bias"""
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "bias.fits")
+            self.bias.writeFits(path)
+            numReads = []
+
+            class BiasDataRef(object):
+                dataId = dict(ccd=1)
+
+                def get(self, datasetType, immediate=False):
+                    if datasetType == "bias_filename":
+                        return [path]
+                    numReads.append(datasetType)
+                    return afwImage.ExposureF(path)
+
+            config = ipIsr.IsrTask.ConfigClass()
+            config.doSeparableBias = True
+            # without a detector the bias is modelled as one amplifier, so keep every nonzero residual
+            config.separableBiasThreshold = 0.0
+            config.calibCacheMaxBytes = 10*1024**2
+            config.derivedCalibDir = os.path.join(directory, "derived")
+            task = ipIsr.IsrTask(config=config)
+            task.getCalibCache().clear()
+            models = [task.readSeparableBias(BiasDataRef(), None) for i in range(2)]
+            self.assertIs(models[0], models[1])
+            self.assertEqual(numReads, ["bias"])
+            task.getCalibCache().clear()
+            stored = task.readSeparableBias(BiasDataRef(), None)
+            self.assertEqual(numReads, ["bias"])
+            self.assertEqual(stored.getNumResiduals(), models[0].getNumResiduals())
+
+            expected = self.makeExposure()
+            ipIsr.biasCorrection(expected.getMaskedImage(), self.bias.getMaskedImage())
+            exposure = self.makeExposure()
+            task.biasCorrection(exposure, stored)
+            self.assertMaskedImagesAlmostEqual(exposure.getMaskedImage(), expected.getMaskedImage())
+            task.getCalibCache().clear()
+        finally:
+            shutil.rmtree(directory)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
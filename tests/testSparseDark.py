@@ -0,0 +1,149 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+import os
+import shutil
+import tempfile
+import unittest
+from builtins import object, range, zip
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.ip.isr as ipIsr
+
+
+def makeDark(bbox, darkTime=2.0):
+    """!Make a dark with a different rate in each half (amplifier) and a few hot and masked pixels"""
+    dark = afwImage.ExposureF(bbox)
+    maskedImage = dark.getMaskedImage()
+    imageArray = maskedImage.getImage().getArray()
+    imageArray[:, :10] = 1.0*darkTime
+    imageArray[:, 10:] = 2.0*darkTime
+    imageArray[3, 4] = 50.0*darkTime
+    imageArray[7, 15] = 80.0*darkTime
+    maskedImage.getVariance().getArray()[:] = 0.5*darkTime**2
+    maskedImage.getMask().getArray()[5, 12] = 1
+    dark.getInfo().setVisitInfo(afwImage.VisitInfo(exposureTime=darkTime, darkTime=darkTime))
+    return dark
+
+
+class SparseDarkTestCase(lsst.utils.tests.TestCase):
+    """!Unit tests for SparseDarkModel and its use by IsrTask"""
+
+    def setUp(self):
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(20, 10))
+        self.ampBBoxList = [afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(10, 10)),
+                            afwGeom.Box2I(afwGeom.Point2I(10, 0), afwGeom.Extent2I(10, 10))]
+        self.dark = makeDark(self.bbox)
+
+    def tearDown(self):
+        self.bbox = None
+        self.ampBBoxList = None
+        self.dark = None
+
+    def makeExposure(self, darkTime=3.0):
+        exposure = afwImage.ExposureF(self.bbox)
+        exposure.getMaskedImage().getImage().getArray()[:] = 100.0
+        exposure.getInfo().setVisitInfo(afwImage.VisitInfo(exposureTime=darkTime, darkTime=darkTime))
+        return exposure
+
+    def testModel(self):
+        model = ipIsr.SparseDarkModel.fromExposure(self.dark, self.ampBBoxList, threshold=5.0)
+        np.testing.assert_array_almost_equal(model.ampRates, [1.0, 2.0])
+        self.assertEqual(model.getNumHotPixels(), 3)
+        self.assertEqual(sorted(zip(model.hotX, model.hotY)), [(4, 3), (12, 5), (15, 7)])
+
+        expected = self.makeExposure()
+        ipIsr.darkCorrection(expected.getMaskedImage(), self.dark.getMaskedImage(), 3.0, 2.0)
+        exposure = self.makeExposure()
+        model.apply(exposure.getMaskedImage(), 3.0)
+        self.assertMaskedImagesAlmostEqual(exposure.getMaskedImage(), expected.getMaskedImage())
+
+        # a region of the detector
+        regionBBox = afwGeom.Box2I(afwGeom.Point2I(8, 2), afwGeom.Extent2I(10, 6))
+        region = self.makeExposure()
+        region = region.Factory(region, regionBBox, afwImage.PARENT, True)
+        model.apply(region.getMaskedImage(), 3.0)
+        self.assertMaskedImagesAlmostEqual(region.getMaskedImage(),
+                                           expected.Factory(expected, regionBBox).getMaskedImage())
+
+        restored = ipIsr.SparseDarkModel.fromArrays(model.getArrays())
+        for name in ipIsr.SparseDarkModel.arrayNames:
+            np.testing.assert_array_equal(getattr(restored, name), getattr(model, name))
+
+    def testIsrTask(self):
+        """!Test that IsrTask makes, caches and stores the model of a dark"""
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "dark.fits")
+            self.dark.writeFits(path)
+            numReads = []
+
+            class DarkDataRef(object):
+                dataId = dict(ccd=1)
+
+                def get(self, datasetType, immediate=False):
+                    if datasetType == "dark_filename":
+                        return [path]
+                    numReads.append(datasetType)
+                    return afwImage.ExposureF(path)
+
+            config = ipIsr.IsrTask.ConfigClass()
+            config.doSparseDark = True
+            # without a detector the dark is modelled as one amplifier, so one half is all hot pixels
+            config.sparseDarkThreshold = 0.1
+            config.calibCacheMaxBytes = 10*1024**2
+            config.derivedCalibDir = os.path.join(directory, "derived")
+            task = ipIsr.IsrTask(config=config)
+            task.getCalibCache().clear()
+            models = [task.readSparseDark(DarkDataRef(), None) for i in range(2)]
+            self.assertIs(models[0], models[1])
+            self.assertEqual(numReads, ["dark"])
+            task.getCalibCache().clear()
+            stored = task.readSparseDark(DarkDataRef(), None)
+            self.assertEqual(numReads, ["dark"])
+            self.assertEqual(stored.getNumHotPixels(), models[0].getNumHotPixels())
+
+            expected = self.makeExposure()
+            ipIsr.darkCorrection(expected.getMaskedImage(), self.dark.getMaskedImage(), 3.0, 2.0)
+            exposure = self.makeExposure()
+            task.darkCorrection(exposure, stored)
+            self.assertMaskedImagesAlmostEqual(exposure.getMaskedImage(), expected.getMaskedImage())
+            task.getCalibCache().clear()
+        finally:
+            shutil.rmtree(directory)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
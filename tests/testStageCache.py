@@ -0,0 +1,270 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+import gc
+import os
+import shutil
+import tempfile
+import unittest
+import weakref
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.image.testUtils  # noqa F401; for assertMaskedImagesAlmostEqual
+import lsst.pipe.base as pipeBase
+import lsst.ip.isr as ipIsr
+
+
+def makeExposure(bbox, mean, sigma, exposureTime=1.0, darkTime=1.0):
+    """!Make an exposure with a random image plane and a visit info
+
+    @param[in] bbox  bounding box of exposure
+    @param[in] mean  mean image value
+    @param[in] sigma  standard deviation of image values
+    @param[in] exposureTime  exposure time (sec)
+    @param[in] darkTime  dark time (sec)
+    """
+    exposure = afwImage.ExposureF(bbox)
+    maskedImage = exposure.getMaskedImage()
+    shape = maskedImage.getImage().getArray().shape
+    maskedImage.getImage().getArray()[:] = np.random.normal(loc=mean, scale=sigma, size=shape)
+    maskedImage.getVariance().getArray()[:] = 1.0
+    exposure.getInfo().setVisitInfo(afwImage.VisitInfo(exposureTime=exposureTime, darkTime=darkTime))
+    return exposure
+
+
+class StageCacheTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        np.random.seed(12)
+        self.directory = tempfile.mkdtemp()
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(23, 19))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.bbox = None
+
+    def testPutGet(self):
+        cache = ipIsr.StageCache(self.directory, maxBytes=0)
+        exposure = makeExposure(self.bbox, 100.0, 10.0)
+        self.assertIsNone(cache.get("abc"))
+        self.assertFalse(cache.has("abc"))
+        cache.put("abc", exposure)
+        self.assertTrue(cache.has("abc"))
+        self.assertMaskedImagesEqual(cache.get("abc").getMaskedImage(), exposure.getMaskedImage())
+        cache.remove("abc")
+        self.assertFalse(cache.has("abc"))
+
+    def testEvict(self):
+        """!Test that least recently used entries are deleted to stay within maxBytes"""
+        cache = ipIsr.StageCache(self.directory, maxBytes=0)
+        exposure = makeExposure(self.bbox, 100.0, 10.0)
+        cache.put("a", exposure)
+        entryBytes = os.path.getsize(os.path.join(self.directory, "a.fits"))
+        cache.put("b", exposure)
+        # make "a" the older entry, then use it so that "b" is least recently used
+        os.utime(os.path.join(self.directory, "a.fits"), (0, 0))
+        os.utime(os.path.join(self.directory, "b.fits"), (1, 1))
+        cache.get("a")
+        cache.maxBytes = 2*entryBytes
+        cache.put("c", exposure)
+        self.assertTrue(cache.has("a"))
+        self.assertFalse(cache.has("b"))
+        self.assertTrue(cache.has("c"))
+
+    def testKeys(self):
+        """!Test that keys change after a stage whose config or calibrations change, and not before"""
+        cache = ipIsr.StageCache(self.directory, maxBytes=0)
+        config = ipIsr.IsrTask.ConfigClass()
+        bias = makeExposure(self.bbox, 10.0, 1.0)
+        stageList = [pipeBase.Struct(name="first", configNames=["overscanOrder"], calibs=[]),
+                     pipeBase.Struct(name="second", configNames=["fwhm"], calibs=[bias])]
+        seed = cache.digestExposure(makeExposure(self.bbox, 100.0, 10.0))
+        keyList = cache.makeKeys(seed, stageList, config)
+        self.assertEqual(keyList, cache.makeKeys(seed, stageList, config))
+
+        config.fwhm += 1
+        newKeyList = cache.makeKeys(seed, stageList, config)
+        self.assertEqual(newKeyList[0], keyList[0])
+        self.assertNotEqual(newKeyList[1], keyList[1])
+
+        config.overscanOrder += 1
+        newKeyList = cache.makeKeys(seed, stageList, config)
+        self.assertNotEqual(newKeyList[0], keyList[0])
+
+        stageList[1].calibs = [makeExposure(self.bbox, 10.0, 1.0)]
+        config = ipIsr.IsrTask.ConfigClass()
+        newKeyList = cache.makeKeys(seed, stageList, config)
+        self.assertEqual(newKeyList[0], keyList[0])
+        self.assertNotEqual(newKeyList[1], keyList[1])
+
+    def testCalibHandles(self):
+        """!Test that handles of calibrations are identified by their calibKey, not their data ID"""
+        cache = ipIsr.StageCache(self.directory, maxBytes=0)
+
+        class Handle(object):
+            datasetType = "bias"
+            dataId = dict(visit=1, ccd=2)
+
+            def __init__(self, calibKey):
+                self.calibKey = calibKey
+
+        oldKey = ("bias", ("bias.fits",), None, "abc")
+        self.assertEqual(cache.digestObject(Handle(oldKey)), cache.digestObject(Handle(oldKey)))
+        # a re-certified bias with the same name has different contents
+        self.assertNotEqual(cache.digestObject(Handle(oldKey)),
+                            cache.digestObject(Handle(("bias", ("bias.fits",), None, "def"))))
+        # a calibration that cannot be identified matches nothing
+        self.assertNotEqual(cache.digestObject(Handle(None)), cache.digestObject(Handle(None)))
+
+    def testCalibDigestsReleased(self):
+        """!Test that digesting a calibration exposure does not keep it alive"""
+        cache = ipIsr.StageCache(self.directory, maxBytes=0)
+        bias = makeExposure(self.bbox, 10.0, 1.0)
+        digest = cache.digestObject(bias)
+        self.assertEqual(cache.digestObject(bias), digest)
+        biasRef = weakref.ref(bias)
+        del bias
+        gc.collect()
+        self.assertIsNone(biasRef())
+
+    def testRun(self):
+        """!Test that IsrTask.run resumes from the cache and gives the same result"""
+        config = ipIsr.IsrTask.ConfigClass()
+        config.doAssembleCcd = False
+        config.doDefect = False
+        config.doFringe = False
+        config.doLinearize = False
+        config.doFlat = False
+        config.doWrite = False
+        config.stageCacheDir = self.directory
+        config.stageCacheStages = ["assemble", "dark"]
+        bias = makeExposure(self.bbox, 10.0, 1.0)
+        dark = makeExposure(self.bbox, 2.0, 0.1, darkTime=10.0)
+        raw = makeExposure(self.bbox, 1000.0, 100.0)
+
+        task = ipIsr.IsrTask(config=config)
+        refExposure = task.run(raw.clone(), bias=bias, dark=dark).exposure
+        self.assertEqual(len([name for name in os.listdir(self.directory) if name.endswith(".fits")]), 2)
+
+        task = ipIsr.IsrTask(config=config)
+        exposure = task.run(raw.clone(), bias=bias, dark=dark).exposure
+        self.assertMaskedImagesAlmostEqual(exposure.getMaskedImage(), refExposure.getMaskedImage())
+
+        # a different dark invalidates the cached output of the dark stage, but not of assembly
+        task.run(raw.clone(), bias=bias, dark=makeExposure(self.bbox, 2.0, 0.1, darkTime=10.0))
+        self.assertEqual(len([name for name in os.listdir(self.directory) if name.endswith(".fits")]), 3)
+
+    def testStageConfig(self):
+        """!Test that changing a config field read by a stage invalidates the cached output of the stage"""
+        config = ipIsr.IsrTask.ConfigClass()
+        config.doAssembleCcd = False
+        config.doDefect = False
+        config.doFringe = False
+        config.doLinearize = False
+        config.doWrite = False
+        config.flatScalingType = "USER"
+        config.stageCacheDir = self.directory
+        config.stageCacheStages = ["flat"]
+        bias = makeExposure(self.bbox, 10.0, 1.0)
+        dark = makeExposure(self.bbox, 2.0, 0.1, darkTime=10.0)
+        flat = makeExposure(self.bbox, 1.0, 0.01)
+        raw = makeExposure(self.bbox, 1000.0, 100.0)
+
+        def numCached():
+            return len([name for name in os.listdir(self.directory) if name.endswith(".fits")])
+
+        refExposure = ipIsr.IsrTask(config=config).run(raw.clone(), bias=bias, dark=dark, flat=flat).exposure
+        self.assertEqual(numCached(), 1)
+
+        config.flatUserScale = 2.0
+        exposure = ipIsr.IsrTask(config=config).run(raw.clone(), bias=bias, dark=dark, flat=flat).exposure
+        self.assertEqual(numCached(), 2)
+        self.assertFloatsAlmostEqual(exposure.getMaskedImage().getImage().getArray(),
+                                     2.0*refExposure.getMaskedImage().getImage().getArray(), rtol=1e-5)
+
+        def makeKeys():
+            task = ipIsr.IsrTask(config=config)
+            stageList = task.makeStageList([], pipeBase.Struct(doLinearize=False), bias=bias, dark=dark,
+                                           flat=flat)
+            cache = task.getStageCache()
+            return cache.makeKeys(cache.digestExposure(raw), stageList, config)
+
+        for name, value in (("useFlatScaleMetadata", True), ("stripHeight", 8), ("doFusedDetrend", True)):
+            keyList = makeKeys()
+            setattr(config, name, value)
+            self.assertNotEqual(makeKeys()[-1], keyList[-1], msg=name)
+
+    def testCheckpoint(self):
+        """!Test that an interrupted run resumes from a checkpoint, which is deleted on completion"""
+        config = ipIsr.IsrTask.ConfigClass()
+        config.doAssembleCcd = False
+        config.doDefect = False
+        config.doFringe = False
+        config.doLinearize = False
+        config.doFlat = False
+        config.doWrite = False
+        config.checkpointDir = self.directory
+        config.checkpointStages = ["assemble", "bias"]
+        bias = makeExposure(self.bbox, 10.0, 1.0)
+        dark = makeExposure(self.bbox, 2.0, 0.1, darkTime=10.0)
+        raw = makeExposure(self.bbox, 1000.0, 100.0)
+        checkpointId = ipIsr.IsrTask.makeCheckpointId(dict(visit=1, ccd=2))
+
+        refExposure = ipIsr.IsrTask(config=config).run(raw.clone(), bias=bias, dark=dark).exposure
+
+        class InterruptedError(Exception):
+            pass
+
+        class InterruptedIsrTask(ipIsr.IsrTask):
+            def darkCorrection(self, exposure, darkExposure):
+                raise InterruptedError()
+
+        with self.assertRaises(InterruptedError):
+            InterruptedIsrTask(config=config).run(raw.clone(), bias=bias, dark=dark,
+                                                  checkpointId=checkpointId)
+        self.assertEqual(len([name for name in os.listdir(self.directory) if name.endswith(".fits")]), 2)
+
+        class ResumedIsrTask(ipIsr.IsrTask):
+            def biasCorrection(self, exposure, biasExposure):
+                raise RuntimeError("bias should not be reapplied after resuming")
+
+        exposure = ResumedIsrTask(config=config).run(raw.clone(), bias=bias, dark=dark,
+                                                     checkpointId=checkpointId).exposure
+        self.assertMaskedImagesAlmostEqual(exposure.getMaskedImage(), refExposure.getMaskedImage())
+        self.assertEqual(len([name for name in os.listdir(self.directory) if name.endswith(".fits")]), 0)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()